@@ -29,7 +29,7 @@ from buildbot.status.mail import MailNotifier
 from buildbot.process import metrics, botmaster
 from buildbot.interfaces import IBuildSlave, ILatentBuildSlave
 from buildbot.process.properties import Properties
-from buildbot.locks import LockAccess
+from buildbot.locks import LockAccess, BaseLockId
 from buildbot.util import subscription
 from buildbot import config
 
@@ -90,6 +90,13 @@ class AbstractBuildSlave(config.ReconfigurableServiceMixin, pb.Avatar,
         self.access = []
         if locks:
             self.access = locks
+        for access in self.access:
+            if isinstance(access, LockAccess):
+                access = access.lockid
+            if isinstance(access, BaseLockId) and access.distributed:
+                config.error(
+                    "slave %r cannot use distributed lock %r"
+                    % (name, access.name))
         self.lock_subscriptions = []
 
         self.properties = Properties()
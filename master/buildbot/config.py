@@ -71,6 +71,7 @@ class MasterConfig(object):
         self.codebaseGenerator = None
         self.prioritizeBuilders = None
         self.slavePortnum = None
+        self.slaveUpdateWindow = 16
         self.multiMaster = False
         self.debugPassword = None
         self.manhole = None
@@ -106,7 +107,8 @@ class MasterConfig(object):
         "logMaxSize", "logMaxTailSize", "manhole", "mergeRequests", "metrics",
         "multiMaster", "prioritizeBuilders", "projectName", "projectURL",
         "properties", "revlink", "schedulers", "slavePortnum", "slaves",
-        "status", "title", "titleURL", "user_managers", "validation"
+        "slaveUpdateWindow", "status", "title", "titleURL", "user_managers",
+        "validation"
     ])
 
     @classmethod
@@ -288,6 +290,11 @@ class MasterConfig(object):
                 slavePortnum = "tcp:%d" % slavePortnum
             self.slavePortnum = slavePortnum
 
+        copy_int_param('slaveUpdateWindow')
+        if self.slaveUpdateWindow is not None and self.slaveUpdateWindow < 0:
+            errors.addError("c['slaveUpdateWindow'] must be 0 or more, "
+                            "or None")
+
         if 'multiMaster' in config_dict:
             self.multiMaster = config_dict["multiMaster"]
 
@@ -323,7 +330,9 @@ class MasterConfig(object):
     def load_db(self, filename, config_dict, errors):
         if 'db' in config_dict:
             db = config_dict['db']
-            if set(db.keys()) > set(['db_url', 'db_poll_interval']):
+            if set(db.keys()) - set(['db_url', 'db_poll_interval',
+                                     'slow_query_threshold', 'pool_sizes',
+                                     'replica_url']):
                 errors.addError("unrecognized keys in c['db']")
             self.db.update(db)
         if 'db_url' in config_dict:
@@ -341,6 +350,31 @@ class MasterConfig(object):
         else:
             self.db['db_poll_interval'] = db_poll_interval
 
+        slow_query_threshold = self.db.get('slow_query_threshold')
+        if slow_query_threshold is not None and \
+                not isinstance(slow_query_threshold, (int, float)):
+            errors.addError("c['db']['slow_query_threshold'] must be a number")
+
+        from buildbot.db.pool import WORKLOADS
+        pool_sizes = self.db.get('pool_sizes')
+        if pool_sizes is not None:
+            if not isinstance(pool_sizes, dict):
+                errors.addError("c['db']['pool_sizes'] must be a dictionary")
+            else:
+                for workload, size in pool_sizes.iteritems():
+                    if workload not in WORKLOADS:
+                        errors.addError("unknown workload %r in "
+                                "c['db']['pool_sizes']; use one of %s"
+                                % (workload, ", ".join(WORKLOADS)))
+                    elif size is not None and \
+                            (not isinstance(size, int) or size < 1):
+                        errors.addError("c['db']['pool_sizes'][%r] must be "
+                                "a positive int" % (workload,))
+
+        replica_url = self.db.get('replica_url')
+        if replica_url is not None and not isinstance(replica_url, basestring):
+            errors.addError("c['db']['replica_url'] must be a string")
+
 
     def load_metrics(self, filename, config_dict, errors):
         # we don't try to validate metrics keys
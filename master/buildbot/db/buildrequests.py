@@ -96,6 +96,27 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                      for row in res.fetchall() ]
         return self.db.pool.do(thd)
 
+    def getUnclaimedBuildRequestCounts(self):
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            claims_tbl = self.db.model.buildrequest_claims
+            q = sa.select([ reqs_tbl.c.buildername,
+                            sa.func.count(reqs_tbl.c.id),
+                            sa.func.min(reqs_tbl.c.submitted_at) ],
+                    from_obj=[ reqs_tbl.outerjoin(claims_tbl,
+                                    reqs_tbl.c.id == claims_tbl.c.brid) ],
+                    whereclause=((claims_tbl.c.claimed_at == None)
+                                 & (reqs_tbl.c.complete == 0)),
+                    group_by=[ reqs_tbl.c.buildername ])
+            res = conn.execute(q)
+            rv = {}
+            for buildername, count, oldest in res.fetchall():
+                rv[buildername] = dict(count=count,
+                        oldest=oldest and epoch2datetime(oldest) or None)
+            res.close()
+            return rv
+        return self.db.pool.forWorkload('status').do(thd)
+
     @with_master_objectid
     def claimBuildRequests(self, brids, claimed_at=None, _reactor=reactor,
                             _master_objectid=None):
@@ -235,7 +256,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                         (claims_tbl.c.claimed_at < old_epoch) &
                         claims_tbl.c.brid.in_(expired_brids)))
             return res.rowcount
-        d = self.db.pool.do(thd)
+        d = self.db.pool.forWorkload('maintenance').do(thd)
         def log_nonzero_count(count):
             if count != 0:
                 log.msg("unclaimed %d expired buildrequests (over %d seconds "
@@ -131,7 +131,7 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
                                 (bs_tbl.c.complete == None))
             res = conn.execute(q)
             return [ self._row2dict(row) for row in res.fetchall() ]
-        return self.db.pool.do(thd)
+        return self.db.pool.forWorkload('status').do(thd)
 
     def getBuildsetProperties(self, buildsetid):
         """
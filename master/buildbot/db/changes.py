@@ -149,7 +149,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             changeids = [ row.changeid for row in rp ]
             rp.close()
             return list(reversed(changeids))
-        d = self.db.pool.do(thd)
+        d = self.db.pool.forWorkload('status').do(thd)
 
         # then turn those into changes, using the cache
         def get_changes(changeids):
@@ -199,7 +199,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 table = self.db.model.metadata.tables[table_name]
                 conn.execute(
                     table.delete(table.c.changeid.in_(ids_to_delete)))
-        return self.db.pool.do(thd)
+        return self.db.pool.forWorkload('maintenance').do(thd)
 
     def _chdict_from_change_row_thd(self, conn, ch_row):
         # This method must be run in a db.pool thread, and returns a chdict
@@ -21,6 +21,7 @@ from buildbot import config
 from buildbot.db import enginestrategy
 from buildbot.db import pool, model, changes, schedulers, sourcestamps, sourcestampsets
 from buildbot.db import state, buildsets, buildrequests, builds, users
+from buildbot.db import locks
 
 class DatabaseNotReadyError(Exception):
     pass
@@ -76,6 +77,7 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         self.state = state.StateConnectorComponent(self)
         self.builds = builds.BuildsConnectorComponent(self)
         self.users = users.UsersConnectorComponent(self)
+        self.locks = locks.LocksConnectorComponent(self)
 
         self.cleanup_timer = internet.TimerService(self.CLEANUP_PERIOD,
                 self._doCleanup)
@@ -90,7 +92,9 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         # set up the engine and pool
         self._engine = enginestrategy.create_engine(db_url,
                                 basedir=self.basedir)
-        self.pool = pool.DBThreadPool(self._engine, verbose=verbose)
+        self.setupPools(self.master.config.db, verbose=verbose)
+        self.setSlowQueryThreshold(
+                self.master.config.db.get('slow_query_threshold'))
 
         # make sure the db is up to date, unless specifically asked not to
         if check_version:
@@ -107,10 +111,48 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         return d
 
 
+    def setupPools(self, db_config, verbose=False):
+        # the main pool runs scheduler work, and any other workload that
+        # does not have a pool of its own
+        pool_sizes = db_config.get('pool_sizes') or {}
+        self.pool = pool.DBThreadPool(self._engine, verbose=verbose,
+                                      size=pool_sizes.get('scheduler'))
+
+        replica_url = db_config.get('replica_url')
+        for workload in pool.WORKLOADS:
+            if workload == 'scheduler':
+                continue
+            size = pool_sizes.get(workload)
+            if workload == 'status' and replica_url:
+                log.msg("reading status from replica database %r"
+                        % (replica_url,))
+                engine = enginestrategy.create_engine(replica_url,
+                                basedir=self.basedir)
+            elif size:
+                engine = self._engine
+                if getattr(engine, 'optimal_thread_pool_size', None) == 1:
+                    log.msg("this database supports only one connection, so "
+                            "%s queries will share its thread pool"
+                            % (workload,))
+                    continue
+            else:
+                continue
+            self.pool.setWorkloadPool(workload,
+                    pool.DBThreadPool(engine, verbose=verbose, size=size,
+                                      name='DBThreadPool.%s' % workload))
+
+    def setSlowQueryThreshold(self, threshold):
+        for p in [ self.pool ] + self.pool.workloadPools.values():
+            p.slowQueryThreshold = threshold
+
     def reconfigService(self, new_config):
         # double-check -- the master ensures this in config checks
         assert self.configured_url == new_config.db['db_url']
 
+        if self.pool:
+            self.setSlowQueryThreshold(
+                    new_config.db.get('slow_query_threshold'))
+
         return config.ReconfigurableServiceMixin.reconfigService(self,
                                                             new_config)
 
@@ -0,0 +1,156 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from twisted.internet import reactor
+from buildbot.db import base
+from buildbot.db.buildrequests import with_master_objectid
+
+class LockClaimDict(dict):
+    pass
+
+class LocksConnectorComponent(base.DBConnectorComponent):
+    # Documentation is in developer/database.rst
+
+    @with_master_objectid
+    def requestLock(self, lockname, slavename, exclusive, lease,
+                    _reactor=reactor, _master_objectid=None):
+        def thd(conn):
+            tbl = self.db.model.lock_claims
+            self.check_length(tbl.c.lockname, lockname)
+            self.check_length(tbl.c.slavename, slavename)
+            now = _reactor.seconds()
+            res = conn.execute(tbl.insert(),
+                    lockname=lockname, slavename=slavename,
+                    objectid=_master_objectid,
+                    exclusive=exclusive and 1 or 0, granted=0,
+                    requested_at=now, expires_at=now + lease)
+            return res.inserted_primary_key[0]
+        return self.db.pool.do(thd)
+
+    def grantLock(self, claimid, maxCount, lease, _reactor=reactor):
+        def allowed(rows):
+            # ids of the rows that may hold the lock together, in id order
+            num_excl, num_counting = 0, 0
+            ids = []
+            for row in rows:
+                if row.exclusive:
+                    if num_excl or num_counting:
+                        break
+                    num_excl += 1
+                else:
+                    if num_excl or num_counting >= maxCount:
+                        break
+                    num_counting += 1
+                ids.append(row.id)
+            return ids
+
+        def thd(conn):
+            tbl = self.db.model.lock_claims
+            now = _reactor.seconds()
+
+            q = sa.select([ tbl.c.lockname, tbl.c.slavename, tbl.c.granted ],
+                    whereclause=(tbl.c.id == claimid))
+            mine = conn.execute(q).fetchone()
+            if not mine:
+                return None
+            if mine.granted:
+                return True
+            same_lock = ((tbl.c.lockname == mine.lockname)
+                       & (tbl.c.slavename == mine.slavename))
+
+            transaction = conn.begin()
+            try:
+                # claims whose owner has gone away no longer count
+                conn.execute(tbl.delete(same_lock & (tbl.c.expires_at < now)))
+
+                q = sa.select([ tbl.c.id, tbl.c.exclusive, tbl.c.granted ],
+                        whereclause=same_lock, order_by=[ tbl.c.id ])
+                rows = conn.execute(q).fetchall()
+                if claimid not in [ row.id for row in rows ]:
+                    transaction.commit()
+                    return None
+
+                # the lock is granted in the order it was requested, so this
+                # claim must be the first that has not been granted, and must
+                # be compatible with those that have
+                granted = [ row for row in rows if row.granted ]
+                waiting = [ row for row in rows if not row.granted ]
+                if waiting[0].id != claimid \
+                        or claimid not in allowed(granted + waiting[:1]):
+                    transaction.commit()
+                    return False
+
+                conn.execute(tbl.update((tbl.c.id == claimid)
+                                        & (tbl.c.granted == 0)),
+                             granted=1, expires_at=now + lease)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+
+            self._test_timing_hook(conn)
+
+            # another master may have granted a conflicting claim at the same
+            # time; if so, the claim that was requested first wins
+            q = sa.select([ tbl.c.id, tbl.c.exclusive ],
+                    whereclause=(same_lock & (tbl.c.granted != 0)),
+                    order_by=[ tbl.c.id ])
+            if claimid in allowed(conn.execute(q).fetchall()):
+                return True
+            conn.execute(tbl.update(tbl.c.id == claimid), granted=0)
+            return False
+        return self.db.pool.do(thd)
+
+    def _test_timing_hook(self, conn):
+        # called so tests can simulate another master granting a
+        # conflicting claim at the same time
+        pass
+
+    def releaseLock(self, claimid):
+        def thd(conn):
+            tbl = self.db.model.lock_claims
+            conn.execute(tbl.delete(tbl.c.id == claimid))
+        return self.db.pool.do(thd)
+
+    def renewLocks(self, claimids, lease, _reactor=reactor):
+        def thd(conn):
+            tbl = self.db.model.lock_claims
+            expires_at = _reactor.seconds() + lease
+            # batch the claimids, so that the parameter lists supported by
+            # the DBAPI aren't exhausted
+            claimids_list = list(claimids)
+            while claimids_list:
+                batch = claimids_list[:100]
+                del claimids_list[:100]
+                conn.execute(tbl.update(tbl.c.id.in_(batch)),
+                             expires_at=expires_at)
+        return self.db.pool.do(thd)
+
+    def getLockClaims(self, lockname, slavename=''):
+        def thd(conn):
+            tbl = self.db.model.lock_claims
+            q = tbl.select(whereclause=((tbl.c.lockname == lockname)
+                                      & (tbl.c.slavename == slavename)),
+                           order_by=[ tbl.c.id ])
+            return [ self._claimdictFromRow(row)
+                     for row in conn.execute(q).fetchall() ]
+        return self.db.pool.do(thd)
+
+    def _claimdictFromRow(self, row):
+        return LockClaimDict(claimid=row.id, lockname=row.lockname,
+                slavename=row.slavename, objectid=row.objectid,
+                exclusive=bool(row.exclusive), granted=bool(row.granted),
+                requested_at=row.requested_at, expires_at=row.expires_at)
@@ -0,0 +1,43 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+
+def upgrade(migrate_engine):
+
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    # autoload the objects table, so that the foreign key can be resolved
+    sa.Table('objects', metadata, autoload=True)
+
+    lock_claims = sa.Table('lock_claims', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('lockname', sa.String(256), nullable=False),
+        sa.Column('slavename', sa.String(256), nullable=False,
+            server_default=''),
+        sa.Column('objectid', sa.Integer, sa.ForeignKey('objects.id'),
+            nullable=False),
+        sa.Column('exclusive', sa.SmallInteger, nullable=False),
+        sa.Column('granted', sa.SmallInteger, nullable=False,
+            server_default=sa.DefaultClause("0")),
+        sa.Column('requested_at', sa.Integer, nullable=False),
+        sa.Column('expires_at', sa.Integer, nullable=False),
+    )
+    lock_claims.create()
+
+    idx = sa.Index('lock_claims_lock', lock_claims.c.lockname,
+            lock_claims.c.slavename)
+    idx.create()
@@ -319,6 +319,34 @@ class Model(base.DBConnectorComponent):
         sa.Column("value_json", sa.Text, nullable=False),
     )
 
+    # locks
+
+    # This table holds the claims on distributed locks, both those that have
+    # been granted and those still waiting, in the order they were requested.
+    # Each claim carries a lease, which the owning master renews while it
+    # holds or waits for the lock; claims whose lease has expired are removed
+    # when the lock is next granted.
+    lock_claims = sa.Table('lock_claims', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        # name of the lock
+        sa.Column('lockname', sa.String(256), nullable=False),
+        # slave this claim applies to, for slave locks; '' for master locks
+        sa.Column('slavename', sa.String(256), nullable=False,
+            server_default=''),
+        # master that made this claim
+        sa.Column('objectid', sa.Integer, sa.ForeignKey('objects.id'),
+            nullable=False),
+        # true (nonzero) for exclusive access, false for counting access
+        sa.Column('exclusive', sa.SmallInteger, nullable=False),
+        # true (nonzero) once the lock has been granted to this claim
+        sa.Column('granted', sa.SmallInteger, nullable=False,
+            server_default=sa.DefaultClause("0")),
+        # time the claim was made
+        sa.Column('requested_at', sa.Integer, nullable=False),
+        # time at which the claim lapses if its lease is not renewed
+        sa.Column('expires_at', sa.Integer, nullable=False),
+    )
+
     #users
 
     # This table identifies individual users, and contains buildbot-specific
@@ -390,6 +418,8 @@ class Model(base.DBConnectorComponent):
             unique=True)
     sa.Index('name_per_object', object_state.c.objectid, object_state.c.name,
             unique=True)
+    sa.Index('lock_claims_lock', lock_claims.c.lockname,
+            lock_claims.c.slavename)
 
     # MySQl creates indexes for foreign keys, and these appear in the
     # reflection.  This is a list of (table, index) names that should be
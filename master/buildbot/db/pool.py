@@ -13,13 +13,17 @@
 #
 # Copyright Buildbot Team Members
 
+import sys
 import time
+import threading
 import traceback
 import inspect
 import shutil
 import os
+import Queue
 import sqlalchemy as sa
 import tempfile
+from collections import deque
 from buildbot.process import metrics
 from twisted.internet import reactor, threads
 from twisted.python import threadpool, log
@@ -31,6 +35,12 @@ from twisted.python import threadpool, log
 debug = False
 _debug_id = 1
 
+# the classes of database work, highest priority first: scheduling (claiming
+# and completing build requests, adding changes and buildsets, and anything
+# else not otherwise classified), status reads for the web UI, and background
+# maintenance such as pruning old changes
+WORKLOADS = ('scheduler', 'status', 'maintenance')
+
 def timed_do_fn(f):
     """Decorate a do function to log before, after, and elapsed time,
     with the name of the calling function.  This is not speedy!"""
@@ -78,9 +88,102 @@ def timed_do_fn(f):
     wrap.__doc__ = f.__doc__
     return wrap
 
+class Query(object):
+    """
+    The timing of a single call to L{DBThreadPool.do} or
+    L{DBThreadPool.do_with_engine}.  C{name} is the name of the function that
+    made the call, usually a connector method.  C{queued}, C{started} and
+    C{finished} are times; C{started} and C{finished} are None if the query
+    never ran.  C{statements} lists the SQL the query executed, but is only
+    collected while a slow-query threshold is set.
+    """
+
+    __slots__ = ('name', 'workload', 'queued', 'started', 'finished', 'rows',
+                 'statements')
+
+    maxStatements = 10
+
+    def __init__(self, name, queued, workload='scheduler'):
+        self.name = name
+        self.workload = workload
+        self.queued = queued
+        self.started = self.finished = None
+        self.rows = 0
+        self.statements = None
+
+    def addStatement(self, statement):
+        if len(self.statements) < self.maxStatements:
+            self.statements.append(statement)
+
+def countRows(rv):
+    """Return the number of rows in C{rv}, the result of a query: the
+    length of a list or tuple, zero for None, and otherwise one."""
+    if rv is None:
+        return 0
+    if isinstance(rv, (list, tuple, set, frozenset)):
+        return len(rv)
+    return 1
+
+class WorkloadQueue(Queue.Queue):
+    """
+    The queue of work for a L{DBThreadPool}'s threads.  Queries are taken in
+    the order of their workload in L{WORKLOADS}, and in the order they were
+    queued within a workload, so that where workloads share a pool,
+    scheduling work does not wait behind status reads.  Requests to stop a
+    thread go last, as they would in a plain queue.
+    """
+
+    def _init(self, maxsize):
+        # one deque per workload, and one for anything else
+        self.queue = [ deque() for w in WORKLOADS ] + [ deque() ]
+
+    def _qsize(self, len=len):
+        return sum([ len(q) for q in self.queue ])
+
+    def _put(self, item):
+        self.queue[self._priority(item)].append(item)
+
+    def _get(self):
+        for q in self.queue:
+            if q:
+                return q.popleft()
+
+    def _priority(self, item):
+        # items are (ctx, func, args, kwargs, onResult) tuples, as queued by
+        # ThreadPool.callInThreadWithCallback; for queries, args ends with
+        # the Query
+        if item is not threadpool.WorkerStop:
+            args = item[2]
+            if args and isinstance(args[-1], Query) \
+                    and args[-1].workload in WORKLOADS:
+                return WORKLOADS.index(args[-1].workload)
+        return len(WORKLOADS)
+
+class WorkloadPool(object):
+    """
+    Runs queries for one of the L{WORKLOADS}, in the L{DBThreadPool} that
+    serves it.  Get instances from L{DBThreadPool.forWorkload}.
+    """
+
+    def __init__(self, pool, workload):
+        self.pool = pool
+        self.workload = workload
+        self.engine = pool.engine
+
+    def do(self, callable, *args, **kwargs):
+        name = sys._getframe(1).f_code.co_name
+        return self.pool._submit(name, self.workload, False, callable,
+                                 args, kwargs)
+
+    def do_with_engine(self, callable, *args, **kwargs):
+        name = sys._getframe(1).f_code.co_name
+        return self.pool._submit(name, self.workload, True, callable,
+                                 args, kwargs)
+
 class DBThreadPool(threadpool.ThreadPool):
 
     running = False
+    _stop_evt = None
 
     # Some versions of SQLite incorrectly cache metadata about which tables are
     # and are not present on a per-connection basis.  This cache can be flushed
@@ -90,7 +193,12 @@ class DBThreadPool(threadpool.ThreadPool):
     # in bug #1810.
     __broken_sqlite = False
 
-    def __init__(self, engine, verbose=False):
+    # queries taking longer than this many seconds to execute are logged with
+    # their SQL; None disables the slow-query log
+    slowQueryThreshold = None
+
+    def __init__(self, engine, verbose=False, size=None,
+                 name='DBThreadPool'):
         # verbose is used by upgrade scripts, and if it is set we should print
         # messages about versions and other warnings
         log_msg = log.msg
@@ -99,19 +207,41 @@ class DBThreadPool(threadpool.ThreadPool):
                 print m
 
         pool_size = 5
+        if size:
+            pool_size = size
 
         # If the engine has an C{optimal_thread_pool_size} attribute, then the
-        # maxthreads of the thread pool will be set to that value.  This is
+        # maxthreads of the thread pool will be limited to that value.  This is
         # most useful for SQLite in-memory connections, where exactly one
         # connection (and thus thread) should be used.
         if hasattr(engine, 'optimal_thread_pool_size'):
-            pool_size = engine.optimal_thread_pool_size
+            if size:
+                pool_size = min(size, engine.optimal_thread_pool_size)
+            else:
+                pool_size = engine.optimal_thread_pool_size
 
         threadpool.ThreadPool.__init__(self,
                         minthreads=1,
                         maxthreads=pool_size,
-                        name='DBThreadPool')
+                        name=name)
+        self.q = WorkloadQueue(0)
         self.engine = engine
+
+        # pools dedicated to particular workloads, which are otherwise run in
+        # this pool
+        self.workloadPools = {}
+        self._workloadViews = {}
+
+        # the number of queries submitted but not yet finished; this is only
+        # updated in the reactor thread
+        self.inFlight = 0
+
+        # the query running in each thread, so that its SQL can be recorded
+        self._local = threading.local()
+        if hasattr(sa, 'event'):
+            sa.event.listen(engine, 'after_cursor_execute',
+                            self._afterCursorExecute)
+
         if engine.dialect.name == 'sqlite':
             vers = self.get_sqlite_version()
             if vers < (3,7):
@@ -151,11 +281,37 @@ class DBThreadPool(threadpool.ThreadPool):
         """Manually stop the pool.  This is only necessary from tests, as the
         pool will stop itself when the reactor stops under normal
         circumstances."""
+        for wpool in self.workloadPools.values():
+            wpool.shutdown()
+        if self._start_evt:
+            # the pool never started
+            reactor.removeSystemEventTrigger(self._start_evt)
+            self._start_evt = None
         if not self._stop_evt:
             return # pool is already stopped
         reactor.removeSystemEventTrigger(self._stop_evt)
         self._stop()
 
+    def setWorkloadPool(self, workload, pool):
+        """Run the queries for C{workload} in C{pool}, another
+        DBThreadPool, rather than in this one."""
+        assert workload in WORKLOADS
+        self.workloadPools[workload] = pool
+        self._workloadViews.pop(workload, None)
+
+    def forWorkload(self, workload):
+        """Return a L{WorkloadPool}, with C{do} and C{do_with_engine}
+        methods that run queries as part of C{workload}, in the pool
+        dedicated to it, if any, or otherwise in this pool, at that
+        workload's priority."""
+        try:
+            return self._workloadViews[workload]
+        except KeyError:
+            assert workload in WORKLOADS
+            view = self._workloadViews[workload] = WorkloadPool(
+                    self.workloadPools.get(workload, self), workload)
+            return view
+
     # Try about 170 times over the space of a day, with the last few tries
     # being about an hour apart.  This is designed to span a reasonable amount
     # of time for repairing a broken database server, while still failing
@@ -163,7 +319,19 @@ class DBThreadPool(threadpool.ThreadPool):
     BACKOFF_START = 1.0
     BACKOFF_MULT = 1.05
     MAX_OPERATIONALERROR_TIME = 3600*24 # one day
-    def __thd(self, with_engine, callable, args, kwargs):
+    def __thd(self, with_engine, callable, args, kwargs, query):
+        query.started = time.time()
+        if query.statements is not None:
+            self._local.query = query
+        try:
+            rv = self.__thd_retry(with_engine, callable, args, kwargs)
+            query.rows = countRows(rv)
+            return rv
+        finally:
+            query.finished = time.time()
+            self._local.query = None
+
+    def __thd_retry(self, with_engine, callable, args, kwargs):
         # try to call callable(arg, *args, **kwargs) repeatedly until no
         # OperationalErrors occur, where arg is either the engine (with_engine)
         # or a connection (not with_engine)
@@ -214,12 +382,72 @@ class DBThreadPool(threadpool.ThreadPool):
         return rv
 
     def do(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, False, callable, args, kwargs)
+        name = sys._getframe(1).f_code.co_name
+        return self._submit(name, 'scheduler', False, callable, args, kwargs)
 
     def do_with_engine(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, True, callable, args, kwargs)
+        name = sys._getframe(1).f_code.co_name
+        return self._submit(name, 'scheduler', True, callable, args, kwargs)
+
+    def _submit(self, name, workload, with_engine, callable, args, kwargs):
+        query = Query(name, time.time(), workload)
+        if self.slowQueryThreshold is not None:
+            query.statements = []
+        self.inFlight += 1
+        self._updateSaturation()
+        d = threads.deferToThreadPool(reactor, self,
+                self.__thd, with_engine, callable, args, kwargs, query)
+        d.addBoth(self._queryDone, query)
+        return d
+
+    # instrumentation
+
+    def _afterCursorExecute(self, conn, cursor, statement, parameters,
+                            context, executemany):
+        # called in the pool's threads, for each statement executed
+        query = getattr(self._local, 'query', None)
+        if query is not None:
+            query.addStatement(statement)
+
+    def _updateSaturation(self):
+        registry = metrics.getRegistry()
+        if registry is not None:
+            saturation = self.getSaturation()
+            registry.setGauge('%s.busy' % self.name, saturation['busy'])
+            registry.setGauge('%s.waiting' % self.name, saturation['waiting'])
+
+    def _queryDone(self, res, query):
+        self.inFlight -= 1
+        self._updateSaturation()
+        if query.started is None or query.finished is None:
+            return res
+
+        wait = query.started - query.queued
+        elapsed = query.finished - query.started
+        registry = metrics.getRegistry()
+        if registry is not None:
+            registry.recordTime('DBThreadPool.wait', wait)
+            registry.recordTime('DBThreadPool.wait.%s' % query.name, wait)
+            registry.recordTime('DBThreadPool.execute', elapsed)
+            registry.recordTime('DBThreadPool.execute.%s' % query.name,
+                                elapsed)
+            registry.increment('DBThreadPool.rows.%s' % query.name,
+                               query.rows)
+
+        threshold = self.slowQueryThreshold
+        if threshold is not None and elapsed >= threshold:
+            log.msg("slow query in %s: %0.3fs (after waiting %0.3fs for a "
+                    "thread), %d rows: %s" % (query.name, elapsed, wait,
+                        query.rows, '; '.join(query.statements or [])))
+        return res
+
+    def getSaturation(self):
+        """Return a dictionary giving the number of threads in the pool
+        (C{size}), the number of queries running (C{busy}) and the number
+        waiting for a thread (C{waiting})."""
+        return dict(size=self.max,
+                    busy=min(self.inFlight, self.max),
+                    waiting=max(self.inFlight - self.max, 0))
 
     def detect_bug1810(self):
         # detect buggy SQLite implementations; call only for a known-sqlite
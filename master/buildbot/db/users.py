@@ -144,7 +144,7 @@ class UsersConnectorComponent(base.DBConnectorComponent):
                     ud = dict(uid=row.uid, identifier=row.identifier)
                     dicts.append(ud)
             return dicts
-        d = self.db.pool.do(thd)
+        d = self.db.pool.forWorkload('status').do(thd)
         return d
 
     def updateUser(self, uid=None, identifier=None, bb_username=None,
@@ -137,6 +137,17 @@ class IStatus(Interface):
         """Return the IBuilderStatus object for a given named Builder. Raises
         KeyError if there is no Builder by that name."""
 
+    def getPendingBuildRequestCounts():
+        """
+        Count the unclaimed build requests of all builders at once.  The
+        counts may be a few seconds old.
+
+        @returns: dictionary mapping the name of each builder with unclaimed
+        requests to a dictionary with keys C{count} and C{oldest} (the
+        submission time of the oldest request, as a datetime), via Deferred.
+        The result is shared, and must not be modified.
+        """
+
     def getSlaveNames():
         """Return a list of buildslave names, suitable for passing to
         getSlave()."""
@@ -324,6 +335,14 @@ class IBuilderStatus(Interface):
         @returns: list of objects via Deferred
         """
 
+    def getPendingBuildRequestCount():
+        """
+        Count the unclaimed build requests for this builder, using
+        L{IStatus.getPendingBuildRequestCounts}.
+
+        @returns: integer via Deferred
+        """
+
     def getCurrentBuilds():
         """Return a list containing an IBuildStatus object for each build
         currently in progress."""
@@ -336,6 +355,11 @@ class IBuilderStatus(Interface):
         build, which may be None if the builder has not yet finished any
         builds."""
 
+    def getDurationHistory():
+        """Return a L{buildbot.status.durations.DurationHistory} describing
+        the durations of this builder's recent successful builds and their
+        steps."""
+
     def getBuild(number):
         """Return an IBuildStatus object for a historical build. Each build
         is numbered (starting at 0 when the Builder is first added),
@@ -395,6 +419,13 @@ class IBuilderStatus(Interface):
                            of builds that will be examined.
         """
 
+    def getCachedFinishedBuilds(num_builds=None):
+        """Return a list of the finished builds that are in memory, most
+        recent first, without loading any builds from disk.
+
+        @param num_builds: if provided, return at most this many builds.
+        """
+
     def subscribe(receiver):
         """Register an IStatusReceiver to receive new status events. The
         receiver will be given builderChangedState, buildStarted, and
@@ -808,6 +839,12 @@ class IStatusLog(Interface):
         """Return one big string with the contents of the Log. This merges
         all chunks (including headers) together."""
 
+    def getTextTail(size):
+        """Return a tuple (text, truncated), where text is the last C{size}
+        bytes of the non-header chunks of the Log, and truncated tells whether
+        any text before them was left out.  This reads as little of the Log
+        as it can."""
+
     def getChunks():
         """Generate a list of (channel, text) tuples. 'channel' is a number,
         0 for stdout, 1 for stderr, 2 for header. (note that stderr is merged
@@ -1066,6 +1103,9 @@ class ILogFile(Interface):
         pass
     def addHeader(data):
         pass
+    def addEntries(entries):
+        """Add a list of (channel, data) tuples to the log in one operation.
+        Adjacent entries for the same channel may be coalesced."""
     def finish():
         """The process that is feeding the log file has finished, and no
         further data will be added. This closes the logfile."""
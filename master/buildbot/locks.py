@@ -14,8 +14,9 @@
 # Copyright Buildbot Team Members
 
 
+import weakref
 from twisted.python import log
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from buildbot import util
 from buildbot.util import subscription
 
@@ -36,12 +37,16 @@ class BaseLock:
            currently no way of distinguishing between them.
     """
     description = "<BaseLock>"
+    distributed = False
 
     def __init__(self, name, maxCount=1):
         self.name = name          # Name of the lock
         self.waiting = []         # Current queue, tuples (LockAccess, deferred)
         self.owners = []          # Current owners, tuples (owner, LockAccess)
         self.maxCount = maxCount  # maximal number of counting owners
+        self.waking = 0           # waiters that are about to be woken up
+        # time each owner started waiting, until it claims the lock
+        self.waitStarted = weakref.WeakKeyDictionary()
 
         # subscriptions to this lock being released
         self.release_subs = subscription.SubscriptionPoint("%r releases"
@@ -79,17 +84,40 @@ class BaseLock:
             # Wants exclusive access
             return num_excl == 0 and num_counting == 0
 
+    def isAvailableTo(self, requester, access):
+        """ Return a boolean whether the lock is available for claiming by
+            C{requester} """
+        return self.isAvailable(access)
+
+    def canClaim(self, access):
+        """ Return a boolean whether a new owner could claim the lock now,
+            without waiting behind the current waiters """
+        return not self.waiting and not self.waking \
+                and self.isAvailable(access)
+
     def claim(self, owner, access):
         """ Claim the lock (lock must be available) """
         debuglog("%s claim(%s, %s)" % (self, owner, access.mode))
         assert owner is not None
-        assert self.isAvailable(access), "ask for isAvailable() first"
+        assert self.isAvailableTo(owner, access), \
+                "ask for isAvailableTo() first"
 
         assert isinstance(access, LockAccess)
         assert access.mode in ['counting', 'exclusive']
         self.owners.append((owner, access))
+        self._logWaitTime(owner)
         debuglog(" %s is claimed '%s'" % (self, access.mode))
 
+    def _logWaitTime(self, owner):
+        started = self.waitStarted.pop(owner, None)
+        if started is None:
+            return
+        # imported here, as buildbot.process.metrics imports buildbot.config,
+        # which imports this module
+        from buildbot.process import metrics
+        metrics.MetricTimeEvent.log('Lock.wait.%s' % self.name,
+                                    util.now() - started)
+
     def subscribeToReleases(self, callback):
         """Schedule C{callback} to be invoked every time this lock is
         released.  Returns a L{Subscription}."""
@@ -124,11 +152,16 @@ class BaseLock:
                     num_excl = num_excl + 1
 
             del self.waiting[0]
-            reactor.callLater(0, d.callback, self)
+            self.waking += 1
+            reactor.callLater(0, self._wake, d)
 
         # notify any listeners
         self.release_subs.deliver()
 
+    def _wake(self, d):
+        self.waking -= 1
+        d.callback(self)
+
     def waitUntilMaybeAvailable(self, owner, access):
         """Fire when the lock *might* be available. The caller will need to
         check with isAvailable() when the deferred fires. This loose form is
@@ -138,7 +171,8 @@ class BaseLock:
         """
         debuglog("%s waitUntilAvailable(%s)" % (self, owner))
         assert isinstance(access, LockAccess)
-        if self.isAvailable(access):
+        self.waitStarted.setdefault(owner, util.now())
+        if self.isAvailableTo(owner, access):
             return defer.succeed(self)
         d = defer.Deferred()
         self.waiting.append((access, d))
@@ -149,10 +183,16 @@ class BaseLock:
         assert isinstance(access, LockAccess)
         assert (access, d) in self.waiting
         self.waiting.remove( (access, d) )
+        self.waitStarted.pop(owner, None)
 
     def isOwner(self, owner, access):
         return (owner, access) in self.owners
 
+    def releaseGrant(self, owner, access):
+        """ Give back the lock if it has been granted to C{owner}, but not
+            claimed yet.  Only distributed locks are granted. """
+        pass
+
 
 class RealMasterLock(BaseLock):
     def __init__(self, lockid):
@@ -162,6 +202,226 @@ class RealMasterLock(BaseLock):
     def getLock(self, slave):
         return self
 
+class DistributedLock(BaseLock):
+    """
+    A lock shared by all of the masters using the same database.  Each claim
+    on the lock is a row in the C{lock_claims} table, and the lock is granted
+    to those rows in the order they were requested, as the lock's mode and
+    C{maxCount} allow.
+
+    A claim is requested when an owner starts waiting for the lock, and
+    L{isAvailableTo} is only true for an owner once the database has granted
+    its claim; L{isAvailable}, which does not know the owner, is never true.
+    The owner keeps the grant until it claims the lock, stops waiting,
+    releases the lock or gives the grant back with L{releaseGrant}, so that a
+    build or step can hold the grants of several distributed locks while it
+    waits for the rest of them.  Builds and steps wait for their local locks
+    before requesting distributed locks, and give back their grants when
+    they have to wait for a local lock again, so that no local lock is
+    waited for while holding a distributed lock.
+
+    Each claim has a lease of C{lease} seconds, which is renewed every
+    C{pollInterval} seconds while the claim is held or waiting; the claims of
+    a master that goes away lapse when their lease expires.  Releases by
+    other masters are noticed when the lease is renewed.
+    """
+
+    lease = 60
+    pollInterval = 5
+
+    def __init__(self, name, maxCount=1, slavename='', master=None,
+                 _reactor=reactor):
+        BaseLock.__init__(self, name, maxCount)
+        self.slavename = slavename
+        self.master = master
+        self._reactor = _reactor
+        # claimids granted to waiters but not yet claimed, as (owner,
+        # LockAccess, claimid) tuples
+        self.grants = []
+        # claimids of the current owners, as (owner, LockAccess, claimid)
+        # tuples; LockAccess instances are compared, not hashed
+        self.claims = []
+        # claimids of the waiters, keyed by deferred; None until the claim
+        # has been recorded in the database
+        self.requests = {}
+        # the owners of the waiters, keyed by deferred
+        self.requesters = {}
+        self._granting = defer.DeferredLock()
+        self._poller = None
+
+    distributed = True
+
+    def isAvailable(self, access):
+        # the lock is only ever available to the owner it was granted to
+        return False
+
+    def isAvailableTo(self, requester, access):
+        return self._findGrant(requester, access) is not None
+
+    def canClaim(self, access):
+        # only the database knows whether the lock is free, but it is not if
+        # it is held, granted or waited for on this master
+        return not self.waiting and not self.grants \
+                and BaseLock.isAvailable(self, access)
+
+    def claim(self, owner, access):
+        i = self._findGrant(owner, access)
+        assert i is not None, "ask for isAvailableTo() first"
+        o, a, claimid = self.grants.pop(i)
+        self.claims.append((owner, access, claimid))
+        self.owners.append((owner, access))
+        self._logWaitTime(owner)
+        debuglog(" %s is claimed '%s'" % (self, access.mode))
+
+    def release(self, owner, access):
+        assert isinstance(access, LockAccess)
+
+        debuglog("%s release(%s, %s)" % (self, owner, access.mode))
+        entry = (owner, access)
+        if not entry in self.owners:
+            # give back a grant the owner did not get to claim
+            self.releaseGrant(owner, access)
+            debuglog("%s already released" % self)
+            return
+        self.owners.remove(entry)
+        for i, (o, a, claimid) in enumerate(self.claims):
+            if (o, a) == entry:
+                del self.claims[i]
+                break
+        d = self.master.db.locks.releaseLock(claimid)
+        d.addCallback(lambda _ : self._tryGrants())
+        d.addErrback(log.err, "while releasing %s" % (self,))
+
+        # notify any listeners
+        self.release_subs.deliver()
+
+    def waitUntilMaybeAvailable(self, owner, access):
+        debuglog("%s waitUntilAvailable(%s)" % (self, owner))
+        assert isinstance(access, LockAccess)
+        self.waitStarted.setdefault(owner, util.now(self._reactor))
+        if self.isAvailableTo(owner, access):
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self.waiting.append((access, d))
+        self.requests[d] = None
+        self.requesters[d] = owner
+        # make the request once the caller has added its callbacks, so that
+        # it can claim the lock when it is granted
+        self._reactor.callLater(0, self._request, access, d)
+        self._startPolling()
+        return d
+
+    def stopWaitingUntilAvailable(self, owner, access, d):
+        BaseLock.stopWaitingUntilAvailable(self, owner, access, d)
+        claimid = self.requests.pop(d)
+        del self.requesters[d]
+        # if the claim has not been recorded yet, _request will drop it
+        if claimid is not None:
+            rd = self.master.db.locks.releaseLock(claimid)
+            rd.addErrback(log.err, "while releasing %s" % (self,))
+
+    def _findGrant(self, owner, access):
+        for i, (o, a, claimid) in enumerate(self.grants):
+            if o is owner and a == access:
+                return i
+        return None
+
+    def releaseGrant(self, owner, access):
+        i = self._findGrant(owner, access)
+        if i is None:
+            return
+        o, a, claimid = self.grants.pop(i)
+        self.waitStarted.pop(owner, None)
+        d = self.master.db.locks.releaseLock(claimid)
+        d.addCallback(lambda _ : self._tryGrants())
+        d.addErrback(log.err, "while releasing %s" % (self,))
+
+    def _logWaitTime(self, owner):
+        started = self.waitStarted.pop(owner, None)
+        if started is None:
+            return
+        from buildbot.process import metrics
+        metrics.MetricTimeEvent.log('Lock.wait.%s' % self.name,
+                                    util.now(self._reactor) - started)
+
+    def _request(self, access, d):
+        rd = self.master.db.locks.requestLock(self.name, self.slavename,
+                access.mode == 'exclusive', self.lease)
+        def recorded(claimid):
+            if d not in self.requests:
+                # the waiter went away in the meantime
+                return self.master.db.locks.releaseLock(claimid)
+            self.requests[d] = claimid
+            return self._tryGrants()
+        rd.addCallback(recorded)
+        rd.addErrback(log.err, "while requesting %s" % (self,))
+
+    def _tryGrants(self):
+        return self._granting.run(self._grantWaiters)
+
+    @defer.inlineCallbacks
+    def _grantWaiters(self):
+        # wake up waiters, in order, for as long as the database grants the
+        # lock to them
+        locksdb = self.master.db.locks
+        for access, d in self.waiting[:]:
+            claimid = self.requests.get(d)
+            if claimid is None:
+                break
+            granted = yield locksdb.grantLock(claimid, self.maxCount,
+                                              self.lease)
+            if granted is None:
+                # the claim's lease ran out; ask again, at the back of the
+                # queue
+                self.requests[d] = None
+                self._request(access, d)
+                break
+            if not granted:
+                break
+            if d not in self.requests:
+                # the waiter went away while the lock was being granted
+                yield locksdb.releaseLock(claimid)
+                continue
+
+            self.waiting.remove((access, d))
+            del self.requests[d]
+            owner = self.requesters.pop(d)
+            # the grant is kept for the waiter, even if it goes on to wait
+            # for another lock, until it claims, releases or stops waiting
+            self.grants.append((owner, access, claimid))
+            d.callback(self)
+
+    def _startPolling(self):
+        if self._poller:
+            return
+        self._poller = task.LoopingCall(self._poll)
+        self._poller.clock = self._reactor
+        d = self._poller.start(self.pollInterval, now=False)
+        d.addErrback(log.err, "while polling %s" % (self,))
+
+    @defer.inlineCallbacks
+    def _poll(self):
+        claimids = [ claimid for (o, a, claimid) in self.claims ]
+        claimids.extend([ claimid for (o, a, claimid) in self.grants ])
+        claimids.extend([ claimid for claimid in self.requests.values()
+                          if claimid is not None ])
+        if not claimids and not self.requests:
+            self._poller.stop()
+            self._poller = None
+            return
+        yield self.master.db.locks.renewLocks(claimids, self.lease)
+        yield self._tryGrants()
+
+
+class DistributedMasterLock(DistributedLock):
+    def __init__(self, lockid):
+        DistributedLock.__init__(self, lockid.name, lockid.maxCount)
+        self.description = "<DistributedMasterLock(%s, %s)>" % (self.name,
+                                                                self.maxCount)
+
+    def getLock(self, slave):
+        return self
+
 class RealSlaveLock:
     def __init__(self, lockid):
         self.name = lockid.name
@@ -180,13 +440,31 @@ class RealSlaveLock:
         if not self.locks.has_key(slavename):
             maxCount = self.maxCountForSlave.get(slavename,
                                                  self.maxCount)
-            lock = self.locks[slavename] = BaseLock(self.name, maxCount)
+            lock = self.locks[slavename] = self._makeLock(slavename, maxCount)
             desc = "<SlaveLock(%s, %s)[%s] %d>" % (self.name, maxCount,
                                                    slavename, id(lock))
             lock.description = desc
             self.locks[slavename] = lock
         return self.locks[slavename]
 
+    def _makeLock(self, slavename, maxCount):
+        return BaseLock(self.name, maxCount)
+
+class DistributedSlaveLock(RealSlaveLock):
+    # the master, filled in by BotMaster.getLockByID
+    master = None
+
+    def _makeLock(self, slavename, maxCount):
+        return DistributedLock(self.name, maxCount, slavename=slavename,
+                               master=self.master)
+
+def localLocksFirst(lock_list):
+    """ Return the (lock, access) tuples in C{lock_list} in the order a build
+        or step should wait for them: local locks before distributed locks,
+        otherwise in the given order. """
+    return ([ la for la in lock_list if not la[0].distributed ] +
+            [ la for la in lock_list if la[0].distributed ])
+
 
 class LockAccess(util.ComparableMixin):
     """ I am an object representing a way to access a lock.
@@ -218,6 +496,8 @@ class BaseLockId(util.ComparableMixin):
     - Link to the actual lock class should be added with the L{lockClass}
       class variable.
     """
+    distributed = False
+
     def access(self, mode):
         """ Express how the lock should be accessed """
         assert mode in ['counting', 'exclusive']
@@ -246,13 +526,19 @@ class MasterLock(BaseLockId):
 
     Use this to protect a resource that is shared among all builders and all
     slaves, for example to limit the load on a common SVN repository.
+
+    If distributed is true, the lock is shared among all masters using the
+    same database, rather than being local to this master.
     """
 
-    compare_attrs = ['name', 'maxCount']
+    compare_attrs = ['name', 'maxCount', 'distributed']
     lockClass = RealMasterLock
-    def __init__(self, name, maxCount=1):
+    def __init__(self, name, maxCount=1, distributed=False):
         self.name = name
         self.maxCount = maxCount
+        self.distributed = distributed
+        if distributed:
+            self.lockClass = DistributedMasterLock
 
 class SlaveLock(BaseLockId):
     """I am a semaphore that limits simultaneous actions on each buildslave.
@@ -272,14 +558,21 @@ class SlaveLock(BaseLockId):
     you can provide maxCountForSlave with a dictionary that maps slavename to
     owner count, to allow some slaves more parallelism than others.
 
+    If distributed is true, each copy is shared among all masters using the
+    same database, for slaves that are connected to several masters.
     """
 
-    compare_attrs = ['name', 'maxCount', '_maxCountForSlaveList']
+    compare_attrs = ['name', 'maxCount', '_maxCountForSlaveList',
+                     'distributed']
     lockClass = RealSlaveLock
-    def __init__(self, name, maxCount=1, maxCountForSlave={}):
+    def __init__(self, name, maxCount=1, maxCountForSlave={},
+                 distributed=False):
         self.name = name
         self.maxCount = maxCount
         self.maxCountForSlave = maxCountForSlave
+        self.distributed = distributed
+        if distributed:
+            self.lockClass = DistributedSlaveLock
         # for comparison purposes, turn this dictionary into a stably-sorted
         # list of tuples
         self._maxCountForSlaveList = self.maxCountForSlave.items()
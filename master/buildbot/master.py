@@ -290,6 +290,11 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
             config.error(
                 "Cannot change c['db']['db_url'] after the master has started",
             )
+        for key in 'pool_sizes', 'replica_url':
+            if self.config.db.get(key) != new_config.db.get(key):
+                config.error(
+                    "Cannot change c['db'][%r] after the master has started"
+                    % (key,))
 
         # adjust the db poller
         if (self.config.db['db_poll_interval']
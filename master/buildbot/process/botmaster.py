@@ -141,6 +141,9 @@ class BotMaster(config.ReconfigurableServiceMixin, service.MultiService):
 
     def startService(self):
         def buildRequestAdded(notif):
+            bldr = self.builders.get(notif['buildername'])
+            if bldr:
+                bldr.invalidateUnclaimedRequests()
             self.maybeStartBuildsForBuilder(notif['buildername'])
         self.buildrequest_sub = \
             self.master.subscribeToBuildRequests(buildRequestAdded)
@@ -285,7 +288,9 @@ class BotMaster(config.ReconfigurableServiceMixin, service.MultiService):
         """
         assert isinstance(lockid, (locks.MasterLock, locks.SlaveLock))
         if not lockid in self.locks:
-            self.locks[lockid] = lockid.lockClass(lockid)
+            lock = self.locks[lockid] = lockid.lockClass(lockid)
+            if lockid.distributed:
+                lock.master = self.master
         # if the master.cfg file has changed maxCount= on the lock, the next
         # time a build is started, they'll get a new RealLock instance. Note
         # that this requires that MasterLock and SlaveLock (marker) instances
@@ -21,7 +21,7 @@ from twisted.python import log, components
 from twisted.python.failure import Failure
 from twisted.internet import reactor, defer, error
 
-from buildbot import interfaces, locks
+from buildbot import interfaces, locks, util
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, EXCEPTION, \
   RETRY, SKIPPED, worst_status
 from buildbot.status.builder import Results
@@ -76,6 +76,9 @@ class Build(properties.PropertiesMixin):
         self.terminate = False
 
         self._acquiringLock = None
+        # seconds this build waited for its locks, once it has them
+        self.lockWaitTime = None
+        self._lockWaitStarted = None
 
     def setBuilder(self, builder):
         """
@@ -274,8 +277,18 @@ class Build(properties.PropertiesMixin):
         if self.stopped:
             return defer.succeed(None)
         log.msg("acquireLocks(build %s, locks %s)" % (self, self.locks))
-        for lock, access in self.locks:
-            if not lock.isAvailable(access):
+        if self._lockWaitStarted is None:
+            self._lockWaitStarted = util.now()
+        # locks claimed by the builder when it started this build are
+        # already ours
+        for lock, access in locks.localLocksFirst(self.locks):
+            if lock.isOwner(self, access):
+                continue
+            if not lock.isAvailableTo(self, access):
+                if not lock.distributed:
+                    # don't keep others from distributed locks while waiting
+                    for l, la in self.locks:
+                        l.releaseGrant(self, la)
                 log.msg("Build %s waiting for lock %s" % (self, lock))
                 d = lock.waitUntilMaybeAvailable(self, access)
                 d.addCallback(self.acquireLocks)
@@ -283,7 +296,14 @@ class Build(properties.PropertiesMixin):
                 return d
         # all locks are available, claim them all
         for lock, access in self.locks:
-            lock.claim(self, access)
+            if not lock.isOwner(self, access):
+                lock.claim(self, access)
+        self.lockWaitTime = util.now() - self._lockWaitStarted
+        metrics.MetricTimeEvent.log('Build.lockWait.%s' % self.builder.name,
+                                    self.lockWaitTime)
+        if self.lockWaitTime >= 1:
+            log.msg("Build %s waited %.1fs for locks"
+                    % (self, self.lockWaitTime))
         return defer.succeed(None)
 
     def _startBuild_2(self, res):
@@ -551,11 +571,12 @@ class Build(properties.PropertiesMixin):
         if self.locks:
             log.msg("releaseLocks(%s): %s" % (self, self.locks))
         for lock, access in self.locks:
-            if lock.isOwner(self, access):
-                lock.release(self, access)
-            else:
+            if not lock.isOwner(self, access):
                 # This should only happen if we've been interrupted
                 assert self.stopped
+            # this also gives back a distributed lock that was granted to
+            # the build while it waited for another lock
+            lock.release(self, access)
 
     # IBuildControl
 
@@ -14,19 +14,20 @@
 # Copyright Buildbot Team Members
 
 
-import random, weakref
+import weakref
 from zope.interface import implements
 from twisted.python import log, failure
 from twisted.spread import pb
 from twisted.application import service, internet
 from twisted.internet import defer
 
-from buildbot import interfaces, config
+from buildbot import interfaces, config, locks
 from buildbot.status.progress import Expectations
 from buildbot.status.builder import RETRY
 from buildbot.status.buildrequest import BuildRequestStatus
 from buildbot.process.properties import Properties
 from buildbot.process import buildrequest, slavebuilder
+from buildbot.process.slaveaffinity import WorkspaceAffinity
 from buildbot.process.slavebuilder import BUILDING
 from buildbot.db import buildrequests
 
@@ -44,6 +45,24 @@ class Builder(config.ReconfigurableServiceMixin,
         # this is created the first time we get a good build
         self.expectations = None
 
+        # the workspaces this builder has left on its slaves, used to choose
+        # a slave when there is no nextSlave function
+        self.affinity = WorkspaceAffinity(name)
+        # the request the default slave chooser should find a slave for; set
+        # by maybeStartBuild
+        self._nextRequest = None
+
+        # this builder's unclaimed build requests, oldest first, or None if
+        # they must be read from the database; see getUnclaimedRequests.  The
+        # generation is bumped whenever this changes, so that a query that
+        # was in flight at the time does not overwrite newer information.
+        self._unclaimedRequests = None
+        self._unclaimedRequestsGeneration = 0
+
+        # subscriptions to the releases of locks that kept builds from
+        # starting, keyed by lock
+        self._lockSubscriptions = {}
+
         # build/wannabuild slots: Build objects move along this sequence
         self.building = []
         # old_building holds active builds that were stolen from a predecessor
@@ -105,20 +124,55 @@ class Builder(config.ReconfigurableServiceMixin,
     def getOldestRequestTime(self):
 
         """Returns the submitted_at of the oldest unclaimed build request for
-        this builder, or None if there are no build requests.
+        this builder, or None if there are no build requests.  This uses
+        L{getUnclaimedRequests}, so it is usually answered from memory.
 
         @returns: datetime instance or None, via Deferred
         """
-        unclaimed = yield self.master.db.buildrequests.getBuildRequests(
-                        buildername=self.name, claimed=False)
+        unclaimed = yield self.getUnclaimedRequests()
 
         if unclaimed:
-            unclaimed = [ brd['submitted_at'] for brd in unclaimed ]
-            unclaimed.sort()
-            defer.returnValue(unclaimed[0])
+            defer.returnValue(unclaimed[0]['submitted_at'])
         else:
             defer.returnValue(None)
 
+    @defer.inlineCallbacks
+    def getUnclaimedRequests(self):
+        """Returns the unclaimed build requests for this builder, oldest
+        first.  The list is kept in memory until new requests arrive for this
+        builder, requests are returned to the queue, or C{maybeStartBuild}
+        reads the queue again, so this is cheap enough to call on every
+        prioritization.  It may be stale if other masters claim requests for
+        this builder, so it must not be used to decide what to claim.
+
+        @returns: list of build request dictionaries, via Deferred
+        """
+        if self._unclaimedRequests is None:
+            generation = self._unclaimedRequestsGeneration
+            brdicts = yield self.master.db.buildrequests.getBuildRequests(
+                            buildername=self.name, claimed=False)
+            if generation != self._unclaimedRequestsGeneration:
+                # the queue changed while we were reading it, so this result
+                # should not be kept
+                defer.returnValue(sorted(brdicts,
+                                  key=lambda brd : brd['submitted_at']))
+            self._setUnclaimedRequests(brdicts)
+        defer.returnValue(self._unclaimedRequests[:])
+
+    def invalidateUnclaimedRequests(self):
+        """Forget the cached list of unclaimed build requests; call this
+        when requests are added to or returned to this builder's queue."""
+        self._unclaimedRequests = None
+        self._unclaimedRequestsGeneration += 1
+
+    def _setUnclaimedRequests(self, brdicts):
+        # keep copies, without any brobj added by _brdictToBuildRequest
+        self._unclaimedRequests = sorted(
+                [ dict([ (k, v) for (k, v) in brd.iteritems() if k != 'brobj' ])
+                  for brd in brdicts ],
+                key=lambda brd : brd['submitted_at'])
+        self._unclaimedRequestsGeneration += 1
+
     def reclaimAllBuilds(self):
         brids = set()
         for b in self.building:
@@ -279,6 +333,26 @@ class Builder(config.ReconfigurableServiceMixin,
         build.setLocks(self.config.locks)
         cleanups.append(lambda : slavebuilder.slave.releaseLocks())
 
+        # claim the build's locks now, in the same turn of the reactor as
+        # they were found to be available, so that the build does not occupy
+        # the slave while waiting for them.  Locks that cannot be claimed
+        # immediately (distributed locks) are acquired by the build.
+        lock_list = self._getLocks(slavebuilder)
+        if not self._locksAvailable(lock_list):
+            log.msg("locks for %s were taken; re-queueing the request"
+                    % (build,))
+            run_cleanups()
+            defer.returnValue(False)
+            return
+        reserved = [ (lock, access) for lock, access in lock_list
+                     if lock.isAvailable(access) ]
+        for lock, access in reserved:
+            lock.claim(build, access)
+        def release_reserved():
+            for lock, access in reserved:
+                lock.release(build, access)
+        cleanups.append(release_reserved)
+
         if len(self.config.env) > 0:
             build.setSlaveEnvironment(self.config.env)
 
@@ -365,7 +439,8 @@ class Builder(config.ReconfigurableServiceMixin,
         # will start the actual build process.  This is done with a fresh
         # Deferred since _startBuildFor should not wait until the build is
         # finished.
-        d = build.startBuild(bs, self.expectations, slavebuilder)
+        expectations = self._getExpectations(slavebuilder.slave.slavename)
+        d = build.startBuild(bs, expectations, slavebuilder)
         d.addCallback(self.buildFinished, slavebuilder, bids)
         # this shouldn't happen. if it does, the slave will be wedged
         d.addErrback(log.err)
@@ -399,6 +474,10 @@ class Builder(config.ReconfigurableServiceMixin,
 
         results = build.build_status.getResults()
         self.building.remove(build)
+        if results != RETRY and sb.slave:
+            started, finished = build.build_status.getTimes()
+            self.affinity.buildFinished(sb.slave.slavename, build.sources,
+                                        started, finished)
         if results == RETRY:
             self._resubmit_buildreqs(build).addErrback(log.err)
         else:
@@ -424,7 +503,18 @@ class Builder(config.ReconfigurableServiceMixin,
 
     def _resubmit_buildreqs(self, build):
         brids = [br.id for br in build.requests]
-        return self.master.db.buildrequests.unclaimBuildRequests(brids)
+        d = self.master.db.buildrequests.unclaimBuildRequests(brids)
+        d.addCallback(lambda _ : self.invalidateUnclaimedRequests())
+        return d
+
+    def _getExpectations(self, slavename):
+        # prefer the median step times from the duration history, which are
+        # not thrown off by a single unusual build, and survive a restart
+        times = self.builder_status.getDurationHistory().getStepTimes(
+                                                        slavename=slavename)
+        if not times:
+            return self.expectations
+        return (self.expectations or Expectations()).withTimes(times)
 
     def setExpectations(self, progress):
         """Mark the build as successful and update expectations for the next
@@ -471,8 +561,10 @@ class Builder(config.ReconfigurableServiceMixin,
                     buildername=self.name, claimed=False)
 
         if not unclaimed_requests:
+            self._setUnclaimedRequests(unclaimed_requests)
             self.updateBigStatus()
             return
+        generation = self._unclaimedRequestsGeneration
 
         # sort by submitted_at, so the first is the oldest
         unclaimed_requests.sort(key=lambda brd : brd['submitted_at'])
@@ -480,10 +572,21 @@ class Builder(config.ReconfigurableServiceMixin,
         # get the mergeRequests function for later
         mergeRequests_fn = self._getMergeRequestsFn()
 
+        # set if any requests were claimed and then returned to the queue
+        requeued = False
+
         # match them up until we're out of options
         while available_slavebuilders and unclaimed_requests:
-            # first, choose a slave (using nextSlave)
-            slavebuilder = yield self._chooseSlave(available_slavebuilders)
+            # first, choose a slave (using nextSlave).  Without nextSlave, the
+            # slave is chosen for the request that the default nextBuild
+            # would choose, if any slave has a workspace for it.
+            if not self.config.nextSlave and self.affinity.hasHistory():
+                self._nextRequest = \
+                    yield self._brdictToBuildRequest(unclaimed_requests[0])
+            try:
+                slavebuilder = yield self._chooseSlave(available_slavebuilders)
+            finally:
+                self._nextRequest = None
 
             if not slavebuilder:
                 break
@@ -493,6 +596,13 @@ class Builder(config.ReconfigurableServiceMixin,
                          "'%s'; cannot start build") % self.name)
                 break
 
+            # don't claim requests for a build that would only sit on the
+            # slave waiting for its locks; this is tried again when they are
+            # released
+            if not self._locksAvailable(self._getLocks(slavebuilder)):
+                available_slavebuilders.remove(slavebuilder)
+                continue
+
             # then choose a request (using nextBuild)
             brdict = yield self._chooseBuild(unclaimed_requests)
 
@@ -521,6 +631,7 @@ class Builder(config.ReconfigurableServiceMixin,
                 unclaimed_requests = \
                     yield self.master.db.buildrequests.getBuildRequests(
                             buildername=self.name, claimed=False)
+                generation = self._unclaimedRequestsGeneration
 
                 # go around the loop again
                 continue
@@ -540,6 +651,7 @@ class Builder(config.ReconfigurableServiceMixin,
             if not build_started:
                 # build was not started, so unclaim the build requests
                 yield self.master.db.buildrequests.unclaimBuildRequests(brids)
+                requeued = True
 
                 # and try starting builds again.  If we still have a working slave,
                 # then this may re-claim the same buildrequests
@@ -552,6 +664,13 @@ class Builder(config.ReconfigurableServiceMixin,
                 unclaimed_requests.remove(brdict)
             available_slavebuilders.remove(slavebuilder)
 
+        # what is left is what we know to be unclaimed, unless requests were
+        # returned to the queue or added to it since it was read
+        if requeued or generation != self._unclaimedRequestsGeneration:
+            self.invalidateUnclaimedRequests()
+        else:
+            self._setUnclaimedRequests(unclaimed_requests)
+
         self._breakBrdictRefloops(unclaimed_requests)
         self.updateBigStatus()
         return
@@ -559,10 +678,48 @@ class Builder(config.ReconfigurableServiceMixin,
     # a few utility functions to make the maybeStartBuild a bit shorter and
     # easier to read
 
+    def _getLocks(self, slavebuilder):
+        """
+        Get the real locks a build on the given slave needs.
+
+        @returns: list of (lock, access) tuples
+        """
+        lock_list = []
+        for access in self.config.locks:
+            if not isinstance(access, locks.LockAccess):
+                access = access.defaultAccess()
+            lock = self.botmaster.getLockByID(access.lockid)
+            lock_list.append((lock.getLock(slavebuilder.slave), access))
+        return lock_list
+
+    def _locksAvailable(self, lock_list):
+        """
+        Check whether a new build could claim all of the given locks without
+        waiting.  If not, arrange for builds to be started again when the locks
+        that are in the way are released.
+
+        @param lock_list: list of (lock, access) tuples, from L{_getLocks}
+        @returns: boolean
+        """
+        busy = [ lock for lock, access in lock_list
+                 if not lock.canClaim(access) ]
+        for lock in busy:
+            if lock not in self._lockSubscriptions:
+                self._lockSubscriptions[lock] = \
+                        lock.subscribeToReleases(self._lockReleased)
+        return not busy
+
+    def _lockReleased(self):
+        for sub in self._lockSubscriptions.values():
+            sub.unsubscribe()
+        self._lockSubscriptions = {}
+        self.botmaster.maybeStartBuildsForBuilder(self.name)
+
     def _chooseSlave(self, available_slavebuilders):
         """
         Choose the next slave, using the C{nextSlave} configuration if
-        available, and falling back to C{random.choice} otherwise.
+        available, and falling back to the slave with the warmest workspace
+        for the next request, or the least recently used slave, otherwise.
 
         @param available_slavebuilders: list of slavebuilders to choose from
         @returns: SlaveBuilder or None via Deferred
@@ -571,7 +728,11 @@ class Builder(config.ReconfigurableServiceMixin,
             return defer.maybeDeferred(lambda :
                     self.config.nextSlave(self, available_slavebuilders))
         else:
-            return defer.succeed(random.choice(available_slavebuilders))
+            sources = None
+            if self._nextRequest:
+                sources = self._nextRequest.sources.values()
+            return defer.succeed(self.affinity.chooseSlave(
+                                        available_slavebuilders, sources))
 
     def _chooseBuild(self, buildrequests):
         """
@@ -41,6 +41,9 @@ class RemoteCommand(pb.Referenceable):
     active = False
     rc = None
     debug = False
+    # while a batch of updates is being processed, stdio output is collected
+    # here and handed to the log in one addEntries call
+    _stdioBatch = None
 
     def __init__(self, remote_command, args, ignore_updates=False, collectStdout=False):
         self.logs = {}
@@ -107,8 +110,13 @@ class RemoteCommand(pb.Referenceable):
         # We will receive remote_update messages as the command runs.
         # We will get a single remote_complete when it finishes.
         # We should fire self.deferred when the command is done.
+        args = self.args
+        if not self.step.slaveVersionIsOlderThan(self.remote_command, "2.16"):
+            # ask the slave to send interleaved output as 'segments' updates
+            args = args.copy()
+            args['segmented_updates'] = True
         d = self.remote.callRemote("startCommand", self, self.commandID,
-                                   self.remote_command, self.args)
+                                   self.remote_command, args)
         return d
 
     def _finished(self, failure=None):
@@ -165,20 +173,30 @@ class RemoteCommand(pb.Referenceable):
         """
         self.buildslave.messageReceivedFromSlave()
         max_updatenum = 0
-        for (update, num) in updates:
-            #log.msg("update[%d]:" % num)
-            try:
-                if self.active and not self.ignore_updates:
-                    self.remoteUpdate(update)
-            except:
-                # log failure, terminate build, let slave retire the update
-                self._finished(Failure())
-                # TODO: what if multiple updates arrive? should
-                # skip the rest but ack them all
-            if num > max_updatenum:
-                max_updatenum = num
+        self._stdioBatch = []
+        try:
+            for (update, num) in updates:
+                #log.msg("update[%d]:" % num)
+                try:
+                    if self.active and not self.ignore_updates:
+                        self.remoteUpdate(update)
+                except:
+                    # log failure, terminate build, let slave retire the update
+                    self._flushStdioBatch()
+                    self._finished(Failure())
+                    # TODO: what if multiple updates arrive? should
+                    # skip the rest but ack them all
+                if num > max_updatenum:
+                    max_updatenum = num
+        finally:
+            self._flushStdioBatch()
         return max_updatenum
 
+    def _flushStdioBatch(self):
+        batch, self._stdioBatch = self._stdioBatch, None
+        if batch and 'stdio' in self.logs:
+            self.logs['stdio'].addEntries(batch)
+
     def remote_complete(self, failure=None):
         """
         Called by the slave's L{buildbot.slave.bot.SlaveBuilder} to
@@ -197,17 +215,26 @@ class RemoteCommand(pb.Referenceable):
 
     def addStdout(self, data):
         if 'stdio' in self.logs:
-            self.logs['stdio'].addStdout(data)
+            if self._stdioBatch is not None:
+                self._stdioBatch.append((interfaces.LOG_CHANNEL_STDOUT, data))
+            else:
+                self.logs['stdio'].addStdout(data)
         if self.collectStdout:
             self.stdout += data
 
     def addStderr(self, data):
         if 'stdio' in self.logs:
-            self.logs['stdio'].addStderr(data)
+            if self._stdioBatch is not None:
+                self._stdioBatch.append((interfaces.LOG_CHANNEL_STDERR, data))
+            else:
+                self.logs['stdio'].addStderr(data)
 
     def addHeader(self, data):
         if 'stdio' in self.logs:
-            self.logs['stdio'].addHeader(data)
+            if self._stdioBatch is not None:
+                self._stdioBatch.append((interfaces.LOG_CHANNEL_HEADER, data))
+            else:
+                self.logs['stdio'].addHeader(data)
 
     def addToLog(self, logname, data):
         # Activate delayed logs on first data.
@@ -228,29 +255,41 @@ class RemoteCommand(pb.Referenceable):
         if self.debug:
             for k,v in update.items():
                 log.msg("Update[%s]: %s" % (k,v))
-        if update.has_key('stdout'):
+        if 'stdout' in update:
             # 'stdout': data
             self.addStdout(update['stdout'])
-        if update.has_key('stderr'):
+        if 'stderr' in update:
             # 'stderr': data
             self.addStderr(update['stderr'])
-        if update.has_key('header'):
+        if 'header' in update:
             # 'header': data
             self.addHeader(update['header'])
-        if update.has_key('log'):
+        if 'log' in update:
             # 'log': (logname, data)
             logname, data = update['log']
             self.addToLog(logname, data)
-        if update.has_key('rc'):
+        if 'segments' in update:
+            # 'segments': [ (logname, data), .. ], where logname is one of
+            # 'stdout', 'stderr', 'header' or ('log', logname)
+            for logname, data in update['segments']:
+                if logname == 'stdout':
+                    self.addStdout(data)
+                elif logname == 'stderr':
+                    self.addStderr(data)
+                elif logname == 'header':
+                    self.addHeader(data)
+                else:
+                    self.addToLog(logname[1], data)
+        if 'rc' in update:
             rc = self.rc = update['rc']
             log.msg("%s rc=%s" % (self, rc))
             self.addHeader("program finished with exit code %d\n" % rc)
-        if update.has_key('elapsed'):
+        if 'elapsed' in update:
             self._remoteElapsed = update['elapsed']
 
         # TODO: these should be handled at the RemoteCommand level
         for k in update:
-            if k not in ('stdout', 'stderr', 'header', 'rc'):
+            if k not in ('stdout', 'stderr', 'header', 'rc', 'segments'):
                 if k not in self.updates:
                     self.updates[k] = []
                 self.updates[k].append(update[k])
@@ -511,8 +550,12 @@ class BuildStep(properties.PropertiesMixin):
         if self.stopped:
             return defer.succeed(None)
         log.msg("acquireLocks(step %s, locks %s)" % (self, self.locks))
-        for lock, access in self.locks:
-            if not lock.isAvailable(access):
+        for lock, access in locks.localLocksFirst(self.locks):
+            if not lock.isAvailableTo(self, access):
+                if not lock.distributed:
+                    # don't keep others from distributed locks while waiting
+                    for l, la in self.locks:
+                        l.releaseGrant(self, la)
                 self.step_status.setWaitingForLocks(True)
                 log.msg("step %s waiting for lock %s" % (self, lock))
                 d = lock.waitUntilMaybeAvailable(self, access)
@@ -586,11 +629,12 @@ class BuildStep(properties.PropertiesMixin):
     def releaseLocks(self):
         log.msg("releaseLocks(%s): %s" % (self, self.locks))
         for lock, access in self.locks:
-            if lock.isOwner(self, access):
-                lock.release(self, access)
-            else:
+            if not lock.isOwner(self, access):
                 # This should only happen if we've been interrupted
                 assert self.stopped
+            # this also gives back a distributed lock that was granted to
+            # the step while it waited for another lock
+            lock.release(self, access)
 
     def finished(self, results):
         if self.stopped and results != RETRY:
@@ -664,7 +708,7 @@ class BuildStep(properties.PropertiesMixin):
         sv = self.build.getSlaveCommandVersion(command, None)
         if sv is None:
             return True
-        if map(int, sv.split(".")) < map(int, minversion.split(".")):
+        if map(int, str(sv).split(".")) < map(int, minversion.split(".")):
             return True
         return False
 
@@ -25,13 +25,18 @@ Basic architecture:
     MetricEvent.log(...)
           ||
           \/
-    MetricLogObserver
+    MetricRegistry (of the enabled MetricLogObserver)
           ||
           \/
     MetricHandler
           ||
           \/
     MetricWatcher
+
+Metrics are recorded directly in the registry, rather than being sent
+through Twisted's log observers, as they are counted on some of the busiest
+paths in the master.  Events logged with log.msg(metric=...) are still
+handled, for compatibility.
 """
 from collections import deque
 
@@ -40,9 +45,10 @@ from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
 from twisted.application import service
 from buildbot import util, config
+from buildbot.process.stallwatcher import StallWatcher
 from collections import defaultdict
 
-import gc, os, sys
+import gc, os, sys, math
 # Make use of the resource module if we can
 try:
     import resource
@@ -50,10 +56,186 @@ try:
 except ImportError:
     resource = None
 
+ALARM_OK, ALARM_WARN, ALARM_CRIT = range(3)
+ALARM_TEXT = ["OK", "WARN", "CRIT"]
+
+class TimerSamples(object):
+    """The last C{maxlen} times recorded for a timer, kept in a ring so
+    that recording a time does not allocate."""
+
+    __slots__ = ('samples', 'next', 'maxlen')
+
+    def __init__(self, maxlen=10):
+        self.samples = []
+        self.next = 0
+        self.maxlen = maxlen
+
+    def add(self, elapsed):
+        if len(self.samples) < self.maxlen:
+            self.samples.append(elapsed)
+        else:
+            self.samples[self.next] = elapsed
+            self.next = (self.next + 1) % self.maxlen
+
+    @property
+    def average(self):
+        if not self.samples:
+            return 0
+        return float(sum(self.samples)) / len(self.samples)
+
+class HistogramWindow(object):
+    __slots__ = ('number', 'buckets', 'count', 'total', 'max')
+
+    def __init__(self, number):
+        self.number = number
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+class Histogram(object):
+    """
+    A histogram of the times recorded for a timer over a sliding window of the
+    last C{windows} intervals of C{interval} seconds.  Times are counted in
+    logarithmic buckets, C{bucketsPerOctave} to each doubling, so percentiles
+    are accurate to within a few percent while memory stays bounded by the
+    range of the times rather than their number.
+    """
+
+    bucketsPerOctave = 8
+    # times at or below this are counted together, and reported as 0
+    minTime = 1e-6
+
+    def __init__(self, interval=60, windows=5, _reactor=reactor):
+        self.interval = interval
+        self.windows = windows
+        self._reactor = _reactor
+        self._windows = deque()
+
+    def _bucket(self, elapsed):
+        if elapsed <= self.minTime:
+            return -1
+        return int(math.log(elapsed / self.minTime, 2)
+                   * self.bucketsPerOctave)
+
+    def _bucketTime(self, bucket):
+        if bucket < 0:
+            return 0
+        # the geometric middle of the bucket
+        return self.minTime * 2 ** ((bucket + 0.5) / self.bucketsPerOctave)
+
+    def _rotate(self):
+        number = int(util.now(self._reactor) // self.interval)
+        while self._windows and \
+                self._windows[0].number <= number - self.windows:
+            self._windows.popleft()
+        if not self._windows or self._windows[-1].number != number:
+            self._windows.append(HistogramWindow(number))
+        return self._windows[-1]
+
+    def add(self, elapsed):
+        window = self._rotate()
+        window.buckets[self._bucket(elapsed)] += 1
+        window.count += 1
+        window.total += elapsed
+        if window.max is None or elapsed > window.max:
+            window.max = elapsed
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        """Return a dictionary giving the C{count}, C{sum} and C{max} of the
+        times in the window, and their percentiles, as C{p50} and so on;
+        these are None if there are no times."""
+        self._rotate()
+        buckets = defaultdict(int)
+        count = 0
+        total = 0
+        maximum = None
+        for window in self._windows:
+            for bucket, n in window.buckets.iteritems():
+                buckets[bucket] += n
+            count += window.count
+            total += window.total
+            if window.max is not None and (maximum is None
+                                           or window.max > maximum):
+                maximum = window.max
+
+        rv = dict(count=count, sum=total, max=maximum)
+        ranked = sorted(buckets.items())
+        for p in percentiles:
+            key = 'p%s' % p
+            if not count:
+                rv[key] = None
+                continue
+            rank = max(int(math.ceil(p / 100.0 * count)), 1)
+            seen = 0
+            for bucket, n in ranked:
+                seen += n
+                if seen >= rank:
+                    rv[key] = min(self._bucketTime(bucket), maximum)
+                    break
+        return rv
+
+class MetricRegistry(object):
+    """
+    The current values of all counters, gauges, timers and alarms.  Recording
+    a value is a dictionary update, so this can be used on busy paths;
+    reports are made from snapshots of these values.
+
+    Each timer keeps both its last few times, to report their average, and a
+    L{Histogram} of its times over the last few minutes, to report
+    percentiles.
+    """
+
+    # For testing
+    _reactor = reactor
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.timers = {}
+        self.histograms = {}
+        self.alarms = {}
+
+    def increment(self, counter, count=1):
+        self.counters[counter] += count
+
+    def setCount(self, counter, count):
+        self.counters[counter] = count
+
+    def setGauge(self, gauge, value):
+        self.gauges[gauge] = value
+
+    def recordTime(self, timer, elapsed):
+        try:
+            samples = self.timers[timer]
+            histogram = self.histograms[timer]
+        except KeyError:
+            samples = self.timers[timer] = TimerSamples()
+            histogram = self.histograms[timer] = \
+                    Histogram(_reactor=self._reactor)
+        samples.add(elapsed)
+        histogram.add(elapsed)
+
+    def setAlarm(self, alarm, level, msg=None):
+        self.alarms[alarm] = (level, msg)
+
+# the registry of the enabled MetricLogObserver, or None if metrics are
+# disabled
+_registry = None
+
+def getRegistry():
+    return _registry
+
 class MetricEvent(object):
     @classmethod
     def log(cls, *args, **kwargs):
-        log.msg(metric=cls(*args, **kwargs))
+        if _registry is not None:
+            cls(*args, **kwargs).record(_registry)
+
+    def record(self, registry):
+        # events of other classes are passed through the log to the handlers
+        # registered for them with MetricLogObserver.registerHandler
+        log.msg(metric=self)
 
 class MetricCountEvent(MetricEvent):
     def __init__(self, counter, count=1, absolute=False):
@@ -61,13 +243,47 @@ class MetricCountEvent(MetricEvent):
         self.count = count
         self.absolute = absolute
 
+    @classmethod
+    def log(cls, counter, count=1, absolute=False):
+        # avoid creating an event object
+        if _registry is None:
+            return
+        if absolute:
+            _registry.setCount(counter, count)
+        else:
+            _registry.increment(counter, count)
+
+    def record(self, registry):
+        if self.absolute:
+            registry.setCount(self.counter, self.count)
+        else:
+            registry.increment(self.counter, self.count)
+
+class MetricGaugeEvent(MetricEvent):
+    def __init__(self, gauge, value):
+        self.gauge = gauge
+        self.value = value
+
+    @classmethod
+    def log(cls, gauge, value):
+        if _registry is not None:
+            _registry.setGauge(gauge, value)
+
+    def record(self, registry):
+        registry.setGauge(self.gauge, self.value)
+
 class MetricTimeEvent(MetricEvent):
     def __init__(self, timer, elapsed):
         self.timer = timer
         self.elapsed = elapsed
 
-ALARM_OK, ALARM_WARN, ALARM_CRIT = range(3)
-ALARM_TEXT = ["OK", "WARN", "CRIT"]
+    @classmethod
+    def log(cls, timer, elapsed):
+        if _registry is not None:
+            _registry.recordTime(timer, elapsed)
+
+    def record(self, registry):
+        registry.recordTime(self.timer, self.elapsed)
 
 class MetricAlarmEvent(MetricEvent):
     def __init__(self, alarm, msg=None, level=ALARM_OK):
@@ -75,10 +291,14 @@ class MetricAlarmEvent(MetricEvent):
         self.level = level
         self.msg = msg
 
+    def record(self, registry):
+        registry.setAlarm(self.alarm, self.level, self.msg)
+
 def countMethod(counter):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            MetricCountEvent.log(counter=counter)
+            if _registry is not None:
+                _registry.increment(counter)
             return func(*args, **kwargs)
         return wrapper
     return decorator
@@ -155,8 +375,16 @@ class AveragingFiniteList(FiniteList):
         return self.average
 
 class MetricHandler(object):
-    def __init__(self, metrics):
+    """
+    Handles one type of L{MetricEvent}, reporting on the values kept for it
+    in C{registry}.
+    """
+
+    def __init__(self, metrics, registry=None):
         self.metrics = metrics
+        if registry is None:
+            registry = MetricRegistry()
+        self.registry = registry
         self.watchers = []
 
         self.reset()
@@ -172,7 +400,10 @@ class MetricHandler(object):
         raise NotImplementedError
 
     def handle(self, eventDict, metric):
-        raise NotImplementedError
+        if type(metric).record.im_func is MetricEvent.record.im_func:
+            # the event would only be logged again
+            raise NotImplementedError
+        metric.record(self.registry)
 
     def get(self, metric):
         raise NotImplementedError
@@ -187,21 +418,14 @@ class MetricHandler(object):
         raise NotImplementedError
 
 class MetricCountHandler(MetricHandler):
-    _counters = None
     def reset(self):
-        self._counters = defaultdict(int)
-
-    def handle(self, eventDict, metric):
-        if metric.absolute:
-            self._counters[metric.counter] = metric.count
-        else:
-            self._counters[metric.counter] += metric.count
+        self.registry.counters.clear()
 
     def keys(self):
-        return self._counters.keys()
+        return self.registry.counters.keys()
 
     def get(self, counter):
-        return self._counters[counter]
+        return self.registry.counters.get(counter, 0)
 
     def report(self):
         retval = []
@@ -215,19 +439,37 @@ class MetricCountHandler(MetricHandler):
             retval[counter] = self.get(counter)
         return dict(counters=retval)
 
-class MetricTimeHandler(MetricHandler):
-    _timers = None
+class MetricGaugeHandler(MetricHandler):
     def reset(self):
-        self._timers = defaultdict(AveragingFiniteList)
+        self.registry.gauges.clear()
 
-    def handle(self, eventDict, metric):
-        self._timers[metric.timer].append(metric.elapsed)
+    def keys(self):
+        return self.registry.gauges.keys()
+
+    def get(self, gauge):
+        return self.registry.gauges.get(gauge)
+
+    def report(self):
+        retval = []
+        for gauge in sorted(self.keys()):
+            retval.append("Gauge %s: %s" % (gauge, self.get(gauge)))
+        return "\n".join(retval)
+
+    def asDict(self):
+        return dict(gauges=dict(self.registry.gauges))
+
+class MetricTimeHandler(MetricHandler):
+    def reset(self):
+        self.registry.timers.clear()
 
     def keys(self):
-        return self._timers.keys()
+        return self.registry.timers.keys()
 
     def get(self, timer):
-        return self._timers[timer].average
+        samples = self.registry.timers.get(timer)
+        if samples is None:
+            return 0
+        return samples.average
 
     def report(self):
         retval = []
@@ -241,17 +483,47 @@ class MetricTimeHandler(MetricHandler):
             retval[timer] = self.get(timer)
         return dict(timers=retval)
 
-class MetricAlarmHandler(MetricHandler):
-    _alarms = None
+class MetricHistogramHandler(MetricHandler):
+    """Reports percentiles of the times recorded for each timer, from the
+    timers' L{Histogram}s."""
+
     def reset(self):
-        self._alarms = defaultdict(lambda x: ALARM_OK)
+        self.registry.histograms.clear()
 
-    def handle(self, eventDict, metric):
-        self._alarms[metric.alarm] = (metric.level, metric.msg)
+    def keys(self):
+        return self.registry.histograms.keys()
+
+    def get(self, timer):
+        histogram = self.registry.histograms.get(timer)
+        if histogram is None:
+            return None
+        return histogram.snapshot()
+
+    def report(self):
+        retval = []
+        for timer in sorted(self.keys()):
+            snap = self.get(timer)
+            if not snap['count']:
+                continue
+            retval.append("Timer %s: p50 %.3g p90 %.3g p99 %.3g max %.3g "
+                          "(%d times)" % (timer, snap['p50'], snap['p90'],
+                                          snap['p99'], snap['max'],
+                                          snap['count']))
+        return "\n".join(retval)
+
+    def asDict(self):
+        retval = {}
+        for timer in sorted(self.keys()):
+            retval[timer] = self.get(timer)
+        return dict(histograms=retval)
+
+class MetricAlarmHandler(MetricHandler):
+    def reset(self):
+        self.registry.alarms.clear()
 
     def report(self):
         retval = []
-        for alarm, (level, msg) in sorted(self._alarms.items()):
+        for alarm, (level, msg) in sorted(self.registry.alarms.items()):
             if msg:
                 retval.append("%s %s: %s" % (ALARM_TEXT[level], alarm, msg))
             else:
@@ -260,7 +532,7 @@ class MetricAlarmHandler(MetricHandler):
 
     def asDict(self):
         retval = {}
-        for alarm, (level, msg) in sorted(self._alarms.items()):
+        for alarm, (level, msg) in sorted(self.registry.alarms.items()):
             retval[alarm] = (ALARM_TEXT[level], msg)
         return dict(alarms=retval)
 
@@ -376,14 +648,27 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
         self.periodic_interval = None
         self.log_task = None
         self.log_interval = None
+        self.stall_watcher = None
+        self.stall_config = None
+
+        # Values of all metrics, recorded while this observer is enabled
+        self.registry = MetricRegistry()
 
         # Mapping of metric type to handlers for that type
         self.handlers = {}
 
         # Register our default handlers
-        self.registerHandler(MetricCountEvent, MetricCountHandler(self))
-        self.registerHandler(MetricTimeEvent, MetricTimeHandler(self))
-        self.registerHandler(MetricAlarmEvent, MetricAlarmHandler(self))
+        self.registerHandler(MetricCountEvent,
+                MetricCountHandler(self, self.registry))
+        self.registerHandler(MetricGaugeEvent,
+                MetricGaugeHandler(self, self.registry))
+        self.registerHandler(MetricTimeEvent,
+                MetricTimeHandler(self, self.registry))
+        # histograms are kept for time events too, and reported separately
+        self.registerHandler(Histogram,
+                MetricHistogramHandler(self, self.registry))
+        self.registerHandler(MetricAlarmEvent,
+                MetricAlarmHandler(self, self.registry))
 
         # Make sure our changes poller is behaving
         self.getHandler(MetricTimeEvent).addWatcher(PollerWatcher(self))
@@ -417,11 +702,24 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
                     self.periodic_task.stop()
                     self.periodic_task = None
                 if periodic_interval:
-                    self.periodic_task = LoopingCall(periodicCheck,
-                                                    self._reactor)
+                    self.periodic_task = LoopingCall(self.periodic)
                     self.periodic_task.clock = self._reactor
                     self.periodic_task.start(periodic_interval)
 
+            # and the reactor stall watcher, which is off by default
+            stall_config = (metrics_config.get('stall_threshold'),
+                            metrics_config.get('stall_file', 'stalls.folded'))
+            if stall_config != self.stall_config:
+                self.stopStallWatcher()
+                threshold, filename = stall_config
+                if threshold:
+                    if filename:
+                        filename = os.path.join(self.parent.basedir,
+                                                filename)
+                    self.stall_watcher = StallWatcher(threshold, filename)
+                    self.stall_watcher.setServiceParent(self)
+                self.stall_config = stall_config
+
         # upcall
         return config.ReconfigurableServiceMixin.reconfigService(self,
                                                         new_config)
@@ -431,8 +729,11 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
         service.MultiService.stopService(self)
 
     def enable(self):
+        global _registry
         if self.enabled:
             return
+        self.registry._reactor = self._reactor
+        _registry = self.registry
         log.addObserver(self.emit)
         self.enabled = True
 
@@ -448,9 +749,26 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
             self.log_task.stop()
             self.log_task = None
 
+        self.stopStallWatcher()
+        self.stall_config = None
+
+        global _registry
+        if _registry is self.registry:
+            _registry = None
         log.removeObserver(self.emit)
         self.enabled = False
 
+    def stopStallWatcher(self):
+        if self.stall_watcher:
+            self.stall_watcher.disownServiceParent()
+            self.stall_watcher = None
+
+    def getStalls(self):
+        """Return a summary of reactor stalls, or None if the stall watcher
+        is not enabled."""
+        if self.stall_watcher:
+            return self.stall_watcher.asDict()
+
     def registerHandler(self, interface, handler):
         old = self.getHandler(interface)
         self.handlers[interface] = handler
@@ -459,7 +777,22 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
     def getHandler(self, interface):
         return self.handlers.get(interface)
 
+    def periodic(self):
+        periodicCheck(self._reactor)
+        self.runWatchers()
+
+    def runWatchers(self):
+        # watchers check the recorded values, and log alarms
+        for handler in self.handlers.values():
+            for w in handler.watchers:
+                try:
+                    w.run()
+                except:
+                    log.err()
+
     def emit(self, eventDict):
+        # Handle metric events logged with log.msg(metric=...); metrics are
+        # normally recorded in the registry directly.
         # Ignore non-statistic events
         metric = eventDict.get('metric')
         if not metric or not isinstance(metric, MetricEvent):
@@ -474,12 +807,14 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
             w.run()
 
     def asDict(self):
+        self.runWatchers()
         retval = {}
         for interface, handler in self.handlers.iteritems():
             retval.update(handler.asDict())
         return retval
 
     def report(self):
+        self.runWatchers()
         try:
             for interface, handler in self.handlers.iteritems():
                 report = handler.report()
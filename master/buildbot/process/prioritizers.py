@@ -0,0 +1,230 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Built-in policies for the C{prioritizeBuilders} configuration key.  Each is a
+callable taking the master and a list of builders, and returning the builders
+in the order they should be offered a chance to start builds.
+
+These use only information the master keeps in memory -- each builder's
+cached queue of unclaimed requests (L{Builder.getUnclaimedRequests}) and its
+build duration history -- so that prioritizing does not query the database
+on every pass.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+from buildbot.util import datetime2epoch, now
+from buildbot import config
+
+class SortingPrioritizer(object):
+    """
+    Base class for policies that sort builders by a key.  Subclasses
+    implement C{getSortKey(master, builder, oldest)}, where C{oldest} is the
+    submission time of the builder's oldest unclaimed request, returning a
+    sortable key (lowest first) or a Deferred firing with one.  Builders
+    with equal keys are ordered by their oldest request, and builders with no
+    unclaimed requests are put last.
+    """
+
+    @defer.inlineCallbacks
+    def __call__(self, master, builders):
+        def xform(bldr):
+            d = bldr.getOldestRequestTime()
+            def getKey(oldest):
+                if oldest is None:
+                    return None
+                d = defer.maybeDeferred(self.getSortKey, master, bldr, oldest)
+                d.addCallback(lambda key : (key, datetime2epoch(oldest)))
+                return d
+            d.addCallback(getKey)
+            d.addCallback(lambda key : (key, bldr))
+            return d
+        xformed = yield defer.gatherResults(
+                [ xform(bldr) for bldr in builders ])
+
+        pending = [ (key, bldr) for (key, bldr) in xformed if key is not None ]
+        pending.sort(key=lambda (key, bldr) : key)
+        idle = [ bldr for (key, bldr) in xformed if key is None ]
+        defer.returnValue([ bldr for (key, bldr) in pending ] + idle)
+
+    def getSortKey(self, master, bldr, oldest):
+        raise NotImplementedError
+
+
+class ShortestExpectedFirst(SortingPrioritizer):
+    """
+    Start builds on the builders whose builds are expected to be shortest
+    first, based on the median duration of the builder's recent successful
+    builds.  This minimizes the average time requests wait when there are
+    many more requests than slaves.
+
+    @ivar unknownDuration: expected duration, in seconds, of builds on a
+    builder that has not yet completed a successful build; by default, such
+    builders go first.
+
+    @ivar maxWait: if not None, builders whose oldest request has waited
+    longer than this many seconds go before all others, oldest first, so that
+    long builds are not starved.
+    """
+
+    def __init__(self, unknownDuration=0, maxWait=None, _reactor=reactor):
+        self.unknownDuration = unknownDuration
+        self.maxWait = maxWait
+        self._reactor = _reactor
+
+    def getSortKey(self, master, bldr, oldest):
+        if self.maxWait is not None:
+            waited = now(self._reactor) - datetime2epoch(oldest)
+            if waited > self.maxWait:
+                return (0, 0)
+        duration = bldr.builder_status.getDurationHistory().getBuildTime()
+        if duration is None and bldr.expectations:
+            duration = bldr.expectations.expectedBuildTime()
+        if duration is None:
+            duration = self.unknownDuration
+        return (1, duration)
+
+
+class BuildsetPriority(SortingPrioritizer):
+    """
+    Start builds on the builders with the most urgent requests first.  A
+    request's urgency is taken from its buildset's properties: the property
+    named by C{priorityProperty} (an integer, highest first, defaulting to
+    the request's own priority), then the property named by
+    C{deadlineProperty} (a time, in seconds since the epoch, earliest first;
+    requests without a deadline go after those with one).  A builder is as
+    urgent as its most urgent unclaimed request.
+
+    Buildset properties do not change, so they are fetched once per buildset
+    and kept while the buildset has unclaimed requests.
+    """
+
+    def __init__(self, priorityProperty='priority',
+                 deadlineProperty='deadline'):
+        self.priorityProperty = priorityProperty
+        self.deadlineProperty = deadlineProperty
+        # maps buildsetid to (priority, deadline)
+        self._buildsets = {}
+        self._seen = set()
+
+    @defer.inlineCallbacks
+    def __call__(self, master, builders):
+        self._seen = set()
+        rv = yield SortingPrioritizer.__call__(self, master, builders)
+        # forget buildsets that no longer have any unclaimed requests here
+        for bsid in set(self._buildsets) - self._seen:
+            del self._buildsets[bsid]
+        defer.returnValue(rv)
+
+    @defer.inlineCallbacks
+    def getSortKey(self, master, bldr, oldest):
+        brdicts = yield bldr.getUnclaimedRequests()
+        best = None
+        for brdict in brdicts:
+            priority, deadline = yield self._getUrgency(master, brdict)
+            key = (-priority, deadline is None, deadline)
+            if best is None or key < best:
+                best = key
+        defer.returnValue(best)
+
+    @defer.inlineCallbacks
+    def _getUrgency(self, master, brdict):
+        bsid = brdict['buildsetid']
+        self._seen.add(bsid)
+        if bsid not in self._buildsets:
+            props = yield master.db.buildsets.getBuildsetProperties(bsid)
+            self._buildsets[bsid] = (
+                self._convert(props, self.priorityProperty, int, bsid),
+                self._convert(props, self.deadlineProperty, float, bsid))
+        priority, deadline = self._buildsets[bsid]
+        if priority is None:
+            priority = brdict['priority'] or 0
+        defer.returnValue((priority, deadline))
+
+    def _convert(self, props, name, type, bsid):
+        if name not in props:
+            return None
+        value = props[name][0]
+        try:
+            return type(value)
+        except (TypeError, ValueError):
+            log.msg("ignoring invalid %s property %r on buildset %d"
+                    % (name, value, bsid))
+            return None
+
+
+class FairShare(object):
+    """
+    Share slaves fairly between groups of builders, such as projects or
+    categories.  Builders are offered builds one at a time from the group
+    with the fewest running builds relative to its weight, counting each
+    builder already placed in the order as one more running build; within a
+    group, builders are ordered by their oldest request.  Builders with no
+    unclaimed requests are put last.
+
+    @ivar key: function taking a builder and returning its group; by default,
+    the builder's category.
+
+    @ivar weights: dictionary mapping groups to their relative shares; groups
+    not mentioned have weight 1.
+    """
+
+    def __init__(self, key=None, weights=None):
+        if key is None:
+            key = lambda bldr : bldr.config.category
+        self.key = key
+        self.weights = weights or {}
+        for group, weight in self.weights.items():
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                config.error("FairShare weight for %r must be a positive "
+                             "number" % (group,))
+
+    @defer.inlineCallbacks
+    def __call__(self, master, builders):
+        oldest = yield defer.gatherResults(
+                [ bldr.getOldestRequestTime() for bldr in builders ])
+
+        # count the builds running in each group, including on builders that
+        # have nothing to prioritize
+        running = {}
+        for bldr in master.botmaster.getBuilders():
+            group = self.key(bldr)
+            running[group] = running.get(group, 0) + len(bldr.building)
+
+        queues = {}
+        idle = []
+        for bldr, t in zip(builders, oldest):
+            if t is None:
+                idle.append(bldr)
+                continue
+            queues.setdefault(self.key(bldr), []).append((t, bldr))
+        for queue in queues.itervalues():
+            queue.sort(key=lambda (t, bldr) : t)
+
+        def share(group):
+            # ties go to the group with the oldest request
+            return (float(running.get(group, 0)) / self.weights.get(group, 1),
+                    queues[group][0][0])
+
+        rv = []
+        while queues:
+            group = min(queues, key=share)
+            t, bldr = queues[group].pop(0)
+            rv.append(bldr)
+            running[group] = running.get(group, 0) + 1
+            if not queues[group]:
+                del queues[group]
+        defer.returnValue(rv + idle)
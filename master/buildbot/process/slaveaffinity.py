@@ -0,0 +1,115 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import random
+from buildbot.process import metrics
+
+class WorkspaceAffinity(object):
+    """
+    Keeps track of the workspaces a builder has left on each of its slaves,
+    so that a build can be sent to a slave that has already built the same
+    branch, where an incremental checkout and build will be cheapest.
+
+    For each slave, this remembers the branch and revision of each codebase
+    in the last build there, when that build finished, and how long it took.
+    """
+
+    def __init__(self, buildername):
+        self.buildername = buildername
+        self.workspaces = {}
+        self.choices = 0
+        self.hits = 0
+
+    def buildFinished(self, slavename, sources, started, finished):
+        """
+        Record that a build of C{sources} (a list of SourceStamps) on
+        C{slavename} ran from C{started} to C{finished}.
+        """
+        self.workspaces[slavename] = dict(
+            sources=dict([ (ss.codebase, (ss.branch, ss.revision))
+                           for ss in sources ]),
+            finished=finished,
+            duration=finished - started)
+
+    def getWorkspace(self, slavename):
+        """
+        Return a dictionary describing the workspace on C{slavename}, with keys
+        C{sources} (mapping codebase to C{(branch, revision)}), C{finished} and
+        C{duration}; or None if this builder has not built there.
+        """
+        return self.workspaces.get(slavename)
+
+    def hasHistory(self):
+        return bool(self.workspaces)
+
+    def _warmth(self, slavename, sources):
+        # a sortable measure of how well the workspace on slavename suits a
+        # build of sources, or None if it has not built any of the branches
+        ws = self.workspaces.get(slavename)
+        if ws is None or not sources:
+            return None
+        branches = revisions = 0
+        for ss in sources:
+            built = ws['sources'].get(ss.codebase)
+            if built is None or built[0] != ss.branch:
+                continue
+            branches += 1
+            if ss.revision and built[1] == ss.revision:
+                revisions += 1
+        if not branches:
+            return None
+        # prefer matching more codebases and revisions, then the most recently
+        # updated workspace, then the slave that built it fastest
+        return (branches, revisions, ws['finished'], -ws['duration'])
+
+    def _lastUsed(self, slavename):
+        ws = self.workspaces.get(slavename)
+        if ws is None:
+            return 0
+        return ws['finished']
+
+    def chooseSlave(self, slavebuilders, sources):
+        """
+        Choose the slave from C{slavebuilders} whose workspace is warmest for a
+        build of C{sources} (a list of SourceStamps, or None if not known).  If
+        no slave has built any of those branches, choose the slave this builder
+        has used least recently.  Ties are broken randomly.
+
+        @returns: a SlaveBuilder
+        """
+        if not self.workspaces:
+            # nothing is warm, and nothing has been used
+            warm = []
+            candidates = slavebuilders
+        else:
+            warmth = [ (self._warmth(sb.slave.slavename, sources), sb)
+                       for sb in slavebuilders ]
+            warm = [ (w, sb) for (w, sb) in warmth if w is not None ]
+        if warm:
+            best = max([ w for (w, sb) in warm ])
+            candidates = [ sb for (w, sb) in warm if w == best ]
+            self.hits += 1
+            metrics.MetricCountEvent.log('WorkspaceAffinity.hits', 1)
+        elif self.workspaces:
+            oldest = min([ self._lastUsed(sb.slave.slavename)
+                           for sb in slavebuilders ])
+            candidates = [ sb for sb in slavebuilders
+                           if self._lastUsed(sb.slave.slavename) == oldest ]
+        self.choices += 1
+        metrics.MetricCountEvent.log('WorkspaceAffinity.choices', 1)
+        metrics.MetricCountEvent.log(
+                'WorkspaceAffinity.hit_percent.%s' % self.buildername,
+                100 * self.hits / self.choices, absolute=True)
+        return random.choice(candidates)
@@ -109,6 +109,8 @@ class AbstractSlaveBuilder(pb.Referenceable):
         d.addCallback(lambda _:
             self.remote.callRemote("print", "attached"))
 
+        d.addCallback(lambda _: self._sendUpdateWindow())
+
         def setIdle(res):
             self.state = IDLE
             return self
@@ -116,6 +118,17 @@ class AbstractSlaveBuilder(pb.Referenceable):
 
         return d
 
+    def _sendUpdateWindow(self):
+        # advertise the number of unacknowledged updates the slave may have
+        # in flight; older slaves lack remote_setUpdateWindow, which is fine
+        window = self.builder.master.config.slaveUpdateWindow
+        d = self.remote.callRemote("setUpdateWindow", window)
+        def _failed(why):
+            log.msg("slave does not support setUpdateWindow; updates to %s "
+                    "will not be flow-controlled" % (self.builder_name,))
+        d.addErrback(_failed)
+        return d
+
     def prepare(self, builder_status, build):
         if not self.slave.acquireLocks():
             return defer.succeed(False)
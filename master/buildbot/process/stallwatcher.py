@@ -0,0 +1,213 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import thread
+import threading
+from collections import deque
+from twisted.python import log, runtime
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.application import service
+
+class StallWatcher(service.Service):
+    """
+    Finds out what blocks the reactor.  The reactor records a heartbeat every
+    C{threshold / 2} seconds; a watchdog thread checks it every C{threshold /
+    4} seconds, and while the heartbeat is more than C{threshold} seconds late
+    it samples the reactor thread's Python stack, using
+    C{sys._current_frames}.
+
+    Samples are counted by stack, and the counts are periodically written to
+    C{filename} in the "folded" format read by flamegraph tools, one stack per
+    line, with the count at the end.  At most C{maxStacks} different stacks
+    are kept; further samples are counted as C{[other]}.  The most recent
+    stalls are kept, with the stack sampled most often during each.
+    """
+
+    maxStacks = 1000
+    maxDepth = 100
+    maxRecent = 20
+    saveInterval = 60
+
+    # For testing
+    _reactor = reactor
+    _time = staticmethod(time.time)
+
+    def __init__(self, threshold, filename=None):
+        self.threshold = threshold
+        self.filename = filename
+        self.beatInterval = threshold / 2.0
+        self.sampleInterval = threshold / 4.0
+
+        # all of the following are protected by self.lock, as they are
+        # updated by the watchdog thread
+        self.lock = threading.Lock()
+        self.stacks = {}
+        # samples taken during the current stall
+        self.stallStacks = {}
+        self.samples = 0
+        self.changed = False
+
+        # these are only used in the reactor thread
+        self.stalls = 0
+        self.stalledTime = 0
+        self.recent = deque(maxlen=self.maxRecent)
+        self.lastBeat = None
+
+        self._stopping = threading.Event()
+        self._thread = None
+        self._mainThreadId = None
+        self.beat_task = None
+        self.save_task = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._mainThreadId = thread.get_ident()
+        self.lastBeat = self._time()
+
+        self.beat_task = LoopingCall(self.beat)
+        self.beat_task.clock = self._reactor
+        self.beat_task.start(self.beatInterval, now=False)
+        if self.filename:
+            self.save_task = LoopingCall(self.save)
+            self.save_task.clock = self._reactor
+            self.save_task.start(self.saveInterval, now=False)
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run,
+                                        name='StallWatcher')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stopService(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(self.sampleInterval * 4)
+            self._thread = None
+        for task in self.beat_task, self.save_task:
+            if task and task.running:
+                task.stop()
+        self.beat_task = self.save_task = None
+        self.save()
+        return service.Service.stopService(self)
+
+    # reactor thread
+
+    def beat(self):
+        now = self._time()
+        late = now - self.lastBeat - self.beatInterval
+        self.lastBeat = now
+        if late <= self.threshold:
+            return
+
+        with self.lock:
+            stallStacks = self.stallStacks
+            self.stallStacks = {}
+        self.stalls += 1
+        self.stalledTime += late
+        stack = None
+        if stallStacks:
+            stack = max(stallStacks, key=stallStacks.get).split(';')
+        self.recent.append(dict(started=now - late, duration=late,
+                                stack=stack))
+
+        # imported here to avoid a circular import
+        from buildbot.process import metrics
+        metrics.MetricCountEvent.log('reactor.stalls', 1)
+        metrics.MetricTimeEvent.log('reactorStall', late)
+
+    def asDict(self):
+        with self.lock:
+            top = sorted(self.stacks.items(), key=lambda (s, n) : -n)[:10]
+            samples = self.samples
+        return dict(threshold=self.threshold,
+                    stalls=self.stalls,
+                    stalled_time=self.stalledTime,
+                    samples=samples,
+                    sample_interval=self.sampleInterval,
+                    recent=list(self.recent),
+                    top=[ dict(stack=stack.split(';'), samples=n)
+                          for stack, n in top ])
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            if not self.changed:
+                return
+            lines = [ "%s %d\n" % (stack, n)
+                      for stack, n in sorted(self.stacks.items()) ]
+            self.changed = False
+        tmpfilename = self.filename + ".tmp"
+        try:
+            with open(tmpfilename, "w") as f:
+                f.writelines(lines)
+            if runtime.platformType  == 'win32':
+                # windows cannot rename a file on top of an existing one
+                if os.path.exists(self.filename):
+                    os.unlink(self.filename)
+            os.rename(tmpfilename, self.filename)
+        except:
+            log.msg("unable to save reactor stall stacks to %s"
+                    % self.filename)
+            log.err()
+
+    # watchdog thread
+
+    def run(self):
+        while not self._stopping.wait(self.sampleInterval):
+            try:
+                self.sample()
+            except:
+                log.err(None, "while sampling the reactor stack")
+
+    def sample(self):
+        late = self._time() - self.lastBeat - self.beatInterval
+        if late <= self.threshold:
+            return
+        frame = sys._current_frames().get(self._mainThreadId)
+        if frame is None:
+            return
+        try:
+            stack = self.foldStack(frame)
+        finally:
+            del frame
+
+        with self.lock:
+            for counts in self.stacks, self.stallStacks:
+                key = stack
+                if key not in counts and len(counts) >= self.maxStacks:
+                    key = '[other]'
+                counts[key] = counts.get(key, 0) + 1
+            self.samples += 1
+            self.changed = True
+
+    def foldStack(self, frame):
+        """Return the stack of C{frame}, outermost first, as a string of
+        frames separated by semicolons."""
+        frames = []
+        while frame is not None and len(frames) < self.maxDepth:
+            code = frame.f_code
+            name = "%s (%s:%d)" % (code.co_name, code.co_filename,
+                                   frame.f_lineno)
+            frames.append(name.replace(';', ':'))
+            frame = frame.f_back
+        frames.reverse()
+        return ";".join(frames)
@@ -24,6 +24,7 @@ from buildbot import config as config_module
 from buildbot import monkeypatches
 from buildbot.db import connector
 from buildbot.master import BuildMaster
+from buildbot.status import buildindex
 from buildbot.util import in_reactor
 from buildbot.scripts import base
 
@@ -136,6 +137,18 @@ def upgradeFiles(config):
                 print "Error moving %s to %s: %s" % (index_html, root_html,
                                                      str(e))
 
+def rebuildBuildIndexes(config, master_cfg):
+    if not config['quiet']:
+        print "rebuilding build indexes"
+
+    for builder_config in master_cfg.builders:
+        builddir = os.path.join(config['basedir'], builder_config.builddir)
+        if not os.path.isdir(builddir):
+            continue
+        count = buildindex.rebuildBuildIndex(builddir)
+        if not config['quiet']:
+            print " indexed %d builds of %s" % (count, builder_config.name)
+
 @defer.inlineCallbacks
 def upgradeDatabase(config, master_cfg):
     if not config['quiet']:
@@ -166,6 +179,7 @@ def upgradeMaster(config, _noMonkey=False):
         return
 
     upgradeFiles(config)
+    rebuildBuildIndexes(config, master_cfg)
     yield upgradeDatabase(config, master_cfg)
 
     if not config['quiet']:
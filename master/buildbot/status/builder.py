@@ -27,6 +27,8 @@ from buildbot.util.lru import LRUCache
 from buildbot.status.event import Event
 from buildbot.status.build import BuildStatus
 from buildbot.status.buildrequest import BuildRequestStatus
+from buildbot.status.durations import DurationHistory
+from buildbot.status.buildindex import BuildIndex, getBuildKeys
 
 # user modules expect these symbols to be present here
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, SKIPPED
@@ -61,6 +63,8 @@ class BuilderStatus(styles.Versioned):
     category = None
     currentBigState = "offline" # or idle/waiting/interlocked/building
     basedir = None # filled in by our parent
+    durations = None # loaded from basedir on demand
+    buildindex = None # loaded from basedir on demand
 
     def __init__(self, buildername, category, master):
         self.name = buildername
@@ -99,6 +103,8 @@ class BuilderStatus(styles.Versioned):
         del d['status']
         del d['nextBuildNumber']
         del d['master']
+        d.pop('durations', None)
+        d.pop('buildindex', None)
         return d
 
     def __setstate__(self, d):
@@ -141,6 +147,8 @@ class BuilderStatus(styles.Versioned):
                 # interrupted build, need to save it anyway.
                 # BuildStatus.saveYourself will mark it as interrupted.
                 b.saveYourself()
+        if self.buildindex is not None:
+            self.buildindex.save()
         filename = os.path.join(self.basedir, "builder")
         tmpfilename = filename + ".tmp"
         try:
@@ -155,6 +163,87 @@ class BuilderStatus(styles.Versioned):
             log.msg("unable to save builder %s" % self.name)
             log.err()
 
+    def getDurationHistory(self):
+        if self.durations is None:
+            self.durations = DurationHistory(
+                    os.path.join(self.basedir, "durations"))
+            self.durations.load()
+        return self.durations
+
+    def _recordDurations(self, s):
+        started, finished = s.getTimes()
+        if started is None or finished is None:
+            return
+        steps = []
+        for step in s.getSteps():
+            step_started, step_finished = step.getTimes()
+            if step_started is not None and step_finished is not None:
+                steps.append((step.getName(), step_finished - step_started))
+        history = self.getDurationHistory()
+        history.addBuild(s.getSlavename(), started, finished, steps)
+        history.save()
+
+    def getBuildIndex(self):
+        if self.buildindex is None:
+            self.buildindex = BuildIndex(
+                    os.path.join(self.basedir, "buildindex"))
+            running = [ b.number for b in self.currentBuilds ]
+            if not self.buildindex.load():
+                # builds finished before now are not in the new index;
+                # running builds will be added when they finish
+                self.buildindex.first = min([ self.nextBuildNumber ] + running)
+                self.buildindex.next = self.buildindex.first
+                return self.buildindex
+            # if the master did not shut down cleanly, builds finished since
+            # the index was last saved must be indexed again
+            caught_up = False
+            for number in range(self.buildindex.next, self.nextBuildNumber):
+                if number in running:
+                    continue
+                build = self.getBuild(number)
+                if build is not None:
+                    self.buildindex.addBuildStatus(build)
+                    caught_up = True
+            if caught_up:
+                self.buildindex.saveSoon()
+        return self.buildindex
+
+    def generateIndexedBuilds(self, branch=util.NotABranch, revision=None,
+                              scan=True):
+        """Generate the builds on C{branch} (if given) and of C{revision}
+        (if given), most recent first, including running builds.  Builds
+        are found using the builder's L{BuildIndex}, falling back to
+        scanning the builds from before the index was created unless
+        C{scan} is false."""
+        def matches(build):
+            build_branch, build_revision = getBuildKeys(build)
+            if branch is not util.NotABranch and build_branch != branch:
+                return False
+            if revision is not None and build_revision != revision:
+                return False
+            return True
+
+        index = self.getBuildIndex()
+        numbers = set([ n for n in index.getBuildNumbers(branch, revision)
+                        if n >= index.first ])
+        # running builds are not yet indexed
+        numbers.update([ b.number for b in self.currentBuilds if matches(b) ])
+        for number in sorted(numbers, reverse=True):
+            build = self.getBuild(number)
+            if build is not None:
+                yield build
+
+        if not scan:
+            return
+        number = index.first - 1
+        while number >= 0:
+            build = self.getBuild(number)
+            if build is None:
+                return
+            if matches(build):
+                yield build
+            number -= 1
+
     # build cache management
 
     def setCacheSize(self, size):
@@ -219,7 +308,7 @@ class BuilderStatus(styles.Versioned):
         # get the horizons straight
         buildHorizon = self.master.config.buildHorizon
         if buildHorizon is not None:
-            earliest_build = self.nextBuildNumber - self.buildHorizon
+            earliest_build = self.nextBuildNumber - buildHorizon
         else:
             earliest_build = 0
 
@@ -263,6 +352,10 @@ class BuilderStatus(styles.Versioned):
                 try: os.unlink(pathname)
                 except OSError: pass
 
+        if self.buildindex is not None:
+            self.buildindex.forget(earliest_build)
+            self.buildindex.saveSoon()
+
     # IBuilderStatus methods
     def getName(self):
         return self.name
@@ -284,6 +377,12 @@ class BuilderStatus(styles.Versioned):
         d.addCallback(make_statuses)
         return d
 
+    def getPendingBuildRequestCount(self):
+        d = self.status.getPendingBuildRequestCounts()
+        d.addCallback(lambda counts :
+                counts.get(self.name, {}).get('count', 0))
+        return d
+
     def getCurrentBuilds(self):
         return self.currentBuilds
 
@@ -345,6 +444,19 @@ class BuilderStatus(styles.Versioned):
                 if got >= num_builds:
                     return
 
+    def getCachedFinishedBuilds(self, num_builds=None):
+        numbers = self.buildCache.keys()
+        numbers.sort(reverse=True)
+        builds = []
+        for number in numbers:
+            if num_builds is not None and len(builds) >= num_builds:
+                break
+            # a cache hit, so this never loads a pickle
+            build = self.buildCache.get(number)
+            if build is not None and build.isFinished():
+                builds.append(build)
+        return builds
+
     def eventGenerator(self, branches=[], categories=[], committers=[], minTime=0):
         """This function creates a generator which will provide all of this
         Builder's status events, starting with the most recent and
@@ -499,10 +611,16 @@ class BuilderStatus(styles.Versioned):
     def _buildFinished(self, s):
         assert s in self.currentBuilds
         s.saveYourself()
+        index = self.getBuildIndex()
+        index.addBuildStatus(s)
+        index.saveSoon()
         self.currentBuilds.remove(s)
 
         name = self.getName()
         results = s.getResults()
+        # only complete builds say how long the next one will take
+        if results in (SUCCESS, WARNINGS):
+            self._recordDurations(s)
         for w in self.watchers:
             try:
                 w.buildFinished(name, s, results)
@@ -543,9 +661,9 @@ class BuilderStatus(styles.Versioned):
     def asDict_async(self):
         """Just like L{asDict}, but with a nonzero pendingBuilds."""
         result = self.asDict()
-        d = self.getPendingBuildRequestStatuses()
-        def combine(statuses):
-            result['pendingBuilds'] = len(statuses)
+        d = self.getPendingBuildRequestCount()
+        def combine(count):
+            result['pendingBuilds'] = count
             return result
         d.addCallback(combine)
         return d
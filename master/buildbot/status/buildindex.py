@@ -0,0 +1,185 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import re
+import bisect
+from cPickle import load
+from twisted.internet import reactor
+from twisted.python import log, runtime
+from twisted.persisted import styles
+from buildbot.util import json, NotABranch
+
+def getBuildKeys(build):
+    """Return the branch and revision (or None) under which the BuildStatus
+    C{build} is indexed.  The revision is the build's C{got_revision}
+    property, or its C{revision} property if it has none."""
+    ss = build.getSourceStamp()
+    branch = ss and ss.branch
+    revision = build.getProperty('got_revision',
+                                 build.getProperty('revision', None))
+    if revision is not None and revision != '':
+        revision = str(revision)
+    else:
+        revision = None
+    return branch, revision
+
+class BuildIndex(object):
+    """
+    An index of a builder's finished builds by branch and by revision, so
+    that the builds on a branch or of a revision can be found without loading
+    every build in the builder's history.
+
+    The index is stored, as JSON, in C{filename}.  It covers the builds
+    numbered C{first} and later; builds before that were finished before the
+    index was created, and must be found by scanning, until the index is
+    rebuilt by C{buildbot upgrade-master}.
+
+    Changes are written out in batches by L{saveSoon}, at most
+    C{saveDelay} seconds after they are made.  Builds numbered C{next} and
+    later were not indexed when the index was last saved.
+    """
+
+    saveDelay = 10
+    _reactor = reactor # for tests
+
+    _saveTimer = None
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.first = 0
+        self.next = 0
+        # these map branches and revisions to sorted lists of build numbers
+        self.branches = {}
+        self.revisions = {}
+
+    def addBuild(self, number, branch, revision):
+        self.next = max(self.next, number + 1)
+        bisect.insort(self.branches.setdefault(branch, []), number)
+        if revision is not None:
+            bisect.insort(self.revisions.setdefault(revision, []), number)
+
+    def addBuildStatus(self, build):
+        branch, revision = getBuildKeys(build)
+        self.addBuild(build.getNumber(), branch, revision)
+
+    def getBuildNumbers(self, branch=NotABranch, revision=None):
+        """Return the sorted numbers of indexed builds on C{branch} (if
+        given) and of C{revision} (if given); with neither, return the
+        numbers of all indexed builds."""
+        if revision is not None:
+            numbers = self.revisions.get(revision, [])
+            if branch is not NotABranch:
+                onbranch = set(self.branches.get(branch, []))
+                numbers = [ n for n in numbers if n in onbranch ]
+            return list(numbers)
+        if branch is not NotABranch:
+            return list(self.branches.get(branch, []))
+        numbers = set()
+        for column in self.branches.itervalues():
+            numbers.update(column)
+        return sorted(numbers)
+
+    def forget(self, earliest):
+        """Forget builds numbered before C{earliest}, which have been
+        pruned."""
+        for index in self.branches, self.revisions:
+            for key, numbers in index.items():
+                del numbers[:bisect.bisect_left(numbers, earliest)]
+                if not numbers:
+                    del index[key]
+
+    # persistence
+
+    def load(self):
+        """Load the index, returning False if it does not exist."""
+        if not self.filename or not os.path.exists(self.filename):
+            return False
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except:
+            log.msg("unable to load build index from %s" % self.filename)
+            log.err()
+            return False
+        self.first = data['first']
+        # branches may be None, so they are stored as a list of pairs
+        self.branches = dict([ (branch, numbers)
+                               for branch, numbers in data['branches'] ])
+        self.revisions = data['revisions']
+        # indexes saved by older versions do not record 'next'
+        self.next = data.get('next',
+                max([ self.first ] + [ n + 1 for n in self.getBuildNumbers() ]))
+        return True
+
+    def saveSoon(self):
+        """Save the index after C{saveDelay} seconds, along with any other
+        changes made by then."""
+        if not self.filename or self._saveTimer is not None:
+            return
+        self._saveTimer = self._reactor.callLater(self.saveDelay, self.save)
+
+    def save(self):
+        """Save the index now, including any changes waiting for
+        L{saveSoon}."""
+        if self._saveTimer is not None:
+            if self._saveTimer.active():
+                self._saveTimer.cancel()
+            self._saveTimer = None
+        if not self.filename:
+            return
+        data = dict(first=self.first,
+                    next=self.next,
+                    branches=self.branches.items(),
+                    revisions=self.revisions)
+        tmpfilename = self.filename + ".tmp"
+        try:
+            with open(tmpfilename, "w") as f:
+                json.dump(data, f)
+            if runtime.platformType  == 'win32':
+                # windows cannot rename a file on top of an existing one
+                if os.path.exists(self.filename):
+                    os.unlink(self.filename)
+            os.rename(tmpfilename, self.filename)
+        except:
+            log.msg("unable to save build index to %s" % self.filename)
+            log.err()
+
+def rebuildBuildIndex(basedir):
+    """
+    Rebuild the index of the builds whose pickles are in the builder
+    directory C{basedir}, covering every build there.
+
+    @returns: the number of builds indexed
+    """
+    index = BuildIndex(os.path.join(basedir, "buildindex"))
+    count = 0
+    for filename in os.listdir(basedir):
+        if not re.match(r"^\d+$", filename):
+            continue
+        try:
+            with open(os.path.join(basedir, filename), "rb") as f:
+                build = load(f)
+            styles.doUpgrade()
+            index.addBuild(int(filename), *getBuildKeys(build))
+        except:
+            log.msg("unable to index build %s in %s" % (filename, basedir))
+            log.err()
+            continue
+        count += 1
+    index.save()
+    return count
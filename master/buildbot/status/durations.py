@@ -0,0 +1,159 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import math
+from collections import deque
+from twisted.python import log, runtime
+from buildbot.util import json
+
+def percentile(values, p):
+    """Return the C{p}th percentile of C{values}, by the nearest-rank method,
+    or None if there are no values."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class DurationHistory(object):
+    """
+    The durations of a builder's recent successful builds, and of each of
+    their steps, kept in a ring buffer of the last C{size} builds.  Unlike the
+    builder's L{Expectations}, which keep a moving average, this can answer
+    for percentiles, and for a particular slave.
+
+    The history is stored column-wise, as JSON, in C{filename}.
+
+    @ivar minSamples: the number of builds on a slave needed before
+    slave-specific durations are used in preference to those of all slaves
+    """
+
+    size = 100
+    minSamples = 3
+
+    def __init__(self, filename=None, size=None):
+        self.filename = filename
+        if size is not None:
+            self.size = size
+        self.finished = deque(maxlen=self.size)
+        self.slavenames = deque(maxlen=self.size)
+        self.durations = deque(maxlen=self.size)
+        # maps step name to a column of durations, with None where a build
+        # did not run that step
+        self.steps = {}
+
+    def __len__(self):
+        return len(self.durations)
+
+    def addBuild(self, slavename, started, finished, steps):
+        """Record a build on C{slavename}, with C{steps} a list of (name,
+        duration) tuples."""
+        self.finished.append(finished)
+        self.slavenames.append(slavename)
+        self.durations.append(finished - started)
+        steps = dict(steps)
+        for name in steps:
+            if name not in self.steps:
+                self.steps[name] = deque([ None ] * (len(self) - 1),
+                                         maxlen=self.size)
+        for name, column in self.steps.items():
+            column.append(steps.get(name))
+            # drop steps that are no longer run at all
+            if column.count(None) == len(column):
+                del self.steps[name]
+
+    def _select(self, column, slavename, fallback=True):
+        if slavename is not None:
+            values = [ v for (v, s) in zip(column, self.slavenames)
+                       if s == slavename and v is not None ]
+            if len(values) >= self.minSamples or not fallback:
+                return values
+        return [ v for v in column if v is not None ]
+
+    def getBuildTime(self, p=50, slavename=None):
+        """Return the C{p}th percentile of build durations, on C{slavename} if
+        it has enough history, or None if there is no history."""
+        return percentile(self._select(self.durations, slavename), p)
+
+    def getStepTime(self, stepname, p=50, slavename=None):
+        """Return the C{p}th percentile of the durations of step C{stepname},
+        or None if it has no history."""
+        if stepname not in self.steps:
+            return None
+        return percentile(self._select(self.steps[stepname], slavename), p)
+
+    def getStepTimes(self, p=50, slavename=None):
+        """Return a dictionary mapping step names to the C{p}th percentile of
+        their durations."""
+        return dict([ (name, self.getStepTime(name, p, slavename))
+                      for name in self.steps ])
+
+    def asDict(self):
+        def summary(column, slavename=None):
+            values = self._select(column, slavename, fallback=False)
+            return dict(p50=percentile(values, 50),
+                        p90=percentile(values, 90),
+                        samples=len(values))
+        def summarize(slavename=None):
+            return dict(build=summary(self.durations, slavename),
+                        steps=dict([ (name, summary(column, slavename))
+                                     for name, column
+                                     in self.steps.iteritems() ]))
+        result = summarize()
+        result['slaves'] = dict([ (slavename, summarize(slavename))
+                                  for slavename in set(self.slavenames) ])
+        return result
+
+    # persistence
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except:
+            log.msg("unable to load duration history from %s" % self.filename)
+            log.err()
+            return
+        self.finished.extend(data['finished'])
+        self.slavenames.extend(data['slavenames'])
+        self.durations.extend(data['durations'])
+        for name, column in data['steps'].iteritems():
+            self.steps[name] = deque(column[-self.size:], maxlen=self.size)
+
+    def save(self):
+        if not self.filename:
+            return
+        data = dict(finished=list(self.finished),
+                    slavenames=list(self.slavenames),
+                    durations=list(self.durations),
+                    steps=dict([ (name, list(column))
+                                 for name, column in self.steps.iteritems() ]))
+        tmpfilename = self.filename + ".tmp"
+        try:
+            with open(tmpfilename, "w") as f:
+                json.dump(data, f)
+            if runtime.platformType  == 'win32':
+                # windows cannot rename a file on top of an existing one
+                if os.path.exists(self.filename):
+                    os.unlink(self.filename)
+            os.rename(tmpfilename, self.filename)
+        except:
+            log.msg("unable to save duration history to %s" % self.filename)
+            log.err()
@@ -0,0 +1,219 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""Stream status events to web frontends running in other processes.
+
+See L{buildbot.status.web.frontend} for the consuming side."""
+
+from zope.interface import implements
+from twisted.application import strports
+from twisted.internet import interfaces, protocol, reactor
+from twisted.python import log
+from buildbot import util
+from buildbot.status.status_push import StatusPush
+from buildbot.util import json
+
+class StatusEventProtocol(protocol.Protocol):
+    """
+    One connected frontend.  Packets are written as lines of JSON.  While the
+    transport's buffer is full, packets are held here instead; a frontend that
+    falls more than C{maxBuffer} bytes behind is disconnected, so that a slow
+    frontend costs the master a bounded amount of memory.  It will reconnect,
+    and start again from a fresh snapshot.
+    """
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self):
+        self.paused = False
+        self.dropped = False
+        self.pending = []
+        self.pendingSize = 0
+        # the id of the first packet not covered by this client's snapshot,
+        # or None until the snapshot has been sent
+        self.since = None
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self.factory.clientConnected(self)
+
+    def connectionLost(self, reason):
+        self.factory.clientDisconnected(self)
+
+    def sendData(self, data):
+        if self.dropped:
+            return
+        if not self.paused:
+            self.transport.write(data)
+            return
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.pendingSize > self.factory.maxBuffer:
+            log.msg("status event stream: dropping %s, which is more than "
+                    "%d bytes behind" % (self.transport.getPeer(),
+                                         self.factory.maxBuffer))
+            self.dropped = True
+            self.pending = []
+            self.pendingSize = 0
+            self.transport.loseConnection()
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        pending, self.pending = self.pending, []
+        self.pendingSize = 0
+        if pending and not self.dropped:
+            self.transport.write(''.join(pending))
+
+    def stopProducing(self):
+        self.dropped = True
+        self.pending = []
+        self.pendingSize = 0
+
+
+class StatusEventStream(StatusPush):
+    """
+    Listen on C{port} for web frontends (see
+    L{buildbot.status.web.frontend.WebFrontend}), and stream them the status
+    events generated by L{StatusPush}, one JSON packet per line.
+
+    A newly connected frontend is first sent a snapshot: a C{start} packet,
+    then a C{builderAdded} packet for each builder, followed by
+    C{buildFinished} packets for at most C{numBuilds} of its last builds
+    (only those already in memory, so that no build pickles are loaded) and
+    C{buildStarted} packets for its current builds, and finally a
+    C{slaveConnected} packet for each slave (whether connected or not; the
+    slave's C{connected} key tells).  Live events follow.
+
+    Snapshots are made at most every C{snapshotInterval} seconds, and shared
+    by all of the frontends that connected in the meantime, so that
+    frontends reconnecting over and over do not keep the master busy.
+
+    Events are sent at most every C{bufferDelay} seconds, encoded once for all
+    frontends.  Each frontend may fall at most C{maxBuffer} bytes behind
+    before it is disconnected, so frontends cannot slow down the master.
+    """
+
+    compare_attrs = ["port", "numBuilds", "maxBuffer", "bufferDelay",
+                     "blackList", "snapshotInterval"]
+
+    _reactor = reactor
+
+    def __init__(self, port, numBuilds=20, maxBuffer=4*2**20, bufferDelay=1,
+                 blackList=None, snapshotInterval=10):
+        StatusPush.__init__(self, serverPushCb=StatusEventStream.sendEvents,
+                            filter=False, bufferDelay=bufferDelay,
+                            blackList=blackList)
+        if type(port) is int:
+            # frontends run on the same host, so don't listen elsewhere
+            port = "tcp:%d:interface=127.0.0.1" % port
+        self.port = port
+        self.numBuilds = numBuilds
+        self.maxBuffer = maxBuffer
+        self.snapshotInterval = snapshotInterval
+        self.clients = []
+        # clients waiting for the next snapshot
+        self.snapshotWaiters = []
+        self.snapshotTimer = None
+        self.lastSnapshot = None
+
+        self.factory = protocol.ServerFactory()
+        self.factory.protocol = StatusEventProtocol
+        self.factory.maxBuffer = maxBuffer
+        self.factory.clientConnected = self.clientConnected
+        self.factory.clientDisconnected = self.clientDisconnected
+        strports.service(port, self.factory).setServiceParent(self)
+
+    def __repr__(self):
+        return "<StatusEventStream on %s>" % (self.port,)
+
+    def stopService(self):
+        if self.snapshotTimer:
+            self.snapshotTimer.cancel()
+            self.snapshotTimer = None
+        return StatusPush.stopService(self)
+
+    def clientConnected(self, client):
+        self.clients.append(client)
+        self.snapshotWaiters.append(client)
+        if self.snapshotTimer:
+            return
+        delay = 0
+        if self.lastSnapshot is not None:
+            delay = max(0, self.lastSnapshot + self.snapshotInterval
+                           - util.now(self._reactor))
+        self.snapshotTimer = self._reactor.callLater(delay, self.sendSnapshot)
+
+    def clientDisconnected(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        if client in self.snapshotWaiters:
+            self.snapshotWaiters.remove(client)
+
+    def sendSnapshot(self):
+        self.snapshotTimer = None
+        clients, self.snapshotWaiters = self.snapshotWaiters, []
+        if not clients:
+            return
+        self.lastSnapshot = util.now(self._reactor)
+        data = self.encode(self.makeSnapshot())
+        # events still queued happened before the snapshot was taken
+        since = self.state['next_id']
+        for client in clients:
+            client.since = since
+            client.sendData(data)
+
+    def encode(self, packets):
+        return ''.join([ json.dumps(packet) + '\n' for packet in packets ])
+
+    def makeSnapshot(self):
+        packets = [ self.makePacket('start', status=self.status) ]
+        for name in self.status.getBuilderNames():
+            builder = self.status.getBuilder(name)
+            packets.append(self.makePacket('builderAdded', builderName=name,
+                                           builder=builder))
+            finished = builder.getCachedFinishedBuilds(
+                                        num_builds=self.numBuilds)
+            finished.reverse()
+            for build in finished:
+                packets.append(self.makePacket('buildFinished', build=build))
+            for build in builder.getCurrentBuilds():
+                packets.append(self.makePacket('buildStarted', build=build))
+        for name in self.status.getSlaveNames():
+            packets.append(self.makePacket('slaveConnected',
+                                           slave=self.status.getSlave(name)))
+        return packets
+
+    def sendEvents(self):
+        packets = self.queue.popChunk(self.queue.nbItems())
+        if not self.clients or not packets:
+            return
+        data = None
+        for client in self.clients[:]:
+            if client.since is None:
+                # the client's snapshot, when sent, covers these events
+                continue
+            if packets[0]['id'] >= client.since:
+                if data is None:
+                    data = self.encode(packets)
+                client.sendData(data)
+            else:
+                newer = [ p for p in packets if p['id'] >= client.since ]
+                if newer:
+                    client.sendData(self.encode(newer))
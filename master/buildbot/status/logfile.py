@@ -14,6 +14,8 @@
 # Copyright Buildbot Team Members
 
 import os
+import re
+from collections import deque
 from cStringIO import StringIO
 from bz2 import BZ2File
 from gzip import GzipFile
@@ -30,6 +32,28 @@ STDERR = interfaces.LOG_CHANNEL_STDERR
 HEADER = interfaces.LOG_CHANNEL_HEADER
 ChunkTypes = ["stdout", "stderr", "header"]
 
+def _parseChunks(data, pos):
+    """Parse the log file chunks in C{data}, starting at C{pos}, returning a
+    list of (channel, text) tuples, or None if C{data} does not consist of
+    whole chunks from there on."""
+    chunks = []
+    end = len(data)
+    while pos < end:
+        colon = data.find(':', pos, pos + 12)
+        if colon <= pos or not data[pos:colon].isdigit():
+            return None
+        next = colon + 1 + int(data[pos:colon])
+        if next >= end or data[next] != ',' or next == colon + 1:
+            return None
+        channel = data[colon + 1]
+        if channel not in '012':
+            return None
+        chunks.append((int(channel), data[colon + 2:next]))
+        pos = next + 1
+    return chunks
+
+_CHUNK_START = re.compile(r',(?=\d{1,10}:[012])')
+
 class LogFileScanner(netstrings.NetstringParser):
     def __init__(self, chunk_cb, channels=[]):
         self.chunk_cb = chunk_cb
@@ -399,6 +423,71 @@ class LogFile:
         io = StringIO(alltext)
         return io.readlines()
 
+    def getTextTail(self, size):
+        """
+        Return the last C{size} bytes of the non-header text of this log, and
+        whether any text before that was left out.  An uncompressed, finished
+        log is read backwards from its end, so that only the tail is read;
+        otherwise the log is scanned, keeping only the tail in memory.
+
+        @returns: tuple (text, truncated)
+        """
+        channels = (STDOUT, STDERR)
+        if self.finished:
+            f = self.getFile()
+            try:
+                if isinstance(f, file):
+                    rv = self._readTail(f, size, channels)
+                    if rv is not None:
+                        return rv
+            finally:
+                f.close()
+
+        tail = deque()
+        length = 0
+        truncated = False
+        for text in self.getChunks(channels, onlyText=True):
+            tail.append(text)
+            length += len(text)
+            while length - len(tail[0]) >= size:
+                length -= len(tail.popleft())
+                truncated = True
+        text = "".join(tail)
+        if len(text) > size:
+            text = text[-size:]
+            truncated = True
+        return text, truncated
+
+    def _readTail(self, f, size, channels):
+        f.seek(0, 2)
+        end = f.tell()
+        # each chunk has a few bytes of framing, and header chunks are
+        # skipped, so read somewhat more than size
+        window = size + size / 2 + 1024
+        while True:
+            start = max(0, end - window)
+            f.seek(start)
+            data = f.read(end - start)
+            if start == 0:
+                chunks = _parseChunks(data, 0)
+            else:
+                # find the first chunk boundary from which the rest of the
+                # file parses as whole chunks
+                for mo in _CHUNK_START.finditer(data):
+                    chunks = _parseChunks(data, mo.end())
+                    if chunks is not None:
+                        break
+                else:
+                    chunks = None
+            if chunks is None and start == 0:
+                # not a log file we understand; scan it instead
+                return None
+            if chunks is not None:
+                text = "".join([ t for (c, t) in chunks if c in channels ])
+                if len(text) >= size or start == 0:
+                    return text[-size:], start > 0 or len(text) > size
+            window *= 2
+
     def subscribe(self, receiver, catchup):
         if self.finished:
             return
@@ -425,17 +514,24 @@ class LogFile:
         if not self.runEntries:
             return
         channel = self.runEntries[0][0]
-        text = "".join([c[1] for c in self.runEntries])
+        if len(self.runEntries) == 1:
+            text = self.runEntries[0][1]
+        else:
+            text = "".join([c[1] for c in self.runEntries])
         assert channel < 10, "channel number must be a single decimal digit"
-        f = self.openfile
-        f.seek(0, 2)
+        # frame the whole run in memory and hand it to the file in a single
+        # write, rather than three writes per netstring
+        frames = []
         offset = 0
         while offset < len(text):
             size = min(len(text)-offset, self.chunkSize)
-            f.write("%d:%d" % (1 + size, channel))
-            f.write(text[offset:offset+size])
-            f.write(",")
+            frames.append("%d:%d" % (1 + size, channel))
+            frames.append(text[offset:offset+size])
+            frames.append(",")
             offset += size
+        f = self.openfile
+        f.seek(0, 2)
+        f.write("".join(frames))
         self.runEntries = []
         self.runLength = 0
 
@@ -510,6 +606,32 @@ class LogFile:
 
         self.length += len(text)
 
+    def addEntries(self, entries):
+        """
+        Add a sequence of entries to the logfile at once.  C{entries} is a
+        list of C{(channel, text)} tuples, as would be given to L{addEntry}.
+
+        Adjacent entries on the same channel are coalesced before they are
+        added, so watchers, size accounting and the on-disk framing see one
+        chunk per run of output rather than one per entry.  This is the path
+        used by L{buildbot.process.buildstep.RemoteCommand} when a slave
+        delivers several updates in a single message.
+
+        @param entries: list of (channel, text) tuples
+        """
+        run_channel = None
+        run = []
+        for channel, text in entries:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            if channel != run_channel and run:
+                self.addEntry(run_channel, "".join(run))
+                run = []
+            run_channel = channel
+            run.append(text)
+        if run:
+            self.addEntry(run_channel, "".join(run))
+
     def addStdout(self, text):
         """
         Shortcut to add stdout text to the logfile
@@ -663,8 +785,14 @@ class HTMLLogFile:
         return self.html # looks kinda like text
     def getTextWithHeaders(self):
         return self.html
-    def getChunks(self):
+    def getChunks(self, channels=[], onlyText=False):
+        if channels and STDERR not in channels:
+            return []
+        if onlyText:
+            return [self.html]
         return [(STDERR, self.html)]
+    def getTextTail(self, size):
+        return self.html[-size:], len(self.html) > size
 
     def subscribe(self, receiver, catchup):
         pass
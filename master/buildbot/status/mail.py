@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 
+import os
 import re
 import types
 from email.Message import Message
@@ -21,18 +22,17 @@ from email.Utils import formatdate
 from email.MIMEText import MIMEText
 from email.MIMENonMultipart import MIMENonMultipart
 from email.MIMEMultipart import MIMEMultipart
-from StringIO import StringIO
 import urllib
 
 from zope.interface import implements
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 from twisted.python import log as twlog
 
 try:
-    from twisted.mail.smtp import ESMTPSenderFactory
-    ESMTPSenderFactory = ESMTPSenderFactory # for pyflakes
+    from buildbot.status.outbox import SMTPOutbox
+    SMTPOutbox = SMTPOutbox # for pyflakes
 except ImportError:
-    ESMTPSenderFactory = None
+    SMTPOutbox = None
 
 have_ssl = True
 try:
@@ -162,10 +162,17 @@ class MailNotifier(base.StatusReceiverMultiService):
     compare_attrs = ["extraRecipients", "lookup", "fromaddr", "mode",
                      "categories", "builders", "addLogs", "relayhost",
                      "subject", "sendToInterestedUsers", "customMesg",
-                     "messageFormatter", "extraHeaders"]
+                     "messageFormatter", "extraHeaders", "spoolDir",
+                     "maxConnections", "messagesPerConnection",
+                     "maxSendRate", "coalesce", "logAttachmentSize",
+                     "totalLogAttachmentSize", "logErrorPatterns"]
 
     possible_modes = ("change", "failing", "passing", "problem", "warnings")
 
+    # how much of a log, before the part that is attached, is searched for
+    # lines matching logErrorPatterns
+    logErrorScanSize = 1024*1024
+
     def __init__(self, fromaddr, mode=("failing", "passing", "warnings"),
                  categories=None, builders=None, addLogs=False,
                  relayhost="localhost", buildSetSummary=False,
@@ -174,7 +181,11 @@ class MailNotifier(base.StatusReceiverMultiService):
                  sendToInterestedUsers=True, customMesg=None,
                  messageFormatter=defaultMessage, extraHeaders=None,
                  addPatch=True, useTls=False, 
-                 smtpUser=None, smtpPassword=None, smtpPort=25):
+                 smtpUser=None, smtpPassword=None, smtpPort=25,
+                 spoolDir=None, maxConnections=2, messagesPerConnection=20,
+                 maxSendRate=None, coalesce=False,
+                 logAttachmentSize=128*1024, totalLogAttachmentSize=1024*1024,
+                 logErrorPatterns=None):
         """
         @type  fromaddr: string
         @param fromaddr: the email address to be used in the 'From' header.
@@ -226,6 +237,26 @@ class MailNotifier(base.StatusReceiverMultiService):
                         set to a list of log names, to send a subset of the
                         logs. Defaults to False.
 
+        @type  logAttachmentSize: int
+        @param logAttachmentSize: the most bytes of each log to attach; only
+                                  the end of a longer log is attached, along
+                                  with a link to the whole log. Defaults to
+                                  128KiB; None attaches whole logs.
+
+        @type  totalLogAttachmentSize: int
+        @param totalLogAttachmentSize: the most bytes of logs to attach to a
+                                       message.  Logs that do not fit are
+                                       listed, with links, in the message
+                                       instead. Defaults to 1MiB; None
+                                       removes the limit.
+
+        @type  logErrorPatterns: list of strings
+        @param logErrorPatterns: regular expressions; when a log is cut
+                                 short, the lines matching any of them in
+                                 the last MiB before the attached end of
+                                 the log are attached ahead of it.
+                                 Defaults to None.
+
         @type  addPatch: boolean
         @param addPatch: if True, include the patch when the source stamp
                          includes one.
@@ -288,6 +319,29 @@ class MailNotifier(base.StatusReceiverMultiService):
         @type smtpPort: int
         @param smtpPort: The port that will be used when connecting to the
                          relayhost. Defaults to 25.
+
+        @type spoolDir: string
+        @param spoolDir: a directory, relative to the master's basedir, in
+                         which to keep messages until they are sent, so that
+                         they survive a restart. Defaults to None (keep
+                         messages in memory).
+
+        @type maxConnections: int
+        @param maxConnections: the most connections to open to the
+                               relayhost at once. Defaults to 2.
+
+        @type messagesPerConnection: int
+        @param messagesPerConnection: the most messages to send over one
+                                      connection. Defaults to 20.
+
+        @type maxSendRate: number
+        @param maxSendRate: the most messages to send per minute. Defaults to
+                            None (no limit).
+
+        @type coalesce: boolean
+        @param coalesce: if True, messages waiting to go to the same
+                         recipients are sent together as a single digest.
+                         Defaults to False.
         """
         base.StatusReceiverMultiService.__init__(self)
 
@@ -316,6 +370,23 @@ class MailNotifier(base.StatusReceiverMultiService):
         self.categories = categories
         self.builders = builders
         self.addLogs = addLogs
+        for name, value in [ ('logAttachmentSize', logAttachmentSize),
+                             ('totalLogAttachmentSize',
+                                totalLogAttachmentSize) ]:
+            if value is not None and (not isinstance(value, int)
+                                      or value < 1):
+                config.error("%s must be a positive integer or None"
+                             % (name,))
+        self.logAttachmentSize = logAttachmentSize
+        self.totalLogAttachmentSize = totalLogAttachmentSize
+        self.logErrorPatterns = logErrorPatterns
+        self._logErrorRes = []
+        for pattern in logErrorPatterns or []:
+            try:
+                self._logErrorRes.append(re.compile(pattern))
+            except re.error, e:
+                config.error("invalid logErrorPatterns entry %r: %s"
+                             % (pattern, e))
         self.relayhost = relayhost
         if '\n' in subject:
             config.error(
@@ -337,6 +408,32 @@ class MailNotifier(base.StatusReceiverMultiService):
         self.smtpUser = smtpUser
         self.smtpPassword = smtpPassword
         self.smtpPort = smtpPort
+        for name, value in [ ('maxConnections', maxConnections),
+                             ('messagesPerConnection', messagesPerConnection) ]:
+            if not isinstance(value, int) or value < 1:
+                config.error("%s must be a positive integer" % (name,))
+        if maxSendRate is not None and (
+                not isinstance(maxSendRate, (int, float)) or maxSendRate <= 0):
+            config.error("maxSendRate must be a positive number")
+        self.spoolDir = spoolDir
+        self.maxConnections = maxConnections
+        self.messagesPerConnection = messagesPerConnection
+        self.maxSendRate = maxSendRate
+        self.coalesce = coalesce
+        self.outbox = None
+        if SMTPOutbox:
+            if have_ssl and self.useTls:
+                contextFactory = ssl.ClientContextFactory()
+                contextFactory.method = SSLv3_METHOD
+            else:
+                contextFactory = None
+            self.outbox = SMTPOutbox(relayhost=relayhost, port=smtpPort,
+                        smtpUser=smtpUser, smtpPassword=smtpPassword,
+                        useTls=useTls, contextFactory=contextFactory,
+                        maxConnections=maxConnections,
+                        messagesPerConnection=messagesPerConnection,
+                        maxSendRate=maxSendRate, coalesce=coalesce)
+            self.outbox.setServiceParent(self)
         self.buildSetSummary = buildSetSummary
         self.buildSetSubscription = None
         self.watched = []
@@ -360,6 +457,9 @@ class MailNotifier(base.StatusReceiverMultiService):
         self.master_status = self.parent
         self.master_status.subscribe(self)
         self.master = self.master_status.master
+        if self.outbox and self.spoolDir:
+            self.outbox.spoolDir = os.path.join(self.master.basedir,
+                                                self.spoolDir)
 
     def startService(self):
         if self.buildSetSummary:
@@ -575,19 +675,44 @@ class MailNotifier(base.StatusReceiverMultiService):
                 a = self.patch_to_attachment(patch, i)
                 m.attach(a)
         if logs:
+            remaining = self.totalLogAttachmentSize
+            omitted = []
             for log in logs:
                 name = "%s.%s" % (log.getStep().getName(),
                                   log.getName())
-                if ( self._shouldAttachLog(log.getName()) or
-                     self._shouldAttachLog(name) ):
-                    text = log.getText()
-                    if not isinstance(text, unicode):
-                        text = text.decode(LOG_ENCODING)
-                    a = MIMEText(text.encode(ENCODING),
-                                 _charset=ENCODING)
-                    a.add_header('Content-Disposition', "attachment",
-                                 filename=name)
-                    m.attach(a)
+                if not ( self._shouldAttachLog(log.getName()) or
+                         self._shouldAttachLog(name) ):
+                    continue
+                size = self.logAttachmentSize
+                if remaining is not None:
+                    if remaining <= 0:
+                        omitted.append((name, self._getLogURL(log)))
+                        continue
+                    if size is None or size > remaining:
+                        size = remaining
+                text, truncated = self._getLogAttachment(log, size)
+                if remaining is not None:
+                    remaining -= len(text)
+                if not isinstance(text, unicode):
+                    text = text.decode(LOG_ENCODING, 'replace')
+                if truncated:
+                    url = self._getLogURL(log)
+                    if url:
+                        note = u"[log truncated; the full log is at %s]\n" % url
+                    else:
+                        note = u"[log truncated]\n"
+                    text = note + text
+                a = MIMEText(text.encode(ENCODING),
+                             _charset=ENCODING)
+                a.add_header('Content-Disposition', "attachment",
+                             filename=name)
+                m.attach(a)
+            if omitted:
+                text = ("These logs were not attached, to keep this message "
+                        "small:\n\n")
+                for name, url in omitted:
+                    text += " %s: %s\n" % (name, url or "(no URL available)")
+                m.attach(MIMEText(text, 'plain', ENCODING))
 
         #@todo: is there a better way to do this?
         # Add any extra headers that were requested, doing WithProperties
@@ -716,6 +841,53 @@ class MailNotifier(base.StatusReceiverMultiService):
             return self.addLogs
         return logname in self.addLogs
 
+    def _getLogURL(self, log):
+        if not self.master_status:
+            return None
+        return self.master_status.getURLForThing(log)
+
+    def _getLogAttachment(self, log, size):
+        """Return the text of C{log} to attach, in at most C{size} bytes, and
+        whether any of the log was left out.  This is the end of the log,
+        preceded by its lines matching logErrorPatterns, if any."""
+        if size is None:
+            return log.getText(), False
+        if not self._logErrorRes:
+            return log.getTextTail(size)
+        # read the part of the log searched for errors along with its end, so
+        # that the log is read once, and no more of it than that
+        text, truncated = log.getTextTail(self.logErrorScanSize + size)
+        region, text = text[:-size], text[-size:]
+        if not region:
+            return text, truncated
+        if truncated:
+            # the region starts in the middle of a line
+            region = region.partition('\n')[2]
+        truncated = True
+        matches = self._grepLog(region, size // 4)
+        if not matches:
+            return text, truncated
+        matches = ("[lines matching logErrorPatterns]\n" + matches +
+                   "[end of log]\n")
+        return matches + text[len(matches):], truncated
+
+    def _grepLog(self, text, size):
+        """Return the first lines of C{text} matching logErrorPatterns, in at
+        most C{size} bytes."""
+        matches = []
+        length = 0
+        for line in text.split('\n'):
+            for regex in self._logErrorRes:
+                if regex.search(line):
+                    break
+            else:
+                continue
+            if length + len(line) + 1 > size:
+                break
+            matches.append(line + '\n')
+            length += len(line) + 1
+        return ''.join(matches)
+
     def _gotRecipients(self, rlist, m):
         to_recipients = set()
         cc_recipients = set()
@@ -749,35 +921,23 @@ class MailNotifier(base.StatusReceiverMultiService):
         return self.sendMessage(m, list(to_recipients | cc_recipients))
 
     def sendmail(self, s, recipients):
-        result = defer.Deferred()
-        
-        if have_ssl and self.useTls:
-            client_factory = ssl.ClientContextFactory()
-            client_factory.method = SSLv3_METHOD
-        else:
-            client_factory = None
-
-        if self.smtpUser and self.smtpPassword:
-            useAuth = True
-        else:
-            useAuth = False
-        
-        if not ESMTPSenderFactory:
+        if not self.outbox:
             raise RuntimeError("twisted-mail is not installed - cannot "
                                "send mail")
-        sender_factory = ESMTPSenderFactory(
-            self.smtpUser, self.smtpPassword,
-            self.fromaddr, recipients, StringIO(s),
-            result, contextFactory=client_factory,
-            requireTransportSecurity=self.useTls,
-            requireAuthentication=useAuth)
-
-        reactor.connectTCP(self.relayhost, self.smtpPort, sender_factory)
-        
-        return result
+        # the outbox connects to the relayhost, and retries, as needed
+        return self.outbox.send(self.fromaddr, recipients, s)
 
     def sendMessage(self, m, recipients):
-        s = m.as_string()
-        twlog.msg("sending mail (%d bytes) to" % len(s), recipients)
-        return self.sendmail(s, recipients)
+        # subclasses that override sendmail still get every message, as a
+        # string, instead of it being queued in the outbox
+        sendmail = getattr(self.sendmail, 'im_func', None)
+        if sendmail is not MailNotifier.sendmail.im_func:
+            s = m.as_string()
+            twlog.msg("sending mail (%d bytes) to" % len(s), recipients)
+            return self.sendmail(s, recipients)
+        if not self.outbox:
+            raise RuntimeError("twisted-mail is not installed - cannot "
+                               "send mail")
+        twlog.msg("queueing mail to", recipients)
+        return self.outbox.sendMessage(self.fromaddr, recipients, m)
 
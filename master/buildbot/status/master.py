@@ -31,6 +31,11 @@ from buildbot.status import buildset, builder, buildrequest
 class Status(config.ReconfigurableServiceMixin, service.MultiService):
     implements(interfaces.IStatus)
 
+    # seconds for which getPendingBuildRequestCounts may return the same
+    # counts; they are also refreshed when build requests are added or builds
+    # started on this master
+    pendingBuildRequestCountsCacheTime = 5
+
     def __init__(self, master):
         service.MultiService.__init__(self)
         self.master = master
@@ -44,6 +49,15 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         self._buildreq_observers = bbcollections.KeyedSets()
         self._buildset_finished_waiters = bbcollections.KeyedSets()
 
+        # cached result of getPendingBuildRequestCounts, and when it was
+        # fetched; the generation is bumped when the cache is invalidated, so
+        # that a query in flight at the time does not refill it
+        self._pendingCounts = None
+        self._pendingCountsTime = None
+        self._pendingCountsGeneration = 0
+        # callers waiting for a query in flight, or None
+        self._pendingCountsWaiters = None
+
     # service management
 
     def startService(self):
@@ -218,6 +232,37 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
     def getSlave(self, slavename):
         return self.botmaster.slaves[slavename].slave_status
 
+    def getPendingBuildRequestCounts(self):
+        if self._pendingCounts is not None and util.now() \
+                - self._pendingCountsTime < self.pendingBuildRequestCountsCacheTime:
+            return defer.succeed(self._pendingCounts)
+
+        # share a query in flight with other callers
+        d = defer.Deferred()
+        if self._pendingCountsWaiters is not None:
+            self._pendingCountsWaiters.append(d)
+            return d
+        self._pendingCountsWaiters = [ d ]
+
+        generation = self._pendingCountsGeneration
+        fetched = util.now()
+        query_d = self.master.db.buildrequests.getUnclaimedBuildRequestCounts()
+        def done(result):
+            waiters = self._pendingCountsWaiters
+            self._pendingCountsWaiters = None
+            if isinstance(result, dict) \
+                    and generation == self._pendingCountsGeneration:
+                self._pendingCounts = result
+                self._pendingCountsTime = fetched
+            for waiter in waiters:
+                waiter.callback(result)
+        query_d.addBoth(done)
+        return d
+
+    def _invalidatePendingBuildRequestCounts(self):
+        self._pendingCounts = None
+        self._pendingCountsGeneration += 1
+
     def getBuildSets(self):
         d = self.master.db.buildsets.getBuildsets(complete=False)
         def make_status_objects(bsdicts):
@@ -383,6 +428,7 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         return result
 
     def build_started(self, brid, buildername, build_status):
+        self._invalidatePendingBuildRequestCounts()
         if brid in self._buildreq_observers:
             for o in self._buildreq_observers[brid]:
                 eventually(o, build_status)
@@ -435,6 +481,7 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         self._maybeBuildsetFinished(bsid)
 
     def _buildRequestCallback(self, notif):
+        self._invalidatePendingBuildRequestCounts()
         buildername = notif['buildername']
         if buildername in self._builder_observers:
             brs = buildrequest.BuildRequestStatus(buildername,
@@ -0,0 +1,460 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+from StringIO import StringIO
+from email import message_from_file
+from email.Generator import Generator
+from email.MIMEMessage import MIMEMessage
+from email.MIMEMultipart import MIMEMultipart
+from email.Utils import formatdate
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor
+from twisted.mail import smtp
+from twisted.python import log, runtime
+from buildbot.process import metrics
+from buildbot.util import json
+
+class OutboxMessage(object):
+    """A message waiting to be sent, kept either in memory (C{data}) or in a
+    spool file (C{filename}), whose first line is the JSON-encoded
+    envelope."""
+
+    def __init__(self, fromaddr, recipients, data=None, filename=None):
+        self.fromaddr = fromaddr
+        self.recipients = tuple(sorted(set(recipients)))
+        self.data = data
+        self.filename = filename
+        self.attempts = 0
+        self.notBefore = 0
+        self.deferreds = []
+
+    def getFile(self):
+        if self.filename is None:
+            return StringIO(self.data)
+        f = open(self.filename, "rb")
+        f.readline() # skip the envelope
+        return f
+
+    def getEnvelope(self):
+        return (self.fromaddr, self.recipients)
+
+
+class OutboxSender(smtp.ESMTPSender):
+    """Sends the messages its factory's L{SMTPOutbox} has ready, one after
+    another, over one connection."""
+
+    _wait = None
+    _file = None
+    current = None
+
+    def smtpState_from(self, code, resp):
+        # pause between messages to keep to the outbox's rate
+        outbox = self.factory.outbox
+        delay = outbox.getSendDelay()
+        if delay > 0 and outbox.hasReady():
+            if delay <= outbox.maxRateWait:
+                self._wait = outbox._reactor.callLater(delay,
+                                    self.smtpState_from, code, resp)
+                return
+            # quit rather than idle for long; the outbox will reconnect
+            self.factory.done = True
+        self._wait = None
+        return smtp.ESMTPSender.smtpState_from(self, code, resp)
+
+    def getMailFrom(self):
+        self.current = self.factory.nextMessage()
+        if self.current is None:
+            return None
+        return str(self.current.fromaddr)
+
+    def getMailTo(self):
+        return list(self.current.recipients)
+
+    def getMailData(self):
+        self._file = self.current.getFile()
+        return self._file
+
+    def _closeFile(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        self._closeFile()
+        msg, self.current = self.current, None
+        if code in smtp.SUCCESS:
+            self.factory.outbox.messageSent(msg)
+        else:
+            errlog = [ "%s: %03d %s" % (addr, acode, aresp)
+                       for addr, acode, aresp in addresses
+                       if acode not in smtp.SUCCESS ]
+            errlog.append(log.str())
+            self.factory.outbox.messageFailed(msg,
+                    smtp.SMTPDeliveryError(code, resp, '\n'.join(errlog),
+                                           addresses))
+
+    def sendError(self, exc):
+        smtp.SMTPClient.sendError(self, exc)
+        self._closeFile()
+        msg, self.current = self.current, None
+        if msg is not None:
+            self.factory.outbox.messageFailed(msg, exc)
+        else:
+            self.factory.error = exc
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.ESMTPSender.connectionLost(self, reason)
+        if self._wait is not None and self._wait.active():
+            self._wait.cancel()
+        self._wait = None
+        self._closeFile()
+        if self.current is not None:
+            msg, self.current = self.current, None
+            self.factory.outbox.messageFailed(msg, reason.value)
+
+
+class OutboxSenderFactory(protocol.ClientFactory):
+    """One connection to the relay, and the number of messages sent over
+    it."""
+
+    protocol = OutboxSender
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self.sent = 0
+        self.done = False
+        self.error = None
+
+    def buildProtocol(self, addr):
+        outbox = self.outbox
+        p = self.protocol(outbox.smtpUser, outbox.smtpPassword,
+                          outbox.contextFactory, smtp.DNSNAME)
+        p.heloFallback = False
+        p.requireAuthentication = bool(outbox.smtpUser and
+                                       outbox.smtpPassword)
+        p.requireTransportSecurity = outbox.useTls
+        p.timeout = outbox.timeout
+        p.factory = self
+        return p
+
+    def nextMessage(self):
+        if self.done or self.sent >= self.outbox.messagesPerConnection:
+            return None
+        msg = self.outbox.nextMessage()
+        if msg is not None:
+            self.sent += 1
+        return msg
+
+    def clientConnectionFailed(self, connector, reason):
+        self.error = reason.value
+        self.outbox.connectionDone(self)
+
+    def clientConnectionLost(self, connector, reason):
+        self.outbox.connectionDone(self)
+
+
+class SMTPOutbox(service.Service):
+    """
+    Queue mail for C{relayhost}, and send it over at most C{maxConnections}
+    connections at a time, each carrying up to C{messagesPerConnection}
+    messages.  At most C{maxSendRate} messages are sent per minute, if given.
+
+    With C{spoolDir}, each message is written there when it is queued, and
+    removed once it is sent, so that mail queued when the master stops is
+    sent when it starts again.
+
+    A message refused with a temporary (4xx) error is retried after
+    C{retryDelay} seconds, doubling with each attempt, up to C{maxRetries}
+    times; one refused with a permanent error is dropped.  While the relay
+    cannot be reached, sending is retried on the same schedule, without
+    dropping anything.
+
+    With C{coalesce}, ready messages with the same sender and recipients are
+    sent together, as a single digest.
+    """
+
+    maxRateWait = 30
+    maxRetryDelay = 3600
+    timeout = 300
+
+    # for testing
+    _reactor = reactor
+
+    def __init__(self, relayhost="localhost", port=25, smtpUser=None,
+                 smtpPassword=None, useTls=False, contextFactory=None,
+                 spoolDir=None, maxConnections=2, messagesPerConnection=20,
+                 maxSendRate=None, coalesce=False, retryDelay=60,
+                 maxRetries=5):
+        self.relayhost = relayhost
+        self.port = port
+        self.smtpUser = smtpUser
+        self.smtpPassword = smtpPassword
+        self.useTls = useTls
+        self.contextFactory = contextFactory
+        self.spoolDir = spoolDir
+        self.maxConnections = maxConnections
+        self.messagesPerConnection = messagesPerConnection
+        self.maxSendRate = maxSendRate
+        self.coalesce = coalesce
+        self.retryDelay = retryDelay
+        self.maxRetries = maxRetries
+
+        self.queue = []
+        self.connections = []
+        # consecutive failures to reach the relay
+        self.failures = 0
+        self.retryAt = 0
+        self.nextSendTime = 0
+        self.serial = 0
+        self._dispatchTimer = None
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.spoolDir:
+            self.loadSpool()
+        self.dispatch()
+
+    def stopService(self):
+        if self._dispatchTimer and self._dispatchTimer.active():
+            self._dispatchTimer.cancel()
+        self._dispatchTimer = None
+        for factory in self.connections:
+            factory.done = True
+        if self.queue and not self.spoolDir:
+            log.msg("SMTPOutbox: discarding %d unsent messages"
+                    % len(self.queue))
+        return service.Service.stopService(self)
+
+    # queueing
+
+    def send(self, fromaddr, recipients, data):
+        """Queue the message text C{data}, returning a Deferred that fires
+        when it has been sent, or fails when it is dropped."""
+        msg = OutboxMessage(fromaddr, recipients, data=data)
+        return self._queue(msg, lambda f : f.write(data))
+
+    def sendMessage(self, fromaddr, recipients, message):
+        """Queue the L{email.Message.Message} C{message}, writing it
+        straight to the spool if there is one."""
+        if not self.spoolDir:
+            return self.send(fromaddr, recipients, message.as_string())
+        msg = OutboxMessage(fromaddr, recipients)
+        return self._queue(msg, lambda f : Generator(f).flatten(message))
+
+    def _queue(self, msg, write):
+        self._store(msg, write)
+        msg.deferreds.append(defer.Deferred())
+        self.queue.append(msg)
+        metrics.MetricCountEvent.log('SMTPOutbox.queued', 1)
+        self.dispatch()
+        return msg.deferreds[-1]
+
+    def _store(self, msg, write):
+        # write the message to the spool, or keep it in memory
+        if self.spoolDir:
+            try:
+                self._spool(msg, write)
+                return
+            except:
+                log.err(None, "while spooling mail; keeping it in memory")
+        if msg.data is None:
+            s = StringIO()
+            write(s)
+            msg.data = s.getvalue()
+
+    def _spool(self, msg, write):
+        if not os.path.isdir(self.spoolDir):
+            os.makedirs(self.spoolDir)
+        now = self._reactor.seconds()
+        self.serial += 1
+        filename = os.path.join(self.spoolDir,
+                            "%015d.%06d" % (now * 1000, self.serial % 10**6))
+        tmpfilename = filename + ".tmp"
+        with open(tmpfilename, "wb") as f:
+            json.dump(dict(fromaddr=msg.fromaddr,
+                           recipients=msg.recipients), f)
+            f.write("\n")
+            write(f)
+        if runtime.platformType  == 'win32':
+            # windows cannot rename a file on top of an existing one
+            if os.path.exists(filename):
+                os.unlink(filename)
+        os.rename(tmpfilename, filename)
+        msg.filename = filename
+        msg.data = None
+
+    def _unspool(self, msg):
+        if msg.filename is None:
+            return
+        try:
+            os.unlink(msg.filename)
+        except OSError:
+            log.msg("unable to remove spooled mail %s" % msg.filename)
+            log.err()
+
+    def loadSpool(self):
+        if not os.path.isdir(self.spoolDir):
+            return
+        spooled = set([ msg.filename for msg in self.queue ])
+        count = 0
+        for name in sorted(os.listdir(self.spoolDir)):
+            filename = os.path.join(self.spoolDir, name)
+            if name.endswith(".tmp") or filename in spooled:
+                continue
+            try:
+                with open(filename, "rb") as f:
+                    envelope = json.loads(f.readline())
+            except:
+                log.msg("unable to read spooled mail %s" % filename)
+                log.err()
+                continue
+            self.queue.append(OutboxMessage(envelope['fromaddr'],
+                                            envelope['recipients'],
+                                            filename=filename))
+            count += 1
+        if count:
+            log.msg("SMTPOutbox: %d spooled messages to send" % count)
+
+    # sending
+
+    def hasReady(self):
+        now = self._reactor.seconds()
+        for msg in self.queue:
+            if msg.notBefore <= now:
+                return True
+        return False
+
+    def getSendDelay(self):
+        """Return the number of seconds to wait before sending the next
+        message, to keep to C{maxSendRate}."""
+        if not self.maxSendRate:
+            return 0
+        return max(0, self.nextSendTime - self._reactor.seconds())
+
+    def nextMessage(self):
+        """Take the next ready message from the queue, or return None."""
+        now = self._reactor.seconds()
+        for i, msg in enumerate(self.queue):
+            if msg.notBefore <= now:
+                break
+        else:
+            return None
+        del self.queue[i]
+        if self.coalesce:
+            msg = self._coalesce(msg, now)
+        if self.maxSendRate:
+            self.nextSendTime = (max(now, self.nextSendTime)
+                                 + 60.0 / self.maxSendRate)
+        return msg
+
+    def _coalesce(self, msg, now):
+        same = [ m for m in self.queue
+                 if m.notBefore <= now and m.getEnvelope() == msg.getEnvelope() ]
+        if not same:
+            return msg
+        group = [ msg ] + same
+        self.queue = [ m for m in self.queue if m not in same ]
+
+        digest = MIMEMultipart('digest')
+        subjects = []
+        for m in group:
+            f = m.getFile()
+            try:
+                part = message_from_file(f)
+            finally:
+                f.close()
+            subjects.append(part['Subject'] or '')
+            digest.attach(MIMEMessage(part))
+        digest['Date'] = formatdate(localtime=True)
+        digest['Subject'] = "%s (and %d more)" % (subjects[0], len(group) - 1)
+        digest['From'] = msg.fromaddr
+        digest['To'] = ", ".join(msg.recipients)
+
+        coalesced = OutboxMessage(msg.fromaddr, msg.recipients)
+        self._store(coalesced, lambda f : Generator(f).flatten(digest))
+        for m in group:
+            coalesced.deferreds.extend(m.deferreds)
+            coalesced.attempts = max(coalesced.attempts, m.attempts)
+            self._unspool(m)
+        log.msg("SMTPOutbox: coalesced %d messages to %s"
+                % (len(group), ", ".join(msg.recipients)))
+        return coalesced
+
+    def messageSent(self, msg):
+        self.failures = 0
+        self._unspool(msg)
+        metrics.MetricCountEvent.log('SMTPOutbox.sent', 1)
+        for d in msg.deferreds:
+            d.callback(None)
+
+    def messageFailed(self, msg, exc):
+        msg.attempts += 1
+        code = getattr(exc, 'code', -1)
+        permanent = 500 <= code < 600
+        if permanent or msg.attempts > self.maxRetries:
+            log.msg("SMTPOutbox: giving up on mail to %s after %d attempts: %s"
+                    % (", ".join(msg.recipients), msg.attempts, exc))
+            self._unspool(msg)
+            metrics.MetricCountEvent.log('SMTPOutbox.dropped', 1)
+            for d in msg.deferreds:
+                d.errback(exc)
+            return
+        log.msg("SMTPOutbox: will retry mail to %s: %s"
+                % (", ".join(msg.recipients), exc))
+        msg.notBefore = self._reactor.seconds() + self._backoff(msg.attempts)
+        self.queue.append(msg)
+
+    def _backoff(self, failures):
+        return min(self.retryDelay * 2 ** (failures - 1), self.maxRetryDelay)
+
+    def connectionDone(self, factory):
+        if factory not in self.connections:
+            return
+        self.connections.remove(factory)
+        if factory.error is not None and not factory.sent:
+            self.failures += 1
+            self.retryAt = (self._reactor.seconds()
+                            + self._backoff(self.failures))
+            log.msg("SMTPOutbox: cannot send mail via %s:%s: %s"
+                    % (self.relayhost, self.port, factory.error))
+        self.dispatch()
+
+    def dispatch(self):
+        """Open connections to the relay as needed to send the messages that
+        are ready, and arrange to be called again when more will be."""
+        if not self.running:
+            return
+        if self._dispatchTimer and self._dispatchTimer.active():
+            self._dispatchTimer.cancel()
+        self._dispatchTimer = None
+
+        now = self._reactor.seconds()
+        if now >= self.retryAt and self.getSendDelay() <= self.maxRateWait:
+            ready = len([ m for m in self.queue if m.notBefore <= now ])
+            while (len(self.connections) < self.maxConnections
+                   and ready > len(self.connections)):
+                factory = OutboxSenderFactory(self)
+                self.connections.append(factory)
+                self._reactor.connectTCP(self.relayhost, self.port, factory)
+
+        if self.queue and not self.connections:
+            when = max(self.retryAt,
+                       min([ m.notBefore for m in self.queue ]),
+                       self.nextSendTime)
+            self._dispatchTimer = self._reactor.callLater(max(0, when - now),
+                                                          self.dispatch)
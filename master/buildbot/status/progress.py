@@ -265,7 +265,7 @@ class Expectations:
     # TODO: let decay be specified per-metric
     decay = 0.5
 
-    def __init__(self, buildprogress):
+    def __init__(self, buildprogress=None):
         """Create us from a successful build. We will expect each step to
         take as long as it did in that build."""
 
@@ -276,6 +276,9 @@ class Expectations:
         # .times maps stepname to per-step elapsed time
         self.times = {}
 
+        if buildprogress is None:
+            return
+
         for name, step in buildprogress.steps.items():
             self.steps[name] = {}
             for metric, value in step.progress.items():
@@ -313,6 +316,21 @@ class Expectations:
                           (name, metric, new, old, current)
                 self.steps[name][metric] = new
 
+    def withTimes(self, times):
+        """Return a copy of these expectations, with the per-step times in
+        C{times} (a dictionary mapping step name to seconds, such as the
+        medians from a L{buildbot.status.durations.DurationHistory}) in place
+        of the averaged ones."""
+        exp = Expectations()
+        for name, metrics in self.steps.items():
+            exp.steps[name] = metrics.copy()
+        exp.times.update(self.times)
+        for name, seconds in times.items():
+            if seconds is not None:
+                exp.steps.setdefault(name, {})
+                exp.times[name] = seconds
+        return exp
+
     def expectedBuildTime(self):
         if None in self.times.values():
             return None
@@ -216,7 +216,14 @@ class StatusPush(StatusReceiverMultiService):
         """
         if self.blackList and event in self.blackList:
             return
-        # First, generate the packet.
+        packet = self.makePacket(event, **objs)
+        self.queue.pushItem(packet)
+        if self.task is None or not self.task.active():
+            # No task queued since it was probably idle, let's queue a task.
+            return self.queueNextServerPush()
+
+    def makePacket(self, event, **objs):
+        """Generate the packet for an event, without queueing it."""
         packet = {}
         packet['id'] = self.state['next_id']
         self.state['next_id'] += 1
@@ -231,10 +238,7 @@ class StatusPush(StatusReceiverMultiService):
             if self.filter:
                 obj = FilterOut(obj)
             packet['payload'][obj_name] = obj
-        self.queue.pushItem(packet)
-        if self.task is None or not self.task.active():
-            # No task queued since it was probably idle, let's queue a task.
-            return self.queueNextServerPush()
+        return packet
 
     #### Events
 
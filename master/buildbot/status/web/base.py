@@ -17,10 +17,10 @@
 import urlparse, urllib, time, re
 import os, cgi, sys, locale
 import jinja2
-from zope.interface import Interface
-from twisted.internet import defer
+from zope.interface import Interface, implements
+from twisted.internet import defer, interfaces
 from twisted.web import resource, static, server
-from twisted.python import log
+from twisted.python import log, failure
 from buildbot.status import builder, buildstep, build
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, SKIPPED
 from buildbot.status.results import EXCEPTION, RETRY
@@ -258,6 +258,65 @@ class ActionResource(resource.Resource, AccessorMixin):
         d.addErrback(fail)
         return server.NOT_DONE_YET
 
+class IterableProducer(object):
+    """
+    Writes the strings from an iterable, such as the generator returned by a
+    Jinja template's C{generate} method, to a request as the client reads
+    them, rather than building the whole page in memory first.  Unicode
+    strings are encoded as UTF-8, and small strings are collected into writes
+    of about C{writeSize} bytes.
+
+    C{start} returns a Deferred that fires when the iterable is exhausted, or
+    fails if it raises an exception.
+    """
+    implements(interfaces.IPullProducer)
+
+    writeSize = 64*1024
+
+    def __init__(self, request, iterable):
+        self.request = request
+        self.iterator = iter(iterable)
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        self.request.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        if self.iterator is None:
+            return
+        chunks = []
+        size = 0
+        result = None
+        try:
+            for chunk in self.iterator:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.writeSize:
+                    break
+            else:
+                self.iterator = None
+        except:
+            self.iterator = None
+            result = failure.Failure()
+
+        if chunks:
+            self.request.write(''.join(chunks))
+        if self.iterator is None:
+            self.request.unregisterProducer()
+            if result is None:
+                self.deferred.callback(None)
+            else:
+                self.deferred.errback(result)
+
+    def stopProducing(self):
+        # the client has gone away
+        if self.iterator is not None:
+            self.iterator = None
+            self.deferred.callback(None)
+
 class HtmlResource(resource.Resource, ContextMixin):
     # this is a cheap sort of template thingy
     contentType = "text/html; charset=utf-8"
@@ -284,7 +343,7 @@ class HtmlResource(resource.Resource, ContextMixin):
         context['content'] = body
         template = req.site.buildbot_service.templates.get_template(
             "empty.html")
-        return template.render(**context)
+        return template.generate(**context)
 
 
     def render(self, request):
@@ -325,16 +384,27 @@ class HtmlResource(resource.Resource, ContextMixin):
 
         d = defer.maybeDeferred(lambda : self.content(request, ctx))
         def handle(data):
+            # content may return a string, or an iterable of strings (such as
+            # from template.generate) to be streamed to the client
+            streaming = not isinstance(data, basestring)
+            if streaming and request.method == "HEAD":
+                data = u''.join(data)
+                streaming = False
             if isinstance(data, unicode):
                 data = data.encode("utf-8")
             request.setHeader("content-type", self.contentType)
             if request.method == "HEAD":
                 request.setHeader("content-length", len(data))
                 return ''
+            if streaming:
+                d = IterableProducer(request, data).start()
+                d.addCallback(lambda _ : '')
+                return d
             return data
         d.addCallback(handle)
         def ok(data):
-            request.write(data)
+            if data:
+                request.write(data)
             try:
                 request.finish()
             except RuntimeError:
@@ -37,6 +37,7 @@ from buildbot.status.web.builder import BuildersResource
 from buildbot.status.web.buildstatus import BuildStatusStatusResource
 from buildbot.status.web.slaves import BuildSlavesResource
 from buildbot.status.web.status_json import JsonStatusResource
+from buildbot.status.web.prometheus import PrometheusMetricsResource
 from buildbot.status.web.about import AboutBuildbot
 from buildbot.status.web.authz import Authz
 from buildbot.status.web.auth import AuthFailResource,AuthzFailResource, LoginResource, LogoutResource
@@ -44,6 +45,13 @@ from buildbot.status.web.root import RootPage
 from buildbot.status.web.users import UsersResource
 from buildbot.status.web.change_hook import ChangeHookResource
 
+try:
+    # new in Twisted-12.3.0
+    from twisted.web.resource import EncodingResourceWrapper
+    from twisted.web.server import GzipEncoderFactory
+except ImportError:
+    EncodingResourceWrapper = GzipEncoderFactory = None
+
 # this class contains the WebStatus class.  Basic utilities are in base.py,
 # and specific pages are each in their own module.
 
@@ -148,7 +156,8 @@ class WebStatus(service.MultiService):
                  order_console_by_time=False, changecommentlink=None,
                  revlink=None, projects=None, repositories=None,
                  authz=None, logRotateLength=None, maxRotatedFiles=None,
-                 change_hook_dialects = {}, provide_feeds=None):
+                 change_hook_dialects = {}, provide_feeds=None,
+                 compress=True):
         """Run a web server that provides Buildbot status.
 
         @type  http_port: int or L{twisted.application.strports} string
@@ -262,10 +271,17 @@ class WebStatus(service.MultiService):
         
     
         @type  provide_feeds: None or list
-        @param provide_feeds: If empty, provides atom, json, and rss feeds.
-                              Otherwise, a dictionary of strings of
-                              the type of feeds provided.  Current
-                              possibilities are "atom", "json", and "rss"
+        @param provide_feeds: If empty, provides atom, json, metrics and
+                              rss feeds.  Otherwise, a dictionary of
+                              strings of the type of feeds provided.
+                              Current possibilities are "atom", "json",
+                              "metrics" and "rss"
+
+        @type  compress: boolean
+        @param compress: If true (the default), gzip responses for clients
+                         that accept it.  This requires Twisted-12.3.0 or
+                         later, and applies only to the site created by
+                         WebStatus, not to one given as C{site}.
         """
 
         service.MultiService.__init__(self)
@@ -317,6 +333,7 @@ class WebStatus(service.MultiService):
         # store the log settings until we create the site object
         self.logRotateLength = logRotateLength
         self.maxRotatedFiles = maxRotatedFiles        
+        self.compress = compress
 
         # create the web site page structure
         self.childrenToBeAdded = {}
@@ -340,7 +357,7 @@ class WebStatus(service.MultiService):
 
         # Set default feeds
         if provide_feeds is None:
-            self.provide_feeds = ["atom", "json", "rss"]
+            self.provide_feeds = ["atom", "json", "metrics", "rss"]
         else:
             self.provide_feeds = provide_feeds
 
@@ -406,9 +423,24 @@ class WebStatus(service.MultiService):
         self.templates = createJinjaEnv(revlink, self.changecommentlink,
                                         self.repositories, self.projects)
 
+        encoders = []
+        if self.compress:
+            if GzipEncoderFactory:
+                encoders.append(GzipEncoderFactory())
+            else:
+                log.msg("WebStatus: compressed responses are not supported "
+                        "on this version of Twisted")
+
         if not self.site:
             
             class RotateLogSite(server.Site):
+                def getResourceFor(self, request):
+                    rsrc = server.Site.getResourceFor(self, request)
+                    if encoders:
+                        # negotiate a content encoding for every page
+                        rsrc = EncodingResourceWrapper(rsrc, encoders)
+                    return rsrc
+
                 def _openLogFile(self, path):
                     try:
                         from twisted.python.logfile import LogFile
@@ -474,6 +506,8 @@ class WebStatus(service.MultiService):
             root.putChild("atom", Atom10StatusResource(status))
         if "json" in self.provide_feeds:
             root.putChild("json", JsonStatusResource(status))
+        if "metrics" in self.provide_feeds:
+            root.putChild("metrics", PrometheusMetricsResource(status))
 
         self.site.resource = root
 
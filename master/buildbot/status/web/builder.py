@@ -475,17 +475,10 @@ class BuildersResource(HtmlResource):
         builders = req.args.get("builder", status.getBuilderNames())
         branches = [b for b in req.args.get("branch", []) if b]
 
-        # get counts of pending builds for each builder
-        brstatus_ds = []
-        brcounts = {}
-        def keep_count(statuses, builderName):
-            brcounts[builderName] = len(statuses)
-        for builderName in builders:
-            builder_status = status.getBuilder(builderName)
-            d = builder_status.getPendingBuildRequestStatuses()
-            d.addCallback(keep_count, builderName)
-            brstatus_ds.append(d)
-        yield defer.gatherResults(brstatus_ds)
+        # get counts of pending builds for all builders
+        counts = yield status.getPendingBuildRequestCounts()
+        brcounts = dict([ (name, c['count'])
+                          for name, c in counts.iteritems() ])
 
         cxt['branches'] = branches
         bs = cxt['builders'] = []
@@ -220,18 +220,20 @@ class ConsoleStatusResource(HtmlResource):
         return details
 
     def getBuildsForRevision(self, request, builder, builderName, lastRevision,
-                             numBuilds, debugInfo):
+                             numBuilds, debugInfo, branch=ANYBRANCH):
         """Return the list of all the builds for a given builder that we will
         need to be able to display the console page. We start by the most recent
         build, and we go down until we find a build that was built prior to the
-        last change we are interested in."""
+        last change we are interested in.  If a branch is given, only builds
+        on that branch are considered."""
 
         revision = lastRevision 
 
         builds = []
-        build = self.getHeadBuild(builder)
         number = 0
-        while build and number < numBuilds:
+        for build in self.generateBuilds(builder, branch):
+            if number >= numBuilds:
+                break
             debugInfo["builds_scanned"] += 1
             number += 1
 
@@ -258,10 +260,19 @@ class ConsoleStatusResource(HtmlResource):
                     devBuild, current_revision):
                     break
 
-            build = build.getPreviousBuild()
-
         return builds
 
+    def generateBuilds(self, builder, branch):
+        if branch != ANYBRANCH:
+            # use the builder's index to skip builds on other branches
+            for build in builder.generateIndexedBuilds(branch=branch):
+                yield build
+            return
+        build = self.getHeadBuild(builder)
+        while build:
+            yield build
+            build = build.getPreviousBuild()
+
     def getChangeForBuild(self, build, revision):
         if not build or not build.getChanges(): # Forced build
             return DevBuild(revision, build, None)
@@ -276,7 +287,8 @@ class ConsoleStatusResource(HtmlResource):
         return changes[-1]
     
     def getAllBuildsForRevision(self, status, request, lastRevision, numBuilds,
-                                categories, builders, debugInfo):
+                                categories, builders, debugInfo,
+                                branch=ANYBRANCH):
         """Returns a dictionary of builds we need to inspect to be able to
         display the console page. The key is the builder name, and the value is
         an array of build we care about. We also returns a dictionary of
@@ -287,6 +299,7 @@ class ConsoleStatusResource(HtmlResource):
             HTTP GET parameters.
         builders is a list of builders to display. It is coming from the HTTP
             GET parameters.
+        branch is the branch to display, or ANYBRANCH.
         """
 
         allBuilds = dict()
@@ -325,7 +338,8 @@ class ConsoleStatusResource(HtmlResource):
                                                                builderName,
                                                                lastRevision,
                                                                numBuilds,
-                                                               debugInfo)
+                                                               debugInfo,
+                                                               branch)
 
         return (builderList, allBuilds)
 
@@ -662,7 +676,8 @@ class ConsoleStatusResource(HtmlResource):
                                                     numBuilds,
                                                     categories,
                                                     builders,
-                                                    debugInfo)
+                                                    debugInfo,
+                                                    branch)
 
             debugInfo["added_blocks"] = 0
 
@@ -672,8 +687,7 @@ class ConsoleStatusResource(HtmlResource):
 
             templates = request.site.buildbot_service.templates
             template = templates.get_template("console.html")
-            data = template.render(cxt)
-            return data
+            return template.generate(cxt)
         d.addCallback(got_changes)
         return d
 
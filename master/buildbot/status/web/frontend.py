@@ -0,0 +1,398 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""Serve the JSON status API from a process other than the master.
+
+The frontend is fed by a L{buildbot.status.eventstream.StatusEventStream} in
+the master, and keeps its own copy of the status of builders, recent builds
+and slaves.  Older builds are read, read-only, from the master's build
+pickles."""
+
+from __future__ import with_statement
+
+import os
+import urllib
+from cPickle import load
+from twisted.application import internet, service, strports
+from twisted.internet import protocol
+from twisted.persisted import styles
+from twisted.protocols import basic
+from twisted.python import log
+from twisted.web import resource, server
+from buildbot.status.web.status_json import JsonResource, _IS_INT
+from buildbot.util import json, lru
+
+class FrontendStatus(object):
+    """
+    The status of the master, as told by its status event stream.  Builders,
+    slaves and the project are kept as the dictionaries their C{asDict}
+    methods return.  For each builder, the current builds and the last
+    C{numBuilds} finished builds are kept; older builds are loaded from the
+    pickles in C{basedir}, if given, and the last C{cacheSize} of those are
+    cached.
+    """
+
+    cacheSize = 50
+
+    def __init__(self, basedir=None, numBuilds=20):
+        self.basedir = basedir
+        self.numBuilds = numBuilds
+        self.connected = False
+        self.oldBuilds = lru.LRUCache(self._loadBuild, self.cacheSize)
+        self.reset()
+
+    def reset(self):
+        self.project = {}
+        self.builders = {}
+        # maps builder name to a dictionary of builds by number
+        self.builds = {}
+        self.slaves = {}
+
+    def handlePacket(self, packet):
+        handler = getattr(self, 'event_' + packet['event'], None)
+        if handler is None:
+            return
+        handler(**dict([ (str(k), v)
+                         for k, v in packet['payload'].iteritems() ]))
+
+    # accessors
+
+    def getBuild(self, buildername, number):
+        """Return the dictionary describing a build, or None.  Negative
+        numbers count back from the latest build, as for
+        L{BuilderStatus.getBuild}."""
+        builds = self.builds.get(buildername)
+        if builds is None:
+            return None
+        if number < 0:
+            if not builds:
+                return None
+            number = max(builds) + 1 + number
+        if number in builds:
+            return builds[number]
+        build = self.oldBuilds.get((buildername, number))
+        if build is None:
+            return None
+        return build.asDict()
+
+    def _loadBuild(self, (buildername, number)):
+        builder = self.builders.get(buildername)
+        if not self.basedir or not builder or number < 0:
+            return None
+        filename = os.path.join(self.basedir, builder['basedir'], str(number))
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "rb") as f:
+                build = load(f)
+            # upgrade in memory only; the pickle belongs to the master
+            styles.doUpgrade()
+        except:
+            log.msg("unable to load build %d of %s from %s"
+                    % (number, buildername, filename))
+            log.err()
+            return None
+        build.setProcessObjects(ReadOnlyBuilder(buildername, self), None)
+        return build
+
+    def getURLForThing(self, thing):
+        # only used for the logs of builds loaded from disk
+        prefix = self.project.get('buildbotURL')
+        if not prefix:
+            return None
+        step = thing.getStep()
+        return prefix + "builders/%s/builds/%d/steps/%s/logs/%s" % (
+            urllib.quote(step.getBuild().getBuilder().getName(), safe=''),
+            step.getBuild().getNumber(),
+            urllib.quote(step.getName(), safe=''),
+            urllib.quote(thing.getName(), safe=''))
+
+    # events
+
+    def event_start(self, status):
+        self.project = status
+
+    def event_builderAdded(self, builderName, builder):
+        self.builders[builderName] = builder
+        self.builds.setdefault(builderName, {})
+
+    def event_builderChangedState(self, builderName, state):
+        if builderName in self.builders:
+            self.builders[builderName]['state'] = state
+
+    def event_buildedRemoved(self, builderName):
+        self.builders.pop(builderName, None)
+        self.builds.pop(builderName, None)
+
+    def _addBuild(self, build):
+        builds = self.builds.get(build['builderName'])
+        if builds is None:
+            return
+        builds[build['number']] = build
+        finished = sorted([ n for n, b in builds.iteritems()
+                            if b.get('times', [None, None])[1] is not None ])
+        for number in finished[:-self.numBuilds]:
+            del builds[number]
+
+    def _setCurrent(self, build, current):
+        builder = self.builders.get(build['builderName'])
+        if builder is None:
+            return
+        currentBuilds = builder.setdefault('currentBuilds', [])
+        if current and build['number'] not in currentBuilds:
+            currentBuilds.append(build['number'])
+        elif not current and build['number'] in currentBuilds:
+            currentBuilds.remove(build['number'])
+
+    def event_buildStarted(self, build):
+        self._addBuild(build)
+        self._setCurrent(build, True)
+
+    def event_buildETAUpdate(self, build, ETA):
+        self._addBuild(build)
+
+    def event_buildFinished(self, build):
+        self._addBuild(build)
+        self._setCurrent(build, False)
+
+    def _updateStep(self, properties, step, current=None):
+        props = dict([ (p[0], p[1]) for p in properties ])
+        builds = self.builds.get(props.get('buildername'), {})
+        build = builds.get(props.get('buildnumber'))
+        if build is None:
+            return
+        steps = build.get('steps', [])
+        number = step.get('step_number')
+        if number is not None and 0 <= number < len(steps):
+            steps[number] = step
+        if current is True:
+            build['currentStep'] = step
+        elif current is False:
+            build['currentStep'] = None
+
+    def event_stepStarted(self, properties, step):
+        self._updateStep(properties, step, current=True)
+
+    def event_stepTextChanged(self, properties, step, text):
+        self._updateStep(properties, step)
+
+    def event_stepText2Changed(self, properties, step, text2):
+        self._updateStep(properties, step)
+
+    def event_stepETAUpdate(self, properties, step, ETA, expectations):
+        self._updateStep(properties, step)
+
+    def event_logStarted(self, properties, step):
+        self._updateStep(properties, step)
+
+    def event_logFinished(self, properties, step):
+        self._updateStep(properties, step)
+
+    def event_stepFinished(self, properties, step):
+        self._updateStep(properties, step, current=False)
+
+    def event_slaveConnected(self, slave):
+        self.slaves[slave['name']] = slave
+
+    def event_slaveDisconnected(self, slavename):
+        if slavename in self.slaves:
+            self.slaves[slavename]['connected'] = False
+
+
+class ReadOnlyBuilder(object):
+    """Stands in for the L{BuilderStatus} of a build loaded from disk."""
+
+    def __init__(self, name, status):
+        self.name = name
+        self.status = status
+
+    def getName(self):
+        return self.name
+
+
+class StatusEventClient(basic.LineReceiver):
+    delimiter = '\n'
+    # the snapshot of a build with many steps makes for a long line
+    MAX_LENGTH = 64*2**20
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.status.reset()
+        self.factory.status.connected = True
+
+    def connectionLost(self, reason):
+        self.factory.status.connected = False
+
+    def lineReceived(self, line):
+        try:
+            self.factory.status.handlePacket(json.loads(line))
+        except:
+            log.err(None, "while handling a status event")
+
+    def lineLengthExceeded(self, line):
+        log.msg("status event longer than %d bytes; reconnecting"
+                % self.MAX_LENGTH)
+        self.transport.loseConnection()
+
+
+class StatusEventClientFactory(protocol.ReconnectingClientFactory):
+    protocol = StatusEventClient
+    maxDelay = 60
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FrontendRootJsonResource(JsonResource):
+    help = """JSON status of the master, served by a web frontend.
+"""
+    pageTitle = 'Buildbot JSON'
+
+    def __init__(self, status):
+        JsonResource.__init__(self, status)
+        self.putChild('project', ProjectJsonResource(status))
+        self.putChild('builders', BuildersJsonResource(status))
+        self.putChild('slaves', SlavesJsonResource(status))
+
+
+class ProjectJsonResource(JsonResource):
+    help = """Project-wide settings.
+"""
+    pageTitle = 'Project'
+
+    def asDict(self, request):
+        return self.status.project
+
+
+class BuildersJsonResource(JsonResource):
+    help = """List of all the builders defined on the master.
+"""
+    pageTitle = 'Builders'
+
+    def getChild(self, path, request):
+        if path in self.status.builders:
+            return BuilderJsonResource(self.status, path)
+        return JsonResource.getChild(self, path, request)
+
+    def asDict(self, request):
+        return self.status.builders
+
+
+class BuilderJsonResource(JsonResource):
+    help = """Describe a single builder.
+"""
+    pageTitle = 'Builder'
+
+    def __init__(self, status, buildername):
+        JsonResource.__init__(self, status)
+        self.buildername = buildername
+        self.putChild('builds', BuildsJsonResource(status, buildername))
+
+    def asDict(self, request):
+        return self.status.builders.get(self.buildername, {})
+
+
+class BuildsJsonResource(JsonResource):
+    help = """Current and recent builds of a builder; older builds can be
+fetched by number.
+"""
+    pageTitle = 'Builds'
+
+    def __init__(self, status, buildername):
+        JsonResource.__init__(self, status)
+        self.buildername = buildername
+
+    def getChild(self, path, request):
+        if _IS_INT.match(path):
+            build = self.status.getBuild(self.buildername, int(path))
+            if build is not None:
+                return BuildJsonResource(self.status, build)
+        return JsonResource.getChild(self, path, request)
+
+    def asDict(self, request):
+        builds = self.status.builds.get(self.buildername, {})
+        return dict([ (str(n), b) for n, b in builds.iteritems() ])
+
+
+class BuildJsonResource(JsonResource):
+    help = """Describe a single build.
+"""
+    pageTitle = 'Build'
+
+    def __init__(self, status, build):
+        JsonResource.__init__(self, status)
+        self.build = build
+
+    def asDict(self, request):
+        return self.build
+
+
+class SlavesJsonResource(JsonResource):
+    help = """Information about the slaves of the master.
+"""
+    pageTitle = 'Slaves'
+
+    def getChild(self, path, request):
+        if path in self.status.slaves:
+            return SlaveJsonResource(self.status, path)
+        return JsonResource.getChild(self, path, request)
+
+    def asDict(self, request):
+        return self.status.slaves
+
+
+class SlaveJsonResource(JsonResource):
+    help = """Describe a slave.
+"""
+    pageTitle = 'Slave'
+
+    def __init__(self, status, slavename):
+        JsonResource.__init__(self, status)
+        self.slavename = slavename
+
+    def asDict(self, request):
+        return self.status.slaves.get(self.slavename, {})
+
+
+class WebFrontend(service.MultiService):
+    """
+    Serve the JSON status of a master on C{http_port}, under C{/json}, from
+    a separate process.  The status comes from the master's
+    L{StatusEventStream}, at C{master_host}:C{master_port}; builds that are
+    no longer in the stream's snapshot are read from the build pickles in the
+    master's C{basedir}.  Create this in a C{.tac} file, and run it with
+    C{twistd}; run several to spread the load of serving many users.
+    """
+
+    def __init__(self, http_port, master_port, master_host='localhost',
+                 basedir=None, numBuilds=20):
+        service.MultiService.__init__(self)
+        if type(http_port) is int:
+            http_port = "tcp:%d" % http_port
+        self.http_port = http_port
+        self.status = FrontendStatus(basedir=basedir, numBuilds=numBuilds)
+
+        root = resource.Resource()
+        root.putChild('json', FrontendRootJsonResource(self.status))
+        self.site = server.Site(root)
+        strports.service(http_port, self.site).setServiceParent(self)
+
+        self.factory = StatusEventClientFactory(self.status)
+        internet.TCPClient(master_host, master_port,
+                           self.factory).setServiceParent(self)
+
+    def stopService(self):
+        self.factory.stopTrying()
+        return service.MultiService.stopService(self)
@@ -78,7 +78,7 @@ class GridStatusMixin(object):
         if state == "idle" and upcoming:
             state = "waiting"
 
-        n_pending = len((yield builder.getPendingBuildRequestStatuses()))
+        n_pending = yield builder.getPendingBuildRequestCount()
 
         cxt = { 'url': path_to_builder(request, builder),
                 'name': builder.getName(),
@@ -99,9 +99,15 @@ class GridStatusMixin(object):
         """
         get a list of most recent builds on given builder
         """
-        build = builder.getBuild(-1)
+        if branch != ANYBRANCH:
+            # use the builder's index to skip builds on other branches
+            builds = builder.generateIndexedBuilds(branch=branch)
+        else:
+            builds = self._generatePreviousBuilds(builder)
         num = 0
-        while build and num < numBuilds:
+        for build in builds:
+            if num >= numBuilds:
+                break
             start = build.getTimes()[0]
             ss = build.getSourceStamp(absolute=True)
 
@@ -119,8 +125,11 @@ class GridStatusMixin(object):
                 num += 1
                 yield build
 
+    def _generatePreviousBuilds(self, builder):
+        build = builder.getBuild(-1)
+        while build:
+            yield build
             build = build.getPreviousBuild()
-        return
 
     def getRecentSourcestamps(self, status, numBuilds, categories, branch):
         """
@@ -204,7 +213,7 @@ class GridStatusResource(HtmlResource, GridStatusMixin):
             cxt['builders'].append(b)
 
         template = request.site.buildbot_service.templates.get_template("grid.html")
-        defer.returnValue(template.render(**cxt))
+        defer.returnValue(template.generate(**cxt))
 
 
 class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
@@ -271,5 +280,5 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
             builder_builds.append(map(lambda b: self.build_cxt(request, b), builds))
 
         template = request.site.buildbot_service.templates.get_template('grid_transposed.html')
-        yield template.render(**cxt)
+        defer.returnValue(template.generate(**cxt))
 
@@ -0,0 +1,104 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.web import resource
+from buildbot.process.metrics import ALARM_TEXT
+
+def escapeLabel(value):
+    # builder names, and so some metric names, may be unicode
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+                 .replace('"', '\\"'))
+
+def isNumber(value):
+    return isinstance(value, (int, long, float)) \
+            and not isinstance(value, bool)
+
+class PrometheusMetricsResource(resource.Resource):
+    """
+    The master's metrics, in the Prometheus text exposition format.  Each
+    kind of metric is a single metric family, with the buildbot metric name as
+    the C{name} label, as buildbot's metric names are not valid Prometheus
+    names.  Timer percentiles, counts and maxima are over the sliding window
+    kept by the timers' histograms.
+    """
+    isLeaf = True
+
+    def __init__(self, status):
+        resource.Resource.__init__(self)
+        self.status = status
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "text/plain; version=0.0.4")
+        metrics = self.status.getMetrics()
+        if not metrics:
+            # Metrics are disabled
+            return ""
+        return self.format(metrics.asDict())
+
+    def format(self, snapshot):
+        lines = []
+        def family(name, type, help):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+        def sample(name, labels, value):
+            if value is None or not isNumber(value):
+                return
+            labels = ",".join([ '%s="%s"' % (k, escapeLabel(v))
+                                for k, v in labels ])
+            lines.append("%s{%s} %r" % (name, labels, float(value)))
+
+        family("buildbot_counter", "gauge", "Buildbot metrics counters.")
+        for name, value in sorted(snapshot.get('counters', {}).items()):
+            sample("buildbot_counter", [ ('name', name) ], value)
+
+        family("buildbot_gauge", "gauge", "Buildbot metrics gauges.")
+        for name, value in sorted(snapshot.get('gauges', {}).items()):
+            sample("buildbot_gauge", [ ('name', name) ], value)
+
+        histograms = sorted(snapshot.get('histograms', {}).items())
+        family("buildbot_timer_seconds", "summary",
+               "Percentiles of buildbot metrics timers.")
+        for name, snap in histograms:
+            for key, quantile in ('p50', '0.5'), ('p90', '0.9'), \
+                                 ('p99', '0.99'):
+                sample("buildbot_timer_seconds",
+                       [ ('name', name), ('quantile', quantile) ], snap[key])
+            sample("buildbot_timer_seconds_sum", [ ('name', name) ],
+                   snap['sum'])
+            sample("buildbot_timer_seconds_count", [ ('name', name) ],
+                   snap['count'])
+        family("buildbot_timer_max_seconds", "gauge",
+               "Longest time recorded by buildbot metrics timers.")
+        for name, snap in histograms:
+            sample("buildbot_timer_max_seconds", [ ('name', name) ],
+                   snap['max'])
+        family("buildbot_timer_window_count", "gauge",
+               "Number of times recorded by buildbot metrics timers.")
+        for name, snap in histograms:
+            sample("buildbot_timer_window_count", [ ('name', name) ],
+                   snap['count'])
+
+        family("buildbot_alarm", "gauge",
+               "Buildbot metrics alarm levels (%s)." %
+               ", ".join([ "%d=%s" % (i, t) for i, t in enumerate(ALARM_TEXT) ]))
+        for name, (level, msg) in sorted(snapshot.get('alarms', {}).items()):
+            sample("buildbot_alarm", [ ('name', name) ],
+                   ALARM_TEXT.index(level))
+
+        return "\n".join(lines) + "\n"
@@ -78,6 +78,9 @@ EXAMPLES = """\
     - Changes of the two last builds on '<A_BUILDER>' builder.
   - /json/builders/<A_BUILDER>/slaves
     - Slaves associated to this builder.
+  - /json/builders/<A_BUILDER>/durations
+    - Median and 90th percentile build and step durations, overall and per
+      slave.
   - /json/builders/<A_BUILDER>?select=&select=slaves
     - Builder information plus details information about its slaves. Neat eh?
   - /json/slaves/<A_SLAVE>
@@ -368,6 +371,21 @@ class BuilderPendingBuildsJsonResource(JsonResource):
         return d
 
 
+class BuilderDurationsJsonResource(JsonResource):
+    help = """Describe the durations of a builder's recent successful builds,
+and of their steps, as medians (p50) and 90th percentiles (p90), in seconds,
+overall and per slave.
+"""
+    pageTitle = 'Builder durations'
+
+    def __init__(self, status, builder_status):
+        JsonResource.__init__(self, status)
+        self.builder_status = builder_status
+
+    def asDict(self, request):
+        return self.builder_status.getDurationHistory().asDict()
+
+
 class BuilderJsonResource(JsonResource):
     help = """Describe a single builder.
 """
@@ -382,6 +400,8 @@ class BuilderJsonResource(JsonResource):
         self.putChild(
                 'pendingBuilds',
                 BuilderPendingBuildsJsonResource(status, builder_status))
+        self.putChild('durations',
+                BuilderDurationsJsonResource(status, builder_status))
 
     def asDict(self, request):
         # buildbot.status.builder.BuilderStatus
@@ -692,6 +712,10 @@ class MetricsJsonResource(JsonResource):
 """
     title = "Metrics"
 
+    def __init__(self, status):
+        JsonResource.__init__(self, status)
+        self.putChild('stalls', MetricsStallsJsonResource(status))
+
     def asDict(self, request):
         metrics = self.status.getMetrics()
         if metrics:
@@ -700,6 +724,20 @@ class MetricsJsonResource(JsonResource):
             # Metrics are disabled
             return None
 
+class MetricsStallsJsonResource(JsonResource):
+    help = """Reactor stalls, and the stacks most often seen during them.
+Only available if the stall_threshold metrics option is set.
+"""
+    title = "Reactor stalls"
+
+    def asDict(self, request):
+        metrics = self.status.getMetrics()
+        if metrics:
+            return metrics.getStalls()
+        else:
+            # Metrics are disabled
+            return None
+
 
 
 class JsonStatusResource(JsonResource):
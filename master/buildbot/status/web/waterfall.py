@@ -107,7 +107,7 @@ class CurrentBox(components.Adapter):
         # when the builder is otherwise idle.
 
         # are any builds pending? (waiting for a slave to be free)
-        brcount = brcounts[builderName]
+        brcount = brcounts.get(builderName, 0)
         if brcount:
             text.append("%d pending" % brcount)
         for t in sorted(upcoming):
@@ -407,23 +407,18 @@ class WaterfallStatusResource(HtmlResource):
             results['changes'] = changes
         changes_d.addCallback(keep_changes)
 
-        # build request counts for each builder
-        allBuilderNames = status.getBuilderNames(categories=self.categories)
-        brstatus_ds = []
-        brcounts = {}
-        def keep_count(statuses, builderName):
-            brcounts[builderName] = len(statuses)
-        for builderName in allBuilderNames:
-            builder_status = status.getBuilder(builderName)
-            d = builder_status.getPendingBuildRequestStatuses()
-            d.addCallback(keep_count, builderName)
-            brstatus_ds.append(d)
+        # build request counts for all builders
+        brcounts_d = status.getPendingBuildRequestCounts()
+        def keep_counts(counts):
+            results['brcounts'] = dict([ (name, c['count'])
+                                         for name, c in counts.iteritems() ])
+        brcounts_d.addCallback(keep_counts)
 
         # wait for it all to finish
-        d = defer.gatherResults([ changes_d ] + brstatus_ds)
+        d = defer.gatherResults([ changes_d, brcounts_d ])
         def call_content(_):
             return self.content_with_db_data(results['changes'],
-                    brcounts, request, ctx)
+                    results['brcounts'], request, ctx)
         d.addCallback(call_content)
         return d
 
@@ -528,8 +523,7 @@ class WaterfallStatusResource(HtmlResource):
             ctx['no_reload_page'] = with_args(request, remove_args=["reload"])
 
         template = request.site.buildbot_service.templates.get_template("waterfall.html")
-        data = template.render(**ctx)
-        return data
+        return template.generate(**ctx)
     
     def buildGrid(self, request, builders, changes):
         debug = False
@@ -17,6 +17,7 @@ from twisted.python import log, failure
 from twisted.internet import reactor
 from buildbot.process.buildstep import BuildStep
 from buildbot.status import builder, buildstep
+from buildbot.status.buildindex import getBuildKeys
 from buildbot import config
 
 class BadStepError(Exception):
@@ -146,6 +147,19 @@ class Blocker(BuildStep):
                 matchingBuild = buildStatus
                 break
 
+        if matchingBuild is None:
+            # builds of the same revision that have dropped out of the cache
+            # can still be found through the builder's index
+            revision = getBuildKeys(myBuildStatus)[1]
+            if revision is not None:
+                for buildStatus in builderStatus.generateIndexedBuilds(
+                        revision=revision, scan=False):
+                    if buildStatus in all_builds:
+                        continue
+                    if self.buildsMatch(myBuildStatus, buildStatus):
+                        matchingBuild = buildStatus
+                        break
+
         if matchingBuild is None:
             msg = "no matching builds found in builder %r" % builderName
             if self.idlePolicy == "error":
@@ -15,6 +15,7 @@
 
 
 import re
+import sys
 from twisted.python import log, failure
 from twisted.spread import pb
 from buildbot.process import buildstep
@@ -367,6 +368,143 @@ class StringFileWriter(pb.Referenceable):
     def remote_close(self):
         pass
 
+# backreferences would be renumbered when patterns are combined
+_backreferenceRe = re.compile(r"\\[1-9]|\(\?P=")
+
+def _combinePatterns(regexps):
+    """
+    Combine compiled regular expressions into a single alternation that
+    matches (or searches) wherever any one of them would.  Returns None if the
+    expressions cannot safely be combined: they use different flags, contain
+    backreferences, or mix incompatible string types."""
+    flags = set([ r.flags for r in regexps ])
+    if len(flags) != 1:
+        return None
+    sources = []
+    for r in regexps:
+        if _backreferenceRe.search(r.pattern):
+            return None
+        sources.append("(?:%s)" % r.pattern)
+    try:
+        return re.compile("|".join(sources), flags.pop())
+    except (re.error, UnicodeError):
+        return None
+
+class SuppressionIndex:
+    """
+    I hold a list of warning suppressions in a form that can be checked
+    quickly for each warning.
+
+    Suppressions that apply to every file and every line are combined into a
+    single regular expression searched against the warning text.  For the
+    remaining file-specific suppressions, a combined regular expression of all
+    of their file patterns acts as a filter, so that the individual
+    suppressions are only examined for warnings in files that one of them
+    might match."""
+
+    def __init__(self, suppressions):
+        self.suppressAll = False
+        textRes = []
+        self.fileSuppressions = []
+        self.otherSuppressions = []
+        for supp in suppressions:
+            fileRe, warnRe, start, end = supp
+            if fileRe is not None:
+                self.fileSuppressions.append(supp)
+            elif start is not None or end is not None:
+                self.otherSuppressions.append(supp)
+            elif warnRe is None:
+                self.suppressAll = True
+            else:
+                textRes.append(warnRe)
+
+        self.textRe = None
+        if textRes:
+            self.textRe = _combinePatterns(textRes)
+            if self.textRe is None:
+                # keep these as individual suppressions
+                self.otherSuppressions.extend([ (None, r, None, None)
+                                                for r in textRes ])
+
+        self.fileRe = None
+        if self.fileSuppressions:
+            self.fileRe = _combinePatterns(
+                    [ supp[0] for supp in self.fileSuppressions ])
+
+    def matches(self, file, lineNo, text):
+        if self.suppressAll:
+            return True
+        if self.textRe and self.textRe.search(text):
+            return True
+        if self.fileSuppressions:
+            # a warning with no file name is matched by any file pattern
+            if file is None or self.fileRe is None or self.fileRe.match(file):
+                if self._matchAny(self.fileSuppressions, file, lineNo, text):
+                    return True
+        return self._matchAny(self.otherSuppressions, file, lineNo, text)
+
+    def _matchAny(self, suppressions, file, lineNo, text):
+        for fileRe, warnRe, start, end in suppressions:
+            if not (file == None or fileRe == None or fileRe.match(file)):
+                continue
+            if not (warnRe == None or warnRe.search(text)):
+                continue
+            if not ((start == None and end == None) or
+                    (lineNo != None and start <= lineNo and end >= lineNo)):
+                continue
+            return True
+        return False
+
+class WarningCountingLogObserver(buildstep.LogLineObserver):
+    """
+    I hand each line of a step's stdio log, stdout and stderr alike, to the
+    step's C{warningLineReceived} method as soon as it arrives.
+
+    The final line of a log need not end with a newline, so it is only
+    delivered by L{flush}, once the log is complete.  If the step raises an
+    exception while handling a line, I stop passing lines along and keep the
+    failure in C{self.failure} for the step to report."""
+
+    failure = None
+
+    def __init__(self):
+        buildstep.LogLineObserver.__init__(self)
+        # warnings can be found on lines of any length
+        self.setMaxLineLength(sys.maxint)
+        self.outTail = ''
+        self.errTail = ''
+
+    def _tail(self, tail, data):
+        i = data.rfind("\n")
+        if i < 0:
+            return tail + data
+        return data[i+1:]
+
+    def outReceived(self, data):
+        self.outTail = self._tail(self.outTail, data)
+        buildstep.LogLineObserver.outReceived(self, data)
+
+    def errReceived(self, data):
+        self.errTail = self._tail(self.errTail, data)
+        buildstep.LogLineObserver.errReceived(self, data)
+
+    def outLineReceived(self, line):
+        if self.failure:
+            return
+        try:
+            self.step.warningLineReceived(line)
+        except:
+            self.failure = failure.Failure()
+
+    errLineReceived = outLineReceived
+
+    def flush(self):
+        """Deliver any final, unterminated lines of stdout and stderr."""
+        for tail in self.outTail, self.errTail:
+            if tail:
+                self.outLineReceived(tail)
+        self.outTail = self.errTail = ''
+
 class WarningCountingShellCommand(ShellCommand):
     renderables = [ 'suppressionFile' ]
 
@@ -412,7 +550,10 @@ class WarningCountingShellCommand(ShellCommand):
                                  maxWarnCount=maxWarnCount,
                                  suppressionFile=suppressionFile)
         self.suppressions = []
+        self.suppressionIndex = None
         self.directoryStack = []
+        self.loggedWarnings = []
+        self.warningObserver = None
 
     def addSuppression(self, suppressionList):
         """
@@ -441,6 +582,7 @@ class WarningCountingShellCommand(ShellCommand):
             if warnRe != None and isinstance(warnRe, basestring):
                 warnRe = re.compile(warnRe)
             self.suppressions.append((fileRe, warnRe, start, end))
+        self.suppressionIndex = None
 
     def warnExtractWholeLine(self, line, match):
         """
@@ -470,14 +612,9 @@ class WarningCountingShellCommand(ShellCommand):
                     file = "%s/%s" % (currentDirectory, file)
 
             # Skip adding the warning if any suppression matches.
-            for fileRe, warnRe, start, end in self.suppressions:
-                if not (file == None or fileRe == None or fileRe.match(file)):
-                    continue
-                if not (warnRe == None or warnRe.search(text)):
-                    continue
-                if not ((start == None and end == None) or
-                        (lineNo != None and start <= lineNo and end >= lineNo)):
-                    continue
+            if self.suppressionIndex is None:
+                self.suppressionIndex = SuppressionIndex(self.suppressions)
+            if self.suppressionIndex.matches(file, lineNo, text):
                 return
 
         warnings.append(line)
@@ -523,58 +660,69 @@ class WarningCountingShellCommand(ShellCommand):
         self.addSuppression(list)
         return ShellCommand.start(self)
 
-    def createSummary(self, log):
-        """
-        Match log lines against warningPattern.
-
-        Warnings are collected into another log for this step, and the
-        build-wide 'warnings-count' is updated."""
-
-        self.warnCount = 0
-
-        # Now compile a regular expression from whichever warning pattern we're
-        # using
+    def setupLogfiles(self, cmd, logfiles):
+        # Compile regular expressions from whichever patterns we're using
         wre = self.warningPattern
-        if isinstance(wre, str):
+        if isinstance(wre, basestring):
             wre = re.compile(wre)
+        self.warningRe = wre
 
         directoryEnterRe = self.directoryEnterPattern
         if (directoryEnterRe != None
                 and isinstance(directoryEnterRe, basestring)):
             directoryEnterRe = re.compile(directoryEnterRe)
+        self.directoryEnterRe = directoryEnterRe
 
         directoryLeaveRe = self.directoryLeavePattern
         if (directoryLeaveRe != None
                 and isinstance(directoryLeaveRe, basestring)):
             directoryLeaveRe = re.compile(directoryLeaveRe)
+        self.directoryLeaveRe = directoryLeaveRe
 
-        # Check if each line in the output from this command matched our
-        # warnings regular expressions. If did, bump the warnings count and
-        # add the line to the collection of lines with warnings
-        warnings = []
-        # TODO: use log.readlines(), except we need to decide about stdout vs
-        # stderr
-        for line in log.getText().split("\n"):
-            if directoryEnterRe:
-                match = directoryEnterRe.search(line)
-                if match:
-                    self.directoryStack.append(match.group(1))
-                    continue
-            if (directoryLeaveRe and
-                self.directoryStack and
-                directoryLeaveRe.search(line)):
-                    self.directoryStack.pop()
-                    continue
-
-            match = wre.match(line)
+        self.warnCount = 0
+        self.loggedWarnings = []
+        self.warningObserver = WarningCountingLogObserver()
+        self.addLogObserver('stdio', self.warningObserver)
+        ShellCommand.setupLogfiles(self, cmd, logfiles)
+
+    def warningLineReceived(self, line):
+        """
+        Check a line of output from this command against the directory and
+        warning patterns.  If it is a warning, bump the warnings count and
+        add the line to the collection of lines with warnings.
+
+        This is called for each line as the command's output arrives."""
+        if self.directoryEnterRe:
+            match = self.directoryEnterRe.search(line)
             if match:
-                self.maybeAddWarning(warnings, line, match)
+                self.directoryStack.append(match.group(1))
+                return
+        if (self.directoryLeaveRe and
+            self.directoryStack and
+            self.directoryLeaveRe.search(line)):
+                self.directoryStack.pop()
+                return
+
+        match = self.warningRe.match(line)
+        if match:
+            self.maybeAddWarning(self.loggedWarnings, line, match)
+
+    def createSummary(self, log):
+        """
+        Summarize the warnings found in the log as it arrived.
+
+        Warnings are collected into another log for this step, and the
+        build-wide 'warnings-count' is updated."""
+
+        self.warningObserver.flush()
+        if self.warningObserver.failure:
+            self.warningObserver.failure.raiseException()
 
         # If there were any warnings, make the log if lines with warnings
         # available
         if self.warnCount:
             self.addCompleteLog("warnings (%d)" % self.warnCount,
-                    "\n".join(warnings) + "\n")
+                    "\n".join(self.loggedWarnings) + "\n")
 
         warnings_stat = self.step_status.getStatistic('warnings', 0)
         self.step_status.setStatistic('warnings', warnings_stat + self.warnCount)
@@ -27,7 +27,8 @@ class Git(Source):
 
     def __init__(self, repourl=None, branch='HEAD', mode='incremental',
                  method=None, submodules=False, shallow=False, progress=False,
-                 retryFetch=False, clobberOnFailure=False, **kwargs):
+                 retryFetch=False, clobberOnFailure=False, mirror=False,
+                 **kwargs):
         """
         @type  repourl: string
         @param repourl: the URL which points at the git repository
@@ -57,6 +58,12 @@ class Git(Source):
 
         @type  retryFetch: boolean
         @param retryFetch: Retry fetching before failing source checkout.
+
+        @type  mirror: boolean or string
+        @param mirror: Fetch through a mirror of the repository shared by
+                       all of the builders on the slave.  If a string, the
+                       directory containing the slave's mirrors, relative to
+                       the builder directory.
         """
 
         self.branch    = branch
@@ -69,6 +76,8 @@ class Git(Source):
         self.fetchcount = 0
         self.clobberOnFailure = clobberOnFailure
         self.mode = mode
+        self.mirror = mirror
+        self.mirrorPath = None
         Source.__init__(self, **kwargs)
         self.addFactoryArguments(branch=branch,
                                  mode=mode,
@@ -80,6 +89,7 @@ class Git(Source):
                                  retryFetch=retryFetch,
                                  clobberOnFailure=
                                  clobberOnFailure,
+                                 mirror=mirror,
                                  )
 
         assert self.mode in ['incremental', 'full']
@@ -100,6 +110,9 @@ class Git(Source):
             return 0
         d.addCallback(checkInstall)
 
+        if self.mirror:
+            d.addCallback(lambda _: self._updateMirror())
+
         if self.mode == 'incremental':
             d.addCallback(lambda _: self.incremental())
         elif self.mode == 'full':
@@ -256,8 +269,47 @@ class Git(Source):
         d.addCallback(lambda _: evaluateCommand(cmd))
         return d
 
+    def _updateMirror(self):
+        if not self.slaveVersion('gitMirror'):
+            log.msg("slave does not support git mirrors; fetching directly")
+            return defer.succeed(0)
+        # the copy method checks out into 'source'
+        if self.method == 'copy':
+            workdir = 'source'
+        else:
+            workdir = self.workdir
+        args = {'repourl': self.repourl,
+                'revision': self.revision,
+                'workdir': workdir,
+                'progress': self.prog,
+                'logEnviron': self.logEnviron,
+                }
+        if isinstance(self.mirror, basestring):
+            args['mirrordir'] = self.mirror
+        cmd = buildstep.RemoteCommand('gitMirror', args)
+        cmd.useLog(self.stdio_log, False)
+        d = self.runCommand(cmd)
+        def evaluate(_):
+            if cmd.rc != 0:
+                # the upstream repository may still be reachable directly
+                log.msg("updating the git mirror failed; fetching directly")
+                return cmd.rc
+            stats = cmd.updates['mirror'][-1]
+            self.mirrorPath = stats['path']
+            self.step_status.setStatistic('git_mirror_hit', stats['hit'])
+            self.step_status.setStatistic('git_fetch_time',
+                                          stats['fetch_time'])
+            self.step_status.setStatistic('git_fetch_bytes',
+                                          stats['fetch_bytes'])
+            return 0
+        d.addCallback(evaluate)
+        return d
+
     def _fetch(self, _):
-        command = ['fetch', '-t', self.repourl, self.branch]
+        # fetch from the slave's mirror, if it has one; the mirror has
+        # already been brought up to date
+        command = ['fetch', '-t', self.mirrorPath or self.repourl,
+                   self.branch]
         # If the 'progress' option is set, tell git fetch to output
         # progress information to the log. This can solve issues with
         # long fetches killed due to lack of output, but only works
@@ -314,6 +366,9 @@ class Git(Source):
             command = ['clone', '--depth', '1', '--branch', self.branch, self.repourl, '.']
         else:
             command = ['clone', '--branch', self.branch, self.repourl, '.']
+        # borrow objects from the mirror, rather than fetching them again
+        if self.mirrorPath:
+            command[1:1] = ['--reference', self.mirrorPath]
         #Fix references
         if self.prog:
             command.append('--progress')
@@ -535,6 +535,7 @@ class Git(Source):
                  reference=None,
                  shallow=False,
                  progress=False,
+                 mirror=False,
                  **kwargs):
         """
         @type  repourl: string
@@ -560,6 +561,12 @@ class Git(Source):
         @param progress: Pass the --progress option when fetching. This
                          can solve long fetches getting killed due to
                          lack of output, but requires Git 1.7.2+.
+
+        @type  mirror: boolean or string
+        @param mirror: Fetch through a mirror of the repository shared by
+                       all of the builders on the slave.  If a string, the
+                       directory containing the slave's mirrors, relative to
+                       the builder directory.
         """
         Source.__init__(self, **kwargs)
         self.repourl = _ComputeRepositoryURL(repourl)
@@ -571,12 +578,14 @@ class Git(Source):
                                  reference=reference,
                                  shallow=shallow,
                                  progress=progress,
+                                 mirror=mirror,
                                  )
         self.args.update({'submodules': submodules,
                           'ignore_ignores': ignore_ignores,
                           'reference': reference,
                           'shallow': shallow,
                           'progress': progress,
+                          'mirror': mirror,
                           })
 
     def computeSourceRevision(self, changes):
@@ -610,9 +619,22 @@ class Git(Source):
         if not slavever:
             raise BuildSlaveTooOldError("slave is too old, does not know "
                                         "about git")
+        if self.args['mirror'] and self.slaveVersionIsOlderThan("git", "2.19"):
+            log.msg("slave does not support git mirrors; fetching directly")
+            self.args['mirror'] = False
         cmd = RemoteCommand("git", self.args)
         self.startCommand(cmd)
 
+    def commandComplete(self, cmd):
+        Source.commandComplete(self, cmd)
+        if 'mirror' in cmd.updates:
+            stats = cmd.updates['mirror'][-1]
+            self.step_status.setStatistic('git_mirror_hit', stats['hit'])
+            self.step_status.setStatistic('git_fetch_time',
+                                          stats['fetch_time'])
+            self.step_status.setStatistic('git_fetch_bytes',
+                                          stats['fetch_bytes'])
+
 
 class Repo(Source):
     """Check out a source tree from a repo repository described by manifest."""
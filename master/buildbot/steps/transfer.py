@@ -16,28 +16,114 @@
 from __future__ import with_statement
 
 
-import os.path, tarfile, tempfile
+import os.path, tarfile, tempfile, threading, shutil, re
 try:
     from cStringIO import StringIO
     assert StringIO
 except ImportError:
     from StringIO import StringIO
-from twisted.internet import reactor
+from collections import deque
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from twisted.internet import reactor, defer, threads
 from twisted.spread import pb
-from twisted.python import log
+from twisted.python import log, failure
 from buildbot.process import buildstep
 from buildbot.process.buildstep import BuildStep
 from buildbot.process.buildstep import SUCCESS, FAILURE, SKIPPED
 from buildbot.interfaces import BuildSlaveTooOldError
-from buildbot.util import json
+from buildbot.util import json, now
 from buildbot import config
 
 
+def _hashFile(path, blocksize=256*1024):
+    sha = sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            sha.update(data)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def _replace(src, dest):
+    # on windows, os.rename does not automatically unlink, so do it manually
+    if os.path.exists(dest):
+        os.unlink(dest)
+    os.rename(src, dest)
+
+
+class ContentStore:
+    """
+    A directory of files named for the SHA-1 digest of their content, from
+    which uploaded files are copied into place.  Files are kept in
+    subdirectories named for the first two digits of their digest.
+
+    Files are copied into and out of the store, rather than hard-linked, so
+    that writing, chmod'ing or touching an uploaded file cannot change the
+    stored content.  Stored files are read-only.
+    """
+
+    _digestRe = re.compile(r'^[0-9a-f]{40}$')
+
+    def __init__(self, basedir):
+        self.basedir = os.path.abspath(basedir)
+
+    def getPath(self, digest):
+        if not self._digestRe.match(digest):
+            raise ValueError("invalid content digest %r" % (digest,))
+        return os.path.join(self.basedir, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.getPath(digest))
+
+    def add(self, path, digest):
+        """
+        Add the file at C{path}, whose content has the given digest, to the
+        store, unless the store already has that content.
+        """
+        storepath = self.getPath(digest)
+        if os.path.exists(storepath):
+            return
+        dirname = os.path.dirname(storepath)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        os.close(fd)
+        os.unlink(tmpname)
+        shutil.copyfile(path, tmpname)
+        os.chmod(tmpname, 0444)
+        _replace(tmpname, storepath)
+
+    def link(self, digest, destfile):
+        """
+        Create (or replace) C{destfile} with the stored content with the given
+        digest.
+        """
+        dirname = os.path.dirname(destfile)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        os.close(fd)
+        os.unlink(tmpname)
+        shutil.copyfile(self.getPath(digest), tmpname)
+        _replace(tmpname, destfile)
+
+
 class _FileWriter(pb.Referenceable):
     """
     Helper class that acts as a file-object with write access
     """
 
+    bytesTransferred = 0
+    bytesSaved = 0
+    savesContent = False
+
     def __init__(self, destfile, maxsize, mode):
         # Create missing directories.
         destfile = os.path.abspath(destfile)
@@ -66,6 +152,7 @@ class _FileWriter(pb.Referenceable):
             self.remaining = self.remaining - len(data)
         else:
             self.fp.write(data)
+        self.bytesTransferred += len(data)
 
     def remote_utime(self, accessed_modified):
         os.utime(self.destfile,accessed_modified)
@@ -76,10 +163,7 @@ class _FileWriter(pb.Referenceable):
         """
         self.fp.close()
         self.fp = None
-        # on windows, os.rename does not automatically unlink, so do it manually
-        if os.path.exists(self.destfile):
-            os.unlink(self.destfile)
-        os.rename(self.tmpname, self.destfile)
+        _replace(self.tmpname, self.destfile)
         self.tmpname = None
         if self.mode is not None:
             os.chmod(self.destfile, self.mode)
@@ -95,6 +179,56 @@ class _FileWriter(pb.Referenceable):
                 os.unlink(self.tmpname)
 
 
+class _ContentFileWriter(_FileWriter):
+    """
+    A FileWriter that can link the destination file from a L{ContentStore}
+    instead of receiving its content, and adds received content to the store.
+    """
+
+    savesContent = True
+
+    def __init__(self, destfile, maxsize, mode, store):
+        _FileWriter.__init__(self, destfile, maxsize, mode)
+        self.store = store
+        self.digest = None
+        self.stored = False
+        self.sha = sha1()
+
+    def remote_haveContent(self, digest, size):
+        """
+        Called by the remote slave with the digest and size of the file it is
+        about to send.  Returns True if the store already has that content,
+        in which case the slave sends no data before calling C{close}.
+        """
+        self.digest = digest
+        if self.remaining is not None and size > self.remaining:
+            return False
+        if self.store.has(digest):
+            self.stored = True
+            self.bytesSaved = size
+        return self.stored
+
+    def remote_write(self, data):
+        written = self.bytesTransferred
+        _FileWriter.remote_write(self, data)
+        self.sha.update(data[:self.bytesTransferred - written])
+
+    def remote_close(self):
+        if self.stored:
+            self.fp.close()
+            self.fp = None
+            os.unlink(self.tmpname)
+            self.tmpname = None
+            self.store.link(self.digest, self.destfile)
+            if self.mode is not None:
+                os.chmod(self.destfile, self.mode)
+            return
+        _FileWriter.remote_close(self)
+        # only store the content if it is what the slave said it would send
+        if self.digest and self.sha.hexdigest() == self.digest:
+            self.store.add(self.destfile, self.digest)
+
+
 def _extractall(self, path=".", members=None):
     """Fallback extractall method for TarFile, in case it doesn't have its own."""
 
@@ -130,45 +264,256 @@ def _extractall(self, path=".", members=None):
             else:
                 self._dbg(1, "tarfile: %s" % e)
 
-class _DirectoryWriter(_FileWriter):
+def _deferToOwnThread(f, *args):
     """
-    A DirectoryWriter is implemented as a FileWriter, with an added post-processing
-    step to unpack the archive, once the transfer has completed.
+    Like C{threads.deferToThread}, but run C{f} in a new thread of its own
+    rather than in the reactor's thread pool.  This is for work that waits
+    on the reactor, such as reading a L{_BlockPipe}, and which would
+    otherwise tie up a pool thread that other work may need first.
     """
+    d = defer.Deferred()
+    def run():
+        try:
+            result = f(*args)
+        except:
+            reactor.callFromThread(d.errback, failure.Failure())
+        else:
+            reactor.callFromThread(d.callback, result)
+    thread = threading.Thread(target=run, name=getattr(f, '__name__', None))
+    # a transfer left hanging must not keep the master from exiting
+    thread.setDaemon(True)
+    thread.start()
+    return d
 
-    def __init__(self, destroot, maxsize, compress, mode):
-        self.destroot = destroot
-        self.compress = compress
 
-        self.fd, self.tarname = tempfile.mkstemp()
-        os.close(self.fd)
+class _BlockPipe:
+    """
+    A file-like object that passes blocks of data written in the reactor
+    thread to a reader in another thread.
 
-        _FileWriter.__init__(self, self.tarname, maxsize, mode)
+    When more than C{maxBuffered} bytes are waiting for the reader, L{write}
+    returns a Deferred that fires once the reader has caught up, so that the
+    writer can wait before sending more.
+    """
 
-    def remote_unpack(self):
-        """
-        Called by remote slave to state that no more data will be transfered
-        """
-        # Make sure remote_close is called, otherwise atomic rename wont happen
-        self.remote_close()
+    def __init__(self, maxBuffered):
+        self.maxBuffered = maxBuffered
+        self.cond = threading.Condition()
+        self.blocks = deque()
+        self.buffered = 0
+        self.closed = False
+        self.cancelled = False
+        self.waiting = None
+
+    def write(self, data):
+        with self.cond:
+            if self.closed:
+                return
+            self.blocks.append(data)
+            self.buffered += len(data)
+            self.cond.notify()
+            if self.buffered > self.maxBuffered:
+                self.waiting = defer.Deferred()
+                return self.waiting
+
+    def close(self):
+        """Signal the end of the data; the reader sees EOF once it has read
+        everything already written"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def cancel(self):
+        """Discard any data not yet read, and make further reads fail.  This
+        is also used once the reader has finished."""
+        with self.cond:
+            self.closed = self.cancelled = True
+            self.blocks.clear()
+            self.buffered = 0
+            self.cond.notify()
+            waiting, self.waiting = self.waiting, None
+        if waiting:
+            waiting.callback(None)
+
+    def read(self, size):
+        """Called from the reader thread; waits for data to be written"""
+        with self.cond:
+            while not self.blocks and not self.closed:
+                self.cond.wait()
+            if self.cancelled:
+                raise IOError("transfer cancelled")
+            chunks = []
+            length = 0
+            while self.blocks and length < size:
+                block = self.blocks.popleft()
+                if length + len(block) > size:
+                    self.blocks.appendleft(block[size-length:])
+                    block = block[:size-length]
+                chunks.append(block)
+                length += len(block)
+            self.buffered -= length
+            waiting = None
+            if self.waiting and self.buffered <= self.maxBuffered:
+                waiting, self.waiting = self.waiting, None
+        if waiting:
+            reactor.callFromThread(waiting.callback, None)
+        return ''.join(chunks)
+
+
+class _DirectoryWriter(pb.Referenceable):
+    """
+    A DirectoryWriter receives a tar archive from the slave, and unpacks it
+    as it arrives.  The archive is read by a TarFile in a worker thread, so
+    nothing is staged on disk and the reactor never waits for extraction.
+    Members are extracted as soon as they are complete, so a failed transfer
+    may leave part of the directory behind.
+    """
+
+    # bytes of archive held for the extraction thread before the slave is
+    # made to wait
+    maxBuffered = 1024*1024
+
+    bytesTransferred = 0
+    bytesSaved = 0
+    savesContent = False
 
+    def __init__(self, destroot, maxsize, compress, mode):
+        self.destroot = destroot
+        self.compress = compress
+        self.mode = mode
+        self.remaining = maxsize
+        self.pipe = _BlockPipe(self.maxBuffered)
+        self.extracted = None
+
+    def _startExtracting(self):
+        if self.extracted is None:
+            # extraction waits for data from the slave for as long as the
+            # upload lasts, so it gets a thread of its own
+            self.extracted = _deferToOwnThread(self._extract)
+            # once the thread is done, stop accepting data for it
+            @self.extracted.addBoth
+            def stop(res):
+                self.pipe.cancel()
+                return res
+
+    def _extract(self):
         # Map configured compression to a TarFile setting
         if self.compress == 'bz2':
             mode='r|bz2'
         elif self.compress == 'gz':
             mode='r|gz'
         else:
-            mode = 'r'
+            mode = 'r|*'
 
         # Support old python
         if not hasattr(tarfile.TarFile, 'extractall'):
             tarfile.TarFile.extractall = _extractall
 
-        # Unpack archive and clean up after self
-        archive = tarfile.open(name=self.tarname, mode=mode)
-        archive.extractall(path=self.destroot)
-        archive.close()
-        os.remove(self.tarname)
+        archive = tarfile.open(mode=mode, fileobj=self.pipe)
+        try:
+            archive.extractall(path=self.destroot,
+                               members=self._replacing(archive))
+        finally:
+            archive.close()
+
+    def _replacing(self, archive):
+        # TarFile writes over existing files in place; remove them first, so
+        # that a file hard-linked elsewhere (as content stores once did) is
+        # replaced rather than modified
+        destroot = os.path.abspath(self.destroot)
+        for tarinfo in archive:
+            if tarinfo.isreg():
+                path = os.path.normpath(os.path.join(destroot, tarinfo.name))
+                if (path.startswith(destroot + os.sep)
+                        and os.path.isfile(path) and not os.path.islink(path)):
+                    os.unlink(path)
+            yield tarinfo
+
+    def remote_write(self, data):
+        """
+        Called from remote slave to add L{data} to the archive, within
+        boundaries of L{maxsize}.  Returns a Deferred if the slave should wait
+        for extraction to catch up.
+
+        @type  data: C{string}
+        @param data: String of data to write
+        """
+        if self.remaining is not None:
+            if len(data) > self.remaining:
+                data = data[:self.remaining]
+            self.remaining = self.remaining - len(data)
+        self.bytesTransferred += len(data)
+        self._startExtracting()
+        return self.pipe.write(data)
+
+    def remote_unpack(self):
+        """
+        Called by remote slave to state that no more data will be transfered.
+        Fires when the archive has been completely unpacked.
+        """
+        self._startExtracting()
+        self.pipe.close()
+        return self.extracted
+
+    def cancel(self):
+        # unclean shutdown; stop the extraction thread, and leave behind
+        # whatever it has already extracted
+        self.pipe.cancel()
+        if self.extracted is not None:
+            self.extracted.addErrback(lambda _ : None)
+
+
+class _ContentDirectoryWriter(_DirectoryWriter):
+    """
+    A DirectoryWriter that links files from a L{ContentStore} into place,
+    rather than receiving their content in the archive, and adds the files it
+    does receive to the store.
+    """
+
+    savesContent = True
+
+    def __init__(self, destroot, maxsize, compress, mode, store):
+        _DirectoryWriter.__init__(self, destroot, maxsize, compress, mode)
+        self.store = store
+        self.manifest = []
+        self.present = set()
+
+    def remote_missingContent(self, manifest):
+        """
+        Called by the remote slave with a list of (name, digest, size) tuples
+        for the regular files in the directory.  Returns the digests that the
+        store does not have; the slave leaves the others out of the archive.
+        """
+        self.manifest = manifest
+        missing = set()
+        for name, digest, size in manifest:
+            if self.store.has(digest):
+                self.present.add(digest)
+                self.bytesSaved += size
+            else:
+                missing.add(digest)
+        return list(missing)
+
+    def _destPath(self, name):
+        destroot = os.path.abspath(self.destroot)
+        path = os.path.normpath(os.path.join(destroot, name))
+        if not path.startswith(destroot + os.sep):
+            return None
+        return path
+
+    def _extract(self):
+        _DirectoryWriter._extract(self)
+        for name, digest, size in self.manifest:
+            path = self._destPath(name)
+            if path is None:
+                log.msg("ignoring content for %r outside of %r"
+                        % (name, self.destroot))
+                continue
+            if digest in self.present:
+                self.store.link(digest, path)
+            elif (os.path.isfile(path) and not os.path.islink(path)
+                    and _hashFile(path) == digest):
+                self.store.add(path, digest)
 
 
 def makeStatusRemoteCommand(step, remote_command, args):
@@ -189,6 +534,9 @@ class _TransferBuildStep(BuildStep):
     haltOnFailure = True
     flunkOnFailure = True
 
+    transfer = None
+    contentStore = None
+
     def setDefaultWorkdir(self, workdir):
         if self.workdir is None:
             self.workdir = workdir
@@ -206,6 +554,30 @@ class _TransferBuildStep(BuildStep):
             d = self.cmd.interrupt(reason)
             return d
 
+    def _getContentStore(self, command):
+        """Return the L{ContentStore} to use, or None if the transfer should
+        not use one"""
+        if self.contentStore is None:
+            return None
+        if self.slaveVersionIsOlderThan(command, "2.17"):
+            log.msg("slave is too old to use a content store; sending "
+                    "the full content")
+            return None
+        return ContentStore(os.path.expanduser(self.contentStore))
+
+    def setTransferStatistics(self):
+        if self.transfer is None:
+            return
+        self.step_status.setStatistic('bytes_transferred',
+                                      self.transfer.bytesTransferred)
+        elapsed = now() - self.transferStarted
+        if elapsed > 0:
+            self.step_status.setStatistic('transfer_rate',
+                    int(self.transfer.bytesTransferred / elapsed))
+        if self.transfer.savesContent:
+            self.step_status.setStatistic('bytes_saved',
+                                          self.transfer.bytesSaved)
+
     def finished(self, result):
         # Subclasses may choose to skip a transfer. In those cases, self.cmd
         # will be None, and we should just let BuildStep.finished() handle
@@ -213,6 +585,7 @@ class _TransferBuildStep(BuildStep):
         if result == SKIPPED:
             return BuildStep.finished(self, SKIPPED)
 
+        self.setTransferStatistics()
         if self.cmd.rc is None or self.cmd.rc == 0:
             return BuildStep.finished(self, SUCCESS)
         return BuildStep.finished(self, FAILURE)
@@ -226,7 +599,7 @@ class FileUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
-                 keepstamp=False, url=None,
+                 keepstamp=False, url=None, contentStore=None,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
@@ -237,6 +610,7 @@ class FileUpload(_TransferBuildStep):
                                  mode=mode,
                                  keepstamp=keepstamp,
                                  url=url,
+                                 contentStore=contentStore,
                                  )
 
         self.slavesrc = slavesrc
@@ -250,6 +624,7 @@ class FileUpload(_TransferBuildStep):
         self.mode = mode
         self.keepstamp = keepstamp
         self.url = url
+        self.contentStore = contentStore
 
     def start(self):
         version = self.slaveVersion("uploadFile")
@@ -273,7 +648,13 @@ class FileUpload(_TransferBuildStep):
             self.addURL(os.path.basename(masterdest), self.url)
 
         # we use maxsize to limit the amount of data on both sides
-        fileWriter = _FileWriter(masterdest, self.maxsize, self.mode)
+        store = self._getContentStore("uploadFile")
+        if store:
+            fileWriter = _ContentFileWriter(masterdest, self.maxsize,
+                                            self.mode, store)
+        else:
+            fileWriter = _FileWriter(masterdest, self.maxsize, self.mode)
+        self.transfer = fileWriter
 
         if self.keepstamp and self.slaveVersionIsOlderThan("uploadFile","2.13"):
             m = ("This buildslave (%s) does not support preserving timestamps. "
@@ -289,7 +670,10 @@ class FileUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'keepstamp': self.keepstamp,
             }
+        if store:
+            args['content_hash'] = True
 
+        self.transferStarted = now()
         self.cmd = makeStatusRemoteCommand(self, 'uploadFile', args)
         d = self.runCommand(self.cmd)
         @d.addErrback
@@ -307,7 +691,8 @@ class DirectoryUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024,
-                 compress=None, url=None, **buildstep_kwargs):
+                 compress=None, url=None, contentStore=None,
+                 **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
                                  masterdest=masterdest,
@@ -316,6 +701,7 @@ class DirectoryUpload(_TransferBuildStep):
                                  blocksize=blocksize,
                                  compress=compress,
                                  url=url,
+                                 contentStore=contentStore,
                                  )
 
         self.slavesrc = slavesrc
@@ -328,6 +714,7 @@ class DirectoryUpload(_TransferBuildStep):
                 "'compress' must be one of None, 'gz', or 'bz2'")
         self.compress = compress
         self.url = url
+        self.contentStore = contentStore
 
     def start(self):
         version = self.slaveVersion("uploadDirectory")
@@ -351,7 +738,14 @@ class DirectoryUpload(_TransferBuildStep):
             self.addURL(os.path.basename(masterdest), self.url)
         
         # we use maxsize to limit the amount of data on both sides
-        dirWriter = _DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
+        store = self._getContentStore("uploadDirectory")
+        if store:
+            dirWriter = _ContentDirectoryWriter(masterdest, self.maxsize,
+                                                self.compress, 0600, store)
+        else:
+            dirWriter = _DirectoryWriter(masterdest, self.maxsize,
+                                         self.compress, 0600)
+        self.transfer = dirWriter
 
         # default arguments
         args = {
@@ -362,7 +756,10 @@ class DirectoryUpload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'compress': self.compress
             }
+        if store:
+            args['content_hash'] = True
 
+        self.transferStarted = now()
         self.cmd = makeStatusRemoteCommand(self, 'uploadDirectory', args)
         d = self.runCommand(self.cmd)
         @d.addErrback
@@ -378,6 +775,7 @@ class DirectoryUpload(_TransferBuildStep):
         if result == SKIPPED:
             return BuildStep.finished(self, SKIPPED)
 
+        self.setTransferStatistics()
         if self.cmd.rc is None or self.cmd.rc == 0:
             return BuildStep.finished(self, SUCCESS)
         return BuildStep.finished(self, FAILURE)
@@ -418,6 +816,291 @@ class _FileReader(pb.Referenceable):
             self.fp = None
 
 
+class _DownloadSource:
+    """
+    A file on the master that is being downloaded by one or more slaves.  The
+    file is opened once, and read in blocks that are shared by all of the
+    readers; a thread reads blocks ahead of the furthest reader.  The file is
+    read with plain reads, so if it is truncated while it is being
+    downloaded, the readers just see it end early.
+    """
+
+    # bytes to read ahead of the furthest reader
+    readAhead = 4*1024*1024
+    blockSize = 256*1024
+
+    def __init__(self, path, digest=None):
+        self.path = path
+        self.fp = open(path, 'rb')
+        st = os.fstat(self.fp.fileno())
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        # held while seeking and reading fp, from the reactor or a thread
+        self.fpLock = threading.Lock()
+        # blocks that have been read, by number; those more than readAhead
+        # behind the furthest reader are dropped
+        self.blocks = {}
+        self.furthest = 0
+        self.refs = 0
+        self.digest = digest
+        self.digestWaiters = None
+        self.prefetched = 0
+        self.prefetching = False
+        self.threads = 0 # threads using fp
+        self.closed = False
+
+    def _readBlock(self, number):
+        with self.fpLock:
+            self.fp.seek(number * self.blockSize)
+            return self.fp.read(self.blockSize)
+
+    def read(self, offset, length):
+        if self.closed:
+            return ''
+        end = min(offset + length, self.size)
+        chunks = []
+        while offset < end:
+            number, start = divmod(offset, self.blockSize)
+            block = self.blocks.get(number)
+            if block is None:
+                # not read ahead (yet), or dropped, so read it now
+                block = self._readBlock(number)
+                if number >= self._firstBlock():
+                    self.blocks[number] = block
+            data = block[start:start + end - offset]
+            if not data:
+                # the file has been truncated
+                break
+            chunks.append(data)
+            offset += len(data)
+        if offset > self.furthest:
+            self.furthest = offset
+            self._dropBlocks()
+        if (not self.prefetching and self.prefetched < self.size
+                and offset + self.readAhead / 2 > self.prefetched):
+            start = max(self.prefetched, offset)
+            stop = min(self.size, offset + self.readAhead)
+            self.prefetching = True
+            d = self._inThread(self._prefetch, start, stop)
+            @d.addCallback
+            def gotBlocks(blocks):
+                if self.closed:
+                    return
+                for number, block in blocks:
+                    self.blocks.setdefault(number, block)
+                self._dropBlocks()
+            @d.addBoth
+            def done(res):
+                self.prefetching = False
+                self.prefetched = stop
+                return res
+            d.addErrback(log.err, 'while prefetching %r' % self.path)
+        return ''.join(chunks)
+
+    def _firstBlock(self):
+        return (self.furthest - self.readAhead) // self.blockSize
+
+    def _dropBlocks(self):
+        first = self._firstBlock()
+        for number in [ n for n in self.blocks if n < first ]:
+            del self.blocks[number]
+
+    def _inThread(self, f, *args):
+        # run f in a thread, keeping fp open until it is done
+        self.threads += 1
+        d = threads.deferToThread(f, *args)
+        @d.addBoth
+        def done(res):
+            self.threads -= 1
+            if self.closed and not self.threads:
+                self.fp.close()
+            return res
+        return d
+
+    def _prefetch(self, start, stop):
+        # runs in a thread
+        return [ (number, self._readBlock(number))
+                 for number in xrange(start // self.blockSize,
+                                      (stop - 1) // self.blockSize + 1) ]
+
+    def getDigest(self):
+        """Return a Deferred that fires with the hex SHA-1 digest of the
+        file, which is only computed once however many readers ask"""
+        if self.digest is not None:
+            return defer.succeed(self.digest)
+        d = defer.Deferred()
+        if self.digestWaiters is None:
+            self.digestWaiters = []
+            d1 = self._inThread(self._hash)
+            d1.addBoth(self._gotDigest)
+        self.digestWaiters.append(d)
+        return d
+
+    def _hash(self):
+        # runs in a thread
+        sha = sha1()
+        for number in xrange(0, (self.size - 1) // self.blockSize + 1):
+            sha.update(self._readBlock(number))
+        return sha.hexdigest()
+
+    def _gotDigest(self, res):
+        waiters, self.digestWaiters = self.digestWaiters, None
+        if not isinstance(res, failure.Failure):
+            self.digest = res
+        for d in waiters:
+            if isinstance(res, failure.Failure):
+                d.errback(res)
+            else:
+                d.callback(res)
+
+    def close(self):
+        self.closed = True
+        self.blocks = {}
+        if not self.threads:
+            self.fp.close()
+
+
+class DownloadSources:
+    """
+    The files currently being downloaded, keyed by path, so that concurrent
+    downloads of the same file share one L{_DownloadSource}.  A source is
+    replaced when the file's size or modification time changes, and the
+    digest of each file is remembered until it does.
+    """
+
+    def __init__(self):
+        self.sources = {}
+        self.digests = {}
+
+    def acquire(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime)
+        src = self.sources.get(path)
+        if src is None or (src.size, src.mtime) != key:
+            digest = None
+            if path in self.digests and self.digests[path][0] == key:
+                digest = self.digests[path][1]
+            src = _DownloadSource(path, digest)
+            self.sources[path] = src
+        src.refs += 1
+        return src
+
+    def release(self, src):
+        if src.digest is not None:
+            self.digests[src.path] = ((src.size, src.mtime), src.digest)
+        src.refs -= 1
+        if src.refs <= 0:
+            if self.sources.get(src.path) is src:
+                del self.sources[src.path]
+            src.close()
+
+downloadSources = DownloadSources()
+
+
+class _SharedFileReader(pb.Referenceable):
+    """
+    Helper class that serves one slave's download from a L{_DownloadSource},
+    either a block at a time as the slave reads it, or by pushing blocks to
+    the slave with up to L{window} of them unacknowledged at once.
+    """
+
+    window = 16
+
+    bytesTransferred = 0
+    bytesSaved = 0
+    savesContent = False
+
+    def __init__(self, sources, source, blocksize):
+        self.sources = sources
+        self.source = source
+        self.blocksize = blocksize
+        self.offset = 0
+        self.consumer = None
+        self.outstanding = 0
+        self.pumping = False
+        self.stopped = False
+        self.pushFailure = None
+        self.pushDone = None
+
+    def remote_read(self, maxlength):
+        """
+        Called from remote slave to read at most L{maxlength} bytes of data
+        """
+        if self.source is None:
+            return ''
+        data = self.source.read(self.offset, maxlength)
+        self.offset += len(data)
+        self.bytesTransferred += len(data)
+        return data
+
+    def remote_push(self, consumer):
+        """
+        Called from remote slave to have the file sent to L{consumer}'s
+        C{write} method, which returns False if no more data is wanted.
+        Returns a Deferred that fires when the last block has been
+        acknowledged.
+        """
+        self.consumer = consumer
+        self.pushDone = defer.Deferred()
+        d = self.pushDone
+        self._pump()
+        return d
+
+    def _pump(self):
+        if self.pumping:
+            return
+        self.pumping = True
+        try:
+            while not self.stopped and self.outstanding < self.window:
+                data = self.remote_read(self.blocksize)
+                if not data:
+                    self.stopped = True
+                    break
+                self.outstanding += 1
+                d = self.consumer.callRemote('write', data)
+                d.addCallbacks(self._acked, self._pushFailed)
+        finally:
+            self.pumping = False
+        if self.stopped and self.outstanding == 0 and self.pushDone:
+            d, self.pushDone = self.pushDone, None
+            if self.pushFailure:
+                d.errback(self.pushFailure)
+            else:
+                d.callback(None)
+
+    def _acked(self, more):
+        self.outstanding -= 1
+        if not more:
+            self.stopped = True
+        self._pump()
+
+    def _pushFailed(self, f):
+        self.outstanding -= 1
+        self.stopped = True
+        if self.pushFailure is None:
+            self.pushFailure = f
+        self._pump()
+
+    def remote_upToDate(self):
+        """
+        Called from remote slave when its copy of the file already matches
+        """
+        if self.source is not None:
+            self.bytesSaved = self.source.size
+
+    def remote_close(self):
+        """
+        Called by remote slave to state that no more data will be transfered
+        """
+        self.release()
+
+    def release(self):
+        if self.source is not None:
+            self.sources.release(self.source)
+            self.source = None
+
+
 class FileDownload(_TransferBuildStep):
 
     name = 'download'
@@ -464,8 +1147,8 @@ class FileDownload(_TransferBuildStep):
 
         # setup structures for reading the file
         try:
-            fp = open(source, 'rb')
-        except IOError:
+            src = downloadSources.acquire(source)
+        except (IOError, OSError):
             # if file does not exist, bail out with an error
             self.addCompleteLog('stderr',
                                 'File %r not available at master' % source)
@@ -473,7 +1156,8 @@ class FileDownload(_TransferBuildStep):
             # maybeDeferred, just re-raise the exception here.
             reactor.callLater(0, BuildStep.finished, self, FAILURE)
             return
-        fileReader = _FileReader(fp)
+        fileReader = _SharedFileReader(downloadSources, src, self.blocksize)
+        self.transfer = fileReader
 
         # default arguments
         args = {
@@ -485,8 +1169,28 @@ class FileDownload(_TransferBuildStep):
             'mode': self.mode,
             }
 
-        self.cmd = makeStatusRemoteCommand(self, 'downloadFile', args)
-        d = self.runCommand(self.cmd)
+        if self.slaveVersionIsOlderThan('downloadFile', '2.18'):
+            d = defer.succeed(None)
+        else:
+            # let the slave skip the download if it already has the file,
+            # and push the file to it rather than waiting for it to read
+            fileReader.savesContent = True
+            d = src.getDigest()
+            @d.addCallback
+            def addStat(digest):
+                args['source_stat'] = dict(size=src.size, mtime=src.mtime,
+                                           digest=digest)
+                args['push'] = True
+
+        @d.addCallback
+        def run(_):
+            self.transferStarted = now()
+            self.cmd = makeStatusRemoteCommand(self, 'downloadFile', args)
+            return self.runCommand(self.cmd)
+        @d.addBoth
+        def release(res):
+            fileReader.release()
+            return res
         d.addCallback(self.finished).addErrback(self.failed)
 
 class StringDownload(_TransferBuildStep):
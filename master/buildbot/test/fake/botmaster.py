@@ -24,7 +24,9 @@ class FakeBotMaster(service.MultiService):
 
     def getLockByID(self, lockid):
         if not lockid in self.locks:
-            self.locks[lockid] = lockid.lockClass(lockid)
+            lock = self.locks[lockid] = lockid.lockClass(lockid)
+            if lockid.distributed:
+                lock.master = self.master
         # if the master.cfg file has changed maxCount= on the lock, the next
         # time a build is started, they'll get a new RealLock instance. Note
         # that this requires that MasterLock and SlaveLock (marker) instances
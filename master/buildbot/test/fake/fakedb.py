@@ -311,6 +311,22 @@ class Build(Row):
 
     id_column = 'id'
 
+class LockClaim(Row):
+    table = "lock_claims"
+
+    defaults = dict(
+        id = None,
+        lockname = 'lk',
+        slavename = '',
+        objectid = None,
+        exclusive = 0,
+        granted = 0,
+        requested_at = 1304262222,
+        expires_at = 1304262282)
+
+    id_column = 'id'
+    required_columns = ( 'objectid', )
+
 # Fake DB Components
 
 # TODO: test these using the same test methods as are used against the real
@@ -908,6 +924,19 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             rv.append(self._brdictFromRow(br))
         return defer.succeed(rv)
 
+    def getUnclaimedBuildRequestCounts(self):
+        rv = {}
+        for br in self.reqs.itervalues():
+            if br.complete or br.id in self.claims:
+                continue
+            counts = rv.setdefault(br.buildername,
+                                   dict(count=0, oldest=None))
+            counts['count'] += 1
+            submitted_at = epoch2datetime(br.submitted_at)
+            if counts['oldest'] is None or submitted_at < counts['oldest']:
+                counts['oldest'] = submitted_at
+        return defer.succeed(rv)
+
     def claimBuildRequests(self, brids, claimed_at=None):
         for brid in brids:
             if brid not in self.reqs or brid in self.claims:
@@ -1145,6 +1174,80 @@ class FakeUsersComponent(FakeDBComponent):
                 return defer.succeed(uid)
         return defer.succeed(None)
 
+class FakeLocksComponent(FakeDBComponent):
+
+    MASTER_ID = 824
+    _reactor = reactor
+
+    def setUp(self):
+        self.claims = {}
+
+    def insertTestData(self, rows):
+        for row in rows:
+            if isinstance(row, LockClaim):
+                self.claims[row.id] = row
+
+    # component methods
+
+    def requestLock(self, lockname, slavename, exclusive, lease):
+        now = self._reactor.seconds()
+        claimid = max([ 0 ] + self.claims.keys()) + 1
+        self.claims[claimid] = LockClaim(id=claimid, lockname=lockname,
+                slavename=slavename, objectid=self.MASTER_ID,
+                exclusive=exclusive and 1 or 0, granted=0,
+                requested_at=now, expires_at=now + lease)
+        return defer.succeed(claimid)
+
+    def grantLock(self, claimid, maxCount, lease):
+        if claimid not in self.claims:
+            return defer.succeed(None)
+        mine = self.claims[claimid]
+        if mine.granted:
+            return defer.succeed(True)
+        now = self._reactor.seconds()
+        rows = [ self.claims[id] for id in sorted(self.claims)
+                 if self.claims[id].lockname == mine.lockname
+                 and self.claims[id].slavename == mine.slavename ]
+        for row in rows:
+            if row.expires_at < now:
+                del self.claims[row.id]
+        rows = [ row for row in rows if row.expires_at >= now ]
+        if claimid not in self.claims:
+            return defer.succeed(None)
+
+        granted = [ row for row in rows if row.granted ]
+        waiting = [ row for row in rows if not row.granted ]
+        if waiting[0].id != claimid:
+            return defer.succeed(False)
+        num_excl = len([ row for row in granted if row.exclusive ])
+        if mine.exclusive:
+            ok = not granted
+        else:
+            ok = not num_excl and len(granted) < maxCount
+        if ok:
+            mine.granted = 1
+            mine.expires_at = now + lease
+        return defer.succeed(ok)
+
+    def releaseLock(self, claimid):
+        self.claims.pop(claimid, None)
+        return defer.succeed(None)
+
+    def renewLocks(self, claimids, lease):
+        for claimid in claimids:
+            if claimid in self.claims:
+                self.claims[claimid].expires_at = \
+                        self._reactor.seconds() + lease
+        return defer.succeed(None)
+
+    def getLockClaims(self, lockname, slavename=''):
+        return defer.succeed([ dict(claimid=row.id, lockname=row.lockname,
+                    slavename=row.slavename, objectid=row.objectid,
+                    exclusive=bool(row.exclusive), granted=bool(row.granted),
+                    requested_at=row.requested_at, expires_at=row.expires_at)
+                for id, row in sorted(self.claims.items())
+                if row.lockname == lockname and row.slavename == slavename ])
+
 class FakeDBConnector(object):
     """
     A stand-in for C{master.db} that operates without an actual database
@@ -1175,6 +1278,8 @@ class FakeDBConnector(object):
         self._components.append(comp)
         self.users = comp = FakeUsersComponent(self, testcase)
         self._components.append(comp)
+        self.locks = comp = FakeLocksComponent(self, testcase)
+        self._components.append(comp)
 
     def setup(self):
         self.is_setup = True
@@ -26,9 +26,11 @@ class FakeRequest(Mock):
     """
 
     written = ''
+    writes = 0
     finished = False
     redirected_to = None
     failure = None
+    producer = None
 
     def __init__(self, args={}):
         Mock.__init__(self)
@@ -48,6 +50,18 @@ class FakeRequest(Mock):
 
     def write(self, data):
         self.written = self.written + data
+        self.writes += 1
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        # like a transport, pull from a non-streaming producer until it
+        # unregisters
+        if not streaming:
+            while self.producer:
+                producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
 
     def redirect(self, url):
         self.redirected_to = url
@@ -63,6 +63,12 @@ class TestAbstractBuildSlave(unittest.TestCase):
             self.ConcreteBuildSlave('bot', 'pass',
                     notify_on_missing=['a@b.com', 13]))
 
+    def test_constructor_distributed_lock(self):
+        lock = locks.SlaveLock('lk', distributed=True)
+        self.assertRaises(config.ConfigErrors, lambda :
+            self.ConcreteBuildSlave('bot', 'pass',
+                    locks=[lock.access('counting')]))
+
     @defer.inlineCallbacks
     def do_test_reconfigService(self, old, old_port, new, new_port):
         master = self.master = fakemaster.make_master()
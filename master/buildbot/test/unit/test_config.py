@@ -47,6 +47,7 @@ global_defaults = dict(
     mergeRequests=None,
     prioritizeBuilders=None,
     slavePortnum=None,
+    slaveUpdateWindow=16,
     multiMaster=False,
     debugPassword=None,
     manhole=None,
@@ -371,6 +372,15 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
     def test_load_global_logMaxTailSize(self):
         self.do_test_load_global(dict(logMaxTailSize=123), logMaxTailSize=123)
 
+    def test_load_global_slaveUpdateWindow(self):
+        self.do_test_load_global(dict(slaveUpdateWindow=4),
+                slaveUpdateWindow=4)
+
+    def test_load_global_slaveUpdateWindow_negative(self):
+        self.cfg.load_global(self.filename,
+                dict(slaveUpdateWindow=-1), self.errors)
+        self.assertConfigError(self.errors, "must be 0 or more")
+
     def test_load_global_properties(self):
         exp = properties.Properties()
         exp.setProperty('x', 10, self.filename)
@@ -492,6 +502,40 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
             self.errors)
         self.assertConfigError(self.errors, "must be an int")
 
+    def test_load_db_slow_query_threshold(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', slow_query_threshold=0.5)),
+            self.errors)
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                   slow_query_threshold=0.5))
+
+    def test_load_db_slow_query_threshold_not_number(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', slow_query_threshold='1s')),
+            self.errors)
+        self.assertConfigError(self.errors, "must be a number")
+
+    def test_load_db_pool_sizes(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', pool_sizes=dict(status=2),
+                         replica_url='efgh')),
+            self.errors)
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                   pool_sizes=dict(status=2),
+                                   replica_url='efgh'))
+
+    def test_load_db_pool_sizes_unknown_workload(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', pool_sizes=dict(web=2))),
+            self.errors)
+        self.assertConfigError(self.errors, "unknown workload 'web'")
+
+    def test_load_db_pool_sizes_not_positive(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', pool_sizes=dict(status=0))),
+            self.errors)
+        self.assertConfigError(self.errors, "must be a positive int")
+
 
     def test_load_metrics_defaults(self):
         self.cfg.load_metrics(self.filename, {}, self.errors)
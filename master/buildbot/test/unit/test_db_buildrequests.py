@@ -296,6 +296,34 @@ class TestBuildsetsConnectorComponent(
         d.addCallback(check)
         return d
 
+    def test_getUnclaimedBuildRequestCounts(self):
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=44, buildsetid=self.BSID,
+                buildername="bbb", submitted_at=1300305712),
+            fakedb.BuildRequest(id=45, buildsetid=self.BSID,
+                buildername="bbb", submitted_at=1300305000),
+            # claimed
+            fakedb.BuildRequest(id=46, buildsetid=self.BSID,
+                buildername="bbb", submitted_at=1300300000),
+            fakedb.BuildRequestClaim(brid=46, objectid=self.OTHER_MASTER_ID,
+                    claimed_at=self.CLAIMED_AT_EPOCH),
+            # complete
+            fakedb.BuildRequest(id=47, buildsetid=self.BSID,
+                buildername="ccc", complete=1,
+                complete_at=self.COMPLETE_AT_EPOCH),
+            fakedb.BuildRequest(id=48, buildsetid=self.BSID,
+                buildername="ddd", submitted_at=1300305712),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getUnclaimedBuildRequestCounts())
+        def check(counts):
+            self.assertEqual(counts, {
+                'bbb' : dict(count=2, oldest=epoch2datetime(1300305000)),
+                'ddd' : dict(count=1, oldest=epoch2datetime(1300305712)),
+            })
+        d.addCallback(check)
+        return d
+
     def do_test_claimBuildRequests(self, rows, now, brids, expected=None,
                                   expfailure=None, claimed_at=None):
         clock = task.Clock()
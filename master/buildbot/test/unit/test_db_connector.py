@@ -17,7 +17,7 @@ import os
 import mock
 from twisted.internet import defer
 from twisted.trial import unittest
-from buildbot.db import connector
+from buildbot.db import connector, enginestrategy
 from buildbot import config
 from buildbot.test.util import db
 from buildbot.test.fake import fakemaster
@@ -85,3 +85,59 @@ class DBConnector(db.RealDatabaseMixin, unittest.TestCase):
     def test_setup_check_version_good(self):
         self.db.model.is_current = lambda : defer.succeed(True)
         return self.startService(check_version=True)
+
+
+class Pools(unittest.TestCase):
+
+    def setUp(self):
+        self.master = fakemaster.make_master()
+        self.master.config = config.MasterConfig()
+        self.db = connector.DBConnector(self.master,
+                                os.path.abspath('basedir'))
+        if not os.path.exists('basedir'):
+            os.makedirs('basedir')
+
+    def tearDown(self):
+        if self.db.pool:
+            self.db.pool.shutdown()
+
+    def setupPools(self, db_url='sqlite:///state.sqlite', **db_config):
+        self.db._engine = enginestrategy.create_engine(db_url,
+                                basedir=os.path.abspath('basedir'))
+        self.db.setupPools(db_config)
+
+    def test_default(self):
+        self.setupPools()
+        self.assertEqual(self.db.pool.workloadPools, {})
+        self.assertIdentical(self.db.pool.forWorkload('status').pool,
+                             self.db.pool)
+
+    def test_pool_sizes(self):
+        self.setupPools(pool_sizes=dict(scheduler=3, status=2))
+        self.assertEqual(self.db.pool.max, 3)
+        self.assertEqual(self.db.pool.workloadPools.keys(), [ 'status' ])
+        status = self.db.pool.workloadPools['status']
+        self.assertEqual(status.max, 2)
+        self.assertIdentical(status.engine, self.db.pool.engine)
+        self.assertIdentical(self.db.pool.forWorkload('status').pool, status)
+        self.assertIdentical(self.db.pool.forWorkload('maintenance').pool,
+                             self.db.pool)
+
+    def test_pool_sizes_single_connection(self):
+        self.setupPools('sqlite://', pool_sizes=dict(status=2))
+        self.assertEqual(self.db.pool.workloadPools, {})
+
+    def test_replica_url(self):
+        self.setupPools(replica_url='sqlite:///replica.sqlite')
+        status = self.db.pool.workloadPools['status']
+        self.assertNotIdentical(status.engine, self.db.pool.engine)
+        self.assertEqual(status.engine.url.database,
+                         os.path.abspath(os.path.join('basedir',
+                                                      'replica.sqlite')))
+
+    def test_slow_query_threshold(self):
+        self.setupPools(pool_sizes=dict(maintenance=1))
+        self.db.setSlowQueryThreshold(2)
+        self.assertEqual(self.db.pool.slowQueryThreshold, 2)
+        self.assertEqual(
+            self.db.pool.workloadPools['maintenance'].slowQueryThreshold, 2)
@@ -0,0 +1,158 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from buildbot.db import locks
+from buildbot.test.util import connector_component
+from buildbot.test.fake import fakedb
+
+class TestLocksConnectorComponent(
+            connector_component.ConnectorComponentMixin,
+            unittest.TestCase):
+
+    MASTER_ID = fakedb.FakeLocksComponent.MASTER_ID
+    OTHER_MASTER_ID = MASTER_ID + 1111
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        d = self.setUpConnectorComponent(
+            table_names=['objects', 'lock_claims' ])
+
+        def finish_setup(_):
+            self.db.locks = locks.LocksConnectorComponent(self.db)
+            self.db.master.getObjectId = lambda : defer.succeed(self.MASTER_ID)
+        d.addCallback(finish_setup)
+        d.addCallback(lambda _ : self.insertTestData([
+                fakedb.Object(id=self.MASTER_ID, name="fake master",
+                              class_name="BuildMaster"),
+                fakedb.Object(id=self.OTHER_MASTER_ID, name="other master",
+                              class_name="BuildMaster"),
+            ]))
+        return d
+
+    def tearDown(self):
+        return self.tearDownConnectorComponent()
+
+    def request(self, exclusive, lockname='lk', slavename=''):
+        return self.db.locks.requestLock(lockname, slavename, exclusive, 60,
+                                         _reactor=self.clock)
+
+    def grant(self, claimid, maxCount=1):
+        return self.db.locks.grantLock(claimid, maxCount, 60,
+                                       _reactor=self.clock)
+
+    def getClaims(self, slavename=''):
+        d = self.db.locks.getLockClaims('lk', slavename)
+        d.addCallback(lambda claims :
+                [ (c['claimid'], c['exclusive'], c['granted'])
+                  for c in claims ])
+        return d
+
+    @defer.inlineCallbacks
+    def test_requestLock(self):
+        claimid = yield self.request(True, slavename='bs1')
+        claims = yield self.db.locks.getLockClaims('lk', 'bs1')
+        self.assertEqual(claims, [ dict(claimid=claimid, lockname='lk',
+                slavename='bs1', objectid=self.MASTER_ID, exclusive=True,
+                granted=False, requested_at=1000, expires_at=1060) ])
+        claims = yield self.db.locks.getLockClaims('lk')
+        self.assertEqual(claims, [])
+
+    @defer.inlineCallbacks
+    def test_grantLock_exclusive(self):
+        first = yield self.request(True)
+        second = yield self.request(True)
+        self.assertEqual((yield self.grant(second)), False)
+        self.assertEqual((yield self.grant(first)), True)
+        self.assertEqual((yield self.grant(first)), True)
+        self.assertEqual((yield self.grant(second)), False)
+        yield self.db.locks.releaseLock(first)
+        self.assertEqual((yield self.grant(second)), True)
+        self.assertEqual((yield self.getClaims()), [ (second, True, True) ])
+
+    @defer.inlineCallbacks
+    def test_grantLock_counting(self):
+        claimids = []
+        for i in range(3):
+            claimids.append((yield self.request(False)))
+        self.assertEqual((yield self.grant(claimids[0], maxCount=2)), True)
+        self.assertEqual((yield self.grant(claimids[1], maxCount=2)), True)
+        self.assertEqual((yield self.grant(claimids[2], maxCount=2)), False)
+
+    @defer.inlineCallbacks
+    def test_grantLock_fifo(self):
+        # a waiting exclusive claim keeps later counting claims waiting
+        counting = yield self.request(False)
+        exclusive = yield self.request(True)
+        later = yield self.request(False)
+        self.assertEqual((yield self.grant(counting, maxCount=2)), True)
+        self.assertEqual((yield self.grant(exclusive, maxCount=2)), False)
+        self.assertEqual((yield self.grant(later, maxCount=2)), False)
+        yield self.db.locks.releaseLock(counting)
+        self.assertEqual((yield self.grant(exclusive, maxCount=2)), True)
+
+    @defer.inlineCallbacks
+    def test_grantLock_separate_slaves(self):
+        bs1 = yield self.request(True, slavename='bs1')
+        bs2 = yield self.request(True, slavename='bs2')
+        self.assertEqual((yield self.grant(bs1)), True)
+        self.assertEqual((yield self.grant(bs2)), True)
+
+    @defer.inlineCallbacks
+    def test_grantLock_expired(self):
+        yield self.insertTestData([
+            fakedb.LockClaim(id=10, objectid=self.OTHER_MASTER_ID,
+                exclusive=1, granted=1, requested_at=900, expires_at=950),
+        ])
+        claimid = yield self.request(True)
+        self.assertEqual((yield self.grant(claimid)), True)
+        self.assertEqual((yield self.getClaims()), [ (claimid, True, True) ])
+
+    @defer.inlineCallbacks
+    def test_grantLock_own_claim_expired(self):
+        claimid = yield self.request(True)
+        self.clock.advance(61)
+        self.assertEqual((yield self.grant(claimid)), None)
+        self.assertEqual((yield self.getClaims()), [])
+
+    @defer.inlineCallbacks
+    def test_grantLock_lost_race(self):
+        yield self.insertTestData([
+            fakedb.LockClaim(id=10, objectid=self.OTHER_MASTER_ID,
+                exclusive=1, granted=0, requested_at=1000, expires_at=1060),
+            fakedb.LockClaim(id=11, objectid=self.MASTER_ID,
+                exclusive=1, granted=0, requested_at=1000, expires_at=1060),
+        ])
+        yield self.db.locks.releaseLock(10)
+        def hook(conn):
+            # meanwhile, another master, which had not yet seen claim 10
+            # released, grants it
+            conn.execute(self.db.model.lock_claims.insert(), id=10,
+                lockname='lk', slavename='', objectid=self.OTHER_MASTER_ID,
+                exclusive=1, granted=1, requested_at=1000, expires_at=1060)
+        self.db.locks._test_timing_hook = hook
+        self.assertEqual((yield self.grant(11)), False)
+        self.assertEqual((yield self.getClaims()),
+                [ (10, True, True), (11, True, False) ])
+
+    @defer.inlineCallbacks
+    def test_renewLocks(self):
+        claimid = yield self.request(True)
+        self.clock.advance(50)
+        yield self.db.locks.renewLocks([ claimid ], 60, _reactor=self.clock)
+        claims = yield self.db.locks.getLockClaims('lk')
+        self.assertEqual(claims[0]['expires_at'], 1110)
@@ -0,0 +1,66 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from twisted.trial import unittest
+from buildbot.test.util import migration
+
+class Migration(migration.MigrateTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        return self.setUpMigrateTest()
+
+    def tearDown(self):
+        return self.tearDownMigrateTest()
+
+    # create tables as they are before migrating to version 023
+    def create_tables_thd(self, conn):
+        metadata = sa.MetaData()
+        metadata.bind = conn
+
+        objects = sa.Table("objects", metadata,
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column('name', sa.String(128), nullable=False),
+            sa.Column('class_name', sa.String(128), nullable=False),
+        )
+        objects.create(bind=conn)
+
+    def test_lock_claims(self):
+        def setup_thd(conn):
+            self.create_tables_thd(conn)
+            conn.execute(sa.text("insert into objects values "
+                            "(13, 'master', 'buildbot.master.BuildMaster')"))
+
+        def verify_thd(conn):
+            metadata = sa.MetaData()
+            metadata.bind = conn
+            lock_claims = sa.Table('lock_claims', metadata, autoload=True)
+
+            conn.execute(lock_claims.insert(), lockname='lk', objectid=13,
+                         exclusive=1, requested_at=100, expires_at=160)
+            res = conn.execute(sa.select([ lock_claims.c.lockname,
+                        lock_claims.c.slavename, lock_claims.c.objectid,
+                        lock_claims.c.exclusive, lock_claims.c.granted,
+                        lock_claims.c.requested_at,
+                        lock_claims.c.expires_at ]))
+            self.assertEqual(map(tuple, res.fetchall()),
+                    [ ('lk', '', 13, 1, 0, 100, 160) ])
+
+            insp = sa.engine.reflection.Inspector.from_engine(conn)
+            self.assertEqual([ (idx['name'], idx['column_names'])
+                               for idx in insp.get_indexes('lock_claims') ],
+                    [ ('lock_claims_lock', [ 'lockname', 'slavename' ]) ])
+
+        return self.do_test_migration(22, 23, setup_thd, verify_thd)
@@ -18,7 +18,9 @@ import time
 import sqlalchemy as sa
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.python import log, threadpool
 from buildbot.db import pool
+from buildbot.process import metrics
 from buildbot.test.util import db
 
 class Basic(unittest.TestCase):
@@ -129,6 +131,158 @@ class Stress(unittest.TestCase):
     del test_inserts
 
 
+class Instrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.engine.optimal_thread_pool_size = 1
+        self.pool = pool.DBThreadPool(self.engine)
+        self.registry = metrics.MetricRegistry()
+        self.patch(metrics, '_registry', self.registry)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def getNumbers(self):
+        def thd(conn):
+            rp = conn.execute("SELECT 1 UNION SELECT 2 UNION SELECT 3")
+            return [ row[0] for row in rp.fetchall() ]
+        return self.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        res = yield self.getNumbers()
+        self.assertEqual(res, [1, 2, 3])
+        for timer in ('DBThreadPool.wait', 'DBThreadPool.wait.getNumbers',
+                      'DBThreadPool.execute',
+                      'DBThreadPool.execute.getNumbers'):
+            snapshot = self.registry.histograms[timer].snapshot()
+            self.assertEqual(snapshot['count'], 1, timer)
+        self.assertEqual(
+            self.registry.counters['DBThreadPool.rows.getNumbers'], 3)
+        self.assertEqual(self.registry.gauges['DBThreadPool.busy'], 0)
+        self.assertEqual(self.registry.gauges['DBThreadPool.waiting'], 0)
+
+    @defer.inlineCallbacks
+    def test_metrics_failure(self):
+        def fail(conn):
+            raise RuntimeError("oh noes")
+        yield self.assertFailure(self.pool.do(fail), RuntimeError)
+        self.assertEqual(
+            self.registry.counters['DBThreadPool.rows.test_metrics_failure'],
+            0)
+        self.assertIn('DBThreadPool.execute.test_metrics_failure',
+                      self.registry.timers)
+
+    def test_saturation(self):
+        self.assertEqual(self.pool.getSaturation(),
+                         dict(size=1, busy=0, waiting=0))
+        d1 = self.getNumbers()
+        d2 = self.getNumbers()
+        self.assertEqual(self.pool.getSaturation(),
+                         dict(size=1, busy=1, waiting=1))
+        self.assertEqual(self.registry.gauges['DBThreadPool.waiting'], 1)
+        d = defer.gatherResults([ d1, d2 ])
+        d.addCallback(lambda _ :
+            self.assertEqual(self.pool.getSaturation(),
+                             dict(size=1, busy=0, waiting=0)))
+        return d
+
+    @defer.inlineCallbacks
+    def test_slow_query_log(self):
+        logged = []
+        self.patch(log, 'msg', lambda line, **kw : logged.append(line))
+        self.pool.slowQueryThreshold = 0
+        yield self.getNumbers()
+        slow = [ l for l in logged if l.startswith('slow query') ]
+        self.assertEqual(len(slow), 1)
+        self.assertIn('getNumbers', slow[0])
+        self.assertIn('3 rows', slow[0])
+        self.assertIn('SELECT 1 UNION SELECT 2 UNION SELECT 3', slow[0])
+
+    @defer.inlineCallbacks
+    def test_slow_query_log_fast(self):
+        logged = []
+        self.patch(log, 'msg', lambda line, **kw : logged.append(line))
+        self.pool.slowQueryThreshold = 60
+        yield self.getNumbers()
+        self.assertEqual([ l for l in logged if l.startswith('slow query') ],
+                         [])
+
+
+class Workloads(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.engine.optimal_thread_pool_size = 1
+        self.pool = pool.DBThreadPool(self.engine)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_size(self):
+        engine = sa.create_engine('sqlite://')
+        def check(engine, size, expected):
+            p = pool.DBThreadPool(engine, size=size)
+            self.addCleanup(p.shutdown)
+            self.assertEqual(p.max, expected)
+        check(engine, None, 5)
+        check(engine, 8, 8)
+        # the engine's limit wins
+        check(self.engine, 8, 1)
+
+    @defer.inlineCallbacks
+    def test_priority(self):
+        order = []
+        def thd(conn, what):
+            order.append(what)
+        # the pool does not start until the reactor runs, so all of these
+        # are queued before any of them runs
+        d1 = self.pool.forWorkload('maintenance').do(thd, 'maintenance1')
+        d2 = self.pool.forWorkload('status').do(thd, 'status')
+        d3 = self.pool.forWorkload('maintenance').do(thd, 'maintenance2')
+        d4 = self.pool.do(thd, 'scheduler')
+        yield defer.gatherResults([ d1, d2, d3, d4 ])
+        self.assertEqual(order, [ 'scheduler', 'status', 'maintenance1',
+                                  'maintenance2' ])
+
+    @defer.inlineCallbacks
+    def test_workload_pool(self):
+        other = pool.DBThreadPool(sa.create_engine('sqlite://'),
+                                  name='DBThreadPool.status')
+        self.addCleanup(other.shutdown)
+        self.pool.setWorkloadPool('status', other)
+        self.assertIdentical(self.pool.forWorkload('status').pool, other)
+        self.assertIdentical(self.pool.forWorkload('status').engine,
+                             other.engine)
+        self.assertIdentical(self.pool.forWorkload('maintenance').pool,
+                             self.pool)
+
+        def thd(conn):
+            return conn.execute("SELECT 1").scalar()
+        res = yield self.pool.forWorkload('status').do(thd)
+        self.assertEqual(res, 1)
+
+    def test_queue_stop_last(self):
+        q = pool.WorkloadQueue(0)
+        q.put(threadpool.WorkerStop)
+        q.put(('ctx', 'func',
+               (False, None, (), {}, pool.Query('x', 0, 'status')), {}, None))
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.get()[2][-1].name, 'x')
+        self.assertIdentical(q.get(), threadpool.WorkerStop)
+
+
+class CountRows(unittest.TestCase):
+
+    def test_countRows(self):
+        self.assertEqual(pool.countRows(None), 0)
+        self.assertEqual(pool.countRows([1, 2]), 2)
+        self.assertEqual(pool.countRows(()), 0)
+        self.assertEqual(pool.countRows(dict(a=1, b=2)), 1)
+        self.assertEqual(pool.countRows(21), 1)
+
+
 class BasicWithDebug(Basic):
 
     # same thing, but with debug=True
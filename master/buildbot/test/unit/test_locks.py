@@ -0,0 +1,293 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import task
+from buildbot import locks
+from buildbot.test.fake import fakedb, fakemaster
+
+class BaseLock(unittest.TestCase):
+
+    def setUp(self):
+        self.lockid = locks.MasterLock('lk')
+        self.lock = locks.RealMasterLock(self.lockid)
+
+    def test_wait_time_metric(self):
+        owner1, owner2 = mock.Mock(), mock.Mock()
+        access = self.lockid.access('exclusive')
+        self.lock.claim(owner1, access)
+        self.patch(locks.util, 'now', lambda _reactor=None : 100)
+        d = self.lock.waitUntilMaybeAvailable(owner2, access)
+        self.lock.release(owner1, access)
+        self.patch(locks.util, 'now', lambda _reactor=None : 130)
+        logged = []
+        from buildbot.process import metrics
+        self.patch(metrics.MetricTimeEvent, 'log',
+                classmethod(lambda cls, timer, elapsed :
+                            logged.append((timer, elapsed))))
+        def claim(lock):
+            lock.claim(owner2, access)
+            self.assertEqual(logged, [ ('Lock.wait.lk', 30) ])
+            self.assertEqual(len(self.lock.waitStarted), 0)
+        d.addCallback(claim)
+        return d
+
+    def test_canClaim(self):
+        owner1, owner2 = mock.Mock(), mock.Mock()
+        access = self.lockid.access('exclusive')
+        self.assertTrue(self.lock.canClaim(access))
+        self.lock.claim(owner1, access)
+        self.assertFalse(self.lock.canClaim(access))
+        self.lock.waitUntilMaybeAvailable(owner2, access)
+        self.lock.release(owner1, access)
+        # owner2 is about to be woken, and should get the lock first
+        self.assertFalse(self.lock.canClaim(access))
+
+    def test_stopWaiting_forgets_owner(self):
+        owner1, owner2 = mock.Mock(), mock.Mock()
+        access = self.lockid.access('exclusive')
+        self.lock.claim(owner1, access)
+        d = self.lock.waitUntilMaybeAvailable(owner2, access)
+        self.lock.stopWaitingUntilAvailable(owner2, access, d)
+        self.assertEqual(len(self.lock.waitStarted), 0)
+
+
+class DistributedLock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(100)
+        self.master = fakemaster.make_master()
+        self.master.db = fakedb.FakeDBConnector(self)
+        self.master.db.locks._reactor = self.clock
+        lockid = locks.MasterLock('lk', distributed=True)
+        self.exclusive = lockid.access('exclusive')
+        self.counting = lockid.access('counting')
+
+    def makeLock(self, maxCount=1):
+        return locks.DistributedLock('lk', maxCount, master=self.master,
+                                     _reactor=self.clock)
+
+    def acquire(self, lock, owner, access):
+        return self.acquireAll([ (lock, access) ], owner)
+
+    def acquireAll(self, lock_list, owner):
+        # acquire the locks the way Build.acquireLocks does, returning a list
+        # that will contain the owner once it has claimed all of them
+        acquired = []
+        def tryClaim(_=None):
+            for lock, access in lock_list:
+                if not lock.isAvailableTo(owner, access):
+                    d = lock.waitUntilMaybeAvailable(owner, access)
+                    d.addCallback(tryClaim)
+                    return
+            for lock, access in lock_list:
+                lock.claim(owner, access)
+            acquired.append(owner)
+        tryClaim()
+        self.clock.advance(0)
+        return acquired
+
+    def getClaims(self):
+        claims = []
+        d = self.master.db.locks.getLockClaims('lk')
+        d.addCallback(lambda c : claims.extend(
+            [ (x['exclusive'], x['granted']) for x in c ]))
+        return claims
+
+    def test_acquire_release(self):
+        lock = self.makeLock()
+        owner = mock.Mock()
+        self.assertEqual(self.acquire(lock, owner, self.exclusive), [ owner ])
+        self.assertEqual(self.getClaims(), [ (True, True) ])
+        self.assertTrue(lock.isOwner(owner, self.exclusive))
+
+        lock.release(owner, self.exclusive)
+        self.assertEqual(self.getClaims(), [])
+        self.assertEqual(lock.owners, [])
+
+    def test_exclusive_between_masters(self):
+        lock1, lock2 = self.makeLock(), self.makeLock()
+        owner1, owner2 = mock.Mock(), mock.Mock()
+        self.assertEqual(self.acquire(lock1, owner1, self.exclusive),
+                         [ owner1 ])
+        acquired = self.acquire(lock2, owner2, self.exclusive)
+        self.assertEqual(acquired, [])
+        self.assertEqual(self.getClaims(), [ (True, True), (True, False) ])
+
+        # lock2 notices the release when it next polls
+        lock1.release(owner1, self.exclusive)
+        self.assertEqual(acquired, [])
+        self.clock.advance(lock2.pollInterval)
+        self.assertEqual(acquired, [ owner2 ])
+        self.assertEqual(self.getClaims(), [ (True, True) ])
+
+    def test_counting(self):
+        lock = self.makeLock(maxCount=2)
+        owners = [ mock.Mock() for i in range(3) ]
+        acquired = [ self.acquire(lock, owner, self.counting)
+                     for owner in owners ]
+        self.assertEqual(acquired, [ [ owners[0] ], [ owners[1] ], [] ])
+
+        # a local release wakes the next waiter immediately
+        lock.release(owners[0], self.counting)
+        self.assertEqual(acquired[2], [ owners[2] ])
+        self.assertEqual(self.getClaims(), [ (False, True), (False, True) ])
+
+    def test_unclaimed_grant_is_kept(self):
+        lock = self.makeLock()
+        owner, other = mock.Mock(), mock.Mock()
+        woken = []
+        d = lock.waitUntilMaybeAvailable(owner, self.exclusive)
+        d.addCallback(woken.append)
+        self.clock.advance(0)
+        self.assertEqual(woken, [ lock ])
+        # the grant is held for the owner, and for nobody else
+        self.assertEqual(self.getClaims(), [ (True, True) ])
+        self.assertTrue(lock.isAvailableTo(owner, self.exclusive))
+        self.assertFalse(lock.isAvailableTo(other, self.exclusive))
+        self.assertFalse(lock.canClaim(self.exclusive))
+
+        # and is renewed while the owner waits for something else
+        self.clock.pump([ 5 ] * 20)
+        self.assertEqual([ c.expires_at
+                           for c in self.master.db.locks.claims.values() ],
+                         [ 200 + 60 ])
+
+        lock.claim(owner, self.exclusive)
+        self.assertTrue(lock.isOwner(owner, self.exclusive))
+        self.assertEqual(lock.grants, [])
+
+    def test_unclaimed_grant_is_given_back_on_release(self):
+        lock = self.makeLock()
+        owner = mock.Mock()
+        lock.waitUntilMaybeAvailable(owner, self.exclusive)
+        self.clock.advance(0)
+        self.assertEqual(self.getClaims(), [ (True, True) ])
+        # as when an interrupted build releases its locks
+        lock.release(owner, self.exclusive)
+        self.assertEqual(self.getClaims(), [])
+        self.assertEqual(lock.grants, [])
+        self.assertTrue(lock.canClaim(self.exclusive))
+
+    def test_acquire_two_locks(self):
+        lockid2 = locks.MasterLock('lk2', distributed=True)
+        lock1 = self.makeLock()
+        lock2 = locks.DistributedLock('lk2', master=self.master,
+                                      _reactor=self.clock)
+        access2 = lockid2.access('exclusive')
+        owner = mock.Mock()
+        acquired = self.acquireAll([ (lock1, self.exclusive),
+                                     (lock2, access2) ], owner)
+        self.assertEqual(acquired, [ owner ])
+        self.assertTrue(lock1.isOwner(owner, self.exclusive))
+        self.assertTrue(lock2.isOwner(owner, access2))
+
+    def test_acquire_two_locks_held_elsewhere(self):
+        lockid2 = locks.MasterLock('lk2', distributed=True)
+        access2 = lockid2.access('exclusive')
+        lock1, other1 = self.makeLock(), self.makeLock()
+        lock2 = locks.DistributedLock('lk2', master=self.master,
+                                      _reactor=self.clock)
+        other2 = locks.DistributedLock('lk2', master=self.master,
+                                       _reactor=self.clock)
+        owner, other = mock.Mock(), mock.Mock()
+        # another master holds the second lock
+        self.assertEqual(self.acquire(other2, other, access2), [ other ])
+        acquired = self.acquireAll([ (lock1, self.exclusive),
+                                     (lock2, access2) ], owner)
+        self.assertEqual(acquired, [])
+        # the first lock stays granted to the owner while it waits
+        self.assertEqual(self.acquire(other1, other, self.exclusive), [])
+
+        other2.release(other, access2)
+        self.clock.advance(lock2.pollInterval)
+        self.assertEqual(acquired, [ owner ])
+        self.assertTrue(lock1.isOwner(owner, self.exclusive))
+        self.assertTrue(lock2.isOwner(owner, access2))
+
+    def test_canClaim(self):
+        lock = self.makeLock()
+        owner = mock.Mock()
+        self.assertTrue(lock.canClaim(self.exclusive))
+        self.acquire(lock, owner, self.exclusive)
+        self.assertFalse(lock.canClaim(self.exclusive))
+
+    def test_stopWaitingUntilAvailable(self):
+        lock1, lock2 = self.makeLock(), self.makeLock()
+        owner1, owner2 = mock.Mock(), mock.Mock()
+        self.acquire(lock1, owner1, self.exclusive)
+        d = lock2.waitUntilMaybeAvailable(owner2, self.exclusive)
+        self.clock.advance(0)
+        self.assertEqual(self.getClaims(), [ (True, True), (True, False) ])
+        lock2.stopWaitingUntilAvailable(owner2, self.exclusive, d)
+        self.assertEqual(lock2.waiting, [])
+        self.assertEqual(self.getClaims(), [ (True, True) ])
+
+    def test_stopWaitingUntilAvailable_before_request(self):
+        lock = self.makeLock()
+        owner = mock.Mock()
+        d = lock.waitUntilMaybeAvailable(owner, self.exclusive)
+        lock.stopWaitingUntilAvailable(owner, self.exclusive, d)
+        self.clock.advance(0)
+        self.assertEqual(self.getClaims(), [])
+
+    def test_leases_renewed(self):
+        lock = self.makeLock()
+        owner = mock.Mock()
+        self.acquire(lock, owner, self.exclusive)
+        self.clock.pump([ 5 ] * 20)
+        self.assertEqual([ c.expires_at
+                           for c in self.master.db.locks.claims.values() ],
+                         [ 200 + 60 ])
+
+        # once the lock is released, polling stops
+        lock.release(owner, self.exclusive)
+        self.clock.advance(5)
+        self.assertEqual(lock._poller, None)
+
+    def test_expired_claim_is_granted(self):
+        lock1, lock2 = self.makeLock(), self.makeLock()
+        owner1, owner2 = mock.Mock(), mock.Mock()
+        self.acquire(lock1, owner1, self.exclusive)
+        acquired = self.acquire(lock2, owner2, self.exclusive)
+        # lock1's master goes away, and its claim lapses
+        lock1._poller.stop()
+        self.clock.pump([ 5 ] * 13)
+        self.assertEqual(acquired, [ owner2 ])
+        self.assertEqual(self.getClaims(), [ (True, True) ])
+
+
+class SlaveLock(unittest.TestCase):
+
+    def test_distributed_lockClass(self):
+        self.assertIdentical(locks.SlaveLock('lk').lockClass,
+                             locks.RealSlaveLock)
+        lockid = locks.SlaveLock('lk', maxCountForSlave={'bs1' : 3},
+                                 distributed=True)
+        self.assertIdentical(lockid.lockClass, locks.DistributedSlaveLock)
+        self.assertNotEqual(lockid, locks.SlaveLock('lk',
+                                 maxCountForSlave={'bs1' : 3}))
+
+    def test_distributed_getLock(self):
+        lockid = locks.SlaveLock('lk', maxCountForSlave={'bs1' : 3},
+                                 distributed=True)
+        real = lockid.lockClass(lockid)
+        real.master = mock.Mock()
+        lock = real.getLock(mock.Mock(slavename='bs1'))
+        self.assertIsInstance(lock, locks.DistributedLock)
+        self.assertEqual((lock.slavename, lock.maxCount, lock.master),
+                         ('bs1', 3, real.master))
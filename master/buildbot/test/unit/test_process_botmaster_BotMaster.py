@@ -19,7 +19,7 @@ from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.application import service
 from buildbot.process.botmaster import BotMaster
-from buildbot import config, interfaces
+from buildbot import config, interfaces, locks
 from buildbot.test.fake import fakemaster
 
 class TestCleanShutdown(unittest.TestCase):
@@ -235,6 +235,33 @@ class TestBotMaster(unittest.TestCase):
 
         brd.maybeStartBuildsOn.assert_called_once_with(['frank'])
 
+    def test_buildRequestAdded(self):
+        brd = self.botmaster.brd = mock.Mock()
+        bldr = self.botmaster.builders['frank'] = mock.Mock(name='frank')
+        callback = self.master.subscribeToBuildRequests.call_args[0][0]
+
+        callback(dict(bsid=10, brid=20, buildername='frank'))
+        callback(dict(bsid=10, brid=21, buildername='larry'))
+
+        bldr.invalidateUnclaimedRequests.assert_called_once_with()
+        self.assertEqual(brd.maybeStartBuildsOn.call_args_list,
+                [ ((['frank'],), {}), ((['larry'],), {}) ])
+
+    def test_getLockByID(self):
+        lockid = locks.MasterLock('lk')
+        lock = self.botmaster.getLockByID(lockid)
+        self.assertIsInstance(lock, locks.RealMasterLock)
+        self.assertIdentical(self.botmaster.getLockByID(locks.MasterLock('lk')),
+                             lock)
+
+    def test_getLockByID_distributed(self):
+        lockid = locks.MasterLock('lk', distributed=True)
+        lock = self.botmaster.getLockByID(lockid)
+        self.assertIsInstance(lock, locks.DistributedMasterLock)
+        self.assertIdentical(lock.master, self.master)
+        self.assertNotIdentical(
+                self.botmaster.getLockByID(locks.MasterLock('lk')), lock)
+
     def test_maybeStartBuildsForSlave(self):
         brd = self.botmaster.brd = mock.Mock()
         b1 = mock.Mock(name='frank')
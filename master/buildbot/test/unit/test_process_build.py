@@ -15,13 +15,14 @@
 
 from zope.interface import implements
 from twisted.trial import unittest
-from twisted.internet import defer
-from buildbot import interfaces
+from twisted.internet import defer, reactor, task
+from buildbot import interfaces, util
 from buildbot.process.build import Build
 from buildbot.process.properties import Properties
 from buildbot.status.results import FAILURE, SUCCESS, WARNINGS, RETRY, EXCEPTION
-from buildbot.locks import SlaveLock
+from buildbot.locks import SlaveLock, MasterLock
 from buildbot.process.buildstep import LoggingBuildStep
+from buildbot.test.fake import fakemaster, fakedb
 
 from mock import Mock
 
@@ -237,6 +238,108 @@ class TestBuild(unittest.TestCase):
         self.assert_(b.currentStep is None)
         self.assert_(b._acquiringLock is not None)
 
+    def testBuildLocksReserved(self):
+        # the builder claims the build's locks before starting it
+        b = self.build
+
+        slavebuilder = Mock()
+
+        l = SlaveLock('lock')
+        lock_access = l.access('exclusive')
+        real_lock = b.builder.botmaster.getLockByID(l).getLock(slavebuilder.slave)
+        b.setLocks([lock_access])
+        real_lock.claim(b, lock_access)
+
+        step = Mock()
+        step.return_value = step
+        step.startStep.return_value = SUCCESS
+        b.setStepFactories([(step, {})])
+
+        self.patch(util, 'now', lambda _reactor=None : 100)
+        b.startBuild(FakeBuildStatus(), None, slavebuilder)
+
+        self.assertEqual(b.result, SUCCESS)
+        self.assertEqual(b.lockWaitTime, 0)
+
+    def testBuildLockWaitTime(self):
+        b = self.build
+
+        slavebuilder = Mock()
+
+        l = SlaveLock('lock')
+        lock_access = l.access('counting')
+        real_lock = b.builder.botmaster.getLockByID(l).getLock(slavebuilder.slave)
+        b.setLocks([lock_access])
+
+        step = Mock()
+        step.return_value = step
+        step.startStep.return_value = SUCCESS
+        b.setStepFactories([(step, {})])
+
+        other = Mock()
+        real_lock.claim(other, lock_access)
+        self.patch(util, 'now', lambda _reactor=None : 100)
+        b.startBuild(FakeBuildStatus(), None, slavebuilder)
+        self.assertEqual(b.lockWaitTime, None)
+
+        self.patch(util, 'now', lambda _reactor=None : 115)
+        real_lock.release(other, lock_access)
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        def check(_):
+            self.assertEqual(b.lockWaitTime, 15)
+        d.addCallback(check)
+        return d
+
+    def testBuildWaitsForLocalLocksFirst(self):
+        # the build does not hold a distributed lock while it waits for a
+        # local lock, which may be held by a build waiting for the
+        # distributed lock as a step lock
+        b = self.build
+        clock = task.Clock()
+        master = fakemaster.make_master()
+        master.db = fakedb.FakeDBConnector(self)
+        master.db.locks._reactor = clock
+
+        slavebuilder = Mock()
+
+        dl, ll = MasterLock('dist', distributed=True), MasterLock('local')
+        dist_access = dl.access('exclusive')
+        local_access = ll.access('exclusive')
+        dist_lock = b.builder.botmaster.getLockByID(dl)
+        dist_lock.master = master
+        dist_lock._reactor = clock
+        local_lock = b.builder.botmaster.getLockByID(ll)
+        b.setLocks([dist_access, local_access])
+
+        step = Mock()
+        step.return_value = step
+        step.startStep.return_value = SUCCESS
+        b.setStepFactories([(step, {})])
+
+        other = Mock()
+        local_lock.claim(other, local_access)
+        b.startBuild(FakeBuildStatus(), None, slavebuilder)
+        clock.advance(0)
+        self.assertEqual(dist_lock.requests, {})
+        self.assertEqual(dist_lock.grants, [])
+
+        # the other build gets the distributed lock, and finishes
+        dist_lock.waitUntilMaybeAvailable(other, dist_access)
+        clock.advance(0)
+        self.assertTrue(dist_lock.isAvailableTo(other, dist_access))
+        dist_lock.claim(other, dist_access)
+        dist_lock.release(other, dist_access)
+        local_lock.release(other, local_access)
+
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        def check(_):
+            clock.advance(0)
+            self.assertEqual(b.result, SUCCESS)
+        d.addCallback(check)
+        return d
+
     def testStopBuildWaitingForLocks(self):
         b = self.build
 
@@ -18,10 +18,11 @@ import random
 from twisted.trial import unittest
 from twisted.python import failure
 from twisted.internet import defer
-from buildbot import config
+from buildbot import config, locks
 from buildbot.test.fake import fakedb, fakemaster
 from buildbot.process import builder
 from buildbot.db import buildrequests
+from buildbot.status import durations, progress
 from buildbot.util import epoch2datetime
 
 class TestBuilderBuildCreation(unittest.TestCase):
@@ -82,7 +83,7 @@ class TestBuilderBuildCreation(unittest.TestCase):
         """C{slaves} maps name : available"""
         self.bldr.slaves = []
         for name, avail in slavebuilders.iteritems():
-            sb = mock.Mock(spec=['isAvailable'], name=name)
+            sb = mock.Mock(spec=['isAvailable', 'slave'], name=name)
             sb.name = name
             sb.isAvailable.return_value = avail
             self.bldr.slaves.append(sb)
@@ -161,6 +162,25 @@ class TestBuilderBuildCreation(unittest.TestCase):
         yield self.do_test_maybeStartBuild(rows=rows,
                 exp_claims=[10], exp_builds=[('test-slave1', [10])])
 
+    @defer.inlineCallbacks
+    def test_maybeStartBuild_caches_unclaimed(self):
+        yield self.makeBuilder(mergeRequests=False)
+
+        self.setSlaveBuilders({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="bldr",
+                submitted_at=135000),
+        ]
+        yield self.do_test_maybeStartBuild(rows=rows,
+                exp_claims=[10], exp_builds=[('test-slave1', [10])])
+
+        # the remaining request is known without another query
+        self.db.buildrequests.getBuildRequests = lambda **kw : self.fail()
+        rqtime = yield self.bldr.getOldestRequestTime()
+        self.assertEqual(rqtime, epoch2datetime(135000))
+
     @defer.inlineCallbacks
     def test_maybeStartBuild_limited_by_available_slaves(self):
         yield self.makeBuilder(mergeRequests=False)
@@ -314,6 +334,63 @@ class TestBuilderBuildCreation(unittest.TestCase):
         yield self.do_test_maybeStartBuild(rows=rows,
                 exp_claims=[11], exp_builds=[('test-slave2', [11])])
 
+    def setUpLock(self):
+        self.lockid = locks.MasterLock('lk')
+        self.lock = locks.RealMasterLock(self.lockid)
+        self.master.botmaster.getLockByID = lambda lockid : self.lock
+        return [ self.lockid.access('exclusive') ]
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuild_lock_busy(self):
+        yield self.makeBuilder()
+        self.bldr.config.locks = self.setUpLock()
+
+        self.lock.claim(mock.Mock(), self.lockid.access('exclusive'))
+        self.setSlaveBuilders({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr"),
+        ]
+        yield self.do_test_maybeStartBuild(rows=rows,
+                exp_claims=[], exp_builds=[])
+
+        # releasing the lock tries again
+        self.master.botmaster.maybeStartBuildsForBuilder.reset_mock()
+        self.lock.release(self.lock.owners[0][0],
+                          self.lockid.access('exclusive'))
+        self.master.botmaster.maybeStartBuildsForBuilder \
+                .assert_called_once_with('bldr')
+        self.assertEqual(self.bldr._lockSubscriptions, {})
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuild_lock_waiters(self):
+        # a lock that is free but has waiters is not jumped
+        yield self.makeBuilder()
+        self.bldr.config.locks = self.setUpLock()
+
+        owner = mock.Mock()
+        self.lock.claim(owner, self.lockid.access('exclusive'))
+        self.lock.waitUntilMaybeAvailable(mock.Mock(),
+                                          self.lockid.access('exclusive'))
+        self.lock.owners = []
+        self.setSlaveBuilders({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr"),
+        ]
+        yield self.do_test_maybeStartBuild(rows=rows,
+                exp_claims=[], exp_builds=[])
+
+    @defer.inlineCallbacks
+    def test_maybeStartBuild_lock_free(self):
+        yield self.makeBuilder()
+        self.bldr.config.locks = self.setUpLock()
+
+        self.setSlaveBuilders({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr"),
+        ]
+        yield self.do_test_maybeStartBuild(rows=rows,
+                exp_claims=[10], exp_builds=[('test-slave1', [10])])
+
     @defer.inlineCallbacks
     def test_maybeStartBuild_builder_stopped(self):
         yield self.makeBuilder()
@@ -397,6 +474,24 @@ class TestBuilderBuildCreation(unittest.TestCase):
             return defer.fail(failure.Failure(RuntimeError()))
         return self.do_test_chooseSlave(nextSlave, exp_fail=RuntimeError)
 
+    @defer.inlineCallbacks
+    def test_chooseSlave_default_affinity(self):
+        slavebuilders = [ mock.Mock(name='sb%d' % i) for i in range(4) ]
+        for i, sb in enumerate(slavebuilders):
+            sb.slave.slavename = 'slave%d' % i
+        yield self.makeBuilder()
+        self.bldr.affinity.buildFinished('slave1',
+                [ mock.Mock(branch='branch-1', revision=None, codebase='') ],
+                0, 10)
+        self.bldr.affinity.buildFinished('slave3',
+                [ mock.Mock(branch='trunk', revision=None, codebase='') ],
+                0, 10)
+        self.bldr._nextRequest = mock.Mock()
+        self.bldr._nextRequest.sources = {
+            '' : mock.Mock(branch='trunk', revision='abcd', codebase='') }
+        sb = yield self.bldr._chooseSlave(slavebuilders)
+        self.assertIdentical(sb, slavebuilders[3])
+
     # _chooseBuild
 
     def do_test_chooseBuild(self, nextBuild, exp_choice=None, exp_fail=None):
@@ -749,3 +844,63 @@ class TestGetOldestRequestTime(unittest.TestCase):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_getUnclaimedRequests_cached(self):
+        yield self.makeBuilder(name='bldr1')
+        yield self.db.insertTestData(self.base_rows)
+        brdicts = yield self.bldr.getUnclaimedRequests()
+        self.assertEqual([ brd['brid'] for brd in brdicts ], [ 111, 333 ])
+
+        # a new request is not seen until the cache is invalidated
+        yield self.db.insertTestData([
+            fakedb.BuildRequest(id=555, submitted_at=500,
+                        buildername='bldr1', buildsetid=11) ])
+        rqtime = yield self.bldr.getOldestRequestTime()
+        self.assertEqual(rqtime, epoch2datetime(1000))
+
+        self.bldr.invalidateUnclaimedRequests()
+        rqtime = yield self.bldr.getOldestRequestTime()
+        self.assertEqual(rqtime, epoch2datetime(500))
+
+    @defer.inlineCallbacks
+    def test_getUnclaimedRequests_invalidated_during_query(self):
+        yield self.makeBuilder(name='bldr1')
+        yield self.db.insertTestData(self.base_rows)
+        getBuildRequests = self.db.buildrequests.getBuildRequests
+        def invalidating(**kwargs):
+            d = getBuildRequests(**kwargs)
+            self.bldr.invalidateUnclaimedRequests()
+            return d
+        self.db.buildrequests.getBuildRequests = invalidating
+        brdicts = yield self.bldr.getUnclaimedRequests()
+        self.assertEqual([ brd['brid'] for brd in brdicts ], [ 111, 333 ])
+        # the result was not kept
+        self.assertEqual(self.bldr._unclaimedRequests, None)
+
+
+class TestGetExpectations(unittest.TestCase):
+
+    def setUp(self):
+        self.bldr = builder.Builder('bldr')
+        self.history = durations.DurationHistory()
+        self.bldr.builder_status = mock.Mock()
+        self.bldr.builder_status.getDurationHistory.return_value = \
+                self.history
+
+    def test_no_history(self):
+        self.assertIdentical(self.bldr._getExpectations('slv'), None)
+        self.bldr.expectations = exp = progress.Expectations()
+        self.assertIdentical(self.bldr._getExpectations('slv'), exp)
+
+    def test_history(self):
+        for t in [ 10, 20, 300 ]:
+            self.history.addBuild('slv', 0, t, [ ('compile', t) ])
+        exp = self.bldr._getExpectations('slv')
+        self.assertEqual(exp.times, dict(compile=20))
+
+    def test_history_and_expectations(self):
+        self.history.addBuild('slv', 0, 30, [ ('compile', 30) ])
+        self.bldr.expectations = progress.Expectations()
+        self.bldr.expectations.times = dict(compile=99, test=5)
+        exp = self.bldr._getExpectations('slv')
+        self.assertEqual(exp.times, dict(compile=30, test=5))
@@ -194,3 +194,83 @@ class TestLoggingBuildStep(unittest.TestCase):
         lbs = buildstep.LoggingBuildStep(log_eval_func=eval)
         status = lbs.evaluateCommand(cmd)
         self.assertEqual(status, WARNINGS, "evaluateCommand didn't call log_eval_func or overrode its results")
+
+
+class TestRemoteCommand(unittest.TestCase):
+
+    def makeRemoteCommand(self):
+        rc = buildstep.RemoteCommand('shell', {})
+        rc.buildslave = mock.Mock()
+        rc.active = True
+        rc.updates = {}
+        self.stdio = mock.Mock(name='stdio')
+        rc.logs['stdio'] = self.stdio
+        return rc
+
+    def test_remote_update_batches_stdio(self):
+        rc = self.makeRemoteCommand()
+        maxnum = rc.remote_update([
+            ({'stdout': 'a'}, 0),
+            ({'stdout': 'b', 'stderr': 'c'}, 1),
+            ({'rc': 0}, 2),
+        ])
+        self.assertEqual(maxnum, 2)
+        self.stdio.addEntries.assert_called_once_with([
+            (0, 'a'), (0, 'b'), (1, 'c'),
+            (2, 'program finished with exit code 0\n')])
+        self.assertFalse(self.stdio.addStdout.called)
+        self.assertEqual(rc.rc, 0)
+
+    def test_remote_update_segments(self):
+        rc = self.makeRemoteCommand()
+        other = mock.Mock(name='other')
+        rc.logs['other'] = other
+        rc.remote_update([
+            ({'segments' : [('stdout', 'a'), ('stderr', 'b'),
+                            (('log', 'other'), 'c'), ('stdout', 'd')]}, 0),
+        ])
+        self.stdio.addEntries.assert_called_once_with([
+            (0, 'a'), (1, 'b'), (0, 'd')])
+        other.addStdout.assert_called_once_with('c')
+        self.assertEqual(rc.updates, {})
+
+    def test_start_segmented_updates(self):
+        for version, expected in [ ('2.15', False), ('2.16', True),
+                                   (None, False) ]:
+            rc = buildstep.RemoteCommand('shell', {'command' : 'make'})
+            rc.step = buildstep.BuildStep()
+            rc.step.build = mock.Mock()
+            rc.step.build.getSlaveCommandVersion.return_value = version
+            rc.remote = mock.Mock()
+            rc.commandID = '1'
+            rc._start()
+            args = rc.remote.callRemote.call_args[0][4]
+            self.assertEqual('segmented_updates' in args, expected)
+            self.assertEqual(args['command'], 'make')
+            self.assertEqual(rc.args, {'command' : 'make'})
+
+    def test_remote_update_collectStdout(self):
+        rc = self.makeRemoteCommand()
+        rc.collectStdout = True
+        rc.remote_update([({'stdout': 'a'}, 0), ({'stdout': 'b'}, 1)])
+        self.assertEqual(rc.stdout, 'ab')
+
+    def test_addStdout_outside_update(self):
+        rc = self.makeRemoteCommand()
+        rc.addStdout('x')
+        self.stdio.addStdout.assert_called_once_with('x')
+
+    def test_remote_update_exception_flushes(self):
+        rc = self.makeRemoteCommand()
+        def remoteUpdate(update):
+            if 'boom' in update:
+                raise RuntimeError('boom')
+            rc.addStdout(update['stdout'])
+        rc.remoteUpdate = remoteUpdate
+        calls = []
+        def _finished(failure=None):
+            # output received before the failure must already be logged
+            calls.append(self.stdio.addEntries.call_args_list[:])
+        rc._finished = _finished
+        rc.remote_update([({'stdout': 'a'}, 0), ({'boom': 1}, 1)])
+        self.assertEqual(calls, [[(([(0, 'a')],), {})]])
@@ -16,6 +16,7 @@
 import gc, sys
 from twisted.trial import unittest
 from twisted.internet import task
+from twisted.python import log
 from buildbot.process import metrics
 from buildbot.test.fake import fakemaster
 
@@ -123,6 +124,141 @@ class TestMetricTimeEvent(TestMetricBase):
         report = self.observer.asDict()
         self.assertEquals(report['timers']['foo_time'], sum(data)/float(len(data)))
 
+class TestMetricGaugeEvent(TestMetricBase):
+    def testGauge(self):
+        metrics.MetricGaugeEvent.log('queue_length', 3)
+        metrics.MetricGaugeEvent.log('queue_length', 2)
+        report = self.observer.asDict()
+        self.assertEquals(report['gauges']['queue_length'], 2)
+
+class TestRegistry(TestMetricBase):
+    def testDirect(self):
+        registry = metrics.getRegistry()
+        self.assertIdentical(registry, self.observer.registry)
+        registry.increment('num_widgets')
+        registry.recordTime('foo_time', 2)
+        registry.recordTime('foo_time', 4)
+        report = self.observer.asDict()
+        self.assertEquals(report['counters']['num_widgets'], 1)
+        self.assertEquals(report['timers']['foo_time'], 3)
+
+    def testTimerSamples(self):
+        samples = metrics.TimerSamples(maxlen=3)
+        for i in range(5):
+            samples.add(i)
+        self.assertEquals(sorted(samples.samples), [ 2, 3, 4 ])
+        self.assertEquals(samples.average, 3)
+
+    def testDisabled(self):
+        self.master.config.metrics = None
+        self.observer.reconfigService(self.master.config)
+        self.assertIdentical(metrics.getRegistry(), None)
+        metrics.MetricCountEvent.log('num_widgets', 1)
+        metrics.MetricTimeEvent.log('foo_time', 1)
+        report = self.observer.asDict()
+        self.assertEquals(report['counters'], {})
+        self.assertEquals(report['timers'], {})
+
+    def testLoggedEvent(self):
+        # events sent through the log are still handled
+        log.msg(metric=metrics.MetricCountEvent('num_widgets', 2))
+        report = self.observer.asDict()
+        self.assertEquals(report['counters']['num_widgets'], 2)
+
+    def testCustomEvent(self):
+        # events of other classes go to their handlers through the log
+        class MetricWidgetEvent(metrics.MetricEvent):
+            def __init__(self, widget):
+                self.widget = widget
+        class WidgetHandler(metrics.MetricHandler):
+            def reset(self):
+                self.widgets = []
+            def handle(self, eventDict, metric):
+                self.widgets.append(metric.widget)
+        handler = WidgetHandler(self.observer)
+        self.observer.registerHandler(MetricWidgetEvent, handler)
+        MetricWidgetEvent.log('sprocket')
+        self.assertEquals(handler.widgets, [ 'sprocket' ])
+
+    def testWatchersRunPeriodically(self):
+        self.patch(gc, 'garbage', [])
+        metrics.MetricTimeEvent.log('BuildMaster.pollDatabaseChanges()', 70)
+        self.observer.periodic()
+        self.assertEquals(
+            self.observer.registry.alarms['BuildMaster.pollDatabaseChanges()'],
+            (metrics.ALARM_CRIT, None))
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.histogram = metrics.Histogram(interval=60, windows=5,
+                                           _reactor=self.clock)
+
+    def testEmpty(self):
+        self.assertEquals(self.histogram.snapshot(),
+                dict(count=0, sum=0, max=None, p50=None, p90=None, p99=None))
+
+    def testPercentiles(self):
+        for i in range(1, 101):
+            self.histogram.add(i / 100.0)
+        snap = self.histogram.snapshot()
+        self.assertEquals(snap['count'], 100)
+        self.assertAlmostEqual(snap['sum'], 50.5)
+        self.assertEquals(snap['max'], 1.0)
+        # buckets are about 9% wide, so percentiles are within 5%
+        self.assertApproximates(snap['p50'], 0.50, 0.025)
+        self.assertApproximates(snap['p90'], 0.90, 0.045)
+        self.assertApproximates(snap['p99'], 0.99, 0.05)
+        self.assertTrue(snap['p99'] <= 1.0)
+
+    def testOutlier(self):
+        for i in range(99):
+            self.histogram.add(0.01)
+        self.histogram.add(30)
+        snap = self.histogram.snapshot()
+        self.assertApproximates(snap['p90'], 0.01, 0.0005)
+        self.assertApproximates(snap['p99'], 0.01, 0.0005)
+        self.assertEquals(snap['max'], 30)
+        self.assertEquals(metrics.Histogram(_reactor=self.clock).snapshot(
+                            percentiles=(100,))['p100'], None)
+
+    def testZero(self):
+        self.histogram.add(0)
+        self.histogram.add(-0.001)
+        self.assertEquals(self.histogram.snapshot()['p50'], 0)
+
+    def testSlidingWindow(self):
+        self.histogram.add(10)
+        self.clock.advance(120)
+        self.histogram.add(1)
+        self.assertEquals(self.histogram.snapshot()['max'], 10)
+        # the first window has expired 5 minutes after it began
+        self.clock.advance(180)
+        snap = self.histogram.snapshot()
+        self.assertEquals((snap['count'], snap['max']), (1, 1))
+        self.clock.advance(300)
+        self.assertEquals(self.histogram.snapshot()['count'], 0)
+
+class TestMetricHistograms(TestMetricBase):
+    def testHistograms(self):
+        for elapsed in (0.1, 0.2, 0.3):
+            metrics.MetricTimeEvent.log('foo_time', elapsed)
+        report = self.observer.asDict()
+        snap = report['histograms']['foo_time']
+        self.assertEquals(snap['count'], 3)
+        self.assertEquals(snap['max'], 0.3)
+        self.assertApproximates(snap['p50'], 0.2, 0.01)
+        self.assertApproximates(report['timers']['foo_time'], 0.2, 0.0001)
+
+    def testReport(self):
+        logged = []
+        self.patch(log, 'msg', lambda line, **kw : logged.append(line))
+        metrics.MetricTimeEvent.log('foo_time', 2)
+        self.observer.report()
+        self.assertIn('Timer foo_time: 2', logged)
+        self.assertIn('Timer foo_time: p50 2 p90 2 p99 2 max 2 '
+                      '(1 times)', logged)
+
 class TestPeriodicChecks(TestMetricBase):
     def testPeriodicCheck(self):
         # fake out that there's no garbage (since we can't rely on Python
@@ -0,0 +1,191 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from buildbot.process import prioritizers
+from buildbot.util import epoch2datetime
+from buildbot import config
+
+class PrioritizerMixin(object):
+
+    def setUp(self):
+        self.master = mock.Mock(name='master')
+        self.builders = {}
+        self.master.botmaster.getBuilders = lambda : self.builders.values()
+        self.bsprops = {}
+        self.master.db.buildsets.getBuildsetProperties = mock.Mock(
+                side_effect=lambda bsid : defer.succeed(self.bsprops[bsid]))
+
+    def addBuilder(self, name, requests=(), duration=None, category=None,
+                   running=0, median=None):
+        """Add a builder with the given unclaimed requests, each a tuple
+        (submitted_at, buildsetid, priority)"""
+        bldr = mock.Mock(name=name)
+        bldr.name = name
+        brdicts = [ dict(submitted_at=epoch2datetime(t), buildsetid=bsid,
+                         priority=prio)
+                    for (t, bsid, prio) in sorted(requests) ]
+        bldr.getUnclaimedRequests = lambda : defer.succeed(brdicts)
+        oldest = brdicts and brdicts[0]['submitted_at'] or None
+        bldr.getOldestRequestTime = lambda : defer.succeed(oldest)
+        if duration is None:
+            bldr.expectations = None
+        else:
+            bldr.expectations.expectedBuildTime.return_value = duration
+        history = bldr.builder_status.getDurationHistory.return_value
+        history.getBuildTime.return_value = median
+        bldr.config.category = category
+        bldr.building = [ mock.Mock() ] * running
+        self.builders[name] = bldr
+
+    def prioritize(self, prioritizer, expected):
+        d = defer.maybeDeferred(prioritizer, self.master,
+                                self.builders.values())
+        def check(rv):
+            self.assertEqual([ b.name for b in rv ], expected)
+        d.addCallback(check)
+        return d
+
+
+class ShortestExpectedFirst(PrioritizerMixin, unittest.TestCase):
+
+    def test_durations(self):
+        self.addBuilder('long', [ (10, 1, 0) ], duration=3600)
+        self.addBuilder('short', [ (20, 2, 0) ], duration=60)
+        self.addBuilder('idle', [], duration=1)
+        self.addBuilder('new', [ (30, 3, 0) ])
+        return self.prioritize(prioritizers.ShortestExpectedFirst(),
+                ['new', 'short', 'long', 'idle'])
+
+    def test_history(self):
+        # the median from the duration history is preferred
+        self.addBuilder('long', [ (10, 1, 0) ], duration=60, median=3600)
+        self.addBuilder('short', [ (20, 2, 0) ], duration=3600, median=60)
+        self.addBuilder('average', [ (30, 3, 0) ], duration=600)
+        return self.prioritize(prioritizers.ShortestExpectedFirst(),
+                ['short', 'average', 'long'])
+
+    def test_unknownDuration(self):
+        self.addBuilder('long', [ (10, 1, 0) ], duration=3600)
+        self.addBuilder('short', [ (20, 2, 0) ], duration=60)
+        self.addBuilder('new', [ (30, 3, 0) ])
+        return self.prioritize(
+                prioritizers.ShortestExpectedFirst(unknownDuration=600),
+                ['short', 'new', 'long'])
+
+    def test_ties(self):
+        self.addBuilder('b', [ (20, 1, 0) ], duration=60)
+        self.addBuilder('a', [ (10, 2, 0) ], duration=60)
+        return self.prioritize(prioritizers.ShortestExpectedFirst(),
+                ['a', 'b'])
+
+    def test_maxWait(self):
+        clock = task.Clock()
+        clock.advance(5000)
+        self.addBuilder('long', [ (1000, 1, 0) ], duration=3600)
+        self.addBuilder('longer', [ (500, 1, 0) ], duration=7200)
+        self.addBuilder('short', [ (4900, 2, 0) ], duration=60)
+        return self.prioritize(
+                prioritizers.ShortestExpectedFirst(maxWait=3600,
+                                                   _reactor=clock),
+                ['longer', 'long', 'short'])
+
+
+class BuildsetPriority(PrioritizerMixin, unittest.TestCase):
+
+    def test_priority(self):
+        self.bsprops = { 1 : {}, 2 : { 'priority' : (10, 'Force') },
+                         3 : { 'priority' : ('5', 'Force') } }
+        self.addBuilder('low', [ (10, 1, 0) ])
+        self.addBuilder('high', [ (20, 2, 0) ])
+        self.addBuilder('mid', [ (15, 1, 0), (30, 3, 0) ])
+        self.addBuilder('idle')
+        return self.prioritize(prioritizers.BuildsetPriority(),
+                ['high', 'mid', 'low', 'idle'])
+
+    def test_request_priority(self):
+        self.bsprops = { 1 : {}, 2 : {} }
+        self.addBuilder('low', [ (10, 1, 0) ])
+        self.addBuilder('high', [ (20, 2, 3) ])
+        return self.prioritize(prioritizers.BuildsetPriority(),
+                ['high', 'low'])
+
+    def test_deadline(self):
+        self.bsprops = { 1 : {}, 2 : { 'deadline' : (2000, 'Sched') },
+                         3 : { 'deadline' : (1000, 'Sched') },
+                         4 : { 'deadline' : ('soon', 'Sched') } }
+        self.addBuilder('none', [ (10, 1, 0) ])
+        self.addBuilder('later', [ (20, 2, 0) ])
+        self.addBuilder('sooner', [ (30, 3, 0) ])
+        self.addBuilder('invalid', [ (5, 4, 0) ])
+        return self.prioritize(prioritizers.BuildsetPriority(),
+                ['sooner', 'later', 'invalid', 'none'])
+
+    @defer.inlineCallbacks
+    def test_cached_properties(self):
+        self.bsprops = { 1 : {}, 2 : { 'priority' : (1, 'Force') } }
+        self.addBuilder('a', [ (10, 1, 0) ])
+        self.addBuilder('b', [ (20, 2, 0), (30, 1, 0) ])
+        prioritizer = prioritizers.BuildsetPriority()
+        yield self.prioritize(prioritizer, ['b', 'a'])
+        yield self.prioritize(prioritizer, ['b', 'a'])
+        self.assertEqual(
+            self.master.db.buildsets.getBuildsetProperties.call_count, 2)
+
+        # buildset 2 has gone, and is forgotten
+        self.addBuilder('b', [ (30, 1, 0) ])
+        yield self.prioritize(prioritizer, ['a', 'b'])
+        self.assertEqual(prioritizer._buildsets.keys(), [ 1 ])
+
+
+class FairShare(PrioritizerMixin, unittest.TestCase):
+
+    def test_round_robin(self):
+        self.addBuilder('x1', [ (10, 1, 0) ], category='x')
+        self.addBuilder('x2', [ (20, 1, 0) ], category='x')
+        self.addBuilder('x3', [ (30, 1, 0) ], category='x')
+        self.addBuilder('y1', [ (40, 1, 0) ], category='y')
+        self.addBuilder('y2', [ (50, 1, 0) ], category='y')
+        self.addBuilder('y3', [], category='y')
+        return self.prioritize(prioritizers.FairShare(),
+                ['x1', 'y1', 'x2', 'y2', 'x3', 'y3'])
+
+    def test_running(self):
+        self.addBuilder('x1', [ (10, 1, 0) ], category='x', running=2)
+        self.addBuilder('x2', [ (20, 1, 0) ], category='x')
+        self.addBuilder('y1', [ (40, 1, 0) ], category='y')
+        self.addBuilder('y2', [ (50, 1, 0) ], category='y')
+        # z is busy, but has nothing pending
+        self.addBuilder('z1', [], category='z', running=5)
+        return self.prioritize(prioritizers.FairShare(),
+                ['y1', 'y2', 'x1', 'x2', 'z1'])
+
+    def test_weights_and_key(self):
+        self.addBuilder('x1', [ (10, 1, 0) ])
+        self.addBuilder('x2', [ (20, 1, 0) ])
+        self.addBuilder('x3', [ (30, 1, 0) ])
+        self.addBuilder('y1', [ (40, 1, 0) ])
+        self.addBuilder('y2', [ (50, 1, 0) ])
+        return self.prioritize(
+                prioritizers.FairShare(key=lambda b : b.name[0],
+                                       weights={ 'x' : 2 }),
+                ['x1', 'y1', 'x2', 'x3', 'y2'])
+
+    def test_weight_invalid(self):
+        for weight in 0, -1, 'x':
+            self.assertRaises(config.ConfigErrors,
+                              prioritizers.FairShare, weights={ 'x' : weight })
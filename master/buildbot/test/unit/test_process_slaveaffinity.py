@@ -0,0 +1,88 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import random
+import mock
+from twisted.trial import unittest
+from buildbot.process import slaveaffinity
+
+def ss(branch, revision=None, codebase=''):
+    return mock.Mock(branch=branch, revision=revision, codebase=codebase)
+
+class TestWorkspaceAffinity(unittest.TestCase):
+
+    def setUp(self):
+        self.affinity = slaveaffinity.WorkspaceAffinity('bldr')
+        self.slavebuilders = {}
+        for name in 'abcd':
+            sb = mock.Mock(name='sb-' + name)
+            sb.slave.slavename = name
+            self.slavebuilders[name] = sb
+        # take the first of the candidates, in order
+        self.patch(random, 'choice', lambda lst :
+                sorted(lst, key=lambda sb : sb.slave.slavename)[0])
+
+    def choose(self, names, sources):
+        sb = self.affinity.chooseSlave(
+                [ self.slavebuilders[n] for n in names ], sources)
+        return sb.slave.slavename
+
+    def test_no_history(self):
+        self.assertEqual(self.choose('dcb', [ ss('trunk') ]), 'b')
+        self.assertEqual((self.affinity.hits, self.affinity.choices), (0, 1))
+
+    def test_same_branch(self):
+        self.affinity.buildFinished('c', [ ss('trunk') ], 100, 150)
+        self.affinity.buildFinished('b', [ ss('branch-1') ], 100, 150)
+        self.assertEqual(self.choose('abcd', [ ss('trunk') ]), 'c')
+        self.assertEqual(self.choose('abcd', [ ss('branch-1') ]), 'b')
+        self.assertEqual((self.affinity.hits, self.affinity.choices), (2, 2))
+
+    def test_same_revision(self):
+        self.affinity.buildFinished('c', [ ss('trunk', 'r2') ], 100, 150)
+        self.affinity.buildFinished('d', [ ss('trunk', 'r1') ], 100, 200)
+        # d is more recent, but c already has the revision
+        self.assertEqual(self.choose('abcd', [ ss('trunk', 'r2') ]), 'c')
+        self.assertEqual(self.choose('abcd', [ ss('trunk', 'r3') ]), 'd')
+
+    def test_codebases(self):
+        self.affinity.buildFinished('a',
+                [ ss('trunk', codebase='x'), ss('old', codebase='y') ], 0, 50)
+        self.affinity.buildFinished('b',
+                [ ss('trunk', codebase='x'), ss('trunk', codebase='y') ],
+                0, 10)
+        self.assertEqual(self.choose('ab',
+            [ ss('trunk', codebase='x'), ss('trunk', codebase='y') ]), 'b')
+
+    def test_fastest(self):
+        self.affinity.buildFinished('a', [ ss('trunk') ], 50, 100)
+        self.affinity.buildFinished('b', [ ss('trunk') ], 90, 100)
+        self.assertEqual(self.choose('ab', [ ss('trunk') ]), 'b')
+
+    def test_least_recently_used(self):
+        self.affinity.buildFinished('a', [ ss('trunk') ], 0, 300)
+        self.affinity.buildFinished('b', [ ss('trunk') ], 0, 100)
+        self.affinity.buildFinished('c', [ ss('trunk') ], 0, 200)
+        self.assertEqual(self.choose('abc', [ ss('branch-1') ]), 'b')
+        # unused slaves are preferred to all of them
+        self.assertEqual(self.choose('abcd', [ ss('branch-1') ]), 'd')
+        self.assertEqual(self.choose('abcd', None), 'd')
+        self.assertEqual((self.affinity.hits, self.affinity.choices), (0, 3))
+
+    def test_getWorkspace(self):
+        self.affinity.buildFinished('a', [ ss('trunk', 'r1') ], 50, 80)
+        self.assertEqual(self.affinity.getWorkspace('a'),
+            dict(sources={'' : ('trunk', 'r1')}, finished=80, duration=30))
+        self.assertEqual(self.affinity.getWorkspace('b'), None)
@@ -0,0 +1,62 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.spread import pb
+from buildbot.process import slavebuilder
+from buildbot import config
+
+class TestAbstractSlaveBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.sb = slavebuilder.AbstractSlaveBuilder()
+        self.builder = mock.Mock(name='builder')
+        self.builder.name = 'bldr'
+        self.builder.master.config = config.MasterConfig()
+        self.sb.setBuilder(self.builder)
+        self.slave = mock.Mock(name='slave')
+        self.slave.slavename = 'sl'
+        self.calls = []
+
+    def makeRemote(self, unsupported=()):
+        remote = mock.Mock(name='remote')
+        def callRemote(meth, *args):
+            self.calls.append((meth,) + args)
+            if meth in unsupported:
+                return defer.fail(pb.NoSuchMethod(meth))
+            return defer.succeed(None)
+        remote.callRemote = callRemote
+        return remote
+
+    def test_attached_sends_update_window(self):
+        self.builder.master.config.slaveUpdateWindow = 4
+        d = self.sb.attached(self.slave, self.makeRemote(), {})
+        def check(res):
+            self.assertIdentical(res, self.sb)
+            self.assertIn(('setUpdateWindow', 4), self.calls)
+            self.assertEqual(self.sb.state, slavebuilder.IDLE)
+        d.addCallback(check)
+        return d
+
+    def test_attached_old_slave(self):
+        remote = self.makeRemote(unsupported=('setUpdateWindow',))
+        d = self.sb.attached(self.slave, remote, {})
+        def check(res):
+            self.assertIdentical(res, self.sb)
+            self.assertEqual(self.sb.state, slavebuilder.IDLE)
+        d.addCallback(check)
+        return d
@@ -0,0 +1,170 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import sys
+import thread
+from twisted.trial import unittest
+from twisted.internet import task
+from buildbot.process import stallwatcher, metrics
+from buildbot.test.fake import fakemaster
+
+class TestStallWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.abspath(self.mktemp())
+        self.watcher = stallwatcher.StallWatcher(0.4, self.filename)
+        self.now = 100
+        self.watcher._time = lambda : self.now
+        self.watcher._mainThreadId = thread.get_ident()
+        self.watcher.lastBeat = self.now
+
+    def blocked(self):
+        # the reactor is "blocked" in this function while the watchdog
+        # samples it
+        self.watcher.sample()
+
+    def test_no_stall(self):
+        self.now += 0.5
+        self.watcher.sample()
+        self.watcher.beat()
+        self.assertEqual(self.watcher.samples, 0)
+        self.assertEqual(self.watcher.stalls, 0)
+
+    def test_stall(self):
+        self.now += 0.7
+        self.blocked()
+        self.now += 0.1
+        self.blocked()
+        self.watcher.beat()
+        self.assertEqual(self.watcher.samples, 2)
+        self.assertEqual(self.watcher.stalls, 1)
+        self.assertAlmostEqual(self.watcher.stalledTime, 0.6)
+
+        stalls = self.watcher.asDict()
+        self.assertEqual(len(stalls['recent']), 1)
+        recent = stalls['recent'][0]
+        self.assertAlmostEqual(recent['duration'], 0.6)
+        self.assertTrue(recent['stack'][-1].startswith('sample ('))
+        self.assertTrue(recent['stack'][-2].startswith('blocked ('))
+        self.assertEqual(stalls['top'][0]['samples'], 1)
+        self.assertEqual(len(stalls['top']), 2) # different line numbers
+
+        # the next stall has its own stacks
+        self.now += 0.2
+        self.watcher.beat()
+        self.assertEqual(self.watcher.stallStacks, {})
+
+    def test_foldStack(self):
+        def inner():
+            return self.watcher.foldStack(sys._getframe())
+        stack = inner().split(';')
+        self.assertTrue(stack[-1].startswith('inner (%s:' % __file__.rstrip('c')))
+        self.assertTrue(stack[-2].startswith('test_foldStack ('))
+
+    def test_foldStack_maxDepth(self):
+        self.watcher.maxDepth = 2
+        stack = self.watcher.foldStack(sys._getframe()).split(';')
+        self.assertEqual(len(stack), 2)
+        self.assertTrue(stack[-1].startswith('test_foldStack_maxDepth ('))
+
+    def test_maxStacks(self):
+        self.watcher.maxStacks = 1
+        self.now += 1
+        self.blocked()
+        self.watcher.sample()
+        self.assertEqual(sorted(self.watcher.stacks.values()), [ 1, 1 ])
+        self.assertIn('[other]', self.watcher.stacks)
+
+    def test_save(self):
+        self.now += 1
+        self.blocked()
+        self.watcher.save()
+        lines = open(self.filename).read().splitlines()
+        self.assertEqual(len(lines), 1)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertEqual(count, '1')
+        self.assertIn(';blocked (', stack)
+
+    def test_save_unchanged(self):
+        self.watcher.save()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_metrics(self):
+        logged = []
+        self.patch(metrics.MetricTimeEvent, 'log',
+                   classmethod(lambda cls, timer, elapsed :
+                       logged.append((timer, elapsed))))
+        self.now += 1.2
+        self.watcher.beat()
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(logged[0][0], 'reactorStall')
+        self.assertAlmostEqual(logged[0][1], 1.0)
+
+    def test_start_stop(self):
+        clock = task.Clock()
+        self.watcher._reactor = clock
+        self.watcher.startService()
+        self.assertTrue(self.watcher._thread.isAlive())
+        clock.advance(0.2)
+        self.assertEqual(self.watcher.lastBeat, self.now)
+        thread = self.watcher._thread
+        d = self.watcher.stopService()
+        self.assertFalse(thread.isAlive())
+        return d
+
+
+class TestMetricLogObserver(unittest.TestCase):
+
+    def setUp(self):
+        self.observer = metrics.MetricLogObserver()
+        self.observer.parent = self.master = fakemaster.make_master()
+        self.master.basedir = os.path.abspath('basedir')
+        self.master.config.metrics = dict(log_interval=0, periodic_interval=0)
+        self.observer._reactor = task.Clock()
+        self.observer.startService()
+
+    def tearDown(self):
+        if self.observer.running:
+            self.observer.stopService()
+
+    def test_disabled_by_default(self):
+        self.observer.reconfigService(self.master.config)
+        self.assertEqual(self.observer.stall_watcher, None)
+        self.assertEqual(self.observer.getStalls(), None)
+
+    def test_reconfig(self):
+        self.patch(stallwatcher.StallWatcher, 'startService', lambda self : None)
+        self.patch(stallwatcher.StallWatcher, 'stopService', lambda self : None)
+        self.master.config.metrics['stall_threshold'] = 0.5
+        self.observer.reconfigService(self.master.config)
+        watcher = self.observer.stall_watcher
+        self.assertEqual(watcher.threshold, 0.5)
+        self.assertEqual(watcher.filename,
+                         os.path.join(self.master.basedir, 'stalls.folded'))
+        self.assertEqual(self.observer.getStalls()['stalls'], 0)
+
+        # unchanged
+        self.observer.reconfigService(self.master.config)
+        self.assertIdentical(self.observer.stall_watcher, watcher)
+
+        self.master.config.metrics['stall_file'] = None
+        self.observer.reconfigService(self.master.config)
+        self.assertNotIdentical(self.observer.stall_watcher, watcher)
+        self.assertEqual(self.observer.stall_watcher.filename, None)
+
+        self.master.config.metrics = None
+        self.observer.reconfigService(self.master.config)
+        self.assertEqual(self.observer.stall_watcher, None)
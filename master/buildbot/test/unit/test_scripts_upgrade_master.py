@@ -22,6 +22,7 @@ from twisted.internet import defer
 from buildbot.scripts import upgrade_master
 from buildbot import config as config_module
 from buildbot.db import connector, model
+from buildbot.status import buildindex
 from buildbot.test.util import dirs, misc, compat
 
 def mkconfig(**kwargs):
@@ -57,6 +58,10 @@ class TestUpgradeMaster(dirs.DirsMixin, misc.StdoutAssertionsMixin,
             self.calls.append('upgradeFiles')
         self.patch(upgrade_master, 'upgradeFiles', upgradeFiles)
 
+        def rebuildBuildIndexes(config, master_cfg):
+            self.calls.append('rebuildBuildIndexes')
+        self.patch(upgrade_master, 'rebuildBuildIndexes', rebuildBuildIndexes)
+
         def upgradeDatabase(config, master_cfg):
             self.assertIsInstance(master_cfg, config_module.MasterConfig)
             self.calls.append('upgradeDatabase')
@@ -244,6 +249,19 @@ class TestUpgradeMasterFunctions(dirs.DirsMixin, misc.StdoutAssertionsMixin,
         self.assertEqual(self.readFile("test/templates/root.html"), 'ROOT')
         self.assertInStdout('Decide')
 
+    def test_rebuildBuildIndexes(self):
+        os.makedirs('test/bldr')
+        master_cfg = config_module.MasterConfig()
+        master_cfg.builders = [
+            mock.Mock(name='bldr', builddir='bldr'),
+            mock.Mock(name='missing', builddir='missing'),
+        ]
+        rebuild = mock.Mock(return_value=3)
+        self.patch(buildindex, 'rebuildBuildIndex', rebuild)
+        upgrade_master.rebuildBuildIndexes(mkconfig(quiet=True), master_cfg)
+        rebuild.assert_called_once_with(os.path.join('test', 'bldr'))
+        self.assertWasQuiet()
+
     @defer.inlineCallbacks
     def test_upgradeDatabase(self):
         setup = mock.Mock(side_effect=lambda **kwargs : defer.succeed(None))
@@ -16,7 +16,10 @@
 import os
 from mock import Mock
 from twisted.trial import unittest
-from buildbot.status import builder, master
+from twisted.internet import task
+from buildbot import util, sourcestamp
+from buildbot.status import builder, master, buildindex
+from buildbot.status.results import SUCCESS, WARNINGS, FAILURE
 from buildbot.test.fake import fakemaster
 
 class TestBuildStatus(unittest.TestCase):
@@ -24,6 +27,10 @@ class TestBuildStatus(unittest.TestCase):
     # that buildstep.BuildStepStatus is never instantiated here should tell you
     # that these classes are not well isolated!
 
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(buildindex.BuildIndex, '_reactor', self.clock)
+
     def setupBuilder(self, buildername, category=None):
         m = fakemaster.make_master()
         b = builder.BuilderStatus(buildername=buildername, category=category,
@@ -71,3 +78,149 @@ class TestBuildStatus(unittest.TestCase):
                              'propval%d' % build.number)
             self.assertEqual(b.buildCache.hits, hits+1)
             hits = hits + 1
+
+    def testCachedFinishedBuilds(self):
+        b = self.setupBuilder('builder_1')
+        for i in xrange(4):
+            build = b.newBuild()
+            build.buildStarted(build)
+            build.buildFinished()
+        running = b.newBuild()
+        running.buildStarted(running)
+        b.buildCache = builder.LRUCache(b.cacheMiss)
+        b.getBuild(1)
+        b.getBuild(2)
+        b.getBuild(4)
+        misses = b.buildCache.misses
+        self.assertEqual([ build.number
+                           for build in b.getCachedFinishedBuilds() ],
+                         [ 2, 1 ])
+        self.assertEqual([ build.number
+                           for build in b.getCachedFinishedBuilds(1) ],
+                         [ 2 ])
+        self.assertEqual(b.buildCache.misses, misses)
+
+    def testDurationHistory(self):
+        b = self.setupBuilder('builder_1')
+        self.now = 0
+        self.patch(util, 'now', lambda *args : self.now)
+        for i, results in enumerate([ SUCCESS, FAILURE, WARNINGS ]):
+            build = b.newBuild()
+            build.setSlavename('slave%d' % i)
+            step = build.addStepWithName('compile')
+            build.buildStarted(build)
+            self.now += 10
+            step.started = self.now
+            self.now += 100 * (i + 1)
+            step.finished = self.now
+            build.setResults(results)
+            build.buildFinished()
+
+        history = b.getDurationHistory()
+        self.assertEqual(list(history.slavenames), [ 'slave0', 'slave2' ])
+        self.assertEqual(history.getBuildTime(p=100), 310)
+        self.assertEqual(history.getStepTime('compile', p=50), 100)
+
+        # the history is saved, and reloaded by a new BuilderStatus
+        b2 = builder.BuilderStatus(buildername='builder_1', category=None,
+                                   master=b.master)
+        b2.basedir = b.basedir
+        self.assertEqual(list(b2.getDurationHistory().durations),
+                         [ 110, 310 ])
+
+    def testIndexedBuilds(self):
+        b = self.setupBuilder('builder_1')
+        for i, branch in enumerate([ 'br', None, 'br', None ]):
+            build = b.newBuild()
+            build.setSourceStamp(sourcestamp.SourceStamp(branch=branch))
+            build.setProperty('got_revision', 'rev%d' % (i / 2), 'test')
+            build.buildStarted(build)
+            if i < 3:
+                build.buildFinished()
+
+        def numbers(**kwargs):
+            return [ build.number
+                     for build in b.generateIndexedBuilds(**kwargs) ]
+        self.assertEqual(numbers(branch='br'), [ 2, 0 ])
+        self.assertEqual(numbers(branch=None), [ 3, 1 ])
+        self.assertEqual(numbers(revision='rev1'), [ 3, 2 ])
+
+        # the index is saved shortly, and reloaded by a new BuilderStatus
+        self.assertFalse(os.path.exists(os.path.join(b.basedir, "buildindex")))
+        self.clock.advance(buildindex.BuildIndex.saveDelay)
+        b2 = builder.BuilderStatus(buildername='builder_1', category=None,
+                                   master=b.master)
+        b2.basedir = b.basedir
+        b2.determineNextBuildNumber()
+        self.assertEqual(b2.getBuildIndex().getBuildNumbers(branch='br'),
+                         [ 0, 2 ])
+
+    def testIndexedBuildsSavedBySaveYourself(self):
+        b = self.setupBuilder('builder_1')
+        build = b.newBuild()
+        build.setSourceStamp(sourcestamp.SourceStamp(branch='br'))
+        build.buildStarted(build)
+        build.buildFinished()
+        b.saveYourself()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        index = buildindex.BuildIndex(os.path.join(b.basedir, "buildindex"))
+        self.assertTrue(index.load())
+        self.assertEqual(index.getBuildNumbers(branch='br'), [ 0 ])
+
+    def testIndexedBuildsNotSaved(self):
+        b = self.setupBuilder('builder_1')
+        for i, branch in enumerate([ 'br', None, 'br' ]):
+            build = b.newBuild()
+            build.setSourceStamp(sourcestamp.SourceStamp(branch=branch))
+            build.buildStarted(build)
+            build.buildFinished()
+            if i == 0:
+                self.clock.advance(buildindex.BuildIndex.saveDelay)
+
+        # the master stops before the last builds are saved in the index;
+        # a new BuilderStatus indexes them again
+        b2 = builder.BuilderStatus(buildername='builder_1', category=None,
+                                   master=b.master)
+        b2.basedir = b.basedir
+        b2.determineNextBuildNumber()
+        index = b2.getBuildIndex()
+        self.assertEqual(index.getBuildNumbers(branch='br'), [ 0, 2 ])
+        self.assertEqual(index.getBuildNumbers(branch=None), [ 1 ])
+        self.assertEqual(index.next, 3)
+
+    def testIndexedBuildsPruned(self):
+        b = self.setupBuilder('builder_1')
+        for branch in [ 'br', None, 'br' ]:
+            build = b.newBuild()
+            build.setSourceStamp(sourcestamp.SourceStamp(branch=branch))
+            build.buildStarted(build)
+            build.buildFinished()
+        self.clock.advance(buildindex.BuildIndex.saveDelay)
+
+        b.master.config.buildHorizon = 2
+        b.prune()
+        self.assertEqual(b.getBuildIndex().getBuildNumbers(), [ 1, 2 ])
+
+        # the pruned build is forgotten when the index is saved
+        self.clock.advance(buildindex.BuildIndex.saveDelay)
+        index = buildindex.BuildIndex(os.path.join(b.basedir, "buildindex"))
+        self.assertTrue(index.load())
+        self.assertEqual(index.getBuildNumbers(), [ 1, 2 ])
+
+    def testIndexedBuildsBeforeIndex(self):
+        b = self.setupBuilder('builder_1')
+        for branch in [ 'br', None, 'br' ]:
+            build = b.newBuild()
+            build.setSourceStamp(sourcestamp.SourceStamp(branch=branch))
+            build.buildStarted(build)
+            build.buildFinished()
+        # lose the index, as if these builds were from an older version
+        self.clock.advance(buildindex.BuildIndex.saveDelay)
+        os.unlink(os.path.join(b.basedir, "buildindex"))
+        b.buildindex = None
+
+        self.assertEqual([ build.number for build in
+                           b.generateIndexedBuilds(branch='br') ], [ 2, 0 ])
+        self.assertEqual(list(b.generateIndexedBuilds(branch='br',
+                                                      scan=False)), [])
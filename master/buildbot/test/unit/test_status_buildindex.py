@@ -0,0 +1,170 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import mock
+from cPickle import dump
+from twisted.trial import unittest
+from twisted.internet import task
+from buildbot.status import buildindex
+from buildbot.test.util import compat
+
+def mkbuild(number, branch, got_revision=None, revision=None):
+    build = mock.Mock(name='build')
+    build.getNumber.return_value = number
+    build.getSourceStamp.return_value.branch = branch
+    props = {}
+    if got_revision is not None:
+        props['got_revision'] = got_revision
+    if revision is not None:
+        props['revision'] = revision
+    build.getProperty = lambda name, default=None : props.get(name, default)
+    return build
+
+class TestGetBuildKeys(unittest.TestCase):
+
+    def test_got_revision(self):
+        self.assertEqual(buildindex.getBuildKeys(
+                    mkbuild(1, 'br', got_revision='abcd', revision='ab')),
+                    ('br', 'abcd'))
+
+    def test_revision(self):
+        self.assertEqual(buildindex.getBuildKeys(
+                    mkbuild(1, None, revision=1234)), (None, '1234'))
+
+    def test_no_revision(self):
+        self.assertEqual(buildindex.getBuildKeys(
+                    mkbuild(1, 'br', revision='')), ('br', None))
+
+
+class TestBuildIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.abspath(self.mktemp())
+        self.index = buildindex.BuildIndex(self.filename)
+        # finishing out of order
+        self.index.addBuild(3, 'br', 'rev2')
+        self.index.addBuild(1, None, 'rev1')
+        self.index.addBuild(2, 'br', None)
+        self.index.addBuild(4, None, 'rev2')
+
+    def test_getBuildNumbers(self):
+        self.assertEqual(self.index.getBuildNumbers(), [ 1, 2, 3, 4 ])
+        self.assertEqual(self.index.getBuildNumbers(branch='br'), [ 2, 3 ])
+        self.assertEqual(self.index.getBuildNumbers(branch=None), [ 1, 4 ])
+        self.assertEqual(self.index.getBuildNumbers(revision='rev2'), [ 3, 4 ])
+        self.assertEqual(
+                self.index.getBuildNumbers(branch=None, revision='rev2'), [ 4 ])
+        self.assertEqual(self.index.getBuildNumbers(branch='nosuch'), [])
+
+    def test_forget(self):
+        self.index.forget(3)
+        self.assertEqual(self.index.getBuildNumbers(), [ 3, 4 ])
+        self.assertEqual(self.index.revisions, dict(rev2=[ 3, 4 ]))
+
+    def test_save_load(self):
+        self.index.first = 1
+        self.index.save()
+        index = buildindex.BuildIndex(self.filename)
+        self.assertTrue(index.load())
+        self.assertEqual(index.first, 1)
+        self.assertEqual(index.next, 5)
+        self.assertEqual(index.getBuildNumbers(branch=None), [ 1, 4 ])
+        self.assertEqual(index.getBuildNumbers(revision='rev2'), [ 3, 4 ])
+
+    def test_load_without_next(self):
+        open(self.filename, "w").write('{"first": 2, "revisions": {}, '
+                                       '"branches": [["br", [2, 6]]]}')
+        index = buildindex.BuildIndex(self.filename)
+        self.assertTrue(index.load())
+        self.assertEqual(index.next, 7)
+
+    def test_saveSoon(self):
+        clock = task.Clock()
+        self.index._reactor = clock
+        self.index.saveSoon()
+        self.index.addBuild(5, 'br', None)
+        self.index.saveSoon()
+        self.assertFalse(os.path.exists(self.filename))
+
+        # both changes are saved together, once
+        clock.advance(self.index.saveDelay)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        index = buildindex.BuildIndex(self.filename)
+        self.assertTrue(index.load())
+        self.assertEqual(index.getBuildNumbers(branch='br'), [ 2, 3, 5 ])
+
+    def test_save_cancels_saveSoon(self):
+        clock = task.Clock()
+        self.index._reactor = clock
+        self.index.saveSoon()
+        self.index.save()
+        self.assertTrue(os.path.exists(self.filename))
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_load_missing(self):
+        index = buildindex.BuildIndex(self.filename)
+        self.assertFalse(index.load())
+
+    @compat.usesFlushLoggedErrors
+    def test_load_corrupt(self):
+        open(self.filename, "w").write("{not json")
+        index = buildindex.BuildIndex(self.filename)
+        self.assertFalse(index.load())
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+
+
+class FakeSourceStamp(object):
+
+    def __init__(self, branch):
+        self.branch = branch
+
+class FakeBuildStatus(object):
+
+    def __init__(self, branch, got_revision):
+        self.source = FakeSourceStamp(branch)
+        self.got_revision = got_revision
+
+    def getSourceStamp(self):
+        return self.source
+
+    def getProperty(self, name, default=None):
+        if name == 'got_revision':
+            return self.got_revision
+        return default
+
+class TestRebuildBuildIndex(unittest.TestCase):
+
+    @compat.usesFlushLoggedErrors
+    def test_rebuild(self):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        for number, branch, rev in [ (7, 'br', 'abc'), (9, None, 'def') ]:
+            with open(os.path.join(basedir, str(number)), "wb") as f:
+                dump(FakeBuildStatus(branch, rev), f)
+        open(os.path.join(basedir, "8"), "wb").write("garbage")
+        open(os.path.join(basedir, "builder"), "wb").write("not a build")
+
+        self.assertEqual(buildindex.rebuildBuildIndex(basedir), 2)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+
+        index = buildindex.BuildIndex(os.path.join(basedir, "buildindex"))
+        self.assertTrue(index.load())
+        self.assertEqual(index.first, 0)
+        self.assertEqual(index.getBuildNumbers(), [ 7, 9 ])
+        self.assertEqual(index.getBuildNumbers(branch='br'), [ 7 ])
+        self.assertEqual(index.getBuildNumbers(revision='def'), [ 9 ])
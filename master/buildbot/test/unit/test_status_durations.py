@@ -0,0 +1,116 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+from twisted.trial import unittest
+from buildbot.status import durations
+from buildbot.test.util import compat
+
+class TestPercentile(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(durations.percentile([], 50), None)
+
+    def test_percentiles(self):
+        values = [ 5, 1, 4, 2, 3, 10, 9, 8, 7, 6 ]
+        self.assertEqual(durations.percentile(values, 50), 5)
+        self.assertEqual(durations.percentile(values, 90), 9)
+        self.assertEqual(durations.percentile(values, 100), 10)
+        self.assertEqual(durations.percentile(values, 0), 1)
+
+    def test_single(self):
+        self.assertEqual(durations.percentile([ 7 ], 90), 7)
+
+
+class TestDurationHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.abspath(self.mktemp())
+        self.history = durations.DurationHistory(self.filename, size=5)
+
+    def addBuilds(self, history, slavename, durations):
+        for duration in durations:
+            history.addBuild(slavename, 0, duration,
+                    [ ('checkout', 10), ('compile', duration - 10) ])
+
+    def test_empty(self):
+        self.assertEqual(self.history.getBuildTime(), None)
+        self.assertEqual(self.history.getStepTime('compile'), None)
+        self.assertEqual(self.history.getStepTimes(), {})
+
+    def test_outlier(self):
+        self.addBuilds(self.history, 'sl', [ 100, 110, 1000, 105, 95 ])
+        self.assertEqual(self.history.getBuildTime(), 105)
+        self.assertEqual(self.history.getBuildTime(p=90), 1000)
+        self.assertEqual(self.history.getStepTimes(),
+                         dict(checkout=10, compile=95))
+
+    def test_ring_buffer(self):
+        self.addBuilds(self.history, 'sl', [ 1000, 1000, 100, 100, 100 ])
+        self.addBuilds(self.history, 'sl', [ 100 ])
+        self.assertEqual(len(self.history), 5)
+        self.assertEqual(self.history.getBuildTime(p=100), 1000)
+        self.addBuilds(self.history, 'sl', [ 100 ])
+        self.assertEqual(self.history.getBuildTime(p=100), 100)
+
+    def test_per_slave(self):
+        self.addBuilds(self.history, 'fast', [ 50, 60, 70 ])
+        self.addBuilds(self.history, 'slow', [ 500, 600 ])
+        self.assertEqual(self.history.getBuildTime(slavename='fast'), 60)
+        # too few builds on 'slow', so all slaves are considered
+        self.assertEqual(self.history.getBuildTime(slavename='slow'), 70)
+        self.assertEqual(self.history.getBuildTime(slavename='new'), 70)
+
+    def test_steps_come_and_go(self):
+        self.history.addBuild('sl', 0, 10, [ ('a', 10) ])
+        self.history.addBuild('sl', 0, 20, [ ('a', 5), ('b', 15) ])
+        self.assertEqual(list(self.history.steps['b']), [ None, 15 ])
+        self.assertEqual(self.history.getStepTime('b'), 15)
+        for i in range(5):
+            self.history.addBuild('sl', 0, 10, [ ('a', 10) ])
+        self.assertEqual(self.history.steps.keys(), [ 'a' ])
+
+    def test_asDict(self):
+        self.addBuilds(self.history, 'fast', [ 50 ])
+        self.addBuilds(self.history, 'slow', [ 500 ])
+        d = self.history.asDict()
+        self.assertEqual(d['build'], dict(p50=50, p90=500, samples=2))
+        self.assertEqual(d['steps']['checkout'],
+                         dict(p50=10, p90=10, samples=2))
+        self.assertEqual(d['slaves']['slow']['build'],
+                         dict(p50=500, p90=500, samples=1))
+        self.assertEqual(d['slaves']['fast']['steps']['compile'],
+                         dict(p50=40, p90=40, samples=1))
+
+    def test_save_load(self):
+        self.addBuilds(self.history, 'sl', [ 100, 200 ])
+        self.history.save()
+        history = durations.DurationHistory(self.filename, size=5)
+        history.load()
+        self.assertEqual(history.asDict(), self.history.asDict())
+        self.addBuilds(history, 'sl', [ 300, 400, 500, 600 ])
+        self.assertEqual(list(history.durations), [ 200, 300, 400, 500, 600 ])
+        self.assertEqual(len(history.steps['compile']), 5)
+
+    def test_load_missing(self):
+        self.history.load()
+        self.assertEqual(len(self.history), 0)
+
+    @compat.usesFlushLoggedErrors
+    def test_load_corrupt(self):
+        open(self.filename, "w").write("{not json")
+        self.history.load()
+        self.assertEqual(len(self.history), 0)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
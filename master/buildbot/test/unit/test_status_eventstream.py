@@ -0,0 +1,193 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+from buildbot.status import eventstream
+from buildbot.util import json
+
+class StatusEventProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = mock.Mock()
+        self.factory.maxBuffer = 10
+        self.proto = eventstream.StatusEventProtocol()
+        self.proto.factory = self.factory
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def test_connect(self):
+        self.assertIdentical(self.transport.producer, self.proto)
+        self.assertTrue(self.transport.streaming)
+        self.factory.clientConnected.assert_called_with(self.proto)
+
+    def test_sendData(self):
+        self.proto.sendData('abc\n')
+        self.assertEqual(self.transport.value(), 'abc\n')
+
+    def test_paused(self):
+        self.proto.pauseProducing()
+        self.proto.sendData('abc\n')
+        self.proto.sendData('def\n')
+        self.assertEqual(self.transport.value(), '')
+        self.proto.resumeProducing()
+        self.assertEqual(self.transport.value(), 'abc\ndef\n')
+
+    def test_paused_overflow(self):
+        self.proto.pauseProducing()
+        self.proto.sendData('abcdef\n')
+        self.proto.sendData('ghijkl\n')
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.proto.pending, [])
+        self.proto.resumeProducing()
+        self.proto.sendData('mno\n')
+        self.assertEqual(self.transport.value(), '')
+
+
+class StatusEventStream(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(100)
+        self.stream = eventstream.StatusEventStream(port=0)
+        self.stream._reactor = self.clock
+        self.stream.status = self.makeStatus()
+
+    def makeStatusObject(self, **kwargs):
+        obj = mock.Mock()
+        obj.asDict.return_value = kwargs
+        return obj
+
+    def makeStatus(self):
+        status = self.makeStatusObject(title='proj')
+        status.getTitle.return_value = 'proj'
+        builder = self.makeStatusObject(basedir='b1')
+        builder.getCachedFinishedBuilds.return_value = [
+                self.makeStatusObject(number=2),
+                self.makeStatusObject(number=1) ]
+        builder.getCurrentBuilds.return_value = [
+                self.makeStatusObject(number=3) ]
+        status.getBuilderNames.return_value = [ 'b1' ]
+        status.getBuilder.return_value = builder
+        status.getSlaveNames.return_value = [ 's1' ]
+        status.getSlave.return_value = self.makeStatusObject(name='s1')
+        return status
+
+    def test_port(self):
+        self.assertEqual(self.stream.port, 'tcp:0:interface=127.0.0.1')
+
+    def test_makeSnapshot(self):
+        packets = self.stream.makeSnapshot()
+        self.assertEqual([ (p['event'], p['payload']) for p in packets ], [
+            ('start', dict(status=dict(title='proj'))),
+            ('builderAdded', dict(builderName='b1',
+                                  builder=dict(basedir='b1'))),
+            ('buildFinished', dict(build=dict(number=1))),
+            ('buildFinished', dict(build=dict(number=2))),
+            ('buildStarted', dict(build=dict(number=3))),
+            ('slaveConnected', dict(slave=dict(name='s1'))),
+        ])
+        builder = self.stream.status.getBuilder('b1')
+        builder.getCachedFinishedBuilds.assert_called_with(num_builds=20)
+        self.assertFalse(builder.generateFinishedBuilds.called)
+
+    def makeClient(self):
+        client = mock.Mock()
+        client.since = None
+        return client
+
+    def test_clientConnected(self):
+        client = self.makeClient()
+        self.stream.clientConnected(client)
+        self.assertEqual(self.stream.clients, [ client ])
+        self.clock.advance(0)
+        data = client.sendData.call_args[0][0]
+        events = [ json.loads(l)['event'] for l in data.splitlines() ]
+        self.assertEqual(events[0], 'start')
+        self.assertEqual(len(events), 6)
+        self.stream.clientDisconnected(client)
+        self.assertEqual(self.stream.clients, [])
+
+    def test_clientConnected_throttled(self):
+        self.stream.makeSnapshot = mock.Mock(return_value=[])
+        first = self.makeClient()
+        self.stream.clientConnected(first)
+        self.clock.advance(0)
+        self.assertEqual(self.stream.makeSnapshot.call_count, 1)
+
+        # clients reconnecting soon after wait for one shared snapshot
+        clients = [ self.makeClient() for i in range(3) ]
+        for client in clients:
+            self.stream.clientConnected(client)
+        self.clock.advance(0)
+        self.assertEqual(self.stream.makeSnapshot.call_count, 1)
+        self.assertEqual([ c.sendData.called for c in clients ],
+                         [ False ] * 3)
+        self.stream.clientDisconnected(clients[0])
+
+        self.clock.advance(10)
+        self.assertEqual(self.stream.makeSnapshot.call_count, 2)
+        self.assertEqual([ c.sendData.called for c in clients ],
+                         [ False, True, True ])
+
+    def test_clientDisconnected_before_snapshot(self):
+        self.stream.makeSnapshot = mock.Mock(return_value=[])
+        client = self.makeClient()
+        self.stream.clientConnected(client)
+        self.stream.clientDisconnected(client)
+        self.clock.advance(0)
+        self.assertFalse(self.stream.makeSnapshot.called)
+
+    def test_sendEvents(self):
+        old = self.makeClient()
+        self.stream.clientConnected(old)
+        self.clock.advance(0)
+        # queued before the new client's snapshot, but after the old one's
+        self.stream.queue.pushItem(self.stream.makePacket('builderChangedState',
+                                    builderName='b1', state='idle'))
+        new = self.makeClient()
+        self.stream.clientConnected(new)
+        self.clock.advance(10)
+        self.stream.queue.pushItem(self.stream.makePacket('builderChangedState',
+                                    builderName='b1', state='building'))
+        old.reset_mock()
+        new.reset_mock()
+        self.stream.sendEvents()
+
+        def states(client):
+            data = client.sendData.call_args[0][0]
+            return [ json.loads(l)['payload']['state']
+                     for l in data.splitlines() ]
+        self.assertEqual(states(old), [ 'idle', 'building' ])
+        self.assertEqual(states(new), [ 'building' ])
+        self.assertEqual(self.stream.queue.nbItems(), 0)
+
+    def test_sendEvents_beforeSnapshot(self):
+        self.stream.makeSnapshot = mock.Mock(return_value=[])
+        client = self.makeClient()
+        self.stream.clientConnected(client)
+        self.stream.queue.pushItem(self.stream.makePacket('builderChangedState',
+                                    builderName='b1', state='idle'))
+        self.stream.sendEvents()
+        self.assertFalse(client.sendData.called)
+        self.assertEqual(self.stream.queue.nbItems(), 0)
+
+    def test_sendEvents_noClients(self):
+        self.stream.queue.pushItem(self.stream.makePacket('builderChangedState',
+                                    builderName='b1', state='idle'))
+        self.stream.sendEvents()
+        self.assertEqual(self.stream.queue.nbItems(), 0)
@@ -291,6 +291,34 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
                             for args in watcher.logChunk.call_args_list ]
         self.assertEqual(logChunk_chunks, [(0, 'x')] * 15)
 
+    def test_addEntries_coalesces(self):
+        return self.do_test_addEntries(
+                [(0, 'a'), (0, 'b'), (1, 'c'), (0, u'\N{SNOWMAN}')],
+                '3:0ab,2:1c,4:0\xe2\x98\x83,')
+
+    def do_test_addEntries(self, entries, expected):
+        self.logfile.addEntries(entries)
+        self.logfile.finish()
+        fp = self.logfile.getFile()
+        fp.seek(0, 0)
+        self.assertEqual(fp.read(), expected)
+
+    def test_addEntries_watchers(self):
+        watcher = mock.Mock(name='watcher')
+        self.logfile.watchers.append(watcher)
+        self.do_test_addEntries([(0, 'x'), (0, 'y'), (1, 'z')],
+                '3:0xy,2:1z,')
+        logChunk_chunks = [ tuple(args[0][3:])
+                            for args in watcher.logChunk.call_args_list ]
+        self.assertEqual(logChunk_chunks, [(0, 'xy'), (1, 'z')])
+
+    def test_addEntries_logMaxSize(self):
+        self.config.logMaxSize = 10
+        return self.do_test_addEntries([(0, 'abcdef')] * 10 ,
+            '11:0abcdefabcd,'
+            '64:2\nOutput exceeded 10 bytes, remaining output has been '
+            'truncated\n,')
+
     def test_addStdout(self):
         addEntry = mock.Mock()
         self.patch(self.logfile, 'addEntry', addEntry)
@@ -334,3 +362,54 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         self.config.logCompressionMethod = None
         return self.do_test_compressLog('', expect_comp=False)
 
+
+    def write_chunks(self, chunks):
+        for channel, text in chunks:
+            self.logfile.openfile.write('%d:%d%s,' % (len(text) + 1,
+                                                      channel, text))
+        self.logfile.finish()
+
+    def test_getTextTail_short(self):
+        self.write_chunks([(2, 'hdr'), (0, 'abc'), (1, 'def')])
+        self.assertEqual(self.logfile.getTextTail(100), ('abcdef', False))
+
+    def test_getTextTail_seek(self):
+        chunks = [ (i % 3, '%04d,5:0xx,' % i) for i in range(1000) ]
+        self.write_chunks(chunks)
+        text = ''.join([ t for c, t in chunks if c != 2 ])
+        getChunks = mock.Mock(side_effect=self.logfile.getChunks)
+        self.patch(self.logfile, 'getChunks', getChunks)
+        self.assertEqual(self.logfile.getTextTail(5000),
+                         (text[-5000:], True))
+        # read from the end, not scanned
+        self.assertFalse(getChunks.called)
+
+    def test_getTextTail_whole(self):
+        self.write_chunks([ (0, 'x' * 100), (2, 'h' * 5000), (1, 'y' * 100) ])
+        self.assertEqual(self.logfile.getTextTail(200),
+                         ('x' * 100 + 'y' * 100, False))
+        self.assertEqual(self.logfile.getTextTail(150),
+                         ('x' * 50 + 'y' * 100, True))
+
+    def test_getTextTail_unfinished(self):
+        self.logfile.addStdout('abc' * 100)
+        self.logfile.addHeader('hdr')
+        self.logfile.addStderr('xyz')
+        self.assertEqual(self.logfile.getTextTail(6), ('abcxyz', True))
+
+    def test_getTextTail_compressed(self):
+        self.config.logCompressionMethod = 'bz2'
+        self.write_chunks([ (0, '%04d\n' % i) for i in range(1000) ])
+        d = self.logfile.compressLog()
+        def check(_):
+            self.assertEqual(self.logfile.getTextTail(10),
+                             ('0998\n0999\n', True))
+        d.addCallback(check)
+        return d
+
+    def test_parseChunks(self):
+        self.assertEqual(logfile._parseChunks('xx4:0abc,2:2y,', 2),
+                         [ (0, 'abc'), (2, 'y') ])
+        self.assertEqual(logfile._parseChunks('4:0abc,2:2y', 0), None)
+        self.assertEqual(logfile._parseChunks('4:3abc,', 0), None)
+        self.assertEqual(logfile._parseChunks('1:,', 0), None)
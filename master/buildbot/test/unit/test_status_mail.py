@@ -24,11 +24,12 @@ from buildbot.test.fake.fakebuild import FakeBuildStatus
 from buildbot.process import properties
 
 class FakeLog(object):
-    def __init__(self, text):
+    def __init__(self, text, name='log-name'):
         self.text = text
+        self.name = name
 
     def getName(self):
-        return 'log-name'
+        return self.name
 
     def getStep(self):
         class FakeStep(object):
@@ -39,6 +40,9 @@ class FakeLog(object):
     def getText(self):
         return self.text
 
+    def getTextTail(self, size):
+        return self.text[-size:], len(self.text) > size
+
 
 class TestMailNotifier(unittest.TestCase):
     def test_createEmail_message_without_patch_and_log_contains_unicode(self):
@@ -117,6 +121,83 @@ class TestMailNotifier(unittest.TestCase):
             self.assertIn('application/octet-stream', txt)
         return d
 
+    def do_test_createEmail_logs(self, logs, **kwargs):
+        builds = [ FakeBuildStatus(name="build") ]
+        mn = MailNotifier('from@example.org', addLogs=True, **kwargs)
+        mn.master_status = Mock()
+        mn.master_status.getURLForThing = \
+                lambda log : 'http://bb/%s' % log.getName()
+        d = mn.createEmail(create_msgdict(), u'builder', u'pr', SUCCESS,
+                           builds, None, logs)
+        d.addCallback(lambda m : [ p.get_payload(decode=True)
+                                   for p in m.get_payload()[1:] ])
+        return d
+
+    @defer.inlineCallbacks
+    def test_createEmail_logs_truncated(self):
+        logs = [ FakeLog('x' * 10 + 'y' * 10, 'big'), FakeLog('small') ]
+        parts = yield self.do_test_createEmail_logs(logs,
+                                                    logAttachmentSize=10)
+        self.assertEqual(parts, [
+            '[log truncated; the full log is at http://bb/big]\n' + 'y' * 10,
+            'small' ])
+
+    @defer.inlineCallbacks
+    def test_createEmail_logs_total(self):
+        logs = [ FakeLog('a' * 10, 'l1'), FakeLog('b' * 10, 'l2'),
+                 FakeLog('c' * 10, 'l3') ]
+        parts = yield self.do_test_createEmail_logs(logs,
+                            logAttachmentSize=10, totalLogAttachmentSize=15)
+        self.assertEqual(parts[0], 'a' * 10)
+        self.assertEqual(parts[1],
+            '[log truncated; the full log is at http://bb/l2]\n' + 'b' * 5)
+        self.assertIn(' step-name.l3: http://bb/l3\n', parts[2])
+        self.assertEqual(len(parts), 3)
+
+    @defer.inlineCallbacks
+    def test_createEmail_logs_unlimited(self):
+        logs = [ FakeLog('a' * 100) ]
+        parts = yield self.do_test_createEmail_logs(logs,
+                logAttachmentSize=None, totalLogAttachmentSize=None)
+        self.assertEqual(parts, [ 'a' * 100 ])
+
+    @defer.inlineCallbacks
+    def test_createEmail_logs_errorPatterns(self):
+        text = ''.join([ 'line %d\n' % i for i in range(100) ])
+        text = text.replace('line 3\n', 'error: foo\n')
+        logs = [ FakeLog(text) ]
+        parts = yield self.do_test_createEmail_logs(logs,
+                logAttachmentSize=200, logErrorPatterns=[ r'^error:' ])
+        matches = '[lines matching logErrorPatterns]\nerror: foo\n' \
+                  '[end of log]\n'
+        self.assertEqual(parts[0].split('\n', 1)[1],
+                         matches + text[-200 + len(matches):])
+
+    @defer.inlineCallbacks
+    def test_createEmail_logs_errorPatterns_scan_limited(self):
+        self.patch(MailNotifier, 'logErrorScanSize', 103)
+        text = ''.join([ 'line %d\n' % i for i in range(100) ])
+        # too early in the log to be searched
+        text = text.replace('line 3\n', 'error: foo\n')
+        # cut after its first byte by the start of the searched region
+        text = text.replace('line 62\n', 'Xerror:\n')
+        text = text.replace('line 70\n', 'error:7\n')
+        logs = [ FakeLog(text) ]
+        parts = yield self.do_test_createEmail_logs(logs,
+                logAttachmentSize=200, logErrorPatterns=[ r'error:' ])
+        matches = '[lines matching logErrorPatterns]\nerror:7\n' \
+                  '[end of log]\n'
+        self.assertEqual(parts[0].split('\n', 1)[1],
+                         matches + text[-200 + len(matches):])
+
+    def test_init_log_attachment_options_invalid(self):
+        self.assertRaises(config.ConfigErrors,
+                          MailNotifier, 'from@example.org',
+                          logAttachmentSize=0)
+        self.assertRaises(config.ConfigErrors,
+                          MailNotifier, 'from@example.org',
+                          logErrorPatterns=[ '(' ])
+
     def test_init_enforces_categories_and_builders_are_mutually_exclusive(self):
         self.assertRaises(config.ConfigErrors,
                           MailNotifier, 'from@example.org',
@@ -574,6 +655,50 @@ class TestMailNotifier(unittest.TestCase):
         mn.buildMessage(builder.name, [build1, build2], build1.result)
         self.assertEqual(m['To'], "tyler@mayhem.net, user2@example.net")
 
+    def test_init_outbox(self):
+        mn = MailNotifier('from@example.org', relayhost='mail', smtpPort=26,
+                          maxConnections=3, maxSendRate=10, coalesce=True)
+        self.assertEqual((mn.outbox.relayhost, mn.outbox.port,
+                          mn.outbox.maxConnections, mn.outbox.maxSendRate,
+                          mn.outbox.coalesce),
+                         ('mail', 26, 3, 10, True))
+        self.assertIdentical(mn.outbox.parent, mn)
+
+    def test_init_invalid_outbox_args(self):
+        self.assertRaises(config.ConfigErrors,
+                          lambda : MailNotifier('from@example.org',
+                                                maxConnections=0))
+        self.assertRaises(config.ConfigErrors,
+                          lambda : MailNotifier('from@example.org',
+                                                maxSendRate='fast'))
+
+    def test_sendMessage_queues(self):
+        from email.Message import Message
+        mn = MailNotifier('from@example.org')
+        mn.outbox = Mock()
+        m = Message()
+        mn.sendMessage(m, ['to@example.org'])
+        mn.outbox.sendMessage.assert_called_with('from@example.org',
+                                                 ['to@example.org'], m)
+
+    def test_sendMessage_sendmail_overridden(self):
+        from email.Message import Message
+        sent = []
+        class MyMailNotifier(MailNotifier):
+            def sendmail(self, s, recipients):
+                sent.append((s, recipients))
+                return defer.succeed(None)
+        mn = MyMailNotifier('from@example.org')
+        mn.outbox = Mock()
+        m = Message()
+        m['Subject'] = 'hi'
+        d = mn.sendMessage(m, ['to@example.org'])
+        def check(_):
+            self.assertEqual(sent, [ (m.as_string(), ['to@example.org']) ])
+            self.assertFalse(mn.outbox.sendMessage.called)
+        d.addCallback(check)
+        return d
+
 def create_msgdict():
     unibody = u'Unicode body with non-ascii (\u00E5\u00E4\u00F6).'
     msg_dict = dict(body=unibody, type='plain')
@@ -16,6 +16,7 @@
 import mock
 from twisted.trial import unittest
 from twisted.internet import defer
+from buildbot import util
 from buildbot.status import master, base
 from buildbot.test.fake import fakedb
 
@@ -93,3 +94,58 @@ class TestStatus(unittest.TestCase):
         self.assertIdentical(sr0.master, None)
         self.assertIdentical(sr1.master, None)
         self.assertIdentical(sr2.master, None)
+
+    def insertBuildRequests(self, *ids):
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=id, buildsetid=91, buildername='bldr',
+                                submitted_at=1300305712)
+            for id in ids ])
+
+    @defer.inlineCallbacks
+    def test_getPendingBuildRequestCounts_cached(self):
+        s = self.makeStatus()
+        self.patch(util, 'now', lambda _reactor=None : 100)
+        self.insertBuildRequests(44)
+
+        counts = yield s.getPendingBuildRequestCounts()
+        self.assertEqual(counts['bldr']['count'], 1)
+
+        # a new request is not seen until the cache times out..
+        self.insertBuildRequests(45)
+        counts = yield s.getPendingBuildRequestCounts()
+        self.assertEqual(counts['bldr']['count'], 1)
+
+        self.patch(util, 'now', lambda _reactor=None : 106)
+        counts = yield s.getPendingBuildRequestCounts()
+        self.assertEqual(counts['bldr']['count'], 2)
+
+    @defer.inlineCallbacks
+    def test_getPendingBuildRequestCounts_invalidated(self):
+        s = self.makeStatus()
+        self.patch(util, 'now', lambda _reactor=None : 100)
+        self.insertBuildRequests(44)
+
+        counts = yield s.getPendingBuildRequestCounts()
+        self.assertEqual(counts['bldr']['count'], 1)
+
+        # ..or a build request is added on this master
+        self.insertBuildRequests(45)
+        s._buildRequestCallback(dict(buildername='bldr', brid=45))
+        counts = yield s.getPendingBuildRequestCounts()
+        self.assertEqual(counts['bldr']['count'], 2)
+
+    def test_getPendingBuildRequestCounts_shared(self):
+        s = self.makeStatus()
+        query_d = defer.Deferred()
+        self.db.buildrequests.getUnclaimedBuildRequestCounts = \
+                mock.Mock(return_value=query_d)
+
+        results = []
+        s.getPendingBuildRequestCounts().addCallback(results.append)
+        s.getPendingBuildRequestCounts().addCallback(results.append)
+        self.assertEqual(
+            self.db.buildrequests.getUnclaimedBuildRequestCounts.call_count,
+            1)
+
+        query_d.callback({})
+        self.assertEqual(results, [ {}, {} ])
@@ -0,0 +1,285 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import email
+from email.MIMEText import MIMEText
+from zope.interface import implements
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task, error
+from twisted.mail import smtp
+from twisted.python import failure
+from twisted.test import proto_helpers
+from buildbot.status import outbox
+
+class FakeReactor(proto_helpers.MemoryReactor, task.Clock):
+
+    def __init__(self):
+        proto_helpers.MemoryReactor.__init__(self)
+        task.Clock.__init__(self)
+
+
+class TestMessage(object):
+    implements(smtp.IMessage)
+
+    def __init__(self, server, recipients):
+        self.server = server
+        self.recipients = recipients
+        self.lines = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def eomReceived(self):
+        self.server.messages.append((self.recipients,
+                                     email.message_from_string(
+                                            '\n'.join(self.lines) + '\n')))
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        pass
+
+
+class TestDelivery(object):
+    implements(smtp.IMessageDelivery)
+
+    def __init__(self, server):
+        self.server = server
+        self.recipients = []
+
+    def receivedHeader(self, helo, origin, recipients):
+        self.recipients = []
+        return "Received: test"
+
+    def validateFrom(self, helo, origin):
+        return origin
+
+    def validateTo(self, user):
+        local = user.dest.local
+        if local == 'bad':
+            raise smtp.SMTPBadRcpt(user)
+        if local == 'later' and local not in self.server.refused:
+            self.server.refused.add(local)
+            raise smtp.SMTPBadRcpt(user, code=451, resp='try again later')
+        self.recipients.append(str(user.dest))
+        recipients = self.recipients
+        return lambda : TestMessage(self.server, recipients)
+
+
+class TestSMTPServer(smtp.SMTPFactory):
+
+    def __init__(self):
+        smtp.SMTPFactory.__init__(self)
+        self.messages = []
+        self.refused = set()
+        self.connections = 0
+        self.open = 0
+
+    def buildProtocol(self, addr):
+        p = smtp.ESMTP({})
+        p.factory = self
+        p.host = 'localhost'
+        p.delivery = TestDelivery(self)
+        self.connections += 1
+        self.open += 1
+        factory = self
+        lost = p.connectionLost
+        def connectionLost(reason):
+            factory.open -= 1
+            return lost(reason)
+        p.connectionLost = connectionLost
+        return p
+
+
+class SMTPOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TestSMTPServer()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.outboxes = []
+
+    def tearDown(self):
+        for ob in self.outboxes:
+            if ob.running:
+                ob.stopService()
+        return self.port.stopListening()
+
+    def makeOutbox(self, **kwargs):
+        ob = outbox.SMTPOutbox(relayhost='127.0.0.1',
+                               port=self.port.getHost().port, **kwargs)
+        self.outboxes.append(ob)
+        return ob
+
+    def makeMessage(self, subject):
+        m = MIMEText('body of %s' % subject)
+        m['Subject'] = subject
+        m['From'] = 'from@example.org'
+        return m
+
+    @defer.inlineCallbacks
+    def waitForIdle(self, ob):
+        while ob.connections or self.server.open:
+            yield task.deferLater(reactor, 0.01, lambda : None)
+
+    @defer.inlineCallbacks
+    def test_send_reuses_connection(self):
+        ob = self.makeOutbox(maxConnections=1)
+        ob.startService()
+        yield defer.gatherResults([
+            ob.sendMessage('from@example.org', [ 'a@example.org' ],
+                           self.makeMessage('msg %d' % i))
+            for i in range(3) ])
+        yield self.waitForIdle(ob)
+        self.assertEqual([ m['Subject'] for r, m in self.server.messages ],
+                         [ 'msg 0', 'msg 1', 'msg 2' ])
+        self.assertEqual(self.server.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_messagesPerConnection(self):
+        ob = self.makeOutbox(maxConnections=1, messagesPerConnection=2)
+        ob.startService()
+        yield defer.gatherResults([
+            ob.send('from@example.org', [ 'a@example.org' ],
+                    self.makeMessage('msg %d' % i).as_string())
+            for i in range(3) ])
+        yield self.waitForIdle(ob)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 2)
+
+    @defer.inlineCallbacks
+    def test_permanent_failure(self):
+        ob = self.makeOutbox()
+        ob.startService()
+        try:
+            yield ob.sendMessage('from@example.org', [ 'bad@example.org' ],
+                                 self.makeMessage('bad'))
+        except smtp.SMTPDeliveryError, e:
+            self.assertEqual(e.code, 550)
+        else:
+            self.fail("should have failed")
+        yield self.waitForIdle(ob)
+        self.assertEqual(ob.queue, [])
+
+    @defer.inlineCallbacks
+    def test_temporary_failure(self):
+        ob = self.makeOutbox(retryDelay=0.05)
+        ob.startService()
+        yield ob.sendMessage('from@example.org', [ 'later@example.org' ],
+                             self.makeMessage('later'))
+        yield self.waitForIdle(ob)
+        self.assertEqual(self.server.refused, set([ 'later' ]))
+        self.assertEqual([ m['Subject'] for r, m in self.server.messages ],
+                         [ 'later' ])
+
+    @defer.inlineCallbacks
+    def test_spool(self):
+        spoolDir = os.path.abspath(self.mktemp())
+        ob = self.makeOutbox(spoolDir=spoolDir)
+        # not started, so the message stays in the spool
+        ob.sendMessage('from@example.org', [ 'a@example.org' ],
+                       self.makeMessage('spooled'))
+        self.assertEqual(len(os.listdir(spoolDir)), 1)
+
+        ob = self.makeOutbox(spoolDir=spoolDir)
+        ob.startService()
+        yield self.waitForIdle(ob)
+        self.assertEqual([ (r, m['Subject'])
+                           for r, m in self.server.messages ],
+                         [ ([ 'a@example.org' ], 'spooled') ])
+        self.assertEqual(os.listdir(spoolDir), [])
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        ob = self.makeOutbox(coalesce=True)
+        dl = [ ob.sendMessage('from@example.org', [ 'a@example.org' ],
+                              self.makeMessage('msg %d' % i))
+               for i in range(3) ]
+        dl.append(ob.sendMessage('from@example.org', [ 'b@example.org' ],
+                                 self.makeMessage('other')))
+        ob.startService()
+        yield defer.gatherResults(dl)
+        yield self.waitForIdle(ob)
+        messages = sorted([ (r, m) for r, m in self.server.messages ])
+        self.assertEqual(len(messages), 2)
+        recipients, digest = messages[0]
+        self.assertEqual(recipients, [ 'a@example.org' ])
+        self.assertEqual(digest['Subject'], 'msg 0 (and 2 more)')
+        self.assertEqual(digest.get_content_type(), 'multipart/digest')
+        self.assertEqual([ p.get_payload(0)['Subject']
+                           for p in digest.get_payload() ],
+                         [ 'msg 0', 'msg 1', 'msg 2' ])
+        self.assertEqual(messages[1][1]['Subject'], 'other')
+
+
+class SMTPOutboxScheduling(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.outbox = outbox.SMTPOutbox(relayhost='mail', port=25,
+                                        retryDelay=10)
+        self.outbox._reactor = self.reactor
+        self.outbox.startService()
+
+    def tearDown(self):
+        self.outbox.stopService()
+
+    def test_connections(self):
+        self.outbox.maxConnections = 2
+        for i in range(3):
+            self.outbox.send('from@example.org', [ 'a@example.org' ], 'x')
+        self.assertEqual([ (host, port) for host, port, f, t, b
+                           in self.reactor.tcpClients ],
+                         [ ('mail', 25), ('mail', 25) ])
+
+    def test_unreachable(self):
+        self.outbox.send('from@example.org', [ 'a@example.org' ], 'x')
+        factory = self.reactor.tcpClients[0][2]
+        factory.clientConnectionFailed(None,
+                failure.Failure(error.ConnectionRefusedError()))
+        self.assertEqual(self.outbox.failures, 1)
+        self.assertEqual(len(self.outbox.queue), 1)
+        self.reactor.advance(9)
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+
+        # the next failure backs off for longer
+        factory = self.reactor.tcpClients[1][2]
+        factory.clientConnectionFailed(None,
+                failure.Failure(error.ConnectionRefusedError()))
+        self.reactor.advance(19)
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.tcpClients), 3)
+
+    def test_rate(self):
+        self.outbox.maxSendRate = 30
+        for i in range(2):
+            self.outbox.send('from@example.org', [ 'a@example.org' ], 'x')
+        self.assertNotEqual(self.outbox.nextMessage(), None)
+        self.assertEqual(self.outbox.getSendDelay(), 2)
+        self.reactor.advance(1.5)
+        self.assertEqual(self.outbox.getSendDelay(), 0.5)
+
+    def test_retries_exhausted(self):
+        self.outbox.maxRetries = 1
+        d = self.outbox.send('from@example.org', [ 'a@example.org' ], 'x')
+        exc = smtp.SMTPDeliveryError(451, 'later')
+        self.outbox.messageFailed(self.outbox.nextMessage(), exc)
+        self.assertEqual(self.outbox.nextMessage(), None)
+        self.reactor.advance(10)
+        self.outbox.messageFailed(self.outbox.nextMessage(), exc)
+        self.assertEqual(self.outbox.queue, [])
+        return self.assertFailure(d, smtp.SMTPDeliveryError)
@@ -41,3 +41,22 @@ class TestExpectations(unittest.TestCase):
         expectations = progress.Expectations(oldProgress)
         buildProgress = progress.BuildProgress([])
         buildProgress.setExpectationsFrom(expectations)
+
+    def test_withTimes(self):
+        stepProgress = progress.StepProgress("step", ["metric"])
+        stepProgress.startTime, stepProgress.stopTime = 10, 40
+        stepProgress.progress["metric"] = 42
+        expectations = progress.Expectations(
+                progress.BuildProgress([stepProgress]))
+
+        exp = expectations.withTimes(dict(step=20, other=5, none=None))
+        self.assertEqual(exp.times, dict(step=20, other=5))
+        self.assertEqual(dict(exp.steps), dict(step=dict(metric=42), other={}))
+        # the original is unchanged
+        self.assertEqual(expectations.times, dict(step=30))
+
+        newProgress = progress.BuildProgress([
+            progress.StepProgress("step", ["metric"]),
+            progress.StepProgress("other", []) ])
+        newProgress.setExpectationsFrom(exp)
+        self.assertEqual(newProgress.remaining(), 25)
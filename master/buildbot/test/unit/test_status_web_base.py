@@ -16,6 +16,7 @@
 from buildbot.status.web import base
 from twisted.internet import defer
 from twisted.trial import unittest
+from twisted.web import server
 
 from buildbot.test.fake.web import FakeRequest
 
@@ -58,3 +59,53 @@ class ActionResource(unittest.TestCase):
         d.addErrback(check)
         return d
 
+
+class HtmlResource(unittest.TestCase):
+
+    def makeResource(self, content):
+        class MyHtmlResource(base.HtmlResource):
+            def getContext(self, request):
+                return {}
+        rsrc = MyHtmlResource()
+        rsrc.content = lambda request, cxt : content
+        return rsrc
+
+    def render(self, content, method='GET'):
+        request = FakeRequest()
+        request.method = method
+        self.assertIdentical(self.makeResource(content).render(request),
+                             server.NOT_DONE_YET)
+        return request
+
+    @defer.inlineCallbacks
+    def test_render_string(self):
+        request = self.render(u'caf\xe9')
+        yield request.deferred
+        self.assertEqual(request.written, 'caf\xc3\xa9')
+        self.assertTrue(request.finished)
+
+    @defer.inlineCallbacks
+    def test_render_streaming(self):
+        self.patch(base.IterableProducer, 'writeSize', 10)
+        chunks = [ u'<p>%d</p>' % i for i in range(10) ] + [ u'\xe9' ]
+        request = self.render(iter(chunks))
+        yield request.deferred
+        self.assertEqual(request.written,
+                         u''.join(chunks).encode('utf-8'))
+        self.assertTrue(request.finished)
+        self.assertEqual(request.writes, 6)
+        self.assertIdentical(request.producer, None)
+
+    @defer.inlineCallbacks
+    def test_render_streaming_head(self):
+        request = self.render(iter([ u'abc', u'def' ]), method='HEAD')
+        yield request.deferred
+        self.assertEqual(request.written, '')
+        request.setHeader.assert_any_call('content-length', 6)
+
+    def test_render_streaming_error(self):
+        def generate():
+            yield u'abc'
+            raise RuntimeError('sacrebleu')
+        request = self.render(generate())
+        return self.assertFailure(request.deferred, RuntimeError)
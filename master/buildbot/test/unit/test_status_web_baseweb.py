@@ -0,0 +1,126 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import zlib
+import mock
+from twisted.trial import unittest
+from twisted.application import service
+from twisted.test import proto_helpers
+from twisted.web import static
+from buildbot.status.web import baseweb, base
+
+class StreamingResource(base.HtmlResource):
+
+    def __init__(self, chunks):
+        base.HtmlResource.__init__(self)
+        self.chunks = chunks
+
+    def getContext(self, request):
+        return {}
+
+    def content(self, request, context):
+        return iter(self.chunks)
+
+class RotateLogSite(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        # StaticFile uses the master's directory of web pages as the root
+        os.makedirs(os.path.join(self.basedir, "public_html"))
+        self.ws = None
+
+    def tearDown(self):
+        if self.ws is not None:
+            self.ws.site.stopFactory()
+
+    def makeWebStatus(self, compress, **children):
+        self.ws = baseweb.WebStatus(compress=compress, provide_feeds=[])
+        for name, child in children.iteritems():
+            self.ws.putChild(name, child)
+        parent = service.MultiService()
+        parent.master = mock.Mock()
+        parent.master.basedir = self.basedir
+        parent.master.config.revlink = None
+        parent.master.log_rotation.rotateLength = 1000000
+        parent.master.log_rotation.maxRotatedFiles = 2
+        self.ws.setServiceParent(parent)
+        self.ws.site.startFactory()
+
+    def get(self, path, accept_encoding=None):
+        """Request C{path} from the site, as a client would, and return the
+        response's headers (a dict with lowercase keys) and body."""
+        transport = proto_helpers.StringTransport()
+        channel = self.ws.site.buildProtocol(None)
+        channel.makeConnection(transport)
+        request = "GET %s HTTP/1.0\r\n" % path
+        if accept_encoding:
+            request += "Accept-Encoding: %s\r\n" % accept_encoding
+        channel.dataReceived(request + "\r\n")
+        # streaming pages are written by a pull producer, as the client
+        # reads them
+        while transport.producer is not None:
+            transport.producer.resumeProducing()
+        head, body = transport.value().split("\r\n\r\n", 1)
+        headers = {}
+        for line in head.split("\r\n")[1:]:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        return headers, body
+
+    def gunzip(self, body):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+    def test_gzip(self):
+        text = 'hello, world\n' * 100
+        self.makeWebStatus(True, page=static.Data(text, 'text/plain'))
+        headers, body = self.get('/page', accept_encoding='gzip, deflate')
+        self.assertEqual(headers.get('content-encoding'), 'gzip')
+        self.assertEqual(self.gunzip(body), text)
+
+    def test_gzip_not_accepted(self):
+        text = 'hello, world\n' * 100
+        self.makeWebStatus(True, page=static.Data(text, 'text/plain'))
+        headers, body = self.get('/page')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(body, text)
+
+    def test_gzip_streaming(self):
+        self.patch(base.IterableProducer, 'writeSize', 10)
+        chunks = [ u'<p>%d</p>' % i for i in range(100) ] + [ u'\xe9' ]
+        self.makeWebStatus(True, page=StreamingResource(chunks))
+        headers, body = self.get('/page', accept_encoding='gzip')
+        self.assertEqual(headers.get('content-encoding'), 'gzip')
+        self.assertEqual(self.gunzip(body), u''.join(chunks).encode('utf-8'))
+
+    if baseweb.GzipEncoderFactory is None:
+        test_gzip.skip = test_gzip_streaming.skip = \
+            "GzipEncoderFactory is not available in this Twisted"
+
+    def test_no_compress(self):
+        text = 'hello, world\n' * 100
+        self.makeWebStatus(False, page=static.Data(text, 'text/plain'))
+        headers, body = self.get('/page', accept_encoding='gzip')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(body, text)
+
+    def test_no_compress_streaming(self):
+        self.patch(base.IterableProducer, 'writeSize', 10)
+        chunks = [ u'<p>%d</p>' % i for i in range(100) ] + [ u'\xe9' ]
+        self.makeWebStatus(False, page=StreamingResource(chunks))
+        headers, body = self.get('/page', accept_encoding='gzip')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(body, u''.join(chunks).encode('utf-8'))
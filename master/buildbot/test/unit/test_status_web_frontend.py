@@ -0,0 +1,198 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.web import resource
+from buildbot.status.web import frontend
+from buildbot.test.fake.web import FakeRequest
+from buildbot.util import json
+
+def packet(event, **payload):
+    return dict(event=event, payload=payload)
+
+def build(number, finished=True, steps=2):
+    return dict(builderName='b1', number=number,
+                times=[ 10, finished and 20 or None ],
+                steps=[ dict(name='s%d' % i, step_number=i, isFinished=False)
+                        for i in range(steps) ],
+                currentStep=None)
+
+def props(number):
+    return [ [ 'buildername', 'b1', 'Build' ],
+             [ 'buildnumber', number, 'Build' ] ]
+
+class FrontendStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.status = frontend.FrontendStatus(numBuilds=2)
+        self.status.handlePacket(packet('start', status=dict(title='proj')))
+        self.status.handlePacket(packet('builderAdded', builderName='b1',
+                builder=dict(basedir='b1', state='idle', currentBuilds=[])))
+
+    def test_start(self):
+        self.assertEqual(self.status.project, dict(title='proj'))
+
+    def test_unknown_event(self):
+        self.status.handlePacket(packet('requestSubmitted', request={}))
+
+    def test_builderChangedState(self):
+        self.status.handlePacket(packet('builderChangedState',
+                                        builderName='b1', state='building'))
+        self.assertEqual(self.status.builders['b1']['state'], 'building')
+
+    def test_builderRemoved(self):
+        self.status.handlePacket(packet('buildedRemoved', builderName='b1'))
+        self.assertEqual(self.status.builders, {})
+        self.assertEqual(self.status.getBuild('b1', 1), None)
+
+    def test_builds(self):
+        self.status.handlePacket(packet('buildStarted',
+                                        build=build(1, finished=False)))
+        self.assertEqual(self.status.builders['b1']['currentBuilds'], [ 1 ])
+        self.status.handlePacket(packet('buildFinished', build=build(1)))
+        self.assertEqual(self.status.builders['b1']['currentBuilds'], [])
+        self.assertEqual(self.status.getBuild('b1', 1), build(1))
+        self.assertEqual(self.status.getBuild('b1', -1), build(1))
+        self.assertEqual(self.status.getBuild('b1', 2), None)
+
+    def test_builds_pruned(self):
+        self.status.handlePacket(packet('buildStarted',
+                                        build=build(4, finished=False)))
+        for n in 1, 2, 3:
+            self.status.handlePacket(packet('buildFinished', build=build(n)))
+        # the running build is kept, along with the last two finished
+        self.assertEqual(sorted(self.status.builds['b1']), [ 2, 3, 4 ])
+
+    def test_steps(self):
+        self.status.handlePacket(packet('buildStarted',
+                                        build=build(1, finished=False)))
+        step = dict(name='s1', step_number=1, isFinished=False, text=['x'])
+        self.status.handlePacket(packet('stepStarted', properties=props(1),
+                                        step=step))
+        b = self.status.getBuild('b1', 1)
+        self.assertEqual(b['steps'][1], step)
+        self.assertEqual(b['currentStep'], step)
+        step = dict(step, isFinished=True)
+        self.status.handlePacket(packet('stepFinished', properties=props(1),
+                                        step=step))
+        self.assertEqual(b['steps'][1], step)
+        self.assertEqual(b['currentStep'], None)
+
+    def test_steps_unknown_build(self):
+        self.status.handlePacket(packet('stepStarted', properties=props(7),
+                            step=dict(name='s1', step_number=1)))
+
+    def test_slaves(self):
+        self.status.handlePacket(packet('slaveConnected',
+                                        slave=dict(name='s1', connected=True)))
+        self.status.handlePacket(packet('slaveDisconnected', slavename='s1'))
+        self.assertEqual(self.status.slaves,
+                         dict(s1=dict(name='s1', connected=False)))
+
+    def test_reset(self):
+        self.status.reset()
+        self.assertEqual(self.status.builders, {})
+        self.assertEqual(self.status.project, {})
+
+    def test_old_build_missing(self):
+        self.status.basedir = self.mktemp()
+        self.assertEqual(self.status.getBuild('b1', 1), None)
+
+
+class StatusEventClient(unittest.TestCase):
+
+    def test_lines(self):
+        status = frontend.FrontendStatus()
+        status.builders['old'] = {}
+        factory = frontend.StatusEventClientFactory(status)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.assertTrue(status.connected)
+        self.assertEqual(status.builders, {})
+        proto.dataReceived(json.dumps(packet('start',
+                                             status=dict(title='p'))) + '\n')
+        proto.dataReceived('not json\n')
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(status.project, dict(title='p'))
+
+
+class JsonResources(unittest.TestCase):
+
+    def setUp(self):
+        self.status = frontend.FrontendStatus()
+        self.status.handlePacket(packet('start', status=dict(title='proj')))
+        self.status.handlePacket(packet('builderAdded', builderName='b1',
+                builder=dict(basedir='b1', state='idle', currentBuilds=[])))
+        self.status.handlePacket(packet('buildFinished', build=build(1)))
+        self.status.handlePacket(packet('slaveConnected',
+                                        slave=dict(name='s1', connected=True)))
+        self.root = frontend.FrontendRootJsonResource(self.status)
+
+    def get(self, *path):
+        request = FakeRequest()
+        request.postpath = list(path)
+        request.args = {}
+        rsrc = self.root
+        while request.postpath:
+            rsrc = rsrc.getChildWithDefault(request.postpath.pop(0), request)
+        return rsrc, request
+
+    def test_root(self):
+        rsrc, request = self.get()
+        d = rsrc.asDict(request)
+        def check(data):
+            self.assertEqual(sorted(data), [ 'builders', 'project', 'slaves' ])
+            self.assertEqual(data['project'], dict(title='proj'))
+        d.addCallback(check)
+        return d
+
+    def test_build(self):
+        rsrc, request = self.get('builders', 'b1', 'builds', '-1')
+        self.assertEqual(rsrc.asDict(request), build(1))
+
+    def test_builds(self):
+        rsrc, request = self.get('builders', 'b1', 'builds')
+        self.assertEqual(rsrc.asDict(request), { '1' : build(1) })
+
+    def test_missing(self):
+        for path in [ ('builders', 'b2'), ('builders', 'b1', 'builds', '5'),
+                      ('slaves', 's2') ]:
+            rsrc, request = self.get(*path)
+            self.assertIsInstance(rsrc, resource.NoResource)
+
+    def test_slave(self):
+        rsrc, request = self.get('slaves', 's1')
+        self.assertEqual(rsrc.asDict(request),
+                         dict(name='s1', connected=True))
+
+    def test_render(self):
+        rsrc, request = self.get('builders', 'b1')
+        request.method = 'GET'
+        request.path = '/json/builders/b1'
+        d = request.test_render(rsrc)
+        def check(_):
+            self.assertEqual(json.loads(request.written)['state'], 'idle')
+        d.addCallback(check)
+        return d
+
+
+class WebFrontend(unittest.TestCase):
+
+    def test_constructor(self):
+        fe = frontend.WebFrontend(8010, 9988, basedir='master')
+        self.assertEqual(fe.http_port, 'tcp:8010')
+        self.assertEqual(fe.status.basedir, 'master')
+        self.assertEqual(len(list(fe)), 2)
@@ -0,0 +1,79 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from buildbot.status.web import prometheus
+from buildbot.test.fake.web import FakeRequest
+
+class PrometheusMetricsResource(unittest.TestCase):
+
+    def render(self, metrics):
+        status = mock.Mock()
+        status.getMetrics.return_value = metrics
+        rsrc = prometheus.PrometheusMetricsResource(status)
+        request = FakeRequest()
+        request.method = 'GET'
+        d = request.test_render(rsrc)
+        d.addCallback(lambda _ : (request, request.written.split('\n')))
+        return d
+
+    def test_disabled(self):
+        d = self.render(None)
+        def check((request, lines)):
+            self.assertEqual(lines, [ '' ])
+        d.addCallback(check)
+        return d
+
+    def test_metrics(self):
+        metrics = mock.Mock()
+        metrics.asDict.return_value = dict(
+            counters={ 'BotMaster.attached_slaves' : 2 },
+            gauges={ 'queue "length"' : 3, 'description' : 'text' },
+            timers={ 'foo_time' : 0.5 },
+            histograms={ 'foo_time' : dict(count=4, sum=2.0, max=1.5,
+                                           p50=0.25, p90=1.5, p99=1.5),
+                         'idle_time' : dict(count=0, sum=0, max=None,
+                                            p50=None, p90=None, p99=None) },
+            alarms={ 'gc.garbage' : ('WARN', None) })
+        d = self.render(metrics)
+        def check((request, lines)):
+            request.setHeader.assert_called_with('content-type',
+                                        'text/plain; version=0.0.4')
+            samples = [ l for l in lines if l and not l.startswith('#') ]
+            self.assertEqual(samples, [
+                'buildbot_counter{name="BotMaster.attached_slaves"} 2.0',
+                'buildbot_gauge{name="queue \\"length\\""} 3.0',
+                'buildbot_timer_seconds{name="foo_time",quantile="0.5"} 0.25',
+                'buildbot_timer_seconds{name="foo_time",quantile="0.9"} 1.5',
+                'buildbot_timer_seconds{name="foo_time",quantile="0.99"} 1.5',
+                'buildbot_timer_seconds_sum{name="foo_time"} 2.0',
+                'buildbot_timer_seconds_count{name="foo_time"} 4.0',
+                'buildbot_timer_seconds_sum{name="idle_time"} 0.0',
+                'buildbot_timer_seconds_count{name="idle_time"} 0.0',
+                'buildbot_timer_max_seconds{name="foo_time"} 1.5',
+                'buildbot_timer_window_count{name="foo_time"} 4.0',
+                'buildbot_timer_window_count{name="idle_time"} 0.0',
+                'buildbot_alarm{name="gc.garbage"} 1.0',
+            ])
+            self.assertIn('# TYPE buildbot_timer_seconds summary', lines)
+        d.addCallback(check)
+        return d
+
+    def test_unicode_names(self):
+        rsrc = prometheus.PrometheusMetricsResource(mock.Mock())
+        text = rsrc.format(dict(counters={ u'Build.lockWait.caf\xe9' : 1 }))
+        self.assertIn('buildbot_counter{name="Build.lockWait.caf\xc3\xa9"} 1.0',
+                      text.split('\n'))
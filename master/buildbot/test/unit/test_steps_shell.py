@@ -698,6 +698,95 @@ class WarningCountingShellCommand(steps.BuildStepMixin, unittest.TestCase):
         self.assertEqual(we(step, line, re.match(pat, line)),
                 (exp_file, exp_lineNo, exp_text))
 
+    def test_warnings_split_across_chunks(self):
+        self.setupStep(shell.WarningCountingShellCommand(command=['make']))
+        self.expectCommands(
+            ExpectShell(workdir='wkdir', usePTY='slave-config',
+                        command=["make"])
+            + ExpectShell.log('stdio', stdout='normal\nwarn')
+            + ExpectShell.log('stdio', stderr='warning: on stderr\n')
+            + ExpectShell.log('stdio', stdout='ing: split\nnormal\n')
+            + 0
+        )
+        self.expectOutcome(result=WARNINGS, status_text=["'make'", "warnings"])
+        self.expectProperty("warnings-count", 2)
+        self.expectLogfile("warnings (2)",
+                "warning: on stderr\nwarning: split\n")
+        return self.runStep()
+
+    def test_warnings_counted_as_output_arrives(self):
+        self.setupStep(shell.WarningCountingShellCommand(command=['make']))
+        counts = []
+        def check_count(command):
+            counts.append(self.step.warnCount)
+        self.expectCommands(
+            ExpectShell(workdir='wkdir', usePTY='slave-config',
+                        command=["make"])
+            + ExpectShell.log('stdio', stdout='warning: one\n')
+            + Expect.behavior(check_count)
+            + ExpectShell.log('stdio', stdout='warning: two\n')
+            + Expect.behavior(check_count)
+            + 0
+        )
+        self.expectOutcome(result=WARNINGS, status_text=["'make'", "warnings"])
+        self.expectProperty("warnings-count", 2)
+        d = self.runStep()
+        d.addCallback(lambda _ : self.assertEqual(counts, [1, 2]))
+        return d
+
+
+class SuppressionIndex(unittest.TestCase):
+
+    def makeIndex(self, *suppressions):
+        compiled = []
+        for fileRe, warnRe, start, end in suppressions:
+            if fileRe is not None:
+                fileRe = re.compile(fileRe)
+            if warnRe is not None:
+                warnRe = re.compile(warnRe)
+            compiled.append((fileRe, warnRe, start, end))
+        return shell.SuppressionIndex(compiled)
+
+    def test_text_suppressions_combined(self):
+        idx = self.makeIndex((None, 'unused', None, None),
+                             (None, 'deprecated', None, None))
+        self.assertNotEqual(idx.textRe, None)
+        self.assertEqual(idx.otherSuppressions, [])
+        self.assertTrue(idx.matches('a.c', 10, "variable 'x' unused"))
+        self.assertTrue(idx.matches(None, None, "'f' is deprecated"))
+        self.assertFalse(idx.matches('a.c', 10, "implicit declaration"))
+
+    def test_text_suppressions_backreference(self):
+        idx = self.makeIndex((None, r'(\w+) \1', None, None),
+                             (None, 'unused', None, None))
+        self.assertEqual(idx.textRe, None)
+        self.assertTrue(idx.matches('a.c', 10, "the the"))
+        self.assertTrue(idx.matches('a.c', 10, "unused"))
+        self.assertFalse(idx.matches('a.c', 10, "the cat"))
+
+    def test_suppress_all(self):
+        idx = self.makeIndex((None, None, None, None))
+        self.assertTrue(idx.matches('a.c', 10, "anything"))
+
+    def test_file_suppressions(self):
+        idx = self.makeIndex(('src/.*', 'unused', None, None),
+                             ('lib/x.c', None, 10, 20))
+        self.assertNotEqual(idx.fileRe, None)
+        self.assertTrue(idx.matches('src/a.c', 1, "unused"))
+        self.assertFalse(idx.matches('src/a.c', 1, "other"))
+        self.assertTrue(idx.matches('lib/x.c', 15, "other"))
+        self.assertFalse(idx.matches('lib/x.c', 25, "other"))
+        self.assertFalse(idx.matches('tests/a.c', 15, "unused"))
+        # a warning without a file name matches any file pattern
+        self.assertTrue(idx.matches(None, 1, "unused"))
+
+    def test_line_suppressions(self):
+        idx = self.makeIndex((None, None, 100, 199))
+        self.assertTrue(idx.matches('a.c', 150, "x"))
+        self.assertFalse(idx.matches('a.c', 99, "x"))
+        self.assertFalse(idx.matches('a.c', None, "x"))
+
+
 class Compile(steps.BuildStepMixin, unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,48 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+
+import mock
+from twisted.trial import unittest
+
+from buildbot.steps.source import Git
+
+class CommandComplete(unittest.TestCase):
+
+    def setUp(self):
+        self.step = Git(repourl='git://example.org/repo.git')
+        self.step.setProperty = mock.Mock()
+        self.step.step_status = mock.Mock()
+
+    def test_got_revision(self):
+        cmd = mock.Mock()
+        cmd.updates = { 'got_revision' : [ 'abcdef01' ] }
+        self.step.commandComplete(cmd)
+        self.step.setProperty.assert_called_with('got_revision', 'abcdef01',
+                                                 'Source')
+
+    def test_mirror(self):
+        cmd = mock.Mock()
+        cmd.updates = { 'got_revision' : [ 'abcdef01' ],
+                        'mirror' : [ dict(path='/m', hit=True,
+                                          fetch_time=2, fetch_bytes=1024) ] }
+        self.step.commandComplete(cmd)
+        self.step.setProperty.assert_called_with('got_revision', 'abcdef01',
+                                                 'Source')
+        setStatistic = self.step.step_status.setStatistic
+        self.assertEqual(sorted(setStatistic.call_args_list),
+                         [ (('git_fetch_bytes', 1024),),
+                           (('git_fetch_time', 2),),
+                           (('git_mirror_hit', True),) ])
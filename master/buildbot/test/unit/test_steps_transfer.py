@@ -18,7 +18,9 @@ from __future__ import with_statement
 import tempfile, os
 import shutil
 import tarfile
+from hashlib import sha1
 from twisted.trial import unittest
+from twisted.internet import defer, reactor, threads
 
 from mock import Mock
 
@@ -30,6 +32,17 @@ from buildbot import config
 from buildbot.test.util import steps
 from buildbot.test.fake.remotecommand import Expect, ExpectRemoteRef
 
+def makeArchive(mode='w', **files):
+    from cStringIO import StringIO
+    f = StringIO()
+    archive = tarfile.open(fileobj=f, mode=mode)
+    for name, data in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        archive.addfile(info, StringIO(data))
+    archive.close()
+    return f.getvalue()
+
 class TestFileUpload(unittest.TestCase):
     def setUp(self):
         fd, self.destfile = tempfile.mkstemp()
@@ -168,7 +181,7 @@ class TestDirectoryUpload(steps.BuildStepMixin, unittest.TestCase):
             archive.addfile(tarfile.TarInfo("test"), StringIO("Hello World!"))
             writer = command.args['writer']
             writer.remote_write(f.getvalue())
-            writer.remote_unpack()
+            return writer.remote_unpack()
 
         self.expectCommands(
             Expect('uploadDirectory', dict(
@@ -182,6 +195,553 @@ class TestDirectoryUpload(steps.BuildStepMixin, unittest.TestCase):
         d = self.runStep()
         return d
 
+    def testStreamedBlocks(self):
+        self.setupStep(
+            transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir,
+                                     compress='gz'))
+
+        data = makeArchive('w|gz', one="1" * 50000, two="22")
+        @defer.inlineCallbacks
+        def upload_behavior(command):
+            writer = command.args['writer']
+            for i in range(0, len(data), 100):
+                yield writer.remote_write(data[i:i+100])
+            yield writer.remote_unpack()
+
+        self.expectCommands(
+            Expect('uploadDirectory', dict(
+                slavesrc="srcdir", workdir='wkdir',
+                blocksize=16384, compress='gz', maxsize=None,
+                writer=ExpectRemoteRef(transfer._DirectoryWriter)))
+            + Expect.behavior(upload_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS, status_text=["uploading", "srcdir"])
+        d = self.runStep()
+        def check(_):
+            self.assertEqual(open(os.path.join(self.destdir, "one")).read(),
+                             "1" * 50000)
+            self.assertEqual(open(os.path.join(self.destdir, "two")).read(),
+                             "22")
+        d.addCallback(check)
+        return d
+
+    def testBadArchive(self):
+        writer = transfer._DirectoryWriter(self.destdir, None, None, 0600)
+        writer.remote_write("this is not a tar file" * 100)
+        d = writer.remote_unpack()
+        return self.assertFailure(d, tarfile.ReadError)
+
+    def testCancel(self):
+        writer = transfer._DirectoryWriter(self.destdir, None, None, 0600)
+        data = makeArchive(one="1" * 50000)
+        writer.remote_write(data[:1024])
+        writer.cancel()
+        # further data is ignored
+        self.assertEqual(writer.remote_write(data[1024:]), None)
+        return writer.extracted
+
+    def testSmallThreadPool(self):
+        # extraction waits for the slave, so it must not hold a thread from
+        # the reactor's pool; other work needing that pool must still run
+        pool = reactor.getThreadPool()
+        self.addCleanup(pool.adjustPoolsize, pool.min, pool.max)
+        pool.adjustPoolsize(1, 1)
+        writer = transfer._DirectoryWriter(self.destdir, None, None, 0600)
+        data = makeArchive(one="1" * 50000)
+        writer.remote_write(data[:1024])
+        d = threads.deferToThread(lambda : 'pool thread ran')
+        d.addCallback(self.assertEqual, 'pool thread ran')
+        @d.addCallback
+        def finish(_):
+            writer.remote_write(data[1024:])
+            return writer.remote_unpack()
+        @d.addCallback
+        def check(_):
+            self.assertEqual(open(os.path.join(self.destdir, "one")).read(),
+                             "1" * 50000)
+        return d
+
+    def testContentStore(self):
+        storedir = os.path.abspath('store')
+        if os.path.exists(storedir):
+            shutil.rmtree(storedir)
+        self.addCleanup(shutil.rmtree, storedir)
+        store = transfer.ContentStore(storedir)
+        stored = "I am already stored"
+        fd, tmpname = tempfile.mkstemp()
+        os.write(fd, stored)
+        os.close(fd)
+        store.add(tmpname, sha1(stored).hexdigest())
+        os.unlink(tmpname)
+
+        self.setupStep(
+            transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir,
+                                     contentStore=storedir))
+
+        data = makeArchive(**{'sub/new' : 'new content'})
+        manifest = [ ('sub/old', sha1(stored).hexdigest(), len(stored)),
+                     ('sub/new', sha1('new content').hexdigest(), 11) ]
+        @defer.inlineCallbacks
+        def upload_behavior(command):
+            writer = command.args['writer']
+            missing = yield writer.remote_missingContent(manifest)
+            self.assertEqual(missing, [ sha1('new content').hexdigest() ])
+            yield writer.remote_write(data)
+            yield writer.remote_unpack()
+
+        self.expectCommands(
+            Expect('uploadDirectory', dict(
+                slavesrc="srcdir", workdir='wkdir',
+                blocksize=16384, compress=None, maxsize=None,
+                content_hash=True,
+                writer=ExpectRemoteRef(transfer._ContentDirectoryWriter)))
+            + Expect.behavior(upload_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS, status_text=["uploading", "srcdir"])
+        d = self.runStep()
+        def check(_):
+            self.assertEqual(
+                open(os.path.join(self.destdir, 'sub', 'old')).read(), stored)
+            self.assertEqual(
+                open(os.path.join(self.destdir, 'sub', 'new')).read(),
+                'new content')
+            self.assertTrue(store.has(sha1('new content').hexdigest()))
+            self.assertEqual(self.step_statistics['bytes_saved'], len(stored))
+            self.assertEqual(self.step_statistics['bytes_transferred'],
+                             len(data))
+        d.addCallback(check)
+        return d
+
+    def testContentStoreOldSlave(self):
+        self.setupStep(
+            transfer.DirectoryUpload(slavesrc="srcdir", masterdest=self.destdir,
+                                     contentStore='store'),
+            slave_version={'*':"2.16"})
+
+        self.expectCommands(
+            Expect('uploadDirectory', dict(
+                slavesrc="srcdir", workdir='wkdir',
+                blocksize=16384, compress=None, maxsize=None,
+                writer=ExpectRemoteRef(transfer._DirectoryWriter)))
+            + 0)
+
+        self.expectOutcome(result=SUCCESS, status_text=["uploading", "srcdir"])
+        d = self.runStep()
+        d.addCallback(lambda _ :
+            self.assertFalse('bytes_saved' in self.step_statistics))
+        return d
+
+class TestContentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.storedir = os.path.abspath('store')
+        self.workdir = os.path.abspath('work')
+        for d in self.storedir, self.workdir:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        os.makedirs(self.workdir)
+        self.store = transfer.ContentStore(self.storedir)
+
+    def tearDown(self):
+        for d in self.storedir, self.workdir:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+    def makeFile(self, name, data):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_add_link(self):
+        digest = sha1('hello').hexdigest()
+        self.assertFalse(self.store.has(digest))
+        self.store.add(self.makeFile('a', 'hello'), digest)
+        self.assertTrue(self.store.has(digest))
+        self.assertEqual(self.store.getPath(digest),
+                os.path.join(self.storedir, digest[:2], digest))
+        # adding it again is harmless
+        self.store.add(self.makeFile('b', 'hello'), digest)
+
+        dest = os.path.join(self.workdir, 'sub', 'c')
+        self.store.link(digest, dest)
+        self.assertEqual(open(dest).read(), 'hello')
+        # replace an existing file
+        self.store.link(digest, self.makeFile('d', 'goodbye'))
+        self.assertEqual(open(os.path.join(self.workdir, 'd')).read(), 'hello')
+
+    def test_link_copies(self):
+        digest = sha1('hello').hexdigest()
+        src = self.makeFile('a', 'hello')
+        self.store.add(src, digest)
+        dest = os.path.join(self.workdir, 'c')
+        self.store.link(digest, dest)
+        # neither the original nor the linked file shares the stored file
+        for path in src, dest:
+            os.chmod(path, 0600)
+            with open(path, 'wb') as f:
+                f.write('changed')
+            os.utime(path, (0, 0))
+        storepath = self.store.getPath(digest)
+        self.assertEqual(open(storepath).read(), 'hello')
+        self.assertEqual(os.stat(storepath).st_mode & 0777, 0444)
+        self.assertNotEqual(os.stat(storepath).st_mtime, 0)
+
+    def do_upload(self, destroot, files):
+        writer = transfer._ContentDirectoryWriter(destroot, None, None, None,
+                                                  self.store)
+        manifest = [ (name, sha1(data).hexdigest(), len(data))
+                     for name, data in files.items() ]
+        missing = writer.remote_missingContent(manifest)
+        writer.remote_write(makeArchive(**dict([ (name, data)
+                for name, data in files.items()
+                if sha1(data).hexdigest() in missing ])))
+        return writer.remote_unpack()
+
+    @defer.inlineCallbacks
+    def test_directory_upload_twice(self):
+        destroot = os.path.join(self.workdir, 'dest')
+        dest = os.path.join(destroot, 'f')
+        v1, v2 = 'version one', 'version two'
+        yield self.do_upload(destroot, dict(f=v1))
+        yield self.do_upload(destroot, dict(f=v2))
+        self.assertEqual(open(dest).read(), v2)
+        self.assertEqual(open(self.store.getPath(sha1(v1).hexdigest())).read(),
+                         v1)
+        # and v1 is still good for reuse
+        yield self.do_upload(destroot, dict(f=v1))
+        self.assertEqual(open(dest).read(), v1)
+
+    @defer.inlineCallbacks
+    def test_directory_upload_replaces_links(self):
+        # a destination hard-linked to the store is replaced, not written
+        # through
+        if not hasattr(os, 'link'):
+            raise unittest.SkipTest("no hard links on this platform")
+        digest = sha1('old').hexdigest()
+        self.store.add(self.makeFile('a', 'old'), digest)
+        destroot = os.path.join(self.workdir, 'dest')
+        os.makedirs(destroot)
+        os.link(self.store.getPath(digest), os.path.join(destroot, 'f'))
+        writer = transfer._DirectoryWriter(destroot, None, None, None)
+        writer.remote_write(makeArchive(f='new'))
+        yield writer.remote_unpack()
+        self.assertEqual(open(os.path.join(destroot, 'f')).read(), 'new')
+        self.assertEqual(open(self.store.getPath(digest)).read(), 'old')
+
+    def test_invalid_digest(self):
+        self.assertRaises(ValueError, lambda :
+                self.store.has('../../etc/passwd'))
+
+    def test_file_writer_stored(self):
+        digest = sha1('hello').hexdigest()
+        self.store.add(self.makeFile('a', 'hello'), digest)
+        dest = os.path.join(self.workdir, 'dest')
+        writer = transfer._ContentFileWriter(dest, None, None, self.store)
+        self.assertTrue(writer.remote_haveContent(digest, 5))
+        writer.remote_close()
+        self.assertEqual(open(dest).read(), 'hello')
+        self.assertEqual((writer.bytesTransferred, writer.bytesSaved), (0, 5))
+
+    def test_file_writer_missing(self):
+        digest = sha1('hello').hexdigest()
+        dest = os.path.join(self.workdir, 'dest')
+        writer = transfer._ContentFileWriter(dest, None, None, self.store)
+        self.assertFalse(writer.remote_haveContent(digest, 5))
+        writer.remote_write('hel')
+        writer.remote_write('lo')
+        writer.remote_close()
+        self.assertEqual(open(dest).read(), 'hello')
+        self.assertTrue(self.store.has(digest))
+        self.assertEqual((writer.bytesTransferred, writer.bytesSaved), (5, 0))
+
+    def test_file_writer_changed(self):
+        # content that does not match the announced digest is not stored
+        digest = sha1('hello').hexdigest()
+        dest = os.path.join(self.workdir, 'dest')
+        writer = transfer._ContentFileWriter(dest, None, None, self.store)
+        self.assertFalse(writer.remote_haveContent(digest, 5))
+        writer.remote_write('jello')
+        writer.remote_close()
+        self.assertEqual(open(dest).read(), 'jello')
+        self.assertFalse(self.store.has(digest))
+        self.assertFalse(self.store.has(sha1('jello').hexdigest()))
+
+    def test_file_writer_maxsize(self):
+        digest = sha1('hello').hexdigest()
+        self.store.add(self.makeFile('a', 'hello'), digest)
+        dest = os.path.join(self.workdir, 'dest')
+        writer = transfer._ContentFileWriter(dest, 3, None, self.store)
+        self.assertFalse(writer.remote_haveContent(digest, 5))
+        writer.remote_write('hello')
+        writer.remote_close()
+        self.assertEqual(open(dest).read(), 'hel')
+
+class TestBlockPipe(unittest.TestCase):
+
+    def test_read_write(self):
+        pipe = transfer._BlockPipe(100)
+        self.assertEqual(pipe.write('abc'), None)
+        self.assertEqual(pipe.write('defg'), None)
+        pipe.close()
+        self.assertEqual(pipe.read(2), 'ab')
+        self.assertEqual(pipe.read(4), 'cdef')
+        self.assertEqual(pipe.read(4), 'g')
+        self.assertEqual(pipe.read(4), '')
+
+    def test_backpressure(self):
+        pipe = transfer._BlockPipe(4)
+        self.assertEqual(pipe.write('abc'), None)
+        d = pipe.write('def')
+        self.assertNotEqual(d, None)
+        fired = []
+        d.addCallback(fired.append)
+        self.assertEqual(pipe.read(1), 'a')
+        self.assertEqual(pipe.waiting, d)
+        self.assertEqual(pipe.read(2), 'bc')
+        # the writer is released from the reactor thread
+        self.assertEqual(pipe.waiting, None)
+        d2 = defer.Deferred()
+        reactor.callLater(0, d2.callback, None)
+        d2.addCallback(lambda _ : self.assertEqual(fired, [None]))
+        return d2
+
+    def test_cancel(self):
+        pipe = transfer._BlockPipe(1)
+        d = pipe.write('abc')
+        fired = []
+        d.addCallback(fired.append)
+        pipe.cancel()
+        self.assertEqual(fired, [None])
+        self.assertRaises(IOError, lambda : pipe.read(1))
+        self.assertEqual(pipe.write('x'), None)
+
+class FakeConsumer:
+    """Stands in for the slave's DownloadConsumer"""
+    def __init__(self, wanted=None):
+        self.data = []
+        self.wanted = wanted
+        self.waiting = []
+
+    def callRemote(self, meth, data):
+        assert meth == 'write'
+        self.data.append(data)
+        d = defer.Deferred()
+        more = self.wanted is None or len(''.join(self.data)) < self.wanted
+        self.waiting.append((d, more))
+        return d
+
+    def ackAll(self):
+        while self.waiting:
+            d, more = self.waiting.pop(0)
+            d.callback(more)
+
+class TestFileDownload(steps.BuildStepMixin, unittest.TestCase):
+    def setUp(self):
+        fd, self.srcfile = tempfile.mkstemp()
+        os.write(fd, "x" * 40000)
+        os.close(fd)
+        st = os.stat(self.srcfile)
+        self.stat = dict(size=40000, mtime=st.st_mtime,
+                         digest=sha1("x" * 40000).hexdigest())
+        return self.setUpBuildStep()
+
+    def tearDown(self):
+        os.unlink(self.srcfile)
+        return self.tearDownBuildStep()
+
+    def testPush(self):
+        self.setupStep(
+            transfer.FileDownload(mastersrc=self.srcfile, slavedest="dest"))
+
+        consumer = FakeConsumer()
+        def download_behavior(command):
+            reader = command.args['reader']
+            d = reader.remote_push(consumer)
+            # the whole window is sent before anything is acknowledged
+            self.assertEqual(len(consumer.data), 3)
+            consumer.ackAll()
+            d.addCallback(lambda _ : reader.remote_close())
+            return d
+
+        self.expectCommands(
+            Expect('downloadFile', dict(
+                slavedest="dest", workdir='wkdir',
+                blocksize=16384, maxsize=None, mode=None,
+                source_stat=self.stat, push=True,
+                reader=ExpectRemoteRef(transfer._SharedFileReader)))
+            + Expect.behavior(download_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS,
+                           status_text=["downloading", "to", "dest"])
+        d = self.runStep()
+        def check(_):
+            self.assertEqual(''.join(consumer.data), "x" * 40000)
+            self.assertEqual(self.step_statistics['bytes_transferred'], 40000)
+            self.assertEqual(self.step_statistics['bytes_saved'], 0)
+            self.assertEqual(transfer.downloadSources.sources, {})
+        d.addCallback(check)
+        return d
+
+    def testUpToDate(self):
+        self.setupStep(
+            transfer.FileDownload(mastersrc=self.srcfile, slavedest="dest"))
+
+        def download_behavior(command):
+            reader = command.args['reader']
+            reader.remote_upToDate()
+            reader.remote_close()
+
+        self.expectCommands(
+            Expect('downloadFile', dict(
+                slavedest="dest", workdir='wkdir',
+                blocksize=16384, maxsize=None, mode=None,
+                source_stat=self.stat, push=True,
+                reader=ExpectRemoteRef(transfer._SharedFileReader)))
+            + Expect.behavior(download_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS,
+                           status_text=["downloading", "to", "dest"])
+        d = self.runStep()
+        def check(_):
+            self.assertEqual(self.step_statistics['bytes_transferred'], 0)
+            self.assertEqual(self.step_statistics['bytes_saved'], 40000)
+        d.addCallback(check)
+        return d
+
+    def testOldSlave(self):
+        self.setupStep(
+            transfer.FileDownload(mastersrc=self.srcfile, slavedest="dest"),
+            slave_version={'*':"2.17"})
+
+        def download_behavior(command):
+            reader = command.args['reader']
+            data = []
+            while True:
+                block = reader.remote_read(16384)
+                if not block:
+                    break
+                data.append(block)
+            reader.remote_close()
+            self.assertEqual(''.join(data), "x" * 40000)
+
+        self.expectCommands(
+            Expect('downloadFile', dict(
+                slavedest="dest", workdir='wkdir',
+                blocksize=16384, maxsize=None, mode=None,
+                reader=ExpectRemoteRef(transfer._SharedFileReader)))
+            + Expect.behavior(download_behavior)
+            + 0)
+
+        self.expectOutcome(result=SUCCESS,
+                           status_text=["downloading", "to", "dest"])
+        d = self.runStep()
+        d.addCallback(lambda _ :
+            self.assertFalse('bytes_saved' in self.step_statistics))
+        return d
+
+class TestDownloadSources(unittest.TestCase):
+    def setUp(self):
+        fd, self.srcfile = tempfile.mkstemp()
+        os.write(fd, "0123456789" * 1000)
+        os.close(fd)
+        self.sources = transfer.DownloadSources()
+
+    def tearDown(self):
+        os.unlink(self.srcfile)
+
+    def test_shared(self):
+        src1 = self.sources.acquire(self.srcfile)
+        src2 = self.sources.acquire(self.srcfile)
+        self.assertIdentical(src1, src2)
+        self.assertEqual(src1.read(5, 3), "567")
+        self.sources.release(src1)
+        self.assertFalse(src1.closed)
+        self.sources.release(src2)
+        self.assertTrue(src1.closed)
+        self.assertEqual(self.sources.sources, {})
+
+    def test_changed(self):
+        src1 = self.sources.acquire(self.srcfile)
+        with open(self.srcfile, 'a') as f:
+            f.write("more")
+        src2 = self.sources.acquire(self.srcfile)
+        self.assertNotIdentical(src1, src2)
+        self.assertEqual(src2.size, 10004)
+        self.sources.release(src1)
+        self.assertFalse(src2.closed)
+        self.sources.release(src2)
+
+    @defer.inlineCallbacks
+    def test_digest(self):
+        src = self.sources.acquire(self.srcfile)
+        digests = yield defer.gatherResults([ src.getDigest(),
+                                              src.getDigest() ])
+        self.assertEqual(digests,
+                [ sha1("0123456789" * 1000).hexdigest() ] * 2)
+        self.sources.release(src)
+        # the digest is remembered while the file is unchanged
+        src = self.sources.acquire(self.srcfile)
+        self.assertEqual(src.digest, digests[0])
+        self.sources.release(src)
+
+    def test_read_blocks(self):
+        src = self.sources.acquire(self.srcfile)
+        src.blockSize = 64
+        src.readAhead = 256
+        src.prefetching = True # read only what is asked for
+        self.assertEqual(src.read(60, 10), "0123456789")
+        self.assertEqual(sorted(src.blocks), [ 0, 1 ])
+        self.assertEqual(src.read(1000, 30), ("0123456789" * 3))
+        # blocks far behind the furthest reader are not kept
+        self.assertEqual(sorted(src.blocks), [ 15, 16 ])
+        self.assertEqual(src.read(0, 20), "01234567890123456789")
+        self.assertEqual(sorted(src.blocks), [ 15, 16 ])
+        self.assertEqual(src.read(9990, 100), "0123456789")
+        self.sources.release(src)
+
+    def test_truncated(self):
+        src = self.sources.acquire(self.srcfile)
+        src.prefetching = True
+        # the file is truncated in place while it is being downloaded
+        with open(self.srcfile, 'r+') as f:
+            f.truncate(100)
+        self.assertEqual(src.read(90, 20), "0123456789")
+        self.assertEqual(src.read(5000, 100), "")
+        self.sources.release(src)
+
+    def test_empty(self):
+        open(self.srcfile, 'w').close()
+        src = self.sources.acquire(self.srcfile)
+        self.assertEqual(src.read(0, 100), '')
+        self.sources.release(src)
+
+    def test_push_stopped(self):
+        src = self.sources.acquire(self.srcfile)
+        reader = transfer._SharedFileReader(self.sources, src, 1000)
+        reader.window = 2
+        consumer = FakeConsumer(wanted=2500)
+        d = reader.remote_push(consumer)
+        while consumer.waiting:
+            consumer.ackAll()
+        self.assertEqual(len(consumer.data), 4)
+        reader.remote_close()
+        return d
+
+    def test_push_failed(self):
+        src = self.sources.acquire(self.srcfile)
+        reader = transfer._SharedFileReader(self.sources, src, 1000)
+        consumer = FakeConsumer()
+        d = reader.remote_push(consumer)
+        consumer.waiting.pop(0)[0].errback(RuntimeError("lost"))
+        consumer.ackAll()
+        reader.remote_close()
+        return self.assertFailure(d, RuntimeError)
+
 class TestStringDownload(unittest.TestCase):
     def testBasic(self):
         s = transfer.StringDownload("Hello World", "hello.txt")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# usage: python logfile_benchmark.py [options] [recorded-log]
+#
+# Replays a stream of slave updates through RemoteCommand.remote_update into
+# a real LogFile, and reports the ingestion rate in MB/s.  The update stream
+# is taken from an existing on-disk build log (e.g. builder/12-log-compile-
+# stdio, optionally .gz or .bz2), whose chunks are replayed in order as
+# stdout/stderr/header updates.  Without a recorded log, a synthetic stream of
+# interleaved stdout and stderr is generated.
+#
+# Run this from the master directory of a source checkout, or with buildbot
+# installed.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+from bz2 import BZ2File
+from gzip import GzipFile
+
+from buildbot import config
+from buildbot.process.buildstep import RemoteCommand
+from buildbot.status import logfile
+
+CHANNEL_KEYS = { logfile.STDOUT : 'stdout',
+                 logfile.STDERR : 'stderr',
+                 logfile.HEADER : 'header' }
+
+class FakeBuilder(object):
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.master = FakeMaster()
+
+class FakeMaster(object):
+    def __init__(self):
+        self.config = config.MasterConfig()
+
+class FakeBuild(object):
+    def __init__(self, basedir):
+        self.builder = FakeBuilder(basedir)
+
+class FakeStep(object):
+    def __init__(self, basedir):
+        self.build = FakeBuild(basedir)
+
+class FakeSlave(object):
+    def messageReceivedFromSlave(self):
+        pass
+
+def recorded_chunks(filename):
+    if filename.endswith('.bz2'):
+        f = BZ2File(filename, 'r')
+    elif filename.endswith('.gz'):
+        f = GzipFile(filename, 'r')
+    else:
+        f = open(filename, 'r')
+    chunks = []
+    scanner = logfile.LogFileScanner(chunks.append)
+    while True:
+        data = f.read(65536)
+        if not data:
+            break
+        scanner.dataReceived(data)
+    f.close()
+    return chunks
+
+def synthetic_chunks(total, chunksize):
+    line = "gcc -c -O2 -Wall -o build/obj/module.o src/module.c\n"
+    text = (line * (chunksize / len(line) + 1))[:chunksize]
+    chunks = []
+    for i in xrange(total / chunksize):
+        if i % 10 == 9:
+            chunks.append((logfile.STDERR, "warning: something odd\n"))
+        else:
+            chunks.append((logfile.STDOUT, text))
+    return chunks
+
+def make_messages(chunks, per_message):
+    messages = []
+    num = 0
+    for i in xrange(0, len(chunks), per_message):
+        msg = []
+        for channel, text in chunks[i:i+per_message]:
+            msg.append(({ CHANNEL_KEYS[channel] : text }, num))
+            num += 1
+        messages.append(msg)
+    return messages
+
+def run(chunks, per_message, watchers):
+    basedir = tempfile.mkdtemp()
+    try:
+        step = FakeStep(basedir)
+        lf = logfile.LogFile(step, 'stdio', 'bench-stdio')
+        for i in range(watchers):
+            class Watcher:
+                def logChunk(self, build, step, log, channel, text):
+                    pass
+            lf.watchers.append(Watcher())
+        cmd = RemoteCommand('shell', {})
+        cmd.buildslave = FakeSlave()
+        cmd.active = True
+        cmd.updates = {}
+        cmd.useLog(lf, closeWhenFinished=True)
+
+        messages = make_messages(chunks, per_message)
+        nbytes = sum([ len(text) for channel, text in chunks ])
+
+        start = time.time()
+        for msg in messages:
+            cmd.remote_update(msg)
+        lf.finish()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(basedir)
+    return nbytes, elapsed
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [recorded-log]")
+    parser.add_option("--updates-per-message", type="int", default=1,
+            help="number of updates delivered in each remote_update call")
+    parser.add_option("--watchers", type="int", default=1,
+            help="number of no-op log watchers to attach")
+    parser.add_option("--size", type="int", default=100,
+            help="size of the synthetic stream, in MB")
+    parser.add_option("--chunk-size", type="int", default=4096,
+            help="size of each synthetic update, in bytes")
+    opts, args = parser.parse_args()
+
+    if args:
+        chunks = recorded_chunks(args[0])
+    else:
+        chunks = synthetic_chunks(opts.size * 1024 * 1024, opts.chunk_size)
+
+    nbytes, elapsed = run(chunks, opts.updates_per_message, opts.watchers)
+    mb = nbytes / (1024.0 * 1024.0)
+    print "%d updates, %.1f MB in %.3fs: %.1f MB/s" % (
+            len(chunks), mb, elapsed, mb / max(elapsed, 1e-6))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,8 @@ import os.path
 import socket
 import sys
 import signal
+import tempfile
+import cPickle
 
 from twisted.spread import pb
 from twisted.python import log
@@ -25,6 +27,7 @@ from twisted.application import service, internet
 from twisted.cred import credentials
 
 import buildslave
+from buildslave import util
 from buildslave.pbutil import ReconnectingPBClientFactory
 from buildslave.commands import registry, base
 from buildslave import monkeypatches
@@ -32,6 +35,151 @@ from buildslave import monkeypatches
 class UnknownCommand(pb.Error):
     pass
 
+class UpdateQueue:
+    """A FIFO of status updates that are waiting to be sent to the master.
+
+    Adjacent output updates (stdout, stderr, header, or output for the same
+    logfile) are coalesced into a single update, up to C{maxChunkSize} bytes.
+    Once more than C{maxMemory} bytes are queued, further updates are spooled
+    to a temporary file in C{spooldir} until the queue has drained.
+
+    @ivar unacked: number of update messages taken from this queue that the
+    master has not yet acknowledged; maintained by the L{SlaveBuilder}
+    """
+
+    maxChunkSize = 64*1024
+
+    def __init__(self, spooldir=None, maxMemory=1024*1024):
+        self.spooldir = spooldir
+        self.maxMemory = maxMemory
+        self.updates = []
+        self.memorySize = 0
+        self.spool = None
+        self.spoolReadOffset = 0
+        self.spoolCount = 0
+        self.unacked = 0
+        self.drainedWatchers = []
+
+    def __len__(self):
+        return len(self.updates) + self.spoolCount
+
+    def append(self, update):
+        if self.spool is not None:
+            # once spooling, everything goes to the spool until it is empty,
+            # so that the order of updates is preserved
+            self._spoolUpdate(update)
+            return
+        if self.updates:
+            merged = self._coalesce(self.updates[-1], update)
+            if merged is not None:
+                self.memorySize += _updateSize(update)
+                self.updates[-1] = merged
+                return
+        if self.memorySize > self.maxMemory:
+            self._spoolUpdate(update)
+            return
+        self.updates.append(update)
+        self.memorySize += _updateSize(update)
+
+    def popBatch(self, maxUpdates, maxBytes):
+        """Remove and return up to C{maxUpdates} updates, totalling roughly
+        C{maxBytes} bytes of output."""
+        batch = []
+        size = 0
+        while len(batch) < maxUpdates and size < maxBytes:
+            if not self.updates and not self._unspool():
+                break
+            update = self.updates.pop(0)
+            updateSize = _updateSize(update)
+            self.memorySize -= updateSize
+            size += updateSize
+            batch.append(update)
+        return batch
+
+    def discard(self):
+        self.updates = []
+        self.memorySize = 0
+        self._closeSpool()
+        self.checkDrained()
+
+    def waitUntilDrained(self):
+        """Return a Deferred that fires when every update in this queue has
+        been handed to the transport."""
+        if not self:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.drainedWatchers.append(d)
+        return d
+
+    def checkDrained(self):
+        if self:
+            return
+        watchers, self.drainedWatchers = self.drainedWatchers, []
+        for d in watchers:
+            d.callback(None)
+
+    def _coalesce(self, last, update):
+        if len(last) != 1 or len(update) != 1:
+            return None
+        key = last.keys()[0]
+        if key not in update:
+            return None
+        if key in ('stdout', 'stderr', 'header'):
+            if len(last[key]) + len(update[key]) > self.maxChunkSize:
+                return None
+            return { key : last[key] + update[key] }
+        if key == 'log' and last[key][0] == update[key][0]:
+            if len(last[key][1]) + len(update[key][1]) > self.maxChunkSize:
+                return None
+            return { key : (last[key][0], last[key][1] + update[key][1]) }
+        if key == 'segments':
+            if _updateSize(last) + _updateSize(update) > self.maxChunkSize:
+                return None
+            return { key : last[key] + update[key] }
+        return None
+
+    def _spoolUpdate(self, update):
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile(dir=self.spooldir)
+            self.spoolReadOffset = 0
+        self.spool.seek(0, 2)
+        cPickle.dump(update, self.spool, cPickle.HIGHEST_PROTOCOL)
+        self.spoolCount += 1
+
+    def _unspool(self):
+        if not self.spoolCount:
+            return False
+        self.spool.seek(self.spoolReadOffset)
+        update = cPickle.load(self.spool)
+        self.spoolReadOffset = self.spool.tell()
+        self.spoolCount -= 1
+        if not self.spoolCount:
+            self._closeSpool()
+        self.updates.append(update)
+        self.memorySize += _updateSize(update)
+        return True
+
+    def _closeSpool(self):
+        if self.spool is not None:
+            self.spool.close()
+        self.spool = None
+        self.spoolCount = 0
+        self.spoolReadOffset = 0
+
+def _updateSize(update):
+    size = 0
+    for key, value in update.iteritems():
+        if key == 'segments':
+            # a list of (logname, data)
+            for segment in value:
+                size += len(segment[1])
+        elif isinstance(value, basestring):
+            size += len(value)
+        elif isinstance(value, tuple) and len(value) == 2 \
+                and isinstance(value[1], basestring):
+            size += len(value[1])
+    return size
+
 class SlaveBuilder(pb.Referenceable, service.Service):
 
     """This is the local representation of a single Builder: it handles a
@@ -54,9 +202,27 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     # when the step is started
     remoteStep = None
 
+    # at most this many update messages may be awaiting acknowledgement from
+    # the master at any time; further updates are queued (and coalesced) in
+    # .updateQueue.  The master may change this with setUpdateWindow.  A
+    # window of None means "unlimited".
+    updateWindow = 16
+
+    # limits on the size of a single update message
+    maxUpdatesPerMessage = 64
+    maxUpdateMessageSize = 512*1024
+
+    # smoothed round-trip time of update messages, in seconds; RunProcess uses
+    # this to decide how long to buffer output
+    updateRTT = None
+
+    # true if the master can decode 'segments' updates for the current command
+    segmentedUpdates = False
+
     def __init__(self, name):
         #service.Service.__init__(self) # Service has no __init__ method
         self.setName(name)
+        self.updateQueue = UpdateQueue()
 
     def __repr__(self):
         return "<SlaveBuilder '%s' at %d>" % (self.name, id(self))
@@ -101,9 +267,15 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         log.msg("lost remote")
         self.remote = None
 
+    def remote_setUpdateWindow(self, window):
+        """Set the number of update messages that may be awaiting
+        acknowledgement at once; None or 0 means no limit."""
+        self.updateWindow = window or None
+
     def lostRemoteStep(self, remotestep):
         log.msg("lost remote step")
         self.remoteStep = None
+        self.updateQueue.discard()
         if self.stopCommandOnShutdown:
             self.stopCommand()
 
@@ -136,6 +308,8 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         self.command = factory(self, stepId, args)
 
         log.msg(" startCommand:%s [id %s]" % (command,stepId))
+        self.updateQueue = UpdateQueue(spooldir=self.basedir)
+        self.segmentedUpdates = bool(args.get('segmented_updates'))
         self.remoteStep = stepref
         self.remoteStep.notifyOnDisconnect(self.lostRemoteStep)
         d = self.command.doStart()
@@ -172,22 +346,45 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         L{buildbot.process.step.RemoteCommand} object, giving it a sequence
         number in the process. It adds the update to a queue, and asks the
         master to acknowledge the update so it can be removed from that
-        queue."""
+        queue.
+
+        No more than C{updateWindow} messages are left unacknowledged at any
+        time. While the window is full, updates wait in C{updateQueue}, and
+        are sent in batches as acknowledgements arrive."""
 
         if not self.running:
             # .running comes from service.Service, and says whether the
             # service is running or not. If we aren't running, don't send any
             # status messages.
             return
-        # the update[1]=0 comes from the leftover 'updateNum', which the
-        # master still expects to receive. Provide it to avoid significant
-        # interoperability issues between new slaves and old masters.
         if self.remoteStep:
-            update = [data, 0]
-            updates = [update]
-            d = self.remoteStep.callRemote("update", updates)
+            self.updateQueue.append(data)
+            self._sendUpdates(self.remoteStep, self.updateQueue)
+
+    def _sendUpdates(self, remoteStep, queue):
+        while queue and (not self.updateWindow or
+                         queue.unacked < self.updateWindow):
+            # the update[1]=0 comes from the leftover 'updateNum', which the
+            # master still expects to receive. Provide it to avoid significant
+            # interoperability issues between new slaves and old masters.
+            updates = [ [data, 0] for data in
+                        queue.popBatch(self.maxUpdatesPerMessage,
+                                       self.maxUpdateMessageSize) ]
+            queue.unacked += 1
+            d = remoteStep.callRemote("update", updates)
             d.addCallback(self.ackUpdate)
             d.addErrback(self._ackFailed, "SlaveBuilder.sendUpdate")
+            d.addCallback(self._updateRetired, remoteStep, queue, util.now())
+        queue.checkDrained()
+
+    def _updateRetired(self, _, remoteStep, queue, sentAt):
+        rtt = util.now() - sentAt
+        if self.updateRTT is None:
+            self.updateRTT = rtt
+        else:
+            self.updateRTT = 0.875 * self.updateRTT + 0.125 * rtt
+        queue.unacked -= 1
+        self._sendUpdates(remoteStep, queue)
 
     def ackUpdate(self, acknum):
         self.activity() # update the "last activity" timer
@@ -217,11 +414,14 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             log.msg(" but we weren't running, quitting silently")
             return
         if self.remoteStep:
-            self.remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
-            d = self.remoteStep.callRemote("complete", failure)
+            remoteStep = self.remoteStep
+            remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
+            self.remoteStep = None
+            # the completion must not overtake any updates still queued
+            d = self.updateQueue.waitUntilDrained()
+            d.addCallback(lambda _ : remoteStep.callRemote("complete", failure))
             d.addCallback(self.ackComplete)
             d.addErrback(self._ackFailed, "sendComplete")
-            self.remoteStep = None
 
 
     def remote_shutdown(self):
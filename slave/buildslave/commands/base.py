@@ -32,7 +32,7 @@ from buildslave import util
 # this used to be a CVS $-style "Revision" auto-updated keyword, but since I
 # moved to Darcs as the primary repository, this is updated manually each
 # time this file is changed. The last cvs_ver that was here was 1.51 .
-command_version = "2.15"
+command_version = "2.19"
 
 # version history:
 #  >=1.17: commands are interruptable
@@ -64,6 +64,14 @@ command_version = "2.15"
 #  >= 2.13: SlaveFileUploadCommand supports option 'keepstamp'
 #  >= 2.14: RemoveDirectory can delete multiple directories
 #  >= 2.15: 'interruptSignal' option is added to SlaveShellCommand
+#  >= 2.16: commands accept 'segmented_updates', and then send interleaved
+#           output as 'segments' updates: lists of (logname, data) pairs
+#  >= 2.17: uploadFile and uploadDirectory accept 'content_hash', and then
+#           offer SHA-1 digests of the content to the writer before sending it
+#  >= 2.18: downloadFile accepts 'source_stat' and 'push', to skip files that
+#           are up to date and to have the master push the file
+#  >= 2.19: new gitMirror command, and git accepts 'mirror', to share a mirror
+#           of each repository between the builders on a slave
 
 class Command:
     implements(ISlaveCommand)
@@ -14,13 +14,234 @@
 # Copyright Buildbot Team Members
 
 import os
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from twisted.internet import defer
 
-from buildslave.commands.base import SourceBaseCommand
-from buildslave import runprocess
+from buildslave.commands.base import Command, SourceBaseCommand
+from buildslave import runprocess, util
+from buildslave.commands import utils
 from buildslave.commands.base import AbandonChain
 
+# the default directory for mirrors, relative to the builder's basedir, so
+# that all of the builders on a slave share it
+DEFAULT_MIRRORDIR = os.path.join(os.pardir, 'git-mirrors')
+
+# locks for the mirrors, keyed by path, so that only one command at a time
+# updates each mirror
+mirrorLocks = {}
+
+class Mirror:
+    """
+    A bare mirror of a git repository, shared between the builders on a slave.
+    Each repourl gets its own mirror, named after the SHA-1 of the URL, in
+    MIRRORDIR (relative to the builder's basedir).  Checkouts borrow objects
+    from the mirror through alternates, so unreachable objects are never
+    pruned from a mirror.
+
+    COMMAND is the Command on whose behalf the mirror is updated; its
+    builder, timeouts and logEnviron are used for the git processes, and its
+    'command' attribute is set so that it can interrupt them.
+    """
+
+    def __init__(self, command, repourl, mirrordir=None):
+        self.command = command
+        self.repourl = repourl
+        mirrordir = os.path.expanduser(mirrordir or DEFAULT_MIRRORDIR)
+        self.mirrordir = os.path.normpath(
+                os.path.join(command.builder.basedir, mirrordir))
+        self.path = os.path.join(self.mirrordir,
+                                 sha1(repourl).hexdigest() + '.git')
+        self.stats = {}
+
+    def _git(self, args, cwd, **kwargs):
+        cmd = self.command
+        c = runprocess.RunProcess(cmd.builder,
+                         [utils.getCommand("git")] + args, cwd,
+                         sendRC=False, timeout=cmd.timeout,
+                         maxTime=cmd.maxTime, logEnviron=cmd.logEnviron,
+                         usePTY=False, **kwargs)
+        cmd.command = c
+        return c.start()
+
+    @defer.deferredGenerator
+    def _objectsSize(self):
+        """Fire with the size in bytes of the objects in the mirror, loose
+        and packed, as 'git count-objects' reports it, or None if it cannot
+        be determined."""
+        wfd = defer.waitForDeferred(
+            self._git(['count-objects', '-v'], self.path,
+                      sendStdout=False, keepStdout=True))
+        yield wfd
+        if wfd.getResult() != 0:
+            yield None
+            return
+        size = 0
+        for line in self.command.command.stdout.splitlines():
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            if key.strip() in ('size', 'size-pack'):
+                try:
+                    size += int(value) * 1024
+                except ValueError:
+                    yield None
+                    return
+        yield size
+
+    @defer.deferredGenerator
+    def update(self, revision=None, progress=False):
+        """Bring the mirror up to date, cloning it if necessary; fires with
+        the rc of the last git command.  If REVISION is already in the
+        mirror, nothing is fetched.  Sets self.stats to a dictionary with
+        keys 'path', 'hit', 'fetch_time' and 'fetch_bytes'."""
+        lock = mirrorLocks.setdefault(self.path, defer.DeferredLock())
+        wfd = defer.waitForDeferred(lock.acquire())
+        yield wfd
+        wfd.getResult()
+        try:
+            wfd = defer.waitForDeferred(self._update(revision, progress))
+            yield wfd
+            rc = wfd.getResult()
+        finally:
+            lock.release()
+        yield rc
+
+    @defer.deferredGenerator
+    def _update(self, revision, progress):
+        reactor = self.command._reactor
+        hit = os.path.isdir(self.path)
+        self.stats = dict(path=self.path, hit=hit,
+                          fetch_time=0, fetch_bytes=0)
+
+        if hit and revision:
+            wfd = defer.waitForDeferred(
+                self._git(['cat-file', '-e', '%s^{commit}' % revision],
+                          self.path))
+            yield wfd
+            if wfd.getResult() == 0:
+                yield 0
+                return
+
+        if hit:
+            wfd = defer.waitForDeferred(self._objectsSize())
+            yield wfd
+            before = wfd.getResult()
+        else:
+            before = 0
+
+        start = util.now(reactor)
+        if hit:
+            command = ['fetch', 'origin']
+            if progress:
+                command.append('--progress')
+            self.command.sendStatus({'header': "updating mirror of %s in %s\n"
+                                                % (self.repourl, self.path)})
+            wfd = defer.waitForDeferred(self._git(command, self.path))
+            yield wfd
+            rc = wfd.getResult()
+        else:
+            if not os.path.isdir(self.mirrordir):
+                os.makedirs(self.mirrordir)
+            command = ['clone', '--mirror', self.repourl, self.path]
+            if progress:
+                command.append('--progress')
+            self.command.sendStatus({'header': "creating mirror of %s in %s\n"
+                                                % (self.repourl, self.path)})
+            wfd = defer.waitForDeferred(self._git(command, self.mirrordir))
+            yield wfd
+            rc = wfd.getResult()
+            if rc == 0:
+                # checkouts may refer to any object in the mirror
+                wfd = defer.waitForDeferred(
+                    self._git(['config', 'gc.pruneExpire', 'never'],
+                              self.path))
+                yield wfd
+                rc = wfd.getResult()
+
+        self.stats['fetch_time'] = util.now(reactor) - start
+        if rc == 0 and before is not None:
+            # this is approximate: a gc run by the fetch shrinks the objects
+            wfd = defer.waitForDeferred(self._objectsSize())
+            yield wfd
+            after = wfd.getResult()
+            if after is not None:
+                self.stats['fetch_bytes'] = max(0, after - before)
+        yield rc
+
+    def addAlternate(self, srcdir):
+        """Have the checkout in SRCDIR borrow objects from the mirror, if
+        it is not already doing so"""
+        info = os.path.join(srcdir, '.git', 'objects', 'info')
+        if not os.path.isdir(os.path.join(srcdir, '.git', 'objects')):
+            return
+        if not os.path.isdir(info):
+            os.makedirs(info)
+        objects = os.path.join(self.path, 'objects')
+        alternates = os.path.join(info, 'alternates')
+        lines = []
+        if os.path.exists(alternates):
+            lines = open(alternates).read().splitlines()
+        if objects not in lines:
+            f = open(alternates, 'a')
+            f.write(objects + '\n')
+            f.close()
+
+
+class GitMirror(Command):
+    """Update the slave's shared mirror of a git repository.  This command
+    reads the following keys:
+
+    ['repourl'] (required):   the upstream GIT repository string
+    ['mirrordir'] (optional): the directory containing the mirrors,
+                              relative to the builder basedir.  Default:
+                              "../git-mirrors"
+    ['revision'] (optional):  if the mirror already contains this
+                              revision, nothing is fetched
+    ['workdir'] (optional):   if this is a git checkout, add the mirror
+                              to its alternates
+    ['progress'] (optional):  have git output progress markers
+    ['timeout'], ['maxTime'], ['logEnviron']: as for SlaveShellCommand
+
+    Sends a 'mirror' update containing a dictionary with the mirror's 'path',
+    whether the mirror already existed ('hit'), and the 'fetch_time' and
+    'fetch_bytes' spent updating it.
+    """
+
+    header = "git mirror"
+
+    def setup(self, args):
+        self.repourl = args['repourl']
+        self.mirrordir = args.get('mirrordir')
+        self.revision = args.get('revision')
+        self.workdir = args.get('workdir')
+        self.progress = args.get('progress')
+        self.timeout = args.get('timeout', 1200)
+        self.maxTime = args.get('maxTime', None)
+        self.logEnviron = args.get('logEnviron', True)
+        self.command = None
+
+    def start(self):
+        self.mirror = Mirror(self, self.repourl, self.mirrordir)
+        d = self.mirror.update(self.revision, self.progress)
+        def done(rc):
+            if rc == 0 and self.workdir:
+                self.mirror.addAlternate(
+                        os.path.join(self.builder.basedir, self.workdir))
+            self.sendStatus({'mirror': self.mirror.stats})
+            self.sendStatus({'rc': rc})
+        d.addCallback(done)
+        return d
+
+    def interrupt(self):
+        self.interrupted = True
+        if self.command:
+            self.command.kill("command interrupted")
+
+
 
 class Git(SourceBaseCommand):
     """Git specific VC operation. In addition to the arguments
@@ -41,6 +262,10 @@ class Git(SourceBaseCommand):
                                    requires Git 1.7.2 or later.
     ['shallow'] (optional):        if true, use shallow clones that do not
                                    also fetch history
+    ['mirror'] (optional):         if true, fetch from the slave's shared
+                                   mirror of the repository (see GitMirror),
+                                   updating it first; if a string, the
+                                   directory containing the mirrors
     """
 
     header = "git operation"
@@ -56,6 +281,8 @@ class Git(SourceBaseCommand):
         self.ignore_ignores = args.get('ignore_ignores', True)
         self.reference = args.get('reference', None)
         self.gerrit_branch = args.get('gerrit_branch', None)
+        self.mirror = args.get('mirror')
+        self.fetchurl = self.repourl
 
     def _fullSrcdir(self):
         return os.path.join(self.builder.basedir, self.srcdir)
@@ -148,7 +375,7 @@ class Git(SourceBaseCommand):
     def _doFetch(self, dummy, branch):
         # The plus will make sure the repo is moved to the branch's
         # head even if it is not a simple "fast-forward"
-        command = ['fetch', '-t', self.repourl, '+%s' % branch]
+        command = ['fetch', '-t', self.fetchurl, '+%s' % branch]
         # If the 'progress' option is set, tell git fetch to output
         # progress information to the log. This can solve issues with
         # long fetches killed due to lack of output, but only works
@@ -175,6 +402,26 @@ class Git(SourceBaseCommand):
             # No known revision, go grab the latest.
             return self._doFetch(None, branch)
 
+    def doVC(self, res):
+        if not self.mirror:
+            return SourceBaseCommand.doVC(self, res)
+        if self.mirror is True:
+            mirror = Mirror(self, self.repourl)
+        else:
+            mirror = Mirror(self, self.repourl, self.mirror)
+        d = mirror.update(self.revision, self.args.get('progress'))
+        d.addCallback(self._abandonOnFailure)
+        def useMirror(_):
+            self.sendStatus({'mirror': mirror.stats})
+            # new checkouts borrow the mirror's objects, and existing
+            # checkouts are made to
+            self.reference = mirror.path
+            self.fetchurl = mirror.path
+            mirror.addAlternate(self._fullSrcdir())
+            return SourceBaseCommand.doVC(self, res)
+        d.addCallback(useMirror)
+        return d
+
     def _didInit(self, res):
         # If we have a reference repository specified, we need to also set that
         # up after the 'git init'.
@@ -25,6 +25,7 @@ commandRegistry = {
     "cvs" : "buildslave.commands.cvs.CVS",
     "darcs" : "buildslave.commands.darcs.Darcs",
     "git" : "buildslave.commands.git.Git",
+    "gitMirror" : "buildslave.commands.git.GitMirror",
     "repo" : "buildslave.commands.repo.Repo",
     "bzr" : "buildslave.commands.bzr.Bzr",
     "hg" : "buildslave.commands.hg.Mercurial",
@@ -13,13 +13,35 @@
 #
 # Copyright Buildbot Team Members
 
-import os, tarfile, tempfile
+import os, tarfile, time, Queue, threading
 
-from twisted.python import log
-from twisted.internet import defer
+from twisted.python import log, failure
+from twisted.internet import defer, threads
+from twisted.spread import pb
 
 from buildslave.commands.base import Command
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+def hashFile(path, blocksize=256*1024):
+    """Return the hex SHA-1 digest and the size of the file at C{path}"""
+    sha = sha1()
+    size = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            sha.update(data)
+            size += len(data)
+    finally:
+        f.close()
+    return sha.hexdigest(), size
+
 class TransferCommand(Command):
 
     def finished(self, res):
@@ -56,6 +78,9 @@ class SlaveFileUploadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['keepstamp']: whether to preserve file modified and accessed times
+        - ['content_hash']: whether to offer the file's SHA-1 digest to the
+                            writer first, and skip sending content that the
+                            master already has
     """
     debug = False
 
@@ -66,6 +91,7 @@ class SlaveFileUploadCommand(TransferCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.keepstamp = args.get('keepstamp', False)
+        self.contentHash = args.get('content_hash', False)
         self.stderr = None
         self.rc = 0
 
@@ -96,7 +122,10 @@ class SlaveFileUploadCommand(TransferCommand):
         self.sendStatus({'header': "sending %s" % self.path})
 
         d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
+        if self.contentHash and self.fp is not None:
+            self._offerContent(d)
+        else:
+            self._reactor.callLater(0, self._loop, d)
         def _close_ok(res):
             self.fp = None
             d1 = self.writer.callRemote("close")
@@ -121,6 +150,21 @@ class SlaveFileUploadCommand(TransferCommand):
         d.addBoth(self.finished)
         return d
 
+    def _offerContent(self, fire_when_done):
+        # hash the file, and only send it if the master does not already
+        # have that content
+        d = threads.deferToThread(hashFile, self.path)
+        d.addCallback(lambda (digest, size) :
+                self.writer.callRemote('haveContent', digest, size))
+        def check(have):
+            if have:
+                if self.debug:
+                    log.msg('master already has %r' % self.path)
+                self.fp.close()
+                self.fp = None
+            self._loop(fire_when_done)
+        d.addCallbacks(check, fire_when_done.errback)
+
     def _loop(self, fire_when_done):
         d = defer.maybeDeferred(self._writeBlock)
         def _done(finished):
@@ -150,10 +194,18 @@ class SlaveFileUploadCommand(TransferCommand):
                 self.stderr = 'Maximum filesize reached, truncating file \'%s\'' \
                                 % self.path
                 self.rc = 1
-            data = ''
+            d = defer.succeed('')
         else:
-            data = self.fp.read(length)
+            d = defer.maybeDeferred(self._readBlock, length)
+        d.addCallback(self._sendBlock, length)
+        return d
 
+    def _readBlock(self, length):
+        """Read up to C{length} bytes of data to send; may return a
+        Deferred"""
+        return self.fp.read(length)
+
+    def _sendBlock(self, data, length):
         if self.debug:
             log.msg('SlaveFileUploadCommand._writeBlock(): '+
                     'allowed=%d readlen=%d' % (length, len(data)))
@@ -169,7 +221,112 @@ class SlaveFileUploadCommand(TransferCommand):
         return d
 
 
+class _StreamCancelled(Exception):
+    pass
+
+class TarStream(object):
+    """
+    A file-like object into which a TarFile, running in a producer thread,
+    writes an archive, and from which the upload reads the archive back in
+    blocks as it is produced.
+
+    At most C{maxBlocks} blocks are queued; beyond that, the producer waits
+    for the transfer to catch up.
+    """
+
+    maxBlocks = 16
+
+    def __init__(self, blocksize):
+        self.blocksize = blocksize
+        self.queue = Queue.Queue(self.maxBlocks)
+        self.cancelled = False
+        # producer side
+        self.buffer = []
+        self.buffered = 0
+        # consumer side
+        self.pending = ''
+        self.eof = False
+
+    def _put(self, item):
+        # wait for room in the queue, giving up if the transfer is cancelled
+        while True:
+            if self.cancelled:
+                raise _StreamCancelled()
+            try:
+                self.queue.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def write(self, data):
+        """Called from the producer thread with more of the archive"""
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered < self.blocksize:
+            return
+        data = ''.join(self.buffer)
+        while len(data) >= self.blocksize:
+            self._put(data[:self.blocksize])
+            data = data[self.blocksize:]
+        self.buffer = [ data ]
+        self.buffered = len(data)
+
+    def close(self):
+        """Called from the producer thread once the archive is complete"""
+        data = ''.join(self.buffer)
+        if data:
+            self._put(data)
+        self._put(None)
+
+    def fail(self, why):
+        """Called from the producer thread if the archive cannot be
+        produced; the failure is raised to the reader"""
+        self._put(why)
+
+    def read(self, length):
+        """Called from a thread to read up to C{length} bytes of the archive,
+        waiting until they have been produced.  Returns '' at the end of the
+        archive."""
+        while len(self.pending) < length and not self.eof:
+            # wait for the producer, giving up if the transfer is cancelled
+            try:
+                item = self.queue.get(True, 0.1)
+            except Queue.Empty:
+                if self.cancelled:
+                    raise _StreamCancelled()
+                continue
+            if item is None:
+                self.eof = True
+            elif isinstance(item, failure.Failure):
+                self.eof = True
+                item.raiseException()
+            else:
+                self.pending += item
+        data, self.pending = self.pending[:length], self.pending[length:]
+        return data
+
+    def cancel(self):
+        """Stop the producer, if it is still running"""
+        self.cancelled = True
+
+
 class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
+    """
+    Upload a directory from slave to build master, as a tar archive that is
+    unpacked on the master.  The archive is produced in a separate thread and
+    sent as it is written, without being staged on disk.
+    Arguments:
+
+        - ['workdir']:   base directory to use
+        - ['slavesrc']:  name of the slave-side directory to read from
+        - ['writer']:    RemoteReference to a transfer._DirectoryWriter object
+        - ['maxsize']:   max size (in bytes) of the archive to send
+        - ['blocksize']: max size for each data block
+        - ['compress']:  compression to use: None, 'gz' or 'bz2'
+        - ['content_hash']: whether to send the writer a manifest of the
+                            SHA-1 digests of the files first, and leave out
+                            of the archive content the master already has
+    """
     debug = False
 
     def setup(self, args):
@@ -179,6 +336,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.compress = args['compress']
+        self.contentHash = args.get('content_hash', False)
+        self.exclude = None
         self.stderr = None
         self.rc = 0
 
@@ -192,27 +351,36 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         if self.debug:
             log.msg("path: %r" % self.path)
 
-        # Create temporary archive
-        fd, self.tarname = tempfile.mkstemp()
-        fileobj = os.fdopen(fd, 'w')
         if self.compress == 'bz2':
             mode='w|bz2'
         elif self.compress == 'gz':
             mode='w|gz'
         else:
-            mode = 'w'
-        archive = tarfile.open(name=self.tarname, mode=mode, fileobj=fileobj)
-        archive.add(self.path, '')
-        archive.close()
-        fileobj.close()
+            mode = 'w|'
 
-        # Transfer it
-        self.fp = open(self.tarname, 'rb')
+        self.fp = TarStream(self.blocksize)
 
         self.sendStatus({'header': "sending %s" % self.path})
 
+        # Produce the archive in a thread, and send it as it is written.  The
+        # producer waits for the archive to be sent, and reading it takes a
+        # thread from the reactor's pool, so the producer must not hold one
+        # of those too.
+        def startArchive(_):
+            producer = threading.Thread(target=self._produce,
+                                        args=(self.fp, mode),
+                                        name='DirectoryUpload producer')
+            producer.setDaemon(True)
+            producer.start()
+            self._loop(d)
+
         d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
+        if self.contentHash:
+            d1 = threads.deferToThread(self._hashDirectory)
+            d1.addCallback(self._sendManifest)
+            d1.addCallbacks(startArchive, d.errback)
+        else:
+            self._reactor.callLater(0, startArchive, None)
         def unpack(res):
             d1 = self.writer.callRemote("unpack")
             def unpack_err(f):
@@ -221,13 +389,80 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
             d1.addErrback(unpack_err)
             d1.addCallback(lambda ignored: res)
             return d1
-        d.addCallback(unpack)
+        def failed(f):
+            # the archive could not be produced, or a write failed
+            self.rc = 1
+            return f
+        d.addCallbacks(unpack, failed)
         d.addBoth(self.finished)
         return d
 
+    def _walk(self):
+        # yield (path, archive name) for everything below self.path
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames.sort()
+            reldir = dirpath[len(self.path):].strip(os.sep).replace(os.sep, '/')
+            for name in dirnames + sorted(filenames):
+                if reldir:
+                    arcname = reldir + '/' + name
+                else:
+                    arcname = name
+                yield os.path.join(dirpath, name), arcname
+
+    def _hashDirectory(self):
+        # runs in a thread; returns a manifest of (name, digest, size) for
+        # each regular file
+        if not os.path.isdir(self.path):
+            raise OSError("'%s' is not a directory" % self.path)
+        manifest = []
+        for path, arcname in self._walk():
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            digest, size = hashFile(path)
+            manifest.append((arcname, digest, size))
+        return manifest
+
+    def _sendManifest(self, manifest):
+        d = self.writer.callRemote('missingContent', manifest)
+        def leaveOut(missing):
+            # files whose content the master has are left out of the archive
+            missing = set(missing)
+            self.exclude = set([ arcname
+                                 for arcname, digest, size in manifest
+                                 if digest not in missing ])
+        d.addCallback(leaveOut)
+        return d
+
+    def _produce(self, stream, mode):
+        # runs in a thread
+        try:
+            archive = tarfile.open(mode=mode, fileobj=stream)
+            if self.exclude is None:
+                archive.add(self.path, '')
+            else:
+                archive.add(self.path, '', recursive=False)
+                for path, arcname in self._walk():
+                    if arcname not in self.exclude:
+                        archive.add(path, arcname, recursive=False)
+            archive.close()
+        except _StreamCancelled:
+            return
+        except:
+            try:
+                stream.fail(failure.Failure())
+            except _StreamCancelled:
+                pass
+            return
+        try:
+            stream.close()
+        except _StreamCancelled:
+            pass
+
+    def _readBlock(self, length):
+        return threads.deferToThread(self.fp.read, length)
+
     def finished(self, res):
-        self.fp.close()
-        os.remove(self.tarname)
+        self.fp.cancel()
         return TransferCommand.finished(self, res)
 
 
@@ -242,6 +477,11 @@ class SlaveFileDownloadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['mode']:      access mode for the new file
+        - ['source_stat']: optional dictionary with the 'size', 'mtime' and
+                           'digest' (hex SHA-1) of the master's file; if the
+                           slave's file matches, nothing is transferred
+        - ['push']:      if true, ask the reader to push the file to us
+                         rather than reading it a block at a time
     """
     debug = False
 
@@ -252,6 +492,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.bytes_remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.mode = args['mode']
+        self.sourceStat = args.get('source_stat')
+        self.push = args.get('push', False)
         self.stderr = None
         self.rc = 0
 
@@ -259,11 +501,45 @@ class SlaveFileDownloadCommand(TransferCommand):
         if self.debug:
             log.msg('SlaveFileDownloadCommand starting')
 
-        # Open file
         self.path = os.path.join(self.builder.basedir,
                                  self.workdir,
                                  os.path.expanduser(self.filename))
 
+        if self.sourceStat is None:
+            return self._startDownload(False)
+        d = threads.deferToThread(self._isUpToDate)
+        d.addCallback(self._startDownload)
+        return d
+
+    def _isUpToDate(self):
+        # runs in a thread
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if (st.st_size != self.sourceStat['size'] or
+                int(st.st_mtime) != int(self.sourceStat['mtime'])):
+            return False
+        return hashFile(self.path)[0] == self.sourceStat['digest']
+
+    def _startDownload(self, upToDate):
+        if upToDate:
+            self.fp = None
+            if self.mode is not None:
+                # the file may have been downloaded with another mode
+                try:
+                    os.chmod(self.path, self.mode)
+                except OSError:
+                    self.stderr = "Cannot set the mode of '%s'" % self.path
+                    self.rc = 1
+            self.sendStatus({'header': "'%s' is already up to date\n"
+                                       % self.path})
+            d = self.reader.callRemote('upToDate')
+            d.addCallback(lambda _ : self.reader.callRemote('close'))
+            d.addBoth(self.finished)
+            return d
+
+        # Open file
         dirname = os.path.dirname(self.path)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
@@ -290,7 +566,11 @@ class SlaveFileDownloadCommand(TransferCommand):
                 log.msg("Cannot open file '%s' for download" % self.path)
 
         d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
+        if self.push and self.fp is not None:
+            d1 = self.reader.callRemote('push', DownloadConsumer(self))
+            d1.addCallbacks(d.callback, d.errback)
+        else:
+            self._reactor.callLater(0, self._loop, d)
         def _close(res):
             # close the file, but pass through any errors from _loop
             d1 = self.reader.callRemote('close')
@@ -298,9 +578,21 @@ class SlaveFileDownloadCommand(TransferCommand):
             d1.addCallback(lambda ignored: res)
             return d1
         d.addBoth(_close)
+        if self.sourceStat is not None:
+            d.addCallback(self._setMtime)
         d.addBoth(self.finished)
         return d
 
+    def _setMtime(self, res):
+        # give a complete file the master's mtime, so that it can be
+        # recognized as up to date next time
+        if self.fp is None or self.rc != 0 or self.interrupted:
+            return res
+        self.fp.close()
+        self.fp = None
+        os.utime(self.path, (time.time(), self.sourceStat['mtime']))
+        return res
+
     def _loop(self, fire_when_done):
         d = defer.maybeDeferred(self._readBlock)
         def _done(finished):
@@ -349,8 +641,38 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.fp.write(data)
         return False
 
+    def _pushedData(self, data):
+        """Called with data pushed by the reader; returns False if no more
+        data is wanted"""
+        if self.interrupted or self.fp is None:
+            return False
+        more = True
+        if self.bytes_remaining is not None:
+            if len(data) > self.bytes_remaining:
+                data = data[:self.bytes_remaining]
+                self.stderr = "Maximum filesize reached, truncating file '%s'" \
+                                % self.path
+                self.rc = 1
+                more = False
+            self.bytes_remaining = self.bytes_remaining - len(data)
+        self.fp.write(data)
+        return more
+
     def finished(self, res):
         if self.fp is not None:
             self.fp.close()
 
         return TransferCommand.finished(self, res)
+
+
+class DownloadConsumer(pb.Referenceable):
+    """
+    Passed to the master's reader when a download is pushed; the reader
+    calls C{write} with each block of the file.
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def remote_write(self, data):
+        return self.command._pushedData(data)
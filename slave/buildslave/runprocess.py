@@ -25,13 +25,21 @@ import re
 import subprocess
 import traceback
 import stat
+import glob
+import fnmatch
 from collections import deque
 from tempfile import NamedTemporaryFile
 
-from twisted.python import runtime, log
+from twisted.python import runtime, log, filepath
 from twisted.python.win32 import quoteArguments
 from twisted.internet import reactor, defer, protocol, task, error
 
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # not on Linux, or ctypes is missing; LogFileWatcher will poll
+    inotify = None
+
 from buildslave import util
 from buildslave.exceptions import AbandonChain
 
@@ -60,13 +68,95 @@ def shell_quote(cmd_list):
             return pipes.quote(e)
         return " ".join([ quote(e) for e in cmd_list ])
 
+def _escapeGlob(path):
+    """Quote the glob metacharacters in C{path}, so that it matches only
+    itself."""
+    return re.sub(r'([*?[])', r'[\1]', path)
+
+
+class LogFileNotifier:
+    """
+    A single inotify instance, shared by the LogFileWatchers of a command so
+    that a command with many logfiles does not use up the user's inotify
+    instances.  Several watchers may watch the same directory; the instance
+    is closed when the last of them stops.
+    """
+
+    def __init__(self):
+        self.inotify = None
+        # callbacks, by the directory they watch
+        self.callbacks = {}
+
+    def watch(self, dirname, callback):
+        if self.inotify is None:
+            notifier = inotify.INotify()
+            notifier.startReading()
+            self.inotify = notifier
+        if dirname not in self.callbacks:
+            mask = (inotify.IN_MODIFY | inotify.IN_CREATE |
+                    inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE)
+            try:
+                self.inotify.watch(filepath.FilePath(dirname), mask=mask,
+                                   callbacks=[self._notified])
+            except Exception:
+                if not self.callbacks:
+                    self._close()
+                raise
+            self.callbacks[dirname] = []
+        self.callbacks[dirname].append(callback)
+
+    def unwatch(self, dirname, callback):
+        callbacks = self.callbacks.get(dirname, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks and dirname in self.callbacks:
+            del self.callbacks[dirname]
+            try:
+                self.inotify.ignore(filepath.FilePath(dirname))
+            except KeyError:
+                pass # the directory was removed, and the watch with it
+        if not self.callbacks:
+            self._close()
+
+    def _close(self):
+        if self.inotify is not None:
+            self.inotify.loseConnection()
+            self.inotify = None
+
+    def _notified(self, ignored, path, mask):
+        for callback in self.callbacks.get(path.parent().path, [])[:]:
+            callback(ignored, path, mask)
+
+
 class LogFileWatcher:
+    """
+    Watch a logfile written by the command, sending its contents to the
+    master as it grows.
+
+    On Linux, the directory containing the logfile is watched with inotify,
+    and the file is read shortly after it changes.  Elsewhere, or if the
+    directory does not exist yet, the file is polled every POLL_INTERVAL
+    seconds.
+    """
     POLL_INTERVAL = 2
 
-    def __init__(self, command, name, logfile, follow=False):
+    # reads start at MIN_READ_SIZE and double, up to MAX_READ_SIZE, while the
+    # file is growing faster than we read it
+    MIN_READ_SIZE = 10000
+    MAX_READ_SIZE = 1024*1024
+
+    # time to wait after an inotify event before reading, so that a burst of
+    # writes results in a single read
+    NOTIFY_DELAY = 0.1
+
+    _reactor = reactor
+
+    def __init__(self, command, name, logfile, follow=False, notifier=None):
         self.command = command
         self.name = name
         self.logfile = logfile
+        # the LogFileNotifier to use; if None, each watcher has its own
+        self.logFileNotifier = notifier
 
         log.msg("LogFileWatcher created to watch %s" % logfile)
         # we are created before the ShellCommand starts. If the logfile we're
@@ -79,10 +169,20 @@ class LogFileWatcher:
         # added since we started watching
         self.follow = follow
 
-        # every 2 seconds we check on the file again
+        self.readSize = self.MIN_READ_SIZE
+
+        # every 2 seconds we check on the file again, unless inotify is
+        # available
         self.poller = task.LoopingCall(self.poll)
+        self.notifier = None
+        self.notifyDirectory = None
+        self.notifyTimer = None
 
     def start(self):
+        if self._startNotifier():
+            # pick up anything written before the watch was in place
+            self.poll()
+            return
         self.poller.start(self.POLL_INTERVAL).addErrback(self._cleanupPoll)
 
     def _cleanupPoll(self, err):
@@ -91,11 +191,55 @@ class LogFileWatcher:
 
     def stop(self):
         self.poll()
-        if self.poller is not None:
+        self._stopNotifier()
+        if self.poller is not None and self.poller.running:
             self.poller.stop()
         if self.started:
             self.f.close()
 
+    def _watchedDirectory(self):
+        return os.path.dirname(os.path.abspath(self.logfile))
+
+    def _matches(self, path):
+        return path == os.path.abspath(self.logfile)
+
+    def _startNotifier(self):
+        if inotify is None:
+            return False
+        dirname = self._watchedDirectory()
+        if dirname is None or not os.path.isdir(dirname):
+            return False
+        notifier = self.logFileNotifier or LogFileNotifier()
+        try:
+            notifier.watch(dirname, self._notified)
+        except Exception:
+            log.msg("LogFileWatcher: inotify unavailable for %s; polling" %
+                    (dirname,))
+            return False
+        self.notifier = notifier
+        self.notifyDirectory = dirname
+        return True
+
+    def _stopNotifier(self):
+        if self.notifyTimer is not None:
+            if self.notifyTimer.active():
+                self.notifyTimer.cancel()
+            self.notifyTimer = None
+        if self.notifier is not None:
+            self.notifier.unwatch(self.notifyDirectory, self._notified)
+            self.notifier = None
+
+    def _notified(self, ignored, path, mask):
+        if not self._matches(path.path):
+            return
+        if self.notifyTimer is None:
+            self.notifyTimer = self._reactor.callLater(self.NOTIFY_DELAY,
+                                                       self._notifyPoll)
+
+    def _notifyPoll(self):
+        self.notifyTimer = None
+        self.poll()
+
     def statFile(self):
         if os.path.exists(self.logfile):
             s = os.stat(self.logfile)
@@ -121,11 +265,89 @@ class LogFileWatcher:
                 self.f.seek(s[2], 0)
             self.started = True
         self.f.seek(self.f.tell(), 0)
+        total = 0
         while True:
-            data = self.f.read(10000)
+            data = self.f.read(self.readSize)
             if not data:
-                return
+                break
+            total += len(data)
             self.command.addLogfile(self.name, data)
+            if len(data) == self.readSize:
+                # the file is growing quickly; read bigger blocks
+                self.readSize = min(self.readSize * 2, self.MAX_READ_SIZE)
+        if total < self.MIN_READ_SIZE:
+            self.readSize = self.MIN_READ_SIZE
+
+
+class LogGlobWatcher(LogFileWatcher):
+    """
+    Watch every file matching a glob pattern, sending the contents of all of
+    them to a single log.  Files that appear while the command runs are
+    picked up and read from the beginning.  When the output switches from
+    one file to another, a C{==> filename <==} line is sent first.
+
+    A relative C{pattern} is taken relative to C{workdir}, if given; any glob
+    metacharacters in C{workdir} itself are taken literally.
+    """
+
+    def __init__(self, command, name, pattern, follow=False, notifier=None,
+                 workdir=None):
+        self.relativePattern = pattern
+        self.workdir = workdir
+        if workdir is not None:
+            pattern = os.path.join(_escapeGlob(workdir), pattern)
+        self.pattern = pattern
+        self.files = {}
+        self.currentFile = None
+        self.lastFile = None
+        LogFileWatcher.__init__(self, command, name, pattern, follow=follow,
+                                notifier=notifier)
+        # files that already exist are treated like a single logfile that
+        # already exists: only changes are sent
+        for filename in glob.glob(self.pattern):
+            self.files[filename] = LogFileWatcher(self, name, filename,
+                                                  follow=follow)
+
+    def statFile(self):
+        return None
+
+    def _watchedDirectory(self):
+        dirname = os.path.dirname(self.relativePattern)
+        if glob.has_magic(dirname):
+            return None
+        return os.path.abspath(os.path.join(self.workdir or '', dirname))
+
+    def _matches(self, path):
+        return fnmatch.fnmatch(path, os.path.abspath(self.pattern))
+
+    def poll(self):
+        for filename in glob.glob(self.pattern):
+            if filename not in self.files:
+                w = LogFileWatcher(self, self.name, filename,
+                                   follow=self.follow)
+                # a new file: everything in it is new
+                w.old_logfile_stats = None
+                self.files[filename] = w
+        for filename in sorted(self.files):
+            self.currentFile = filename
+            self.files[filename].poll()
+        self.currentFile = None
+
+    def addLogfile(self, name, data):
+        # called by the per-file watchers, from poll()
+        if self.currentFile != self.lastFile:
+            self.lastFile = self.currentFile
+            data = "==> %s <==\n%s" % (self.currentFile, data)
+        self.command.addLogfile(name, data)
+
+    def stop(self):
+        self.poll()
+        self._stopNotifier()
+        if self.poller is not None and self.poller.running:
+            self.poller.stop()
+        for w in self.files.values():
+            if w.started:
+                w.f.close()
 
 
 if runtime.platformType == 'posix':
@@ -214,10 +436,16 @@ class RunProcess:
     interruptSignal = "KILL"
     CHUNK_LIMIT = 128*1024
 
-    # Don't send any data until at least BUFFER_SIZE bytes have been collected
-    # or BUFFER_TIMEOUT elapsed
+    # Don't send any data until enough has been collected for the current
+    # output rate, or the buffer delay has elapsed.  The delay is
+    # BUFFER_LATENCY, or two round trips to the master if that is longer, but
+    # never more than BUFFER_TIMEOUT.  The size threshold is the amount of
+    # output expected during that delay, between BUFFER_MIN_SIZE and
+    # BUFFER_SIZE.
     BUFFER_SIZE = 64*1024
+    BUFFER_MIN_SIZE = 4*1024
     BUFFER_TIMEOUT = 5
+    BUFFER_LATENCY = 0.5
 
     # For sending elapsed time:
     startTime = None
@@ -330,6 +558,15 @@ class RunProcess:
         self.buflen = 0
         self.buftimer = None
 
+        # estimated output rate, in bytes per second
+        self.outputRate = None
+        self._rateWindowStart = None
+        self._rateWindowBytes = 0
+
+        # if true, interleaved output is sent as a single 'segments' update
+        # instead of one update per change of log
+        self.segmentedUpdates = builder.segmentedUpdates
+
         if usePTY == "slave-config":
             self.usePTY = self.builder.usePTY
         else:
@@ -353,6 +590,7 @@ class RunProcess:
         self.useProcGroup = useProcGroup
 
         self.logFileWatchers = []
+        self.logFileNotifier = LogFileNotifier()
         for name,filevalue in self.logfiles.items():
             filename = filevalue
             follow = False
@@ -363,9 +601,17 @@ class RunProcess:
                 filename = filevalue['filename']
                 follow = filevalue.get('follow', False)
 
-            w = LogFileWatcher(self, name,
-                               os.path.join(self.workdir, filename),
-                               follow=follow)
+            # only the user's filename may be a pattern; the workdir is
+            # taken literally
+            if glob.has_magic(filename):
+                w = LogGlobWatcher(self, name, filename, follow=follow,
+                                   notifier=self.logFileNotifier,
+                                   workdir=self.workdir)
+            else:
+                w = LogFileWatcher(self, name,
+                                   os.path.join(self.workdir, filename),
+                                   follow=follow,
+                                   notifier=self.logFileNotifier)
             self.logFileWatchers.append(w)
 
     def __repr__(self):
@@ -606,10 +852,83 @@ class RunProcess:
         self.buftimer = None
         self._sendBuffers()
 
+    def _measureOutputRate(self, n):
+        now = util.now(self._reactor)
+        if self._rateWindowStart is None:
+            self._rateWindowStart = now
+        self._rateWindowBytes += n
+        elapsed = now - self._rateWindowStart
+        if elapsed >= self.BUFFER_LATENCY:
+            rate = self._rateWindowBytes / elapsed
+            if self.outputRate is None:
+                self.outputRate = rate
+            else:
+                self.outputRate = (self.outputRate + rate) / 2.0
+            self._rateWindowStart = now
+            self._rateWindowBytes = 0
+
+    def _bufferDelay(self):
+        """
+        Return the time to wait for more output before sending the buffers
+        """
+        delay = self.BUFFER_LATENCY
+        rtt = self.builder.updateRTT
+        if rtt:
+            delay = max(delay, 2 * rtt)
+        return min(delay, self.BUFFER_TIMEOUT)
+
+    def _bufferSize(self):
+        """
+        Return the amount of buffered output that triggers a send
+        """
+        if self.outputRate is None:
+            return self.BUFFER_SIZE
+        size = int(self.outputRate * self._bufferDelay())
+        return max(self.BUFFER_MIN_SIZE, min(size, self.BUFFER_SIZE))
+
     def _sendBuffers(self):
         """
         Send all the content in our buffers.
         """
+        if self.segmentedUpdates:
+            self._sendSegments()
+        else:
+            self._sendPerLog()
+        self.buflen = 0
+        if self.buftimer:
+            if self.buftimer.active():
+                self.buftimer.cancel()
+            self.buftimer = None
+
+    def _sendSegments(self):
+        """
+        Send the buffers as 'segments' updates, each an ordered list of
+        (logname, data) pairs, so that interleaved output from different logs
+        does not require a message per change of log.
+        """
+        segments = []
+        msg_size = 0
+        while self.buffered:
+            logname, data = self.buffered.popleft()
+            for chunk in self._chunkForSend(data):
+                if len(chunk) == 0: continue
+                if segments and segments[-1][0] == logname:
+                    segments[-1][1].append(chunk)
+                else:
+                    segments.append((logname, [chunk]))
+                msg_size += len(chunk)
+                if msg_size >= self.CHUNK_LIMIT:
+                    self._sendSegmentMessage(segments)
+                    segments = []
+                    msg_size = 0
+        if segments:
+            self._sendSegmentMessage(segments)
+
+    def _sendSegmentMessage(self, segments):
+        self.sendStatus({'segments' : [ (logname, "".join(chunks))
+                                        for logname, chunks in segments ]})
+
+    def _sendPerLog(self):
         msg = {}
         msg_size = 0
         lastlog = None
@@ -650,29 +969,26 @@ class RunProcess:
                     msg = {}
                     logdata = msg.setdefault(logname, [])
                     msg_size = 0
-        self.buflen = 0
         if logdata:
             self._sendMessage(msg)
-        if self.buftimer:
-            if self.buftimer.active():
-                self.buftimer.cancel()
-            self.buftimer = None
 
     def _addToBuffers(self, logname, data):
         """
         Add data to the buffer for logname
-        Start a timer to send the buffers if BUFFER_TIMEOUT elapses.
-        If adding data causes the buffer size to grow beyond BUFFER_SIZE, then
-        the buffers will be sent.
+        Start a timer to send the buffers if the buffer delay elapses.
+        If adding data causes the buffer size to grow beyond the current
+        buffer size threshold, then the buffers will be sent.
         """
         n = len(data)
 
+        self._measureOutputRate(n)
         self.buflen += n
         self.buffered.append((logname, data))
-        if self.buflen > self.BUFFER_SIZE:
+        if self.buflen > self._bufferSize():
             self._sendBuffers()
         elif not self.buftimer:
-            self.buftimer = self._reactor.callLater(self.BUFFER_TIMEOUT, self._bufferTimeout)
+            self.buftimer = self._reactor.callLater(self._bufferDelay(),
+                                                    self._bufferTimeout)
 
     def addStdout(self, data):
         if self.sendStdout:
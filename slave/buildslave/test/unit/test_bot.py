@@ -336,6 +336,123 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_sendUpdate_window(self):
+        sb = self.bot.builders['sb']
+        sb.updateWindow = 2
+        pending = []
+        class SlowStep:
+            def callRemote(self, meth, *args):
+                d = defer.Deferred()
+                pending.append((meth, args, d))
+                return d
+            def notifyOnDisconnect(self, what): pass
+            def dontNotifyOnDisconnect(self, what): pass
+        sb.remoteStep = SlowStep()
+        for data in [ {'stdout' : 'a'}, {'stdout' : 'b'}, {'stdout' : 'c'},
+                      {'stdout' : 'd'}, {'rc' : 0} ]:
+            sb.sendUpdate(data)
+        # only two messages are in flight; the rest was coalesced locally
+        self.assertEqual([ p[1] for p in pending ], [
+            ([[{'stdout' : 'a'}, 0]],),
+            ([[{'stdout' : 'b'}, 0]],),
+        ])
+        pending.pop(0)[2].callback(0)
+        self.assertEqual(pending[-1][1],
+                ([[{'stdout' : 'cd'}, 0], [{'rc' : 0}, 0]],))
+
+        # completion waits for the queue to drain
+        sb.updateQueue.append({'stdout' : 'e'})
+        sb.commandComplete(None)
+        self.assertEqual(pending[-1][0], 'update')
+        pending.pop(0)[2].callback(0)
+        self.assertEqual(pending[-2][1], ([[{'stdout' : 'e'}, 0]],))
+        self.assertEqual(pending[-1][:2], ('complete', (None,)))
+
+    def test_setUpdateWindow(self):
+        d = self.sb.callRemote("setUpdateWindow", 3)
+        def check(_):
+            self.assertEqual(self.bot.builders['sb'].updateWindow, 3)
+        d.addCallback(check)
+        d.addCallback(lambda _ : self.sb.callRemote("setUpdateWindow", 0))
+        def check_unlimited(_):
+            self.assertEqual(self.bot.builders['sb'].updateWindow, None)
+        d.addCallback(check_unlimited)
+        return d
+
+class TestUpdateQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath("basedir")
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def test_coalesce(self):
+        q = bot.UpdateQueue()
+        for data in [ {'stdout' : 'a'}, {'stdout' : 'b'}, {'stderr' : 'c'},
+                      {'log' : ('l', 'd')}, {'log' : ('l', 'e')},
+                      {'log' : ('m', 'f')}, {'rc' : 0}, {'rc' : 1} ]:
+            q.append(data)
+        self.assertEqual(q.popBatch(100, 1000), [
+            {'stdout' : 'ab'}, {'stderr' : 'c'}, {'log' : ('l', 'de')},
+            {'log' : ('m', 'f')}, {'rc' : 0}, {'rc' : 1} ])
+        self.assertFalse(q)
+
+    def test_coalesce_segments(self):
+        q = bot.UpdateQueue()
+        q.append({'segments' : [('stdout', 'a'), ('stderr', 'b')]})
+        q.append({'segments' : [('stdout', 'c')]})
+        self.assertEqual(q.popBatch(100, 1000), [
+            {'segments' : [('stdout', 'a'), ('stderr', 'b'), ('stdout', 'c')]}])
+
+    def test_coalesce_maxChunkSize(self):
+        q = bot.UpdateQueue()
+        q.maxChunkSize = 3
+        for c in 'abcde':
+            q.append({'stdout' : c})
+        self.assertEqual(q.popBatch(100, 1000),
+                [ {'stdout' : 'abc'}, {'stdout' : 'de'} ])
+
+    def test_popBatch_limits(self):
+        q = bot.UpdateQueue()
+        for i in range(5):
+            q.append({'rc' : i})
+        self.assertEqual(len(q.popBatch(2, 1000)), 2)
+        q.append({'stdout' : 'x' * 10})
+        q.append({'stderr' : 'y' * 10})
+        # the three remaining rc updates carry no output, so they do not
+        # count against the byte limit
+        self.assertEqual(len(q.popBatch(100, 5)), 4)
+        self.assertEqual(len(q), 1)
+
+    def test_spool(self):
+        q = bot.UpdateQueue(spooldir=self.basedir, maxMemory=5)
+        q.append({'stdout' : 'x' * 10})
+        q.append({'stderr' : 'y'})
+        q.append({'stderr' : 'z'})
+        self.assertNotEqual(q.spool, None)
+        self.assertEqual(len(q), 3)
+        self.assertEqual(q.popBatch(100, 1000), [ {'stdout' : 'x' * 10},
+                    {'stderr' : 'y'}, {'stderr' : 'z'} ])
+        self.assertEqual(q.spool, None)
+        self.assertEqual(q.memorySize, 0)
+
+    def test_waitUntilDrained(self):
+        q = bot.UpdateQueue()
+        q.append({'rc' : 0})
+        d = q.waitUntilDrained()
+        fired = []
+        d.addCallback(fired.append)
+        q.checkDrained()
+        self.assertEqual(fired, [])
+        q.popBatch(1, 1)
+        q.checkDrained()
+        self.assertEqual(fired, [None])
+
 class TestBotFactory(unittest.TestCase):
 
     def setUp(self):
@@ -17,10 +17,11 @@ import os
 import mock
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from buildslave.test.fake.runprocess import Expect
 from buildslave.test.util.sourcecommand import SourceCommandTestMixin
+from buildslave.test.util.command import CommandTestMixin
 from buildslave.commands import git
 
 class TestGit(SourceCommandTestMixin, unittest.TestCase):
@@ -646,6 +647,77 @@ class TestGit(SourceCommandTestMixin, unittest.TestCase):
         d.addCallback(self.check_sourcedata, "git://github.com/djmitche/buildbot.git master\n")
         return d
 
+    def test_run_mode_update_existing_mirror(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.clean_environ()
+        self.make_command(git.Git, dict(
+            workdir='workdir',
+            mode='update',
+            revision=None,
+            repourl='git://github.com/djmitche/buildbot.git',
+            mirror='mirrors',
+          ),
+            initial_sourcedata = "git://github.com/djmitche/buildbot.git master\n",
+        )
+        self.patch_sourcedirIsUpdateable(True)
+        mirror = os.path.join(self.basedir, 'mirrors',
+                git.sha1('git://github.com/djmitche/buildbot.git').hexdigest()
+                + '.git')
+        os.makedirs(mirror)
+        os.makedirs(os.path.join(self.basedir_workdir, '.git', 'objects'))
+
+        expects = [
+            Expect([ 'path/to/git', 'count-objects', '-v' ],
+                mirror,
+                sendRC=False, timeout=120, usePTY=False,
+                sendStdout=False, keepStdout=True)
+                + { 'stdout' : 'count: 0\nsize: 0\nsize-pack: 10\n' }
+                + 0,
+            Expect([ 'path/to/git', 'fetch', 'origin' ],
+                mirror,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'count-objects', '-v' ],
+                mirror,
+                sendRC=False, timeout=120, usePTY=False,
+                sendStdout=False, keepStdout=True)
+                + { 'stdout' : 'count: 0\nsize: 0\nsize-pack: 10\n' }
+                + 0,
+            Expect([ 'path/to/git', 'fetch', '-t', mirror, '+master' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStderr=True)
+                + { 'stderr' : '' }
+                + 0,
+            Expect(['path/to/git', 'reset', '--hard', 'FETCH_HEAD'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect(['path/to/git', 'branch', '-M', 'master'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'rev-parse', 'HEAD' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStdout=True)
+                + { 'stdout' : '4026d33b0532b11f36b0875f63699adfa8ee8662\n' }
+                + 0,
+        ]
+        self.patch_runprocess(*expects)
+
+        d = self.run_command()
+        d.addCallback(self.check_sourcedata, "git://github.com/djmitche/buildbot.git master\n")
+        def check(_):
+            alternates = os.path.join(self.basedir_workdir, '.git', 'objects',
+                                      'info', 'alternates')
+            self.assertEqual(open(alternates).read(),
+                             os.path.join(mirror, 'objects') + '\n')
+            stats = [ u['mirror'] for u in self.get_updates()
+                      if 'mirror' in u ]
+            self.assertEqual([ (st['path'], st['hit']) for st in stats ],
+                             [ (mirror, True) ])
+        d.addCallback(check)
+        return d
+
     def test_sourcedataMatches_no_file(self):
         self.make_command(git.Git, dict(
             workdir='workdir',
@@ -699,3 +771,167 @@ class TestGit(SourceCommandTestMixin, unittest.TestCase):
     # TODO: gerrit_branch
     # TODO: consolidate Expect objects
     # TODO: ignore_ignores (w/ submodules)
+
+
+class TestGitMirror(CommandTestMixin, unittest.TestCase):
+
+    repourl = 'git://github.com/djmitche/buildbot.git'
+
+    def setUp(self):
+        self.setUpCommand()
+        self.patch(git, 'mirrorLocks', {})
+        self.mirrordir = os.path.join(self.basedir, 'mirrors')
+        self.mirror = os.path.join(self.mirrordir,
+                git.sha1(self.repourl).hexdigest() + '.git')
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+    def make_mirror_command(self, **kwargs):
+        args = dict(repourl=self.repourl, mirrordir='mirrors')
+        args.update(kwargs)
+        self.make_command(git.GitMirror, args, True)
+        self.cmd._reactor = task.Clock()
+
+    def assertMirrorUpdates(self, hit, rc=0, fetch_bytes=0):
+        updates = [ u for u in self.get_updates()
+                    if 'mirror' in u or 'rc' in u ]
+        self.assertEqual(updates, [
+            { 'mirror' : dict(path=self.mirror, hit=hit, fetch_time=0,
+                              fetch_bytes=fetch_bytes) },
+            { 'rc' : rc } ])
+
+    def expectCountObjects(self, stdout):
+        return (Expect([ 'path/to/git', 'count-objects', '-v' ],
+                    self.mirror,
+                    sendRC=False, timeout=1200, usePTY=False,
+                    sendStdout=False, keepStdout=True)
+                + { 'stdout' : stdout }
+                + 0)
+
+    def test_clone(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command()
+        self.patch_runprocess(
+            Expect([ 'path/to/git', 'clone', '--mirror', self.repourl,
+                     self.mirror ],
+                self.mirrordir,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'config', 'gc.pruneExpire', 'never' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+            self.expectCountObjects('count: 2\nsize: 1\nsize-pack: 3\n'),
+        )
+        d = self.run_command()
+        d.addCallback(lambda _ : self.assertMirrorUpdates(hit=False,
+                                                          fetch_bytes=4096))
+        return d
+
+    def test_clone_fails(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command()
+        self.patch_runprocess(
+            Expect([ 'path/to/git', 'clone', '--mirror', self.repourl,
+                     self.mirror ],
+                self.mirrordir,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 128,
+        )
+        d = self.run_command()
+        d.addCallback(lambda _ : self.assertMirrorUpdates(hit=False, rc=128))
+        return d
+
+    def test_fetch(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command(revision='abcdef01', progress=True)
+        os.makedirs(os.path.join(self.mirror, 'objects'))
+        self.patch_runprocess(
+            Expect([ 'path/to/git', 'cat-file', '-e', 'abcdef01^{commit}' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 1,
+            self.expectCountObjects('count: 0\nsize: 0\nsize-pack: 10\n'),
+            Expect([ 'path/to/git', 'fetch', 'origin', '--progress' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+            self.expectCountObjects('count: 2\nsize: 1\nsize-pack: 12\n'),
+        )
+        d = self.run_command()
+        d.addCallback(lambda _ : self.assertMirrorUpdates(hit=True,
+                                                          fetch_bytes=3072))
+        return d
+
+    def test_fetch_gc(self):
+        # a gc during the fetch may leave the mirror smaller than before
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command()
+        os.makedirs(os.path.join(self.mirror, 'objects'))
+        self.patch_runprocess(
+            self.expectCountObjects('count: 100\nsize: 400\nsize-pack: 10\n'),
+            Expect([ 'path/to/git', 'fetch', 'origin' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+            self.expectCountObjects('count: 0\nsize: 0\nsize-pack: 300\n'),
+        )
+        d = self.run_command()
+        d.addCallback(lambda _ : self.assertMirrorUpdates(hit=True))
+        return d
+
+    def test_revision_present(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command(revision='abcdef01')
+        os.makedirs(self.mirror)
+        self.patch_runprocess(
+            Expect([ 'path/to/git', 'cat-file', '-e', 'abcdef01^{commit}' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+        )
+        d = self.run_command()
+        d.addCallback(lambda _ : self.assertMirrorUpdates(hit=True))
+        return d
+
+    def test_alternates(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command(workdir='workdir')
+        os.makedirs(self.mirror)
+        info = os.path.join(self.basedir_workdir, '.git', 'objects', 'info')
+        os.makedirs(info)
+        open(os.path.join(info, 'alternates'), 'w').write('/other/objects\n')
+        self.patch_runprocess(
+            self.expectCountObjects('size: 0\nsize-pack: 0\n'),
+            Expect([ 'path/to/git', 'fetch', 'origin' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+            self.expectCountObjects('size: 0\nsize-pack: 0\n'),
+        )
+        d = self.run_command()
+        def check(_):
+            self.assertEqual(open(os.path.join(info, 'alternates')).read(),
+                    '/other/objects\n%s\n' % os.path.join(self.mirror, 'objects'))
+        d.addCallback(check)
+        return d
+
+    def test_locked(self):
+        # an update of a mirror that is already being updated waits its turn
+        self.patch_getCommand('git', 'path/to/git')
+        self.make_mirror_command(revision='abcdef01')
+        os.makedirs(self.mirror)
+        self.patch_runprocess(
+            Expect([ 'path/to/git', 'cat-file', '-e', 'abcdef01^{commit}' ],
+                self.mirror,
+                sendRC=False, timeout=1200, usePTY=False)
+                + 0,
+        )
+        lock = git.mirrorLocks.setdefault(self.mirror, defer.DeferredLock())
+        lock.acquire()
+        d = self.run_command()
+        self.assertFalse(d.called)
+        lock.release()
+        d.addCallback(lambda _ : self.assertMirrorUpdates(hit=True))
+        return d
@@ -44,6 +44,7 @@ class FakeMasterMethods(object):
         self.count_reads = False
 
         self.unpack_fail = False
+        self.stored = set()
 
         self.written = False
         self.read = False
@@ -92,6 +93,27 @@ class FakeMasterMethods(object):
         if self.unpack_fail:
             return defer.fail(failure.Failure(RuntimeError("out of space")))
 
+    def remote_haveContent(self, digest, size):
+        self.add_update('haveContent %d' % size)
+        return digest in self.stored
+
+    def remote_missingContent(self, manifest):
+        self.add_update('missingContent %s' %
+                ' '.join([ name for name, digest, size in manifest ]))
+        return [ digest for name, digest, size in manifest
+                 if digest not in self.stored ]
+
+    def remote_push(self, consumer):
+        self.add_update('push')
+        while self.data:
+            block, self.data = self.data[:32], self.data[32:]
+            if not consumer.remote_write(block):
+                self.add_update('stopped')
+                break
+
+    def remote_upToDate(self):
+        self.add_update('upToDate')
+
     def remote_utime(self,accessed_modified):
         self.add_update('utime - %s' % accessed_modified[0])
         
@@ -247,6 +269,57 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         dl.addCallback(check)
         return dl
 
+    def test_content_hash_stored(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+        self.fakemaster.stored.add(
+                transfer.sha1("this is some data\n" * 10).hexdigest())
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=64,
+            keepstamp=False,
+            content_hash=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datafile},
+                    'haveContent 180', 'close',
+                    {'rc': 0}
+                ])
+        d.addCallback(check)
+        return d
+
+    def test_content_hash_missing(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=64,
+            keepstamp=False,
+            content_hash=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datafile},
+                    'haveContent 180',
+                    'write 64', 'write 64', 'write 52', 'close',
+                    {'rc': 0}
+                ])
+        d.addCallback(check)
+        return d
+
     def test_timestamp(self):
         self.fakemaster.count_writes = True    # get actual byte counts
         timestamp = ( os.path.getatime(self.datafile),
@@ -365,9 +438,190 @@ class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
 
         return d
 
+    def test_blocks(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=4096,
+            compress=None
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            # an uncompressed archive of this directory is one 10240-byte
+            # record, sent in full blocks
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datadir},
+                    'write 4096', 'write 4096', 'write 2048', 'unpack',
+                    {'rc': 0}
+                ])
+        d.addCallback(check)
+        return d
+
+    def test_small_threadpool(self):
+        # the producer fills the stream's queue and waits for it to be read,
+        # which takes a thread from the reactor's pool; with only one thread
+        # in the pool, the producer must not be holding it
+        pool = reactor.getThreadPool()
+        self.addCleanup(pool.adjustPoolsize, pool.min, pool.max)
+        pool.adjustPoolsize(1, 1)
+        open(os.path.join(self.datadir, "cc"), "wb").write("c" * 100000)
+        self.fakemaster.keep_data = True
+
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=512,
+            compress=None
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            a = tarfile.open(fileobj=StringIO.StringIO(self.fakemaster.data))
+            self.assertEqual(a.extractfile('cc').read(), "c" * 100000)
+            a.close()
+        d.addCallback(check)
+        return d
+
+    def test_truncated(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=512,
+            compress=None
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datadir},
+                    'write 512', 'write 488', 'unpack',
+                    {'rc': 1,
+                     'stderr': "Maximum filesize reached, truncating file '%s'"
+                                % self.datadir}
+                ])
+            # the producer thread has been told to stop
+            self.assertTrue(self.cmd.fp.cancelled)
+        d.addCallback(check)
+        return d
+
+    def test_missing(self):
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data-nosuch',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=512,
+            compress=None
+        ))
+
+        d = self.run_command()
+        self.assertFailure(d, OSError)
+
+        def check(_):
+            self.assertUpdates([
+                    {'header': 'sending %s' % (self.datadir + '-nosuch')},
+                    {'rc': 1}
+                ])
+        d.addCallback(check)
+        return d
+
+    def test_content_hash(self):
+        self.fakemaster.keep_data = True
+        self.fakemaster.stored.add(
+                transfer.sha1("lots of a" * 100).hexdigest())
+        os.makedirs(os.path.join(self.datadir, "sub"))
+        open(os.path.join(self.datadir, "sub", "cc"), "wb").write("c")
+
+        self.make_command(transfer.SlaveDirectoryUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=512,
+            compress=None,
+            content_hash=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datadir},
+                    'missingContent aa bb sub/cc',
+                    'write(s)', 'unpack',
+                    {'rc': 0}
+                ])
+            f = StringIO.StringIO(self.fakemaster.data)
+            a = tarfile.open(fileobj=f, name='check.tar')
+            got_names = sorted([ n.rstrip('/') or '.' for n in a.getnames() ])
+            # aa is already stored, so it is left out
+            self.assertEqual(got_names, [ '.', 'bb', 'sub', 'sub/cc' ])
+            a.close()
+        d.addCallback(check)
+        return d
+
     # this is just a subclass of SlaveUpload, so the remaining permutations
     # are already tested
 
+class TestTarStream(unittest.TestCase):
+
+    def test_blocks(self):
+        stream = transfer.TarStream(4)
+        stream.write('ab')
+        stream.write('cdefghij')
+        stream.close()
+        self.assertEqual(stream.read(4), 'abcd')
+        self.assertEqual(stream.read(3), 'efg')
+        self.assertEqual(stream.read(4), 'hij')
+        self.assertEqual(stream.read(4), '')
+
+    def test_fail(self):
+        stream = transfer.TarStream(4)
+        stream.write('abcd')
+        try:
+            raise RuntimeError("no such file")
+        except RuntimeError:
+            stream.fail(failure.Failure())
+        self.assertEqual(stream.read(4), 'abcd')
+        self.assertRaises(RuntimeError, lambda : stream.read(4))
+
+    def test_cancel(self):
+        stream = transfer.TarStream(1)
+        stream.cancel()
+        self.assertRaises(transfer._StreamCancelled,
+                          lambda : stream.write('x'))
+
+    def test_cancel_reader(self):
+        stream = transfer.TarStream(1)
+        stream.cancel()
+        self.assertRaises(transfer._StreamCancelled,
+                          lambda : stream.read(1))
+
+    def test_producer_waits(self):
+        stream = transfer.TarStream(1)
+        stream.maxBlocks = 2
+        stream.queue = transfer.Queue.Queue(stream.maxBlocks)
+        stream.write('ab')
+        # the queue is now full, so the producer must wait; cancelling the
+        # stream releases it
+        stream.cancel()
+        self.assertRaises(transfer._StreamCancelled,
+                          lambda : stream.write('c'))
+
 class TestDownloadFile(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -440,6 +694,124 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def make_source_stat(self, data, mtime=1234567890):
+        return dict(size=len(data), mtime=mtime,
+                    digest=transfer.sha1(data).hexdigest())
+
+    def test_push(self):
+        self.fakemaster.data = test_data = '1234' * 13
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=32,
+            mode=0777,
+            source_stat=self.make_source_stat(test_data),
+            push=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    'push', 'close',
+                    {'rc': 0}
+                ])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+            # the file gets the master's mtime
+            self.assertEqual(int(os.stat(datafile).st_mtime), 1234567890)
+        d.addCallback(check)
+        return d
+
+    def test_push_truncated(self):
+        self.fakemaster.data = test_data = 'tenchars--' * 10
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=50,
+            blocksize=32,
+            mode=0777,
+            push=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    'push', 'stopped', 'close',
+                    {'rc': 1,
+                     'stderr': "Maximum filesize reached, truncating file '%s'"
+                                % os.path.join(self.basedir, '.', 'data')}
+                ])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data[:50])
+        d.addCallback(check)
+        return d
+
+    def test_up_to_date(self):
+        test_data = 'already here'
+        datafile = os.path.join(self.basedir, 'data')
+        open(datafile, 'w').write(test_data)
+        os.chmod(datafile, 0600)
+        os.utime(datafile, (1234567890, 1234567890))
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=32,
+            mode=0750,
+            source_stat=self.make_source_stat(test_data),
+            push=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    {'header': "'%s' is already up to date\n"
+                               % os.path.join(self.basedir, '.', 'data')},
+                    'upToDate', 'close',
+                    {'rc': 0}
+                ])
+            # the mode is applied all the same
+            self.assertEqual(os.stat(datafile).st_mode & 0777, 0750)
+        d.addCallback(check)
+        return d
+
+    def test_out_of_date(self):
+        # same size and mtime, but different content
+        self.fakemaster.data = test_data = 'new content'
+        datafile = os.path.join(self.basedir, 'data')
+        open(datafile, 'w').write('old content')
+        os.utime(datafile, (1234567890, 1234567890))
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=32,
+            mode=0777,
+            source_stat=self.make_source_stat(test_data),
+            push=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertUpdates([
+                    'push', 'close',
+                    {'rc': 0}
+                ])
+            self.assertEqual(open(datafile).read(), test_data)
+        d.addCallback(check)
+        return d
+
     def test_failure(self):
         self.fakemaster.data = 'hi'
 
@@ -657,6 +657,59 @@ class TestLogging(BasedirMixin, unittest.TestCase):
             {'stdout': 'world'},
             ])
 
+    def testSendBufferedSegmented(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.segmentedUpdates = True
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'hello ')
+        s._addToBuffers('stderr', 'DIEEEEEEE')
+        s._addToBuffers('stdout', 'wor')
+        s._addToBuffers('stdout', 'ld')
+        s._addToBuffers(('log', 'foo'), 'log')
+        s._sendBuffers()
+        self.failUnlessEqual(b.updates, [
+            {'segments': [('stdout', 'hello '), ('stderr', 'DIEEEEEEE'),
+                          ('stdout', 'world'), (('log', 'foo'), 'log')]},
+            ])
+
+    def testSendSegmentedChunked(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.segmentedUpdates = True
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        data = "x" * (runprocess.RunProcess.CHUNK_LIMIT * 3 / 2)
+        s._addToBuffers('stdout', data)
+        s._sendBuffers()
+        self.failUnlessEqual(len(b.updates), 2)
+
+    def testBufferDelay(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        self.assertEqual(s._bufferDelay(), s.BUFFER_LATENCY)
+        b.updateRTT = 1.5
+        self.assertEqual(s._bufferDelay(), 3.0)
+        b.updateRTT = 10
+        self.assertEqual(s._bufferDelay(), s.BUFFER_TIMEOUT)
+
+    def testBufferSizeAdapts(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        clock = s._reactor = task.Clock()
+        self.assertEqual(s._bufferSize(), s.BUFFER_SIZE)
+
+        # a slow trickle of output shrinks the buffer to its minimum, and is
+        # sent after BUFFER_LATENCY rather than BUFFER_TIMEOUT
+        for i in range(4):
+            s._addToBuffers('stdout', 'x' * 100)
+            clock.advance(0.25)
+        self.assertEqual(s._bufferSize(), s.BUFFER_MIN_SIZE)
+        self.assertEqual(len(b.updates), 2)
+
+        # a flood of output grows it to its maximum
+        for i in range(20):
+            s._addToBuffers('stdout', 'x' * 100000)
+            clock.advance(0.1)
+        self.assertEqual(s._bufferSize(), s.BUFFER_SIZE)
+
     def testSendChunked(self):
         b = FakeSlaveBuilder(False, self.basedir)
         s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
@@ -698,3 +751,145 @@ class TestLogFileWatcher(BasedirMixin, unittest.TestCase):
         st = lf.statFile()
         self.assertEqual(st and st[2], 2, "statfile.log exists and size is correct")
         os.remove('statfile.log')
+
+    def makeCommand(self):
+        if not os.path.exists(self.basedir):
+            os.makedirs(self.basedir)
+        class Command:
+            def __init__(self):
+                self.logs = []
+            def addLogfile(self, name, data):
+                self.logs.append((name, data))
+        return Command()
+
+    def test_poll_growing_file(self):
+        cmd = self.makeCommand()
+        fn = os.path.join(self.basedir, 'grow.log')
+        lf = runprocess.LogFileWatcher(cmd, 'test', fn, False)
+        lf.MIN_READ_SIZE = lf.readSize = 4
+        lf.MAX_READ_SIZE = 16
+        open(fn, 'w').write('x' * 40)
+        lf.poll()
+        self.assertEqual(''.join([ d for n, d in cmd.logs ]), 'x' * 40)
+        self.assertEqual([ len(d) for n, d in cmd.logs ], [4, 8, 16, 12])
+        # a quiet file goes back to small reads
+        open(fn, 'a').write('y')
+        lf.poll()
+        self.assertEqual(cmd.logs[-1], ('test', 'y'))
+        self.assertEqual(lf.readSize, 4)
+        lf.stop()
+
+    def test_start_polls_without_inotify(self):
+        self.patch(runprocess, 'inotify', None)
+        cmd = self.makeCommand()
+        fn = os.path.join(self.basedir, 'nonotify.log')
+        lf = runprocess.LogFileWatcher(cmd, 'test', fn, False)
+        clock = task.Clock()
+        lf.poller.clock = clock
+        lf.start()
+        self.assertTrue(lf.poller.running)
+        open(fn, 'w').write('hello')
+        clock.advance(lf.POLL_INTERVAL)
+        self.assertEqual(cmd.logs, [('test', 'hello')])
+        lf.stop()
+
+    def test_start_missing_directory_polls(self):
+        cmd = self.makeCommand()
+        fn = os.path.join(self.basedir, 'nosuchdir', 'x.log')
+        lf = runprocess.LogFileWatcher(cmd, 'test', fn, False)
+        lf.poller.clock = task.Clock()
+        lf.start()
+        self.assertEqual(lf.notifier, None)
+        self.assertTrue(lf.poller.running)
+        lf.stop()
+
+    def test_inotify(self):
+        if runprocess.inotify is None or \
+                not runtime.platform.supportsINotify():
+            raise unittest.SkipTest("inotify is not available")
+        cmd = self.makeCommand()
+        fn = os.path.join(self.basedir, 'notify.log')
+        lf = runprocess.LogFileWatcher(cmd, 'test', fn, False)
+        lf.start()
+        self.assertNotEqual(lf.notifier, None)
+        self.assertFalse(lf.poller.running)
+        open(fn, 'w').write('hello')
+        d = defer.Deferred()
+        reactor.callLater(0.5, d.callback, None)
+        def check(_):
+            self.assertEqual(cmd.logs, [('test', 'hello')])
+        d.addCallback(check)
+        d.addBoth(lambda r : (lf.stop(), r)[1])
+        return d
+
+    def test_glob(self):
+        self.patch(runprocess, 'inotify', None)
+        cmd = self.makeCommand()
+        open(os.path.join(self.basedir, 'old.log'), 'w').write('old')
+        pattern = os.path.join(self.basedir, '*.log')
+        lf = runprocess.LogGlobWatcher(cmd, 'test', pattern, False)
+        lf.poll()
+        self.assertEqual(cmd.logs, [])
+        fn = os.path.join(self.basedir, 'new.log')
+        open(fn, 'w').write('new')
+        lf.poll()
+        self.assertEqual(cmd.logs, [('test', '==> %s <==\nnew' % fn)])
+        open(fn, 'a').write('er')
+        lf.poll()
+        self.assertEqual(cmd.logs[-1], ('test', 'er'))
+        lf.stop()
+
+    def test_runprocess_glob_logfiles(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        rp = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir,
+                logfiles={'tests' : 'test-*.xml', 'one' : 'one.log'})
+        classes = dict([ (w.name, w.__class__) for w in rp.logFileWatchers ])
+        self.assertEqual(classes, {'tests' : runprocess.LogGlobWatcher,
+                                   'one' : runprocess.LogFileWatcher})
+
+    def test_runprocess_logfiles_magic_workdir(self):
+        workdir = os.path.join(self.basedir, 'w[1]')
+        os.makedirs(workdir)
+        open(os.path.join(workdir, 'test-1.xml'), 'w').write('<x/>')
+        b = FakeSlaveBuilder(False, self.basedir)
+        rp = runprocess.RunProcess(b, stdoutCommand('hello'), workdir,
+                logfiles={'tests' : 'test-*.xml', 'one' : 'one.log'})
+        classes = dict([ (w.name, w.__class__) for w in rp.logFileWatchers ])
+        self.assertEqual(classes, {'tests' : runprocess.LogGlobWatcher,
+                                   'one' : runprocess.LogFileWatcher})
+        # the workdir's brackets are not a character class
+        w = [ w for w in rp.logFileWatchers if w.name == 'tests' ][0]
+        self.assertEqual(w._watchedDirectory(), os.path.abspath(workdir))
+        self.assertEqual(w.files.keys(),
+                         [ os.path.join(workdir, 'test-1.xml') ])
+
+    def test_shared_notifier(self):
+        if runprocess.inotify is None or \
+                not runtime.platform.supportsINotify():
+            raise unittest.SkipTest("inotify is not available")
+        cmd = self.makeCommand()
+        notifier = runprocess.LogFileNotifier()
+        fn1 = os.path.join(self.basedir, 'one.log')
+        fn2 = os.path.join(self.basedir, 'two.log')
+        lf1 = runprocess.LogFileWatcher(cmd, 'one', fn1, False,
+                                        notifier=notifier)
+        lf2 = runprocess.LogFileWatcher(cmd, 'two', fn2, False,
+                                        notifier=notifier)
+        lf1.start()
+        lf2.start()
+        self.assertIdentical(lf1.notifier, notifier)
+        self.assertIdentical(lf2.notifier, notifier)
+        inotifyInstance = notifier.inotify
+        open(fn1, 'w').write('hello')
+        open(fn2, 'w').write('world')
+        d = defer.Deferred()
+        reactor.callLater(0.5, d.callback, None)
+        def check(_):
+            self.assertEqual(sorted(cmd.logs),
+                             [('one', 'hello'), ('two', 'world')])
+            lf1.stop()
+            self.assertIdentical(notifier.inotify, inotifyInstance)
+            lf2.stop()
+            self.assertEqual(notifier.inotify, None)
+        d.addCallback(check)
+        return d